@@ -0,0 +1,840 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import random
+import time
+from urllib.parse import parse_qsl
+
+from aredis import StrictRedis, StrictRedisCluster
+from aredis.exceptions import RedisClusterException
+from django.conf import settings
+from django.db import close_old_connections
+
+from app.admission import (
+    ACQUIRE_SCRIPT,
+    ADMISSION_CALLS_KEY,
+    admission_control,
+    AdmissionRejected,
+    get_app_calls_key,
+    RELEASE_SCRIPT)
+from app.cache import DEFAULT_TIMEOUT, get_startup_nodes
+from app.call_coalescing import (
+    call_coalescer,
+    FOLLOW_POLL_INTERVAL,
+    get_call_leader_key,
+    get_follower_response,
+    get_leader_ttl,
+    LEADER_PENDING,
+    RESPONSE_TTL)
+from app.call_timeline import call_timelines, PHASE_APP_RESPONDED, PHASE_DEVICE_RESOLVED, PHASE_PUSH_ENQUEUED
+from app.calls import (
+    CALL_CHANNEL_PREFIX,
+    CALL_OUTCOMES,
+    get_call_cache_key,
+    get_call_channel,
+    get_group_call_key,
+    GET_OUTCOMES_SCRIPT,
+    get_push_receipt,
+    PUSH_RECEIVED_SCRIPT,
+    RECORD_ATTEMPT_SCRIPT,
+    RECORD_ATTEMPTS_SCRIPT,
+    SET_OUTCOME_SCRIPT,
+    START_CALL_SCRIPT,
+    START_CALLS_SCRIPT,
+    STATE_DEVICE_ID,
+    STATE_FIELDS,
+    STATE_PLATFORM,
+    STATE_SIP_USER_ID)
+from app.incoming_call import (
+    ACK,
+    CallSchedule,
+    find_call_devices,
+    find_cancel_device,
+    get_coalesced_metrics,
+    get_filtered_call_result,
+    GroupCall,
+    log_call_cancelled,
+    log_call_outcome,
+    log_call_received,
+    log_call_response,
+    log_call_shed,
+    log_call_timed_out,
+    log_device_lookup_failed,
+    log_duplicate_call,
+    log_no_device,
+    log_push_received,
+    log_wait_started,
+    NAK,
+    RESPONDED_OUTCOMES)
+from app.models import Device
+from app.outbox import enqueue_call_push, SEND_MODE_OUTBOX
+from app.push import send_call_message, send_cancel_message
+from app.response_policy import (
+    choose_call_policy,
+    combine_call_policies,
+    get_device_stats_key,
+    get_platform_stats_key,
+    get_record_calls,
+    get_static_call_policy,
+    POLICY_MODE_ADAPTIVE,
+    RECORD_RESPONSE_SCRIPT,
+    response_policy,
+    ResponseStats)
+from app.tasks import log_to_db
+from app.utils import log_middleware_information
+
+from .serializers import CallResponseSerializer, CancelCallSerializer, IncomingCallSerializer, PushReceivedSerializer
+
+INCOMING_CALL_PATH = '/api/incoming-call/'
+CALL_RESPONSE_PATH = '/api/call-response/'
+PUSH_RECEIVED_PATH = '/api/push-received/'
+CANCEL_CALL_PATH = '/api/cancel-call/'
+
+
+def find_devices(sip_user_id):
+    """
+    Function to find the devices to call for a sip_user_id, run in the DB
+    executor, see `find_call_devices`.
+    """
+    # Drop connections that are broken or exceeded CONN_MAX_AGE, the
+    # executor threads are not part of the request cycle of Django.
+    close_old_connections()
+    return find_call_devices(sip_user_id)
+
+
+def find_device_to_cancel(call_state):
+    """
+    Function to find the device to send the cancel push to, run in the DB
+    executor, see `find_cancel_device`.
+    """
+    close_old_connections()
+    return find_cancel_device(call_state)
+
+
+class BlockingStrictRedisCluster(StrictRedisCluster):
+    """
+    Cluster client that waits for a free connection when all max_connections
+    are in use, instead of failing the command right away like the pool of
+    aredis. A command holds one connection while it runs.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BlockingStrictRedisCluster, self).__init__(*args, **kwargs)
+        self.connections = asyncio.Semaphore(self.connection_pool.max_connections)
+        self.initializing = asyncio.Lock()
+
+    async def execute_command(self, *args, **kwargs):
+        # Discover the slots once instead of in every command that is started
+        # before the discovery finished.
+        if not self.connection_pool.initialized:
+            async with self.initializing:
+                if not self.connection_pool.initialized:
+                    await self.connection_pool.initialize()
+
+        try:
+            await asyncio.wait_for(self.connections.acquire(), settings.REDIS_POOL_TIMEOUT / 1000)
+        except asyncio.TimeoutError:
+            raise RedisClusterException('Too many connections, no connection released in time')
+        try:
+            return await super(BlockingStrictRedisCluster, self).execute_command(*args, **kwargs)
+        finally:
+            self.connections.release()
+
+
+class IncomingCallApplication(object):
+    """
+    ASGI application for the incoming call and call response flow.
+
+    A parked incoming call is a coroutine waiting on a future, so thousands
+    of calls can be parked in one process. One pub/sub listener per process
+    resolves the futures when the outcome of a call is published.
+    """
+    def __init__(self):
+        self.redis = None
+        self.listener = None
+        self.pending = {}
+        self.coalesced = {}
+        self.db_executor = ThreadPoolExecutor(max_workers=settings.ASGI_DB_WORKERS)
+        self.push_executor = ThreadPoolExecutor(max_workers=settings.ASGI_PUSH_WORKERS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path']
+        if scope['method'] != 'POST':
+            await self._respond(send, 405, '')
+        elif path.startswith(INCOMING_CALL_PATH):
+            data = await self._read_data(scope, receive)
+            body = await self.incoming_call(data)
+            if body is None:
+                await self._respond(send, 400, '')
+            else:
+                await self._respond(send, 200, body)
+        elif path.startswith(CALL_RESPONSE_PATH):
+            data = await self._read_data(scope, receive)
+            await self._respond(send, await self.call_response(data), '')
+        elif path.startswith(PUSH_RECEIVED_PATH):
+            data = await self._read_data(scope, receive)
+            await self._respond(send, await self.push_received(data), '')
+        elif path.startswith(CANCEL_CALL_PATH):
+            data = await self._read_data(scope, receive)
+            await self._respond(send, await self.cancel_call(data), '')
+        else:
+            await self._respond(send, 404, '')
+
+    async def _lifespan(self, receive, send):
+        """
+        Handle the lifespan messages of the ASGI server.
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._setup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.listener:
+                    self.listener.cancel()
+                self.push_executor.shutdown(wait=True)
+                self.db_executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _setup(self):
+        """
+        Create the Redis client and start the listener in the running loop.
+        """
+        if self.redis is None:
+            # The commands wait for a free connection, a node never gets more
+            # connections than commands run at once.
+            self.redis = BlockingStrictRedisCluster(
+                startup_nodes=get_startup_nodes(),
+                decode_responses=True,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                max_connections_per_node=True,
+            )
+        if self.listener is None:
+            self.listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        """
+        Resolve the futures of parked calls with the published outcomes.
+
+        Messages published in a Redis cluster are broadcast to all nodes, so
+        listening on one node is enough.
+        """
+        node = get_startup_nodes()[0]
+        while True:
+            pubsub = StrictRedis(host=node['host'], port=node['port'], decode_responses=True).pubsub(
+                ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe('{0}*'.format(CALL_CHANNEL_PREFIX))
+                while True:
+                    message = await pubsub.get_message(timeout=1)
+                    if not message or message['type'] != 'pmessage':
+                        continue
+                    future = self.pending.get(message['channel'][len(CALL_CHANNEL_PREFIX):])
+                    if future and not future.done():
+                        future.set_result(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Parked calls fall back on the safety net poll meanwhile.
+                log_middleware_information(
+                    'Call response listener failed, reconnecting',
+                    OrderedDict(),
+                    logging.ERROR,
+                )
+                await asyncio.sleep(1)
+            finally:
+                pubsub.reset()
+
+    async def _read_data(self, scope, receive):
+        """
+        Read the form or JSON encoded body of the request.
+        """
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        content_type = dict(scope['headers']).get(b'content-type', b'').decode('latin-1')
+        try:
+            if content_type.startswith('application/json'):
+                return json.loads(body.decode('utf-8'))
+            return dict(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+        except ValueError:
+            return {}
+
+    async def _respond(self, send, status, body):
+        """
+        Send a plain text response like the PlainTextRenderer.
+        """
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': body.encode('utf-8'),
+        })
+
+    def _serialize_data(self, data, serializer_class):
+        """
+        Validate the data like VialerAPIView._serialize_data.
+
+        Returns:
+            dict: The validated data or None when validation failed.
+        """
+        serializer = serializer_class(data=data)
+        if not serializer.is_valid(raise_exception=False):
+            log_middleware_information(
+                'BAD REQUEST! Serialization failed with following errors:\n\n{0}\n\nData:\n\n{1}',
+                OrderedDict([
+                    ('serializer_errors', serializer.errors),
+                    ('data', data),
+                ]),
+                logging.INFO,
+            )
+            return None
+        return serializer.validated_data
+
+    async def _push_metrics(self, metrics):
+        """
+        Push the metrics of the incoming call flow to Redis for the
+        Prometheus process.
+        """
+        for key, metric_data in metrics:
+            await self.redis.rpush(key, str(metric_data))
+
+    async def _acquire_slot(self, app_pk, wait):
+        """
+        Async version of AdmissionControl.acquire.
+        """
+        slot = admission_control.acquire_worker(app_pk, wait)
+        if not settings.ADMISSION_MAX_GLOBAL_CALLS:
+            return slot
+
+        keys, args = admission_control.get_acquire_args(slot, wait)
+        try:
+            result = await self.redis.eval(ACQUIRE_SCRIPT, len(keys), *(keys + args))
+        except Exception:
+            # Let the call through, without Redis it fails anyway.
+            admission_control.log_failure('Taking a global admission slot failed')
+            return slot
+        return admission_control.handle_acquire_result(slot, result)
+
+    async def _release_slot(self, slot):
+        """
+        Async version of AdmissionControl.release.
+        """
+        admission_control.worker_slots.release(slot.token)
+        if slot.is_global:
+            try:
+                await self.redis.eval(
+                    RELEASE_SCRIPT, 2, ADMISSION_CALLS_KEY, get_app_calls_key(slot.app_pk), slot.token)
+            except Exception:
+                # The slot expires after the wait of the call.
+                admission_control.log_failure('Releasing a global admission slot failed')
+
+    async def _get_call_policy(self, device):
+        """
+        Async version of ResponsePolicy.get_call_policy.
+        """
+        if settings.APP_PUSH_POLICY_MODE != POLICY_MODE_ADAPTIVE:
+            return get_static_call_policy()
+
+        platform = device.app.platform
+        try:
+            device_stats = ResponseStats(await self.redis.hgetall(get_device_stats_key(device.id)))
+            platform_stats = response_policy.platform_stats.get(platform)
+            if platform_stats is None:
+                platform_stats = ResponseStats(await self.redis.hgetall(get_platform_stats_key(platform)))
+                response_policy.platform_stats.set(platform, platform_stats)
+        except Exception:
+            log_middleware_information(
+                'Reading the response history of {0} failed, using the static policy',
+                OrderedDict([
+                    ('sip_user_id', device.sip_user_id),
+                ]),
+                logging.ERROR,
+            )
+            return get_static_call_policy()
+        return choose_call_policy(device_stats, platform_stats)
+
+    async def _record_response(self, platform, device_id, roundtrip=None, responded=None):
+        """
+        Async version of ResponsePolicy.record.
+        """
+        try:
+            for key, args in get_record_calls(platform, device_id, roundtrip, responded):
+                await self.redis.eval(RECORD_RESPONSE_SCRIPT, 1, key, *args)
+        except Exception:
+            log_middleware_information(
+                'Recording the response history of device {0} failed',
+                OrderedDict([
+                    ('device_id', device_id),
+                ]),
+                logging.ERROR,
+            )
+
+    def _send_push(self, device, unique_key, phonenumber, caller_id, attempt):
+        """
+        Send the call push notification without waiting for the provider,
+        or append it to the push outbox in 'outbox' mode.
+        """
+        asyncio.get_event_loop().run_in_executor(
+            self.push_executor,
+            enqueue_call_push if settings.APP_PUSH_SEND_MODE == SEND_MODE_OUTBOX else send_call_message,
+            device,
+            unique_key,
+            phonenumber,
+            caller_id,
+            attempt,
+        )
+
+    async def incoming_call(self, data):
+        """
+        Async version of IncomingCallView.post.
+
+        Args:
+            data (dict): The posted data.
+
+        Returns:
+            string: With status=ACK or status=NAK based on succes or failure,
+                None when the data is invalid.
+        """
+        received_at = time.time()
+        self._setup()
+        serialized_data = self._serialize_data(data, IncomingCallSerializer)
+        if serialized_data is None:
+            return None
+
+        call_id = serialized_data['call_id']
+        if not call_id:
+            # Generate unique_key for reference on incoming call answer.
+            return await self._handle_timed_call(serialized_data, '%032x' % random.getrandbits(128), received_at)
+
+        # Requests for a call_id that is already handled get its response.
+        future = self.coalesced.get(call_id)
+        if future is not None:
+            log_duplicate_call(call_id)
+            response = await asyncio.shield(future)
+            await self._push_metrics(get_coalesced_metrics(True))
+            return response
+
+        future = asyncio.get_event_loop().create_future()
+        self.coalesced[call_id] = future
+        response = NAK
+        try:
+            if await self._take_lead(call_id):
+                response = await self._handle_timed_call(serialized_data, call_id, received_at)
+                await self._store_response(call_id, response)
+            else:
+                log_duplicate_call(call_id)
+                response = await self._wait_for_leader(call_id)
+                await self._push_metrics(get_coalesced_metrics(False))
+        finally:
+            future.set_result(response)
+            del self.coalesced[call_id]
+        return response
+
+    async def _take_lead(self, call_id):
+        """
+        Async version of the Redis part of CallCoalescer.join.
+
+        Returns:
+            bool: True when this request leads the call.
+        """
+        try:
+            return bool(await self.redis.set(
+                get_call_leader_key(call_id), LEADER_PENDING, nx=True, ex=get_leader_ttl()))
+        except Exception:
+            # Handle the call, at worst a duplicate sends its own pushes.
+            call_coalescer.log_failure('Taking the lead of call {0} failed', call_id)
+            return True
+
+    async def _store_response(self, call_id, response):
+        """
+        Async version of the Redis part of CallCoalescer.finish.
+        """
+        try:
+            await self.redis.set(get_call_leader_key(call_id), response, ex=RESPONSE_TTL)
+        except Exception:
+            # The followers in other processes give up when the key expires.
+            call_coalescer.log_failure('Storing the response of call {0} failed', call_id)
+
+    async def _wait_for_leader(self, call_id):
+        """
+        Async version of CallCoalescer.follow for a leader in another
+        process.
+        """
+        expires_at = time.time() + get_leader_ttl()
+        while True:
+            try:
+                response = get_follower_response(await self.redis.get(get_call_leader_key(call_id)))
+            except Exception:
+                call_coalescer.log_failure('Getting the response of call {0} failed', call_id)
+                return NAK
+            if response is not None:
+                return response
+            if time.time() >= expires_at:
+                return NAK
+            await asyncio.sleep(FOLLOW_POLL_INTERVAL)
+
+    async def _handle_timed_call(self, serialized_data, unique_key, received_at):
+        """
+        Async version of IncomingCallView._handle_timed_call.
+
+        Returns:
+            string: The response of _handle_call.
+        """
+        call_timelines.start(unique_key, received_at)
+        response = NAK
+        try:
+            response = await self._handle_call(serialized_data, unique_key)
+            return response
+        finally:
+            result = 'ACK' if response.startswith(ACK) else 'NAK'
+            await self._push_metrics(call_timelines.end(unique_key, result, serialized_data['sip_user_id']))
+
+    async def _handle_call(self, serialized_data, unique_key):
+        """
+        Send the pushes of a call and wait for the app.
+
+        Returns:
+            string: With status=ACK or status=NAK based on succes or failure.
+        """
+        sip_user_id = serialized_data['sip_user_id']
+        caller_id = serialized_data['caller_id']
+        phonenumber = serialized_data['phonenumber']
+
+        try:
+            devices = await asyncio.get_event_loop().run_in_executor(self.db_executor, find_devices, sip_user_id)
+        except Device.DoesNotExist:
+            result = log_no_device(unique_key, sip_user_id)
+        except Exception:
+            result = log_device_lookup_failed(unique_key, sip_user_id)
+        else:
+            if devices is None:
+                # Answer calls for sip_user_ids without a device without a
+                # lookup.
+                result = get_filtered_call_result()
+            else:
+                device = devices[0]
+                call_timelines.mark(unique_key, PHASE_DEVICE_RESOLVED, platform=device.app.platform)
+                await self._push_metrics(log_call_received(unique_key, sip_user_id, device, phonenumber, caller_id))
+
+                if len(devices) > 1:
+                    # Call all devices of the sip_user_id, the first one
+                    # that accepts gets the call.
+                    if await self._call_devices(unique_key, devices, phonenumber, caller_id):
+                        return ACK
+                    return NAK
+
+                result = await self._call_device(unique_key, sip_user_id, device, phonenumber, caller_id)
+
+        await self._push_metrics(result.metrics)
+        return result.response
+
+    async def _call_device(self, unique_key, sip_user_id, device, phonenumber, caller_id):
+        """
+        Send the pushes to a device and wait for its app.
+
+        Returns:
+            CallResult: The answer for asterisk and the metrics.
+        """
+        # Time related settings, from the response history of the device in
+        # 'adaptive' mode.
+        schedule = CallSchedule(await self._get_call_policy(device))
+
+        # Shed the call right away when too many calls are waiting.
+        try:
+            slot = await self._acquire_slot(device.app_id, schedule.policy.wait)
+        except AdmissionRejected as ex:
+            return log_call_shed(unique_key, sip_user_id, device, ex.reason)
+
+        platform = device.app.platform
+        cache_key = get_call_cache_key(unique_key)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[unique_key] = future
+        try:
+            await self.redis.eval(
+                START_CALL_SCRIPT, 1, cache_key, platform, DEFAULT_TIMEOUT, device.sip_user_id, schedule.policy.wait,
+                device.id, time.time())
+
+            call_timelines.mark(unique_key, PHASE_PUSH_ENQUEUED)
+            self._send_push(device, unique_key, phonenumber, caller_id, schedule.attempt)
+            log_wait_started(unique_key, device, schedule)
+
+            while schedule.is_waiting():
+                try:
+                    available = await asyncio.wait_for(asyncio.shield(future), self._get_wait_timeout(schedule))
+                except asyncio.TimeoutError:
+                    # Safety net for a missed notification.
+                    available = (await self.redis.eval(GET_OUTCOMES_SCRIPT, 1, cache_key))[0]
+
+                if available in RESPONDED_OUTCOMES:
+                    call_timelines.mark(unique_key, PHASE_APP_RESPONDED)
+                    await self._record_response(platform, device.id, responded=True)
+                if available in CALL_OUTCOMES:
+                    return log_call_outcome(unique_key, sip_user_id, device, available, schedule.wait_until)
+
+                attempt = schedule.next_attempt()
+                if attempt is not None:
+                    self._send_push(device, unique_key, phonenumber, caller_id, attempt)
+                    await self.redis.eval(RECORD_ATTEMPT_SCRIPT, 1, cache_key, time.time())
+        finally:
+            self.pending.pop(unique_key, None)
+            await self._release_slot(slot)
+
+        await self._record_response(platform, device.id, responded=False)
+        return log_call_timed_out(unique_key, sip_user_id, device)
+
+    async def _call_devices(self, unique_key, devices, phonenumber, caller_id):
+        """
+        Async version of IncomingCallView._call_devices.
+
+        Returns:
+            list: The devices that accepted the call, empty when none
+                accepted in time.
+        """
+        group_call = GroupCall(unique_key, devices)
+        call_timelines.add_keys(unique_key, group_call.member_keys)
+
+        # The devices share one wait loop, timed for all their histories.
+        schedule = CallSchedule(combine_call_policies([await self._get_call_policy(device) for device in devices]))
+
+        # The call holds one slot like a call to one device.
+        try:
+            slot = await self._acquire_slot(devices[0].app_id, schedule.policy.wait)
+        except AdmissionRejected as ex:
+            await self._push_metrics(group_call.log_shed(ex.reason))
+            return []
+
+        loop = asyncio.get_event_loop()
+        futures = OrderedDict((key, loop.create_future()) for key in group_call.members)
+        self.pending.update(futures)
+        try:
+            args = [DEFAULT_TIMEOUT, schedule.policy.wait]
+            for device in group_call.members.values():
+                args.extend([device.app.platform, device.sip_user_id, device.id])
+            args.append(time.time())
+            cache_keys = [get_call_cache_key(key) for key in group_call.members]
+            await self.redis.eval(START_CALLS_SCRIPT, len(cache_keys), *(cache_keys + args))
+
+            call_timelines.mark(unique_key, PHASE_PUSH_ENQUEUED)
+            for member_key in group_call.member_keys:
+                self._send_push(group_call.members[member_key], member_key, phonenumber, caller_id, schedule.attempt)
+            group_call.log_wait_started(schedule)
+
+            while schedule.is_waiting():
+                if group_call.update(await self._wait_for_outcomes(futures, schedule)):
+                    call_timelines.mark(unique_key, PHASE_APP_RESPONDED)
+                if group_call.is_done():
+                    break
+
+                # Resend the pushes to the devices that did not respond.
+                attempt = schedule.next_attempt()
+                if attempt is not None:
+                    pending_keys = group_call.get_pending_keys()
+                    pending_cache_keys = [get_call_cache_key(key) for key in pending_keys]
+                    await self.redis.eval(
+                        RECORD_ATTEMPTS_SCRIPT, len(pending_cache_keys), *(pending_cache_keys + [time.time()]))
+                    for member_key in pending_keys:
+                        self._send_push(group_call.members[member_key], member_key, phonenumber, caller_id, attempt)
+        finally:
+            for key in futures:
+                self.pending.pop(key, None)
+            await self._release_slot(slot)
+
+        for device, responded in group_call.get_responses(not schedule.is_waiting()):
+            await self._record_response(device.app.platform, device.id, responded=responded)
+
+        # Later cancels of the call find it ended.
+        outcome = group_call.get_outcome()
+        if outcome is not None:
+            await self._set_outcome(group_call.group_key, outcome)
+
+        # Let the other devices stop setting up the call.
+        for member_key in group_call.get_pending_keys():
+            result, handed_off = await self._set_outcome(member_key, 'Cancelled')
+            if result is not None and result[-1] == 1:
+                loop.run_in_executor(
+                    self.push_executor, send_cancel_message, group_call.members[member_key], member_key)
+
+        await self._push_metrics(group_call.log_result(schedule.wait_until))
+        return group_call.get_available()
+
+    async def _wait_for_outcomes(self, futures, schedule):
+        """
+        Async version of GroupCallWaiter.wait.
+
+        Args:
+            futures (OrderedDict): The futures of the calls by unique_key.
+            schedule (CallSchedule): The schedule of the call.
+
+        Returns:
+            dict: The outcome by unique_key of the calls that have one.
+        """
+        waiting = [future for future in futures.values() if not future.done()]
+        done, pending = await asyncio.wait(waiting, timeout=self._get_wait_timeout(schedule))
+        if done:
+            return {key: future.result() for key, future in futures.items() if future.done()}
+
+        # Safety net for a missed notification.
+        cache_keys = [get_call_cache_key(key) for key in futures]
+        values = await self.redis.eval(GET_OUTCOMES_SCRIPT, len(cache_keys), *cache_keys)
+        return {key: value for key, value in zip(futures, values) if value in CALL_OUTCOMES}
+
+    def _get_wait_timeout(self, schedule):
+        """
+        Get the seconds to wait for a notification, at most the safety poll
+        interval.
+        """
+        return max(min(schedule.get_timeout(), settings.APP_PUSH_SAFETY_POLL_INTERVAL / 1000), 0)
+
+    async def call_response(self, data):
+        """
+        Async version of CallResponseView.post.
+
+        Args:
+            data (dict): The posted data.
+
+        Returns:
+            int: The HTTP status code.
+        """
+        self._setup()
+        serialized_data = self._serialize_data(data, CallResponseSerializer)
+        if serialized_data is None:
+            return 400
+
+        unique_key = serialized_data['unique_key']
+        message_start_time = serialized_data['message_start_time']
+        available = str(serialized_data['available'])
+
+        result, handed_off = await self._set_outcome(unique_key, available)
+
+        # Check if the call exists to avoid endpoint probing spam.
+        if result is None:
+            return 404
+
+        call_state = dict(zip(STATE_FIELDS, result))
+        response = log_call_response(unique_key, message_start_time, call_state, handed_off)
+        await self._push_metrics(response.metrics)
+        if response.responded:
+            await self._record_response(
+                call_state[STATE_PLATFORM], call_state[STATE_DEVICE_ID], roundtrip=response.roundtrip)
+
+        # Threaded task to log information to the database.
+        log_to_db(call_state[STATE_PLATFORM], response.roundtrip, serialized_data['available'],
+                  call_state[STATE_SIP_USER_ID])
+        return response.status
+
+    async def push_received(self, data):
+        """
+        Async version of PushReceivedView.post.
+
+        Args:
+            data (dict): The posted data.
+
+        Returns:
+            int: The HTTP status code.
+        """
+        self._setup()
+        serialized_data = self._serialize_data(data, PushReceivedSerializer)
+        if serialized_data is None:
+            return 400
+
+        unique_key = serialized_data['unique_key']
+        attempt = serialized_data['attempt']
+        result = await self.redis.eval(
+            PUSH_RECEIVED_SCRIPT, 1, get_call_cache_key(unique_key), attempt, time.time())
+
+        # Check if the call exists to avoid endpoint probing spam.
+        if result is None:
+            return 404
+
+        receipt = get_push_receipt(result, attempt)
+        await self._push_metrics(log_push_received(unique_key, attempt, receipt))
+        return 202
+
+    async def cancel_call(self, data):
+        """
+        Async version of CancelCallView.post.
+
+        Args:
+            data (dict): The posted data.
+
+        Returns:
+            int: The HTTP status code.
+        """
+        self._setup()
+        serialized_data = self._serialize_data(data, CancelCallSerializer)
+        if serialized_data is None:
+            return 400
+
+        call_id = serialized_data['call_id']
+        result, handed_off = await self._set_outcome(call_id, 'Cancelled')
+        is_group_call = result is None or result[-1] != 1
+        if is_group_call:
+            # A call to several devices, the waiting incoming call cancels
+            # the calls to the devices.
+            result, handed_off = await self._set_outcome(get_group_call_key(call_id), 'Cancelled')
+        if result is None or result[-1] != 1:
+            return 404
+
+        call_state = dict(zip(STATE_FIELDS, result))
+        log_call_cancelled(call_id, call_state)
+
+        if is_group_call:
+            return 202
+
+        # Let the app stop setting up the call.
+        loop = asyncio.get_event_loop()
+        try:
+            device = await loop.run_in_executor(self.db_executor, find_device_to_cancel, call_state)
+        except Exception:
+            device = None
+        if device is not None:
+            loop.run_in_executor(self.push_executor, send_cancel_message, device, call_id)
+        return 202
+
+    async def _set_outcome(self, unique_key, value):
+        """
+        Async version of store_call_outcome.
+
+        Hand the outcome off directly when the call is parked in this
+        process, otherwise the script publishes it for the other nodes.
+
+        Returns:
+            tuple: The result of SET_OUTCOME_SCRIPT and True if the outcome
+                was handed off in this process.
+        """
+        future = self.pending.get(unique_key)
+        parked = future is not None and not future.done()
+        result = await self.redis.eval(
+            SET_OUTCOME_SCRIPT,
+            1,
+            get_call_cache_key(unique_key),
+            value,
+            '' if parked else get_call_channel(unique_key),
+            time.time(),
+        )
+
+        handed_off = False
+        if result is not None and result[-1] == 1 and parked:
+            handed_off = not future.done()
+            if handed_off:
+                future.set_result(value)
+            else:
+                await self.redis.publish(get_call_channel(unique_key), value)
+        return result, handed_off
@@ -96,7 +96,7 @@ class VoipgridAuthentication(BaseAuthentication):
                     (LOG_EMAIL, json_response['email']),
                 ]),
                 logging.INFO,
-                device=Device.objects.get(sip_user_id=sip_user_id),
+                device=Device.objects.filter(sip_user_id=sip_user_id).order_by('-last_seen').first(),
             )
             raise PermissionDenied(detail=None)
 
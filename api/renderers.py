@@ -9,4 +9,7 @@ class PlainTextRenderer(renderers.BaseRenderer):
     format = 'txt'
 
     def render(self, data, media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            # The details of an error, like a bad request.
+            data = ' '.join(str(value) for value in data.values())
         return data.encode(self.charset)
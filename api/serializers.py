@@ -1,5 +1,8 @@
+from django.conf import settings
 from rest_framework import serializers
 
+from app.models import PLATFORM_CHOICES
+
 from .validators import phone_number_validator, token_validator
 
 
@@ -36,15 +39,32 @@ class DeleteDeviceSerializer(TokenSerializer, SipUserIdSerializer):
     app = serializers.CharField(max_length=255)
 
 
+class CheckInSerializer(SipUserIdSerializer):
+    """
+    Serializer for the check-in view.
+    """
+    token = serializers.CharField(max_length=250, required=False)
+
+
 class CallResponseSerializer(serializers.Serializer):
     """
     Serializer for the call response view.
     """
-    unique_key = serializers.CharField(max_length=255)
+    # A call_id with the hash tag and number of a device of a group call.
+    unique_key = serializers.CharField(max_length=260)
     message_start_time = serializers.FloatField()
     available = serializers.BooleanField(default=True)
 
 
+class PushReceivedSerializer(serializers.Serializer):
+    """
+    Serializer for the push received view.
+    """
+    # A call_id with the hash tag and number of a device of a group call.
+    unique_key = serializers.CharField(max_length=260)
+    attempt = serializers.IntegerField(min_value=1)
+
+
 class IncomingCallSerializer(SipUserIdSerializer):
     """
     Serializer for the incoming call view.
@@ -54,6 +74,52 @@ class IncomingCallSerializer(SipUserIdSerializer):
     call_id = serializers.CharField(max_length=255, default=None, allow_blank=True)
 
 
+class RingGroupCallSerializer(serializers.Serializer):
+    """
+    Serializer for the ring group call view.
+    """
+    sip_user_ids = serializers.CharField()
+    caller_id = serializers.CharField(max_length=255, default='', allow_blank=True)
+    phonenumber = serializers.CharField(max_length=32, validators=[phone_number_validator])
+    call_id = serializers.CharField(max_length=255, default=None, allow_blank=True)
+
+    def validate_sip_user_ids(self, value):
+        """
+        Parse the comma separated sip_user_ids to a list without duplicates.
+        """
+        sip_user_ids = []
+        for sip_user_id in value.split(','):
+            sip_user_id = SipUserIdSerializer().fields['sip_user_id'].run_validation(sip_user_id.strip())
+            if sip_user_id not in sip_user_ids:
+                sip_user_ids.append(sip_user_id)
+        if len(sip_user_ids) > settings.RING_GROUP_MAX_MEMBERS:
+            raise serializers.ValidationError(
+                'Ensure there are no more than {0} sip_user_ids.'.format(settings.RING_GROUP_MAX_MEMBERS))
+        return sip_user_ids
+
+
+class CancelCallSerializer(serializers.Serializer):
+    """
+    Serializer for the cancel call view.
+    """
+    call_id = serializers.CharField(max_length=255)
+
+
 class HangupReasonSerializer(SipUserIdSerializer):
-    unique_key = serializers.CharField(max_length=255)
+    unique_key = serializers.CharField(max_length=260)
     reason = serializers.CharField(max_length=None, default=None, allow_blank=True)
+
+
+class BulkNotifySerializer(serializers.Serializer):
+    """
+    Serializer for starting a bulk notification or resuming one by run_id.
+    """
+    run_id = serializers.CharField(max_length=32, required=False)
+    app = serializers.CharField(max_length=255, required=False)
+    platform = serializers.ChoiceField(choices=PLATFORM_CHOICES, required=False)
+    message = serializers.CharField(max_length=1000, required=False)
+
+    def validate(self, data):
+        if 'run_id' not in data and not all(field in data for field in ('app', 'platform', 'message')):
+            raise serializers.ValidationError('Give a run_id or the app, platform and message.')
+        return data
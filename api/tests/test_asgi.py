@@ -0,0 +1,260 @@
+from ast import literal_eval
+import asyncio
+from datetime import datetime, timedelta
+import time
+from unittest import mock
+
+from django.test import TransactionTestCase
+
+from app.cache import RedisClusterCache
+from app.call_coalescing import get_call_leader_key
+from app.call_timeline import PHASE_ANSWERED, PHASE_APP_RESPONDED, PHASE_DEVICE_RESOLVED, PHASE_PUSH_ENQUEUED
+from app.calls import get_group_member_key
+from app.devices import invalidate_device
+from app.models import App, Device
+from main.prometheus.consts import OS_KEY, PHASES_KEY, RESULT_KEY, VIALER_MIDDLEWARE_CALL_PHASE_KEY
+
+from ..asgi import IncomingCallApplication
+from .utils import asgi_post
+
+
+class AsyncIncomingCallTest(TransactionTestCase):
+
+    def setUp(self):
+        super(AsyncIncomingCallTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.application = IncomingCallApplication()
+
+        # URL's.
+        self.response_url = '/api/call-response/'
+        self.incoming_url = '/api/incoming-call/'
+
+        self.ios_app, created = App.objects.get_or_create(platform='apns', app_id='com.voipgrid.vialer')
+        self.call_data = {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+        }
+        # Drop a device cached by an earlier test, the database flush does
+        # not invalidate the device cache.
+        invalidate_device(self.call_data['sip_user_id'])
+        # Forget the response of an earlier test for the same call_id.
+        RedisClusterCache().client.delete(get_call_leader_key(self.call_data['call_id']))
+
+    def tearDown(self):
+        super(AsyncIncomingCallTest, self).tearDown()
+        if self.application.listener:
+            self.application.listener.cancel()
+        self.loop.close()
+
+    def _create_device(self):
+        Device.objects.create(
+            name='test device',
+            token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            os_version='8.3',
+            client_version='1.0',
+            last_seen=datetime.now() - timedelta(days=14),
+            app=self.ios_app,
+        )
+
+    def _create_second_device(self):
+        android_app, created = App.objects.get_or_create(platform='android', app_id='com.voipgrid.vialer')
+        Device.objects.create(
+            name='tablet',
+            token='b652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            last_seen=datetime.now() - timedelta(days=15),
+            app=android_app,
+        )
+
+    async def _respond_after(self, delay, available):
+        await asyncio.sleep(delay)
+        return await asgi_post(self.application, self.response_url, {
+            'unique_key': self.call_data['call_id'],
+            'message_start_time': time.time(),
+            'available': available,
+        })
+
+    def test_unknown_device(self):
+        """
+        Test a call for a sip_user_id without a device.
+        """
+        status, body = self.loop.run_until_complete(
+            asgi_post(self.application, self.incoming_url, self.call_data))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'status=NAK')
+
+    def test_bad_request(self):
+        """
+        Test a call with invalid data.
+        """
+        del self.call_data['phonenumber']
+        status, body = self.loop.run_until_complete(
+            asgi_post(self.application, self.incoming_url, self.call_data))
+
+        self.assertEqual(status, 400)
+
+    @mock.patch('api.asgi.send_call_message')
+    def test_available_incoming_call(self, *mocks):
+        """
+        Test a call when the device is available.
+        """
+        self._create_device()
+
+        (status, body), (response_status, _) = self.loop.run_until_complete(asyncio.gather(
+            asgi_post(self.application, self.incoming_url, self.call_data),
+            self._respond_after(1.5, 'True'),
+        ))
+
+        self.assertEqual(response_status, 202)
+        self.assertEqual(body, b'status=ACK')
+
+    @mock.patch('api.asgi.send_call_message')
+    def test_call_phases(self, *mocks):
+        """
+        Test that the setup phases of a call are timed like in the web
+        workers.
+        """
+        self._create_device()
+        redis_cache = RedisClusterCache()
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+
+        self.loop.run_until_complete(asyncio.gather(
+            asgi_post(self.application, self.incoming_url, self.call_data),
+            self._respond_after(.5, 'True'),
+        ))
+
+        data = [literal_eval(value) for value in redis_cache.client.lrange(VIALER_MIDDLEWARE_CALL_PHASE_KEY, 0, -1)]
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0][OS_KEY], 'apns')
+        self.assertEqual(data[0][RESULT_KEY], 'ACK')
+        self.assertEqual(
+            list(data[0][PHASES_KEY]),
+            [PHASE_DEVICE_RESOLVED, PHASE_PUSH_ENQUEUED, PHASE_APP_RESPONDED, PHASE_ANSWERED],
+        )
+
+    @mock.patch('api.asgi.send_call_message')
+    def test_duplicate_incoming_calls(self, *mocks):
+        """
+        Test that concurrent requests for the same call_id send one push
+        sequence and all get the response of the first request.
+        """
+        self._create_device()
+
+        results = self.loop.run_until_complete(asyncio.gather(
+            self._respond_after(1.5, 'True'),
+            *[asgi_post(self.application, self.incoming_url, self.call_data) for i in range(5)],
+        ))
+
+        self.assertEqual([body for status, body in results[1:]], [b'status=ACK'] * 5)
+        self.assertEqual([call[0][4] for call in mocks[0].call_args_list], [1, 2])
+
+    @mock.patch('api.asgi.send_cancel_message')
+    @mock.patch('api.asgi.send_call_message')
+    def test_cancelled_incoming_call(self, send_call_message, send_cancel_message):
+        """
+        Test that a cancelled call stops waiting right away and withdraws
+        the call push.
+        """
+        self._create_device()
+
+        async def cancel_after(delay):
+            await asyncio.sleep(delay)
+            return await asgi_post(self.application, '/api/cancel-call/', {'call_id': self.call_data['call_id']})
+
+        start = time.time()
+        (status, body), (cancel_status, _) = self.loop.run_until_complete(asyncio.gather(
+            asgi_post(self.application, self.incoming_url, self.call_data),
+            cancel_after(.5),
+        ))
+        run_time = time.time() - start
+        # Wait for the cancel push.
+        self.application.push_executor.shutdown(wait=True)
+
+        self.assertEqual(cancel_status, 202)
+        self.assertEqual(body, b'status=NAK')
+        self.assertLess(run_time, 1)
+        self.assertEqual(send_call_message.call_count, 1)
+        self.assertEqual(send_cancel_message.call_args[0][1], self.call_data['call_id'])
+
+    @mock.patch('api.asgi.send_call_message')
+    def test_not_available_incoming_call(self, *mocks):
+        """
+        Test a call when the device is not available.
+        """
+        self._create_device()
+
+        (status, body), _ = self.loop.run_until_complete(asyncio.gather(
+            asgi_post(self.application, self.incoming_url, self.call_data),
+            self._respond_after(.5, 'False'),
+        ))
+
+        self.assertEqual(body, b'status=NAK')
+
+    @mock.patch('api.asgi.send_cancel_message')
+    @mock.patch('api.asgi.send_call_message')
+    def test_first_device_answers(self, send_call_message, send_cancel_message):
+        """
+        Test that all devices of the sip_user_id are called and the device
+        that accepts first gets the call, the other device is cancelled.
+        """
+        self._create_device()
+        self._create_second_device()
+
+        async def respond_after(delay, member):
+            await asyncio.sleep(delay)
+            return await asgi_post(self.application, self.response_url, {
+                'unique_key': get_group_member_key(self.call_data['call_id'], member),
+                'message_start_time': time.time(),
+            })
+
+        (status, body), (response_status, _) = self.loop.run_until_complete(asyncio.gather(
+            asgi_post(self.application, self.incoming_url, self.call_data),
+            respond_after(.5, 1),
+        ))
+        # Wait for the cancel push.
+        self.application.push_executor.shutdown(wait=True)
+
+        self.assertEqual(response_status, 202)
+        self.assertEqual(body, b'status=ACK')
+        self.assertEqual(
+            sorted((call[0][0].name, call[0][1]) for call in send_call_message.call_args_list),
+            [
+                ('tablet', get_group_member_key(self.call_data['call_id'], 1)),
+                ('test device', get_group_member_key(self.call_data['call_id'], 0)),
+            ],
+        )
+        self.assertEqual(send_cancel_message.call_args[0][1], get_group_member_key(self.call_data['call_id'], 0))
+
+    @mock.patch('api.asgi.send_cancel_message')
+    @mock.patch('api.asgi.send_call_message')
+    def test_cancelled_call_to_devices(self, send_call_message, send_cancel_message):
+        """
+        Test that a cancel by the call_id stops the calls to all devices.
+        """
+        self._create_device()
+        self._create_second_device()
+
+        async def cancel_after(delay):
+            await asyncio.sleep(delay)
+            return await asgi_post(self.application, '/api/cancel-call/', {'call_id': self.call_data['call_id']})
+
+        start = time.time()
+        (status, body), (cancel_status, _) = self.loop.run_until_complete(asyncio.gather(
+            asgi_post(self.application, self.incoming_url, self.call_data),
+            cancel_after(.5),
+        ))
+        run_time = time.time() - start
+        # Wait for the cancel pushes.
+        self.application.push_executor.shutdown(wait=True)
+
+        self.assertEqual(cancel_status, 202)
+        self.assertEqual(body, b'status=NAK')
+        self.assertLess(run_time, 1)
+        self.assertEqual(
+            sorted(call[0][0].name for call in send_cancel_message.call_args_list), ['tablet', 'test device'])
@@ -1,14 +1,28 @@
+import asyncio
 from datetime import datetime, timedelta
 import time
+import tracemalloc
 from unittest import mock
+import uuid
 
 from django.conf import settings
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase
+from gcm.gcm import GCM
+from pyfcm import FCMNotification
+from redis.connection import Connection
+from rediscluster import StrictRedisCluster
+from rediscluster.pipeline import StrictClusterPipeline
 from rest_framework.test import APIClient
 
+from app.cache import RedisClusterCache, shared_redis_cache
+from app.calls import WAIT_MODE_BATCH, WAIT_MODE_NOTIFY, WAIT_MODE_POLL
 from app.models import App, Device
+from app.push_clients import GooglePushClientPool
+from app.tests.utils import StubPushServer
+from app.sip_user_filter import sip_user_filter
 
-from .utils import mocked_send_apns_message, ThreadWithReturn
+from ..asgi import IncomingCallApplication
+from .utils import asgi_post, mocked_send_push_message, ThreadWithReturn
 
 
 class IncomingCallPerformanceTest(TransactionTestCase):
@@ -30,13 +44,14 @@ class IncomingCallPerformanceTest(TransactionTestCase):
             app=self.ios_app,
         )
 
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def _execute_call(self, *mocks):
         call_data = {
             'sip_user_id': '123456789',
             'caller_id': 'Test name',
             'phonenumber': '0123456789',
-            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+            # A new call_id, a repeated one gets the response of the last call.
+            'call_id': uuid.uuid4().hex,
         }
 
         # Now the device exists, call it again in seperate thread.
@@ -70,3 +85,353 @@ class IncomingCallPerformanceTest(TransactionTestCase):
             run_time += end - start
 
         print('Ended in {0} with {1} iterations'.format(run_time, iterations))
+
+
+class IncomingCallRedisOpsTest(IncomingCallPerformanceTest):
+    """
+    Compare the amount of Redis commands per call for the wait modes.
+    """
+    def _count_redis_commands(self, wait_mode):
+        """
+        Execute a call in the given wait mode and count the Redis commands.
+        """
+        original_execute_command = StrictRedisCluster.execute_command
+        commands = []
+
+        def counting_execute_command(client, *args, **kwargs):
+            commands.append(args[0])
+            return original_execute_command(client, *args, **kwargs)
+
+        with mock.patch.object(StrictRedisCluster, 'execute_command', counting_execute_command):
+            with self.settings(APP_PUSH_WAIT_MODE=wait_mode):
+                self._execute_call()
+
+        return len(commands)
+
+    def test_performance(self):
+        poll_commands = self._count_redis_commands(WAIT_MODE_POLL)
+        notify_commands = self._count_redis_commands(WAIT_MODE_NOTIFY)
+
+        print('Redis commands per call, poll: {0} notify: {1}'.format(poll_commands, notify_commands))
+        self.assertLess(notify_commands, poll_commands)
+
+
+class ConcurrentIncomingCallPerformanceTest(IncomingCallPerformanceTest):
+    """
+    Park PERFORMANCE_TEST_CONCURRENCY calls at once on the WSGI view and on
+    the ASGI application and compare the time and memory it takes.
+    """
+    def _new_run(self):
+        # Every run gets new call_ids, a repeated one gets the response of
+        # the last run.
+        self.run_id = uuid.uuid4().hex
+
+    def _call_data(self, index):
+        return {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'concurrent-call-{0}-{1}'.format(self.run_id, index),
+        }
+
+    def _response_data(self, index):
+        return {
+            'unique_key': 'concurrent-call-{0}-{1}'.format(self.run_id, index),
+            'message_start_time': time.time(),
+        }
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def _execute_sync_calls(self, concurrency, *mocks):
+        self._new_run()
+        threads = [
+            ThreadWithReturn(target=self.client.post, args=('/api/incoming-call/', self._call_data(i)))
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Wait until all calls are parked.
+        time.sleep(1)
+
+        for i in range(concurrency):
+            self.client.post('/api/call-response/', self._response_data(i))
+
+        return [thread.join().content for thread in threads]
+
+    @mock.patch('api.asgi.send_call_message')
+    def _execute_async_calls(self, concurrency, *mocks):
+        self._new_run()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        application = IncomingCallApplication()
+
+        async def respond():
+            # Wait until all calls are parked.
+            await asyncio.sleep(1)
+            await asyncio.gather(*[
+                asgi_post(application, '/api/call-response/', self._response_data(i))
+                for i in range(concurrency)
+            ])
+
+        try:
+            results = loop.run_until_complete(asyncio.gather(
+                respond(),
+                *[asgi_post(application, '/api/incoming-call/', self._call_data(i)) for i in range(concurrency)],
+            ))
+        finally:
+            application.listener.cancel()
+            loop.close()
+
+        return [body for status, body in results[1:]]
+
+    def _measure(self, execute_calls, concurrency):
+        tracemalloc.start()
+        start = time.time()
+        try:
+            results = execute_calls(concurrency)
+            run_time = time.time() - start
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(results, [b'status=ACK'] * concurrency)
+        return run_time, peak
+
+    def test_performance(self):
+        concurrency = int(settings.PERFORMANCE_TEST_CONCURRENCY)
+
+        for name, execute_calls in (('WSGI', self._execute_sync_calls), ('ASGI', self._execute_async_calls)):
+            run_time, peak = self._measure(execute_calls, concurrency)
+            print('{0}: {1} parked calls ended in {2:.2f}s, peak memory {3:.1f}KiB per call'.format(
+                name, concurrency, run_time, peak / 1024 / concurrency))
+
+
+class OverloadPerformanceTest(ConcurrentIncomingCallPerformanceTest):
+    """
+    Storm a worker with PERFORMANCE_TEST_CONCURRENCY calls for one app over
+    an admission limit of half of them, followed by calls for a partner app.
+    The admitted calls of both apps must still be answered and the other
+    calls must be shed, the time to shed them is printed.
+    """
+    def setUp(self):
+        super(OverloadPerformanceTest, self).setUp()
+        self.partner_app = App.objects.create(platform='android', app_id='com.partner.app')
+        Device.objects.create(
+            name='partner device',
+            token='partner-token',
+            sip_user_id='987654321',
+            app=self.partner_app,
+        )
+
+    def _timed_post(self, data):
+        start = time.time()
+        response = self.client.post('/api/incoming-call/', data)
+        return response.content, time.time() - start
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def _execute_storm(self, storm, partner, *mocks):
+        self._new_run()
+        call_data = [self._call_data(i) for i in range(storm + partner)]
+        for data in call_data[storm:]:
+            data['sip_user_id'] = '987654321'
+
+        threads = [ThreadWithReturn(target=self._timed_post, args=(data,)) for data in call_data]
+        for thread in threads[:storm]:
+            thread.start()
+        # Let the storm fill the slots before the partner calls.
+        time.sleep(.5)
+        for thread in threads[storm:]:
+            thread.start()
+
+        # Wait until all calls are parked.
+        time.sleep(1)
+
+        for i in range(storm + partner):
+            self.client.post('/api/call-response/', self._response_data(i))
+
+        results = [thread.join() for thread in threads]
+        return results[:storm], results[storm:]
+
+    def test_performance(self):
+        concurrency = int(settings.PERFORMANCE_TEST_CONCURRENCY)
+        limit = concurrency // 2
+        partner = limit - int(limit * .8)
+
+        with self.settings(
+            ADMISSION_MAX_WORKER_CALLS=limit,
+            ADMISSION_MAX_GLOBAL_CALLS=0,
+            ADMISSION_FAIR_SHARE_THRESHOLD=.8,
+            ADMISSION_MAX_APP_SHARE=.5,
+        ):
+            storm_results, partner_results = self._execute_storm(concurrency, partner)
+
+        shed_times = [run_time for content, run_time in storm_results if content == b'status=NAK']
+        storm_acks = sum(content == b'status=ACK' for content, _ in storm_results)
+        print('{0} storm calls over a limit of {1}: {2} answered, {3} shed in at most {4:.0f}ms, '
+              '{5}/{6} partner calls answered'.format(
+                  concurrency, limit, storm_acks, len(shed_times), max(shed_times) * 1000,
+                  sum(content == b'status=ACK' for content, _ in partner_results), partner))
+
+        self.assertEqual(storm_acks, int(limit * .8))
+        self.assertEqual(len(shed_times), concurrency - storm_acks)
+        self.assertEqual([content for content, _ in partner_results], [b'status=ACK'] * partner)
+
+
+class BatchPollerPerformanceTest(ConcurrentIncomingCallPerformanceTest):
+    """
+    Compare the Redis round trips for PERFORMANCE_TEST_CONCURRENCY parked
+    calls between polling per call and one batched poller per process.
+    """
+    def _count_redis_round_trips(self, wait_mode, concurrency):
+        original_execute_command = StrictRedisCluster.execute_command
+        original_execute = StrictClusterPipeline.execute
+        round_trips = []
+
+        def counting_execute_command(client, *args, **kwargs):
+            round_trips.append(args[0])
+            return original_execute_command(client, *args, **kwargs)
+
+        def counting_execute(pipeline, *args, **kwargs):
+            round_trips.append('PIPELINE')
+            return original_execute(pipeline, *args, **kwargs)
+
+        with mock.patch.object(StrictRedisCluster, 'execute_command', counting_execute_command):
+            with mock.patch.object(StrictClusterPipeline, 'execute', counting_execute):
+                with self.settings(APP_PUSH_WAIT_MODE=wait_mode):
+                    results = self._execute_sync_calls(concurrency)
+
+        self.assertEqual(results, [b'status=ACK'] * concurrency)
+        return len(round_trips)
+
+    def test_performance(self):
+        concurrency = int(settings.PERFORMANCE_TEST_CONCURRENCY)
+
+        poll_round_trips = self._count_redis_round_trips(WAIT_MODE_POLL, concurrency)
+        batch_round_trips = self._count_redis_round_trips(WAIT_MODE_BATCH, concurrency)
+
+        print('Redis round trips for {0} parked calls, poll: {1} batch: {2}'.format(
+            concurrency, poll_round_trips, batch_round_trips))
+        self.assertLess(batch_round_trips, poll_round_trips)
+
+
+class RedisClientPerformanceTest(SimpleTestCase):
+    """
+    Compare the latency and the opened connections of call responses between
+    a new cluster client per request and the client shared by the process.
+    """
+    def setUp(self):
+        super(RedisClientPerformanceTest, self).setUp()
+        self.client = APIClient()
+        shared_redis_cache.reset()
+
+    def _measure(self, requests):
+        original_connect = Connection.connect
+        connects = []
+
+        def counting_connect(connection):
+            connects.append(connection)
+            return original_connect(connection)
+
+        latencies = []
+        with mock.patch.object(Connection, 'connect', counting_connect):
+            for index in range(requests):
+                start = time.time()
+                # Unknown calls are answered after one script on the cluster.
+                response = self.client.post('/api/call-response/', {
+                    'unique_key': 'redis-client-benchmark-{0}'.format(index),
+                    'message_start_time': time.time(),
+                })
+                latencies.append(time.time() - start)
+                self.assertEqual(response.status_code, 404)
+
+        return sum(latencies) / requests * 1000, len(connects)
+
+    def test_performance(self):
+        requests = int(settings.PERFORMANCE_TEST_CONCURRENCY)
+
+        with mock.patch('api.views.get_redis_cache', side_effect=RedisClusterCache):
+            new_latency, new_connects = self._measure(requests)
+        shared_latency, shared_connects = self._measure(requests)
+
+        print('{0} call responses, new client: {1:.2f}ms {2} connects, shared client: {3:.2f}ms {4} connects'.format(
+            requests, new_latency, new_connects, shared_latency, shared_connects))
+        self.assertLess(shared_connects, new_connects)
+        self.assertLess(shared_latency, new_latency)
+
+
+class SipUserFilterPerformanceTest(TransactionTestCase):
+    """
+    Measure the rebuild of the sip user filter and extrapolate it to a
+    million devices.
+    """
+    def test_performance(self):
+        devices = int(settings.PERFORMANCE_TEST_CONCURRENCY) * 100
+        app = App.objects.create(platform='android', app_id='com.voipgrid.vialer', push_key='key')
+        Device.objects.bulk_create([
+            Device(
+                id=str(100000000 + index * 89),
+                sip_user_id=str(100000000 + index * 89),
+                token='token{0}'.format(index),
+                app=app,
+            )
+            for index in range(devices)
+        ])
+
+        start = time.time()
+        self.assertEqual(sip_user_filter.rebuild(), devices)
+        run_time = time.time() - start
+
+        print('Rebuilt the sip user filter with {0} devices in {1:.2f}s, {2:.1f}s per million'.format(
+            devices, run_time, run_time / devices * 1000000))
+
+
+class GooglePushClientPerformanceTest(SimpleTestCase):
+    """
+    Compare the latency and the opened connections of pushes to a local stub
+    of FCM and GCM between a new client per push and the shared clients.
+    """
+    def setUp(self):
+        super(GooglePushClientPerformanceTest, self).setUp()
+        self.server = StubPushServer()
+        self.url = self.server.url
+        self.app = mock.Mock(pk=1, app_id='com.voipgrid.vialer', push_key='key')
+
+    def tearDown(self):
+        super(GooglePushClientPerformanceTest, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _measure(self, push, pushes):
+        self.server.connections = 0
+        start = time.time()
+        for _ in range(pushes):
+            push()
+        return (time.time() - start) / pushes * 1000, self.server.connections
+
+    def test_performance(self):
+        pushes = int(settings.PERFORMANCE_TEST_CONCURRENCY)
+        pool = GooglePushClientPool()
+
+        with mock.patch.object(FCMNotification, 'FCM_END_POINT', self.url):
+            new_fcm = self._measure(
+                lambda: FCMNotification(api_key='key').notify_single_device(registration_id='token', data_message={}),
+                pushes,
+            )
+            shared_fcm = self._measure(
+                lambda: pool.get_fcm_client(self.app).notify_single_device(registration_id='token', data_message={}),
+                pushes,
+            )
+
+        pool.evict(self.app.pk)
+        with mock.patch('gcm.gcm.GCM_URL', self.url):
+            new_gcm = self._measure(lambda: GCM('key').json_request(registration_ids=['token'], data={}), pushes)
+            shared_gcm = self._measure(
+                lambda: pool.get_gcm_client(self.app).json_request(registration_ids=['token'], data={}),
+                pushes,
+            )
+
+        for name, new, shared in (('FCM', new_fcm, shared_fcm), ('GCM', new_gcm, shared_gcm)):
+            print('{0} {1} pushes, new client: {2:.2f}ms {3} connects, shared client: {4:.2f}ms {5} connects'.format(
+                name, pushes, new[0], new[1], shared[0], shared[1]))
+            self.assertEqual(new[1], pushes)
+            self.assertEqual(shared[1], 1)
@@ -5,29 +5,49 @@ from unittest import mock
 
 from django.conf import settings
 from django.core.cache import cache
-from django.test import TestCase, TransactionTestCase
+from django.test import override_settings, TestCase, TransactionTestCase
 from freezegun import freeze_time
+from redis import RedisError
 from rest_framework.test import APIClient
 from testfixtures import LogCapture
 
+from app.admission import admission_control
 from app.cache import RedisClusterCache
+from app.call_coalescing import get_call_leader_key
+from app.calls import get_call_cache_key, get_group_member_key, record_call_attempt, start_call
 from app.models import App, Device, ResponseLog
+from app.response_policy import CallPolicy, SOURCE_DEVICE
+from app.sip_user_filter import ABSENT, FILTER_KEY, get_position, sip_user_filter
 from main.prometheus.consts import (
     APP_VERSION_KEY,
+    ATTEMPT_KEY,
     CALL_SETUP_SUCCESSFUL_KEY,
     CODEC_KEY,
     CONNECTION_TYPE_KEY,
     DIRECTION_KEY,
     FAILED_REASON_KEY,
+    FIRST_KEY,
+    HANDOFF_KEY,
+    HANDOFF_LOCAL_VALUE,
     HANGUP_REASON_KEY,
+    LATENCY_KEY,
     MOS_KEY,
     NETWORK_KEY,
     NETWORK_OPERATOR_KEY,
     OS_KEY,
-    OS_VERSION_KEY)
-from .utils import mocked_send_apns_message, mocked_send_fcm_message, ThreadWithReturn
-
-
+    OS_VERSION_KEY,
+    PHASES_KEY,
+    RESULT_KEY,
+    SAVED_SECONDS_KEY,
+    VIALER_MIDDLEWARE_CALL_CANCELLED_KEY,
+    VIALER_MIDDLEWARE_CALL_PHASE_KEY,
+    VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY,
+    VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY,
+    VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY)
+from .utils import mocked_send_push_message, ThreadWithReturn
+
+
+@override_settings(MAX_DEVICES_PER_SIP_USER_ID=1)
 class RegisterDeviceTest(TestCase):
 
     def setUp(self):
@@ -49,7 +69,7 @@ class RegisterDeviceTest(TestCase):
         self.ios_url = '/api/apns-device/'
         self.android_url = '/api/android-device/'
 
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_register_apns_device(self, *mocks):
         """
         This tests more than its name suggests. It also tests, unregister,
@@ -103,7 +123,7 @@ class RegisterDeviceTest(TestCase):
         })
         self.assertEqual(response.status_code, 404, msg='Wrong status code for unregister, expected 404')
 
-    @mock.patch('app.push.send_fcm_message', side_effect=mocked_send_fcm_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_register_android_device(self, *mocks):
         """
         Test if android registration succeeds
@@ -132,6 +152,103 @@ class RegisterDeviceTest(TestCase):
         })
         self.assertEqual(response.status_code, 200, msg='Wrong status code for unregister, expected 200')
 
+    @override_settings(MAX_DEVICES_PER_SIP_USER_ID=2)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_register_second_device(self, *mocks):
+        """
+        Test that a second device is added to the sip_user_id and a third
+        one replaces the least recently seen device.
+        """
+        response = self.client.post(self.ios_url, self.data)
+        self.assertEqual(response.status_code, 201, msg='Wrong status code for create')
+
+        self.data['token'] = 'android4bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6'
+        response = self.client.post(self.android_url, self.data)
+        self.assertEqual(response.status_code, 201, msg='Wrong status code for second device')
+        self.assertEqual(Device.objects.filter(sip_user_id=self.data['sip_user_id']).count(), 2)
+        self.assertFalse(mocks[0].called)
+
+        # Another phone.
+        self.data['token'] = 'c652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6'
+        self.data['name'] = 'other test device'
+        self.data['remote_logging_id'] = 'f6g7h8i9j0'
+        response = self.client.post(self.ios_url, self.data)
+        self.assertEqual(response.status_code, 200, msg='Wrong status code for replacing a device')
+        # Wait for the notify push to the replaced device.
+        time.sleep(.1)
+
+        tokens = set(Device.objects.filter(sip_user_id=self.data['sip_user_id']).values_list('token', flat=True))
+        self.assertEqual(tokens, {
+            'android4bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            'c652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+        })
+        self.assertEqual(
+            mocks[0].call_args[0][0].token, 'a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6')
+
+    @override_settings(MAX_DEVICES_PER_SIP_USER_ID=2)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_refresh_token(self, *mocks):
+        """
+        Test that a new token of a phone replaces the token of its device
+        instead of adding a device.
+        """
+        response = self.client.post(self.ios_url, self.data)
+        self.assertEqual(response.status_code, 201, msg='Wrong status code for create')
+        device_id = Device.objects.get(sip_user_id=self.data['sip_user_id']).id
+
+        # The same phone by its remote_logging_id.
+        self.data['token'] = 'b652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6'
+        response = self.client.post(self.ios_url, self.data)
+        self.assertEqual(response.status_code, 200, msg='Wrong status code for refreshing a token')
+        # Wait for the notify push to the old token.
+        time.sleep(.1)
+
+        device = Device.objects.get(sip_user_id=self.data['sip_user_id'])
+        self.assertEqual(device.id, device_id)
+        self.assertEqual(device.token, self.data['token'])
+        self.assertEqual(
+            mocks[0].call_args[0][0].token, 'a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6')
+
+        # The same phone by its name.
+        del self.data['remote_logging_id']
+        Device.objects.filter(id=device_id).update(remote_logging_id=None)
+        self.data['token'] = 'c652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6'
+        response = self.client.post(self.ios_url, self.data)
+        self.assertEqual(response.status_code, 200, msg='Wrong status code for refreshing a token')
+        self.assertEqual(
+            list(Device.objects.filter(sip_user_id=self.data['sip_user_id']).values_list('id', 'token')),
+            [(device_id, self.data['token'])],
+        )
+
+    @mock.patch('api.views.log_middleware_information')
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_new_token_keeps_fields(self, *mocks):
+        """
+        Test that a device that gets a new token keeps the fields the app
+        did not send again and only the changed fields are reported.
+        """
+        response = self.client.post(self.ios_url, self.data)
+        self.assertEqual(response.status_code, 201, msg='Wrong status code for create')
+
+        response = self.client.post(self.ios_url, {
+            'token': 'b652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            'sip_user_id': self.data['sip_user_id'],
+            'app': self.data['app'],
+            'name': self.data['name'],
+            'os_version': '8.4',
+        })
+        self.assertEqual(response.status_code, 200, msg='Wrong status code for a new token')
+        # Wait for the notify push to the old token.
+        time.sleep(.1)
+
+        device = Device.objects.get(sip_user_id=self.data['sip_user_id'])
+        self.assertEqual(
+            (device.name, device.os_version, device.client_version, device.remote_logging_id),
+            (self.data['name'], '8.4', self.data['client_version'], self.data['remote_logging_id']),
+        )
+        self.assertEqual(
+            mocks[1].call_args[0][1]['status'], 'OK updated and send notify to old token, updated the os_version')
+
     def test_register_unexisting_app(self):
         """
         Test registration of an unexisting app
@@ -143,8 +260,7 @@ class RegisterDeviceTest(TestCase):
         response = self.client.post(self.android_url, self.data)
         self.assertEqual(response.status_code, 404, msg='Wrong status code for create')
 
-    @mock.patch('app.push.send_fcm_message', side_effect=mocked_send_fcm_message)
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_switch_sip_ios_to_android(self, *mocks):
         """
         Test the switch a sip_user_id from an ios to an android client.
@@ -158,8 +274,7 @@ class RegisterDeviceTest(TestCase):
 
         self.assertTrue(Device.objects.count() == 1, 'There should be only one updated device!')
 
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
-    @mock.patch('app.push.send_fcm_message', side_effect=mocked_send_fcm_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_switch_sip_android_to_ios(self, *mocks):
         """
         Test the switch a sip_user_id from an android to an ios client.
@@ -186,7 +301,10 @@ class IOSIncomingCallTest(TransactionTestCase):
 
         self.ios_app, created = App.objects.get_or_create(platform='apns', app_id='com.voipgrid.vialer')
 
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
+        # Forget the response of an earlier test for the same call_id.
+        RedisClusterCache().client.delete(get_call_leader_key('sduiqayduiryqwuioeryqwer76789'))
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_available_incoming_call(self, *mocks):
         """
         Test a call when the device is available (default).
@@ -235,7 +353,219 @@ class IOSIncomingCallTest(TransactionTestCase):
         self.assertEqual(response.content, b'status=ACK')
         self.assertEqual(cache.get('attempts'), 2)
 
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_response_handed_off_in_process(self, *mocks):
+        """
+        Test that a response in the same process wakes up the call directly.
+        """
+        redis_cache = RedisClusterCache()
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY)
+
+        call_data = {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+        }
+
+        Device.objects.create(
+            name='test device',
+            token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            app=self.ios_app,
+        )
+
+        thread = ThreadWithReturn(target=self.client.post, args=(self.incoming_url, call_data))
+        thread.start()
+
+        # Simulate some wait-time before device responds.
+        time.sleep(.5)
+
+        app_data = {
+            'unique_key': call_data['call_id'],
+            'message_start_time': time.time(),
+        }
+        self.client.post(self.response_url, app_data)
+        response = thread.join()
+
+        self.assertEqual(response.content, b'status=ACK')
+        value_list = redis_cache.client.lrange(VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY, 0, -1)
+        self.assertEqual(literal_eval(value_list[0])[HANDOFF_KEY], HANDOFF_LOCAL_VALUE)
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY)
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_call_phases(self, *mocks):
+        """
+        Test that the time spent in the setup phases of a call is pushed.
+        """
+        redis_cache = RedisClusterCache()
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+
+        call_data = {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+        }
+
+        Device.objects.create(
+            name='test device',
+            token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            app=self.ios_app,
+        )
+
+        thread = ThreadWithReturn(target=self.client.post, args=(self.incoming_url, call_data))
+        thread.start()
+
+        # Simulate some wait-time before device responds.
+        time.sleep(.5)
+
+        app_data = {
+            'unique_key': call_data['call_id'],
+            'message_start_time': time.time(),
+        }
+        self.client.post(self.response_url, app_data)
+        response = thread.join()
+
+        self.assertEqual(response.content, b'status=ACK')
+        value_list = redis_cache.client.lrange(VIALER_MIDDLEWARE_CALL_PHASE_KEY, 0, -1)
+        self.assertEqual(len(value_list), 1)
+        data = literal_eval(value_list[0])
+        self.assertEqual(data[OS_KEY], 'apns')
+        self.assertEqual(data[RESULT_KEY], 'ACK')
+        self.assertEqual(
+            list(data[PHASES_KEY]),
+            ['device_resolved', 'push_enqueued', 'app_responded', 'answered'],
+        )
+        self.assertGreater(data[PHASES_KEY]['app_responded'], .4)
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+
+    @mock.patch('api.views.get_call_waiter', side_effect=RedisError)
+    def test_slot_released_when_waiter_fails(self, *mocks):
+        """
+        Test that the admission slot of a call is released when listening
+        for the response fails.
+        """
+        call_data = {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+        }
+
+        Device.objects.create(
+            name='test device',
+            token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            app=self.ios_app,
+        )
+
+        with mock.patch.object(admission_control, 'release', wraps=admission_control.release) as release:
+            with self.assertRaises(RedisError):
+                self.client.post(self.incoming_url, call_data)
+
+        self.assertEqual(release.call_count, 1)
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_duplicate_incoming_calls(self, *mocks):
+        """
+        Test that concurrent requests for the same call_id send one push
+        sequence and all get the response of the first request.
+        """
+        redis_cache = RedisClusterCache()
+        redis_cache.client.delete(VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY)
+
+        call_data = {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+        }
+
+        Device.objects.create(
+            name='test device',
+            token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            app=self.ios_app,
+        )
+
+        threads = [ThreadWithReturn(target=self.client.post, args=(self.incoming_url, call_data)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+
+        # Simulate some wait-time before device responds.
+        time.sleep(1.5)
+
+        app_data = {
+            'unique_key': call_data['call_id'],
+            'message_start_time': time.time(),
+        }
+        self.client.post(self.response_url, app_data)
+        responses = [thread.join() for thread in threads]
+
+        # A retry after the call ended gets the same response.
+        responses.append(self.client.post(self.incoming_url, call_data))
+
+        self.assertEqual([response.content for response in responses], [b'status=ACK'] * 6)
+        attempts = [call[0][3]['attempt'] for call in mocks[0].call_args_list]
+        self.assertEqual(attempts, [1, 2])
+        value_list = redis_cache.client.lrange(VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY, 0, -1)
+        self.assertEqual(len(value_list), 5)
+        redis_cache.client.delete(VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY)
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_cancelled_incoming_call(self, *mocks):
+        """
+        Test that a cancelled call stops waiting and resending right away
+        and withdraws the call push.
+        """
+        redis_cache = RedisClusterCache()
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_CANCELLED_KEY)
+
+        call_data = {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+        }
+
+        Device.objects.create(
+            name='test device',
+            token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            app=self.ios_app,
+        )
+
+        start = time.time()
+        thread = ThreadWithReturn(target=self.client.post, args=(self.incoming_url, call_data))
+        thread.start()
+
+        # Simulate the caller hanging up.
+        time.sleep(.5)
+        cancel_response = self.client.post('/api/cancel-call/', {'call_id': call_data['call_id']})
+        response = thread.join()
+        run_time = time.time() - start
+
+        # The app responds after the call was cancelled.
+        app_data = {
+            'unique_key': call_data['call_id'],
+            'message_start_time': time.time(),
+        }
+        app_response = self.client.post(self.response_url, app_data)
+        # Wait for the cancel push.
+        time.sleep(.1)
+
+        self.assertEqual(cancel_response.status_code, 202)
+        self.assertEqual(response.content, b'status=NAK')
+        self.assertLess(run_time, 1)
+        self.assertEqual(app_response.status_code, 404)
+        self.assertEqual([call[0][2] for call in mocks[0].call_args_list], ['call', 'cancel'])
+        value_list = redis_cache.client.lrange(VIALER_MIDDLEWARE_CALL_CANCELLED_KEY, 0, -1)
+        self.assertGreater(literal_eval(value_list[0])[SAVED_SECONDS_KEY], 3)
+        self.assertEqual(self.client.post('/api/cancel-call/', {'call_id': call_data['call_id']}).status_code, 404)
+        redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_CANCELLED_KEY)
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_not_available_incoming_call(self, *mocks):
         """
         Test a call when device is not available.
@@ -280,7 +610,7 @@ class IOSIncomingCallTest(TransactionTestCase):
         self.assertEqual(response.content, b'status=NAK')
         self.assertEqual(cache.get('attempts'), 2)
 
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_too_late_incoming_call(self, *mocks):
         """
         Test a call when device is too late.
@@ -331,7 +661,7 @@ class IOSIncomingCallTest(TransactionTestCase):
         self.assertEqual(response.content, b'status=NAK')
         self.assertEqual(cache.get('attempts'), 3)
 
-    @mock.patch('app.push.send_apns_message', side_effect=mocked_send_apns_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_log_to_db(self, *mocks):
         """
         Test a call when device is too late.
@@ -401,7 +731,10 @@ class AndroidIncomingCallTest(TransactionTestCase):
 
         self.android_app, created = App.objects.get_or_create(platform='android', app_id='com.voipgrid.vialer')
 
-    @mock.patch('app.push.send_fcm_message', side_effect=mocked_send_fcm_message)
+        # Forget the response of an earlier test for the same call_id.
+        RedisClusterCache().client.delete(get_call_leader_key('asdr2378945auhfjkasdghf897eoiehajklh'))
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_available_incoming_call(self, *mocks):
         """
         Test a call when the device is available (default).
@@ -449,7 +782,7 @@ class AndroidIncomingCallTest(TransactionTestCase):
         self.assertEqual(response.content, b'status=ACK')
         self.assertEqual(cache.get('attempts'), 2)
 
-    @mock.patch('app.push.send_fcm_message', side_effect=mocked_send_fcm_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_not_available_incoming_call(self, *mocks):
         """
         Test a call when device is not available.
@@ -494,7 +827,7 @@ class AndroidIncomingCallTest(TransactionTestCase):
         self.assertEqual(response.content, b'status=NAK')
         self.assertEqual(cache.get('attempts'), 2)
 
-    @mock.patch('app.push.send_fcm_message', side_effect=mocked_send_fcm_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_too_late_incoming_call(self, *mocks):
         """
         Test a call when device is too late.
@@ -545,7 +878,7 @@ class AndroidIncomingCallTest(TransactionTestCase):
         self.assertEqual(response.content, b'status=NAK')
         self.assertEqual(cache.get('attempts'), 3)
 
-    @mock.patch('app.push.send_fcm_message', side_effect=mocked_send_fcm_message)
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
     def test_log_to_db(self, *mocks):
         """
         Test a call when device is too late.
@@ -603,6 +936,254 @@ class AndroidIncomingCallTest(TransactionTestCase):
         self.assertGreater(log_count, 0)
 
 
+class MultipleDevicesIncomingCallTest(TransactionTestCase):
+
+    def setUp(self):
+        super(MultipleDevicesIncomingCallTest, self).setUp()
+        self.client = APIClient()
+
+        # URL's.
+        self.response_url = '/api/call-response/'
+        self.incoming_url = '/api/incoming-call/'
+
+        ios_app, created = App.objects.get_or_create(platform='apns', app_id='com.voipgrid.vialer')
+        android_app, created = App.objects.get_or_create(platform='android', app_id='com.voipgrid.vialer')
+        self.phone = Device.objects.create(
+            name='phone',
+            token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            last_seen=datetime.now(),
+            app=ios_app,
+        )
+        self.tablet = Device.objects.create(
+            name='tablet',
+            token='b652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b502610b6',
+            sip_user_id='123456789',
+            last_seen=datetime.now() - timedelta(hours=1),
+            app=android_app,
+        )
+        self.call_data = {
+            'sip_user_id': '123456789',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+        }
+
+        # Forget the response of an earlier test for the same call_id.
+        RedisClusterCache().client.delete(get_call_leader_key(self.call_data['call_id']))
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_first_device_answers(self, *mocks):
+        """
+        Test that all devices of the sip_user_id are called and the device
+        that accepts first gets the call.
+        """
+        thread = ThreadWithReturn(target=self.client.post, args=(self.incoming_url, self.call_data))
+        thread.start()
+
+        # The tablet, the least recently seen device, responds.
+        time.sleep(.5)
+        app_data = {
+            'unique_key': get_group_member_key(self.call_data['call_id'], 1),
+            'message_start_time': time.time(),
+        }
+        app_response = self.client.post(self.response_url, app_data)
+        response = thread.join()
+        # Wait for the cancel push.
+        time.sleep(.1)
+
+        self.assertEqual(app_response.status_code, 202)
+        self.assertEqual(response.content, b'status=ACK')
+        pushes = sorted((call[0][0].name, call[0][2]) for call in mocks[0].call_args_list)
+        self.assertEqual(pushes, [('phone', 'call'), ('phone', 'cancel'), ('tablet', 'call')])
+        cancel_response = self.client.post('/api/cancel-call/', {'call_id': self.call_data['call_id']})
+        self.assertEqual(cancel_response.status_code, 404)
+
+    @mock.patch('api.views.record_call_outcome')
+    @mock.patch('api.views.get_call_policy', return_value=CallPolicy(1, .5, 1, SOURCE_DEVICE))
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_history_per_device(self, *mocks):
+        """
+        Test that the timing comes from the history of every device and the
+        outcome is recorded in the history of the device.
+        """
+        thread = ThreadWithReturn(target=self.client.post, args=(self.incoming_url, self.call_data))
+        thread.start()
+
+        time.sleep(.2)
+        app_data = {
+            'unique_key': get_group_member_key(self.call_data['call_id'], 0),
+            'message_start_time': time.time(),
+        }
+        self.client.post(self.response_url, app_data)
+        thread.join()
+
+        self.assertEqual(
+            sorted(call[0][1].id for call in mocks[1].call_args_list), sorted([self.phone.id, self.tablet.id]))
+        self.assertEqual(
+            [call[0][1:] for call in mocks[2].call_args_list],
+            [('apns', self.phone.id, True)],
+        )
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_cancelled_call(self, *mocks):
+        """
+        Test that a cancel by the call_id stops the calls to all devices.
+        """
+        start = time.time()
+        thread = ThreadWithReturn(target=self.client.post, args=(self.incoming_url, self.call_data))
+        thread.start()
+
+        time.sleep(.5)
+        cancel_response = self.client.post('/api/cancel-call/', {'call_id': self.call_data['call_id']})
+        response = thread.join()
+        run_time = time.time() - start
+        # Wait for the cancel pushes.
+        time.sleep(.1)
+
+        self.assertEqual(cancel_response.status_code, 202)
+        self.assertEqual(response.content, b'status=NAK')
+        self.assertLess(run_time, 1)
+        pushes = sorted((call[0][0].name, call[0][2]) for call in mocks[0].call_args_list)
+        self.assertEqual(pushes, [('phone', 'call'), ('phone', 'cancel'), ('tablet', 'call'), ('tablet', 'cancel')])
+
+
+class RingGroupCallTest(TransactionTestCase):
+
+    def setUp(self):
+        super(RingGroupCallTest, self).setUp()
+        self.client = APIClient()
+
+        # URL's.
+        self.response_url = '/api/call-response/'
+        self.ring_group_url = '/api/ring-group-call/'
+
+        self.ios_app, created = App.objects.get_or_create(platform='apns', app_id='com.voipgrid.vialer')
+        for sip_user_id in ['123456789', '234567891', '345678912']:
+            Device.objects.create(
+                name='test device',
+                token='a652aee84bdec6c2859eec89a6e5b1a42c400fba43070f404148f27b50261{0}'.format(sip_user_id[:3]),
+                sip_user_id=sip_user_id,
+                app=self.ios_app,
+            )
+
+        # Forget the response of an earlier test for the same call_id.
+        RedisClusterCache().client.delete(get_call_leader_key('group_sduiqayduiryqwuioeryqwer76789'))
+
+    @mock.patch('app.push.send_push_message', side_effect=mocked_send_push_message)
+    def test_first_member_answers(self, *mocks):
+        """
+        Test that the first member that accepts gets the call and the other
+        members are cancelled.
+        """
+        call_data = {
+            'sip_user_ids': '123456789,234567891,345678912,456789123',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+            'call_id': 'sduiqayduiryqwuioeryqwer76789',
+        }
+
+        thread = ThreadWithReturn(target=self.client.post, args=(self.ring_group_url, call_data))
+        thread.start()
+
+        # Simulate some wait-time before a member responds.
+        time.sleep(.5)
+        app_data = {
+            'unique_key': get_group_member_key(call_data['call_id'], 1),
+            'message_start_time': time.time(),
+        }
+        self.client.post(self.response_url, app_data)
+        response = thread.join()
+        # Wait for the cancel pushes.
+        time.sleep(.1)
+
+        self.assertEqual(response.content, b'status=ACK&sip_user_ids=234567891')
+        pushes = sorted((call[0][0].sip_user_id, call[0][2]) for call in mocks[0].call_args_list)
+        self.assertEqual(pushes, [
+            ('123456789', 'call'),
+            ('123456789', 'cancel'),
+            ('234567891', 'call'),
+            ('345678912', 'call'),
+            ('345678912', 'cancel'),
+        ])
+
+    def test_invalid_sip_user_ids(self):
+        """
+        Test that a ring group needs valid sip_user_ids.
+        """
+        call_data = {
+            'sip_user_ids': '123456789,abc',
+            'caller_id': 'Test name',
+            'phonenumber': '0123456789',
+        }
+
+        response = self.client.post(self.ring_group_url, call_data)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class PushReceivedTest(TestCase):
+
+    def setUp(self):
+        super(PushReceivedTest, self).setUp()
+        self.client = APIClient()
+        self.push_received_url = '/api/push-received/'
+        self.unique_key = 'sduiqayduiryqwuioeryqwer76789'
+
+        self.redis_cache = RedisClusterCache()
+        self.redis_cache.client.delete(VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY)
+
+    def tearDown(self):
+        super(PushReceivedTest, self).tearDown()
+        self.redis_cache.client.delete(VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY, get_call_cache_key(self.unique_key))
+
+    def test_push_received(self):
+        """
+        Test that a received push is recorded once per attempt.
+        """
+        start_call(self.redis_cache, self.unique_key, 'apns')
+        record_call_attempt(self.redis_cache, self.unique_key)
+
+        data = {
+            'unique_key': self.unique_key,
+            'attempt': 2,
+        }
+        response = self.client.post(self.push_received_url, data)
+        self.assertEqual(response.status_code, 202)
+
+        # A retried request is accepted but not counted again.
+        response = self.client.post(self.push_received_url, data)
+        self.assertEqual(response.status_code, 202)
+
+        value_list = self.redis_cache.client.lrange(VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY, 0, -1)
+        self.assertEqual(len(value_list), 1)
+        value_dict = literal_eval(value_list[0])
+        self.assertEqual(value_dict[OS_KEY], 'apns')
+        self.assertEqual(value_dict[ATTEMPT_KEY], 2)
+        self.assertTrue(value_dict[FIRST_KEY])
+        self.assertLess(value_dict[LATENCY_KEY], 1)
+
+    def test_unknown_call(self):
+        """
+        Test that a push of an unknown call or attempt is not found.
+        """
+        data = {
+            'unique_key': self.unique_key,
+            'attempt': 1,
+        }
+        response = self.client.post(self.push_received_url, data)
+        self.assertEqual(response.status_code, 404)
+
+        start_call(self.redis_cache, self.unique_key, 'apns')
+        data['attempt'] = 2
+        response = self.client.post(self.push_received_url, data)
+        self.assertEqual(response.status_code, 404)
+
+        data['attempt'] = 0
+        response = self.client.post(self.push_received_url, data)
+        self.assertEqual(response.status_code, 400)
+
+
 class HangupReasonTest(TestCase):
     def setUp(self):
         """
@@ -667,6 +1248,28 @@ class HangupReasonTest(TestCase):
             ),
         )
 
+    @mock.patch('api.views.get_cached_device')
+    def test_sip_user_id_without_device(self, mock_get_cached_device):
+        """
+        Test that a sip_user_id the filter knows has no device is not found
+        without a lookup.
+        """
+        # Other tests may have registered a device for the sip_user_id.
+        shard, offset = get_position('987654321')
+        redis_cache = RedisClusterCache()
+        redis_cache.client.setbit(FILTER_KEY.format(shard), offset, 0)
+        self.assertEqual(sip_user_filter.contains('987654321'), ABSENT)
+
+        self.data['reason'] = 'Device did not now answer'
+        self.data['sip_user_id'] = '987654321'
+        try:
+            response = self.client.post(self.hangup_reason_url, self.data)
+        finally:
+            redis_cache.client.delete(FILTER_KEY.format(shard))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(mock_get_cached_device.called)
+
 
 class LogMetricsTest(TestCase):
     def setUp(self):
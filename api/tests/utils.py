@@ -1,17 +1,15 @@
 from threading import Thread
+from urllib.parse import urlencode
 
 from django.core.cache import cache
 
 
-def mocked_send_apns_message(device, app, message_type, data=None):
+def mocked_send_push_message(device, app, message_type, data=None):
+    """
+    Record the attempt of a push instead of sending it.
+    """
     cache.set('attempts', data.get('attempt', 1), 300)
-    print('WORKED APNS')
-    print(data.get('attempt', 1))
-
-
-def mocked_send_fcm_message(device, app, message_type, data=None):
-    cache.set('attempts', data.get('attempt', 1), 300)
-    print('WORKED FCM')
+    print('WORKED {0}'.format(app.platform.upper()))
     print(data.get('attempt', 1))
 
 
@@ -29,3 +27,29 @@ class ThreadWithReturn(Thread):
         super(ThreadWithReturn, self).join(*args, **kwargs)
 
         return self._return
+
+
+async def asgi_post(application, path, data):
+    """
+    Post form data to an ASGI application.
+
+    Returns:
+        tuple: The status code and body of the response.
+    """
+    scope = {
+        'type': 'http',
+        'method': 'POST',
+        'path': path,
+        'headers': [(b'content-type', b'application/x-www-form-urlencoded')],
+    }
+    messages = [{'type': 'http.request', 'body': urlencode(data).encode('utf-8'), 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from copy import copy
 import datetime
 import logging
 import random
@@ -9,15 +10,74 @@ from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from rest_framework import views
+from rest_framework.authentication import BasicAuthentication
 from rest_framework.exceptions import ParseError
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.status import (HTTP_200_OK, HTTP_201_CREATED,
-                                   HTTP_202_ACCEPTED, HTTP_404_NOT_FOUND)
+                                   HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST,
+                                   HTTP_404_NOT_FOUND, HTTP_503_SERVICE_UNAVAILABLE)
 
 from api.utils import get_metrics_base_data
-from app.cache import RedisClusterCache
+from app.admission import admission_control, AdmissionRejected
+from app.bulk_notify import BulkNotification
+from app.cache import get_redis_cache
+from app.call_coalescing import call_coalescer, ROLE_LEADER, ROLE_LOCAL
+from app.call_timeline import (
+    call_timelines,
+    PHASE_APP_RESPONDED,
+    PHASE_DEVICE_RESOLVED,
+    PHASE_PUSH_ENQUEUED)
+from app.calls import (
+    CALL_OUTCOMES,
+    cancel_call,
+    get_call_waiter,
+    get_group_call_key,
+    GroupCallWaiter,
+    record_call_attempt,
+    record_call_attempts,
+    record_push_received,
+    set_call_response,
+    start_call,
+    start_calls,
+    STATE_DEVICE_ID,
+    STATE_PLATFORM,
+    STATE_SIP_USER_ID)
+from app.devices import get_cached_device, get_cached_devices
+from app.incoming_call import (
+    ACK,
+    CallSchedule,
+    find_call_devices,
+    find_cancel_device,
+    get_coalesced_metrics,
+    get_filtered_call_result,
+    GroupCall,
+    log_call_cancelled,
+    log_call_outcome,
+    log_call_received,
+    log_call_response,
+    log_call_shed,
+    log_call_timed_out,
+    log_device_lookup_failed,
+    log_duplicate_call,
+    log_no_device,
+    log_push_received,
+    log_wait_started,
+    NAK,
+    RESPONDED_OUTCOMES)
 from app.models import App, Device
-from app.tasks import log_to_db, task_incoming_call_notify, task_notify_old_token
+from app.response_policy import (
+    combine_call_policies,
+    get_call_policy,
+    record_call_outcome,
+    record_call_roundtrip)
+from app.sip_user_filter import ABSENT, sip_user_filter
+from app.tasks import (
+    log_to_db,
+    task_bulk_notify,
+    task_cancelled_call_notify,
+    task_incoming_call_notify,
+    task_notify_old_token)
 from app.utils import (
     LOG_CALL_FROM,
     LOG_CALLER_ID,
@@ -28,7 +88,6 @@ from main.prometheus.consts import (
     ACTION_KEY,
     CALL_SETUP_SUCCESSFUL_KEY,
     CODEC_KEY,
-    DIRECTION_KEY,
     FAILED_REASON_KEY,
     HANGUP_REASON_KEY,
     MOS_KEY,
@@ -36,25 +95,38 @@ from main.prometheus.consts import (
     VIALER_CALL_FAILURE_TOTAL_KEY,
     VIALER_CALL_SUCCESS_TOTAL_KEY,
     VIALER_HANGUP_REASON_TOTAL_KEY,
-    VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY,
-    VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY,
-    VIALER_MIDDLEWARE_INCOMING_VALUE,
-    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY,
-    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY)
+    VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY)
 
 from .authentication import VoipgridAuthentication
 from .renderers import PlainTextRenderer
 from .serializers import (
+    BulkNotifySerializer,
     CallResponseSerializer,
+    CancelCallSerializer,
+    CheckInSerializer,
     DeleteDeviceSerializer,
     DeviceSerializer,
     HangupReasonSerializer,
     IncomingCallSerializer,
-    SipUserIdSerializer)
+    PushReceivedSerializer,
+    RingGroupCallSerializer)
 
 logger = logging.getLogger('django')
 
 
+def push_metrics(redis_cache, metrics):
+    """
+    Function to push the metrics of the incoming call flow to Redis for the
+    Prometheus process.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache to push the metrics to.
+        metrics (list): The key and the data per metric.
+    """
+    for key, metric_data in metrics:
+        redis_cache.client.rpush(key, metric_data)
+
+
 class VialerAPIView(views.APIView):
     """
     Super class that provides a few handy methods that are used in most of
@@ -125,6 +197,8 @@ class IncomingCallView(VialerAPIView):
     """
     serializer_class = IncomingCallSerializer
     renderer_classes = (PlainTextRenderer, )
+    # Prefix of the call_id for coalescing the duplicate requests.
+    coalescing_prefix = ''
 
     def post(self, request):
         """
@@ -139,257 +213,351 @@ class IncomingCallView(VialerAPIView):
         Raises:
             Http404: When an app_id is provided that does not exist.
         """
-        redis_cache = RedisClusterCache()
+        received_at = time.time()
+        redis_cache = get_redis_cache()
         serialized_data = self._serialize_request(request)
-
-        sip_user_id = serialized_data['sip_user_id']
-        caller_id = serialized_data['caller_id']
-        phonenumber = serialized_data['phonenumber']
         call_id = serialized_data['call_id']
 
         if not call_id:
             # Generate unique_key for reference on incoming call answer.
             unique_key = random.getrandbits(128)
             unique_key = '%032x' % unique_key
-        else:
-            unique_key = call_id
+            return self._handle_timed_call(redis_cache, serialized_data, unique_key, received_at)
+
+        # Requests for a call_id that is already handled get its response.
+        call, role = call_coalescer.join(redis_cache, self.coalescing_prefix + call_id)
+        if role == ROLE_LEADER:
+            response_data = NAK
+            try:
+                response = self._handle_timed_call(redis_cache, serialized_data, call_id, received_at)
+                response_data = response.data
+            finally:
+                call_coalescer.finish(redis_cache, call, response_data)
+            return response
+
+        log_duplicate_call(call_id)
+        response_data = call_coalescer.follow(redis_cache, call, role)
+        push_metrics(redis_cache, get_coalesced_metrics(role == ROLE_LOCAL))
+        return Response(response_data)
+
+    def _handle_timed_call(self, redis_cache, serialized_data, unique_key, received_at):
+        """
+        Function to handle a call and record how long each phase of its
+        setup took.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache the call state is
+                stored in.
+            serialized_data (dict): The validated post data.
+            unique_key (string): The unique_key of the call.
+            received_at (float): The time the request was received.
 
+        Returns:
+            Response: The response of _handle_call.
+        """
+        call_timelines.start(unique_key, received_at)
+        result = 'NAK'
         try:
-            # Check if there is a registered device for given sip_user_id.
-            device = get_object_or_404(Device, sip_user_id=sip_user_id)
-        except Http404:
-            log_middleware_information(
-                '{0} | Failed to find a device for SIP_user_ID : {1} sending NAK',
-                OrderedDict([
-                    ('unique_key', unique_key),
-                    (LOG_SIP_USER_ID, sip_user_id),
-                ]),
-                logging.WARNING,
-            )
+            response = self._handle_call(redis_cache, serialized_data, unique_key)
+            if response.data.startswith(ACK):
+                result = 'ACK'
+            return response
+        finally:
+            # A ring group call is logged for all its members.
+            sip_user_id = serialized_data.get('sip_user_id') or ','.join(
+                str(sip_user_id) for sip_user_id in serialized_data['sip_user_ids'])
+            call_timelines.finish(redis_cache, unique_key, result, sip_user_id)
+
+    def _handle_call(self, redis_cache, serialized_data, unique_key):
+        """
+        Function to send the pushes of a call and wait for the app.
 
-            # Push data to Redis for when a sip user id couldn't be found.
-            redis_cache.client.rpush(
-                VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY,
-                {
-                    OS_KEY: 'Middleware',
-                    ACTION_KEY: 'Received',
-                    FAILED_REASON_KEY: 'failed no sip_user_id',
-                }
-            )
+        Args:
+            redis_cache (RedisClusterCache): The cache the call state is
+                stored in.
+            serialized_data (dict): The validated post data.
+            unique_key (string): The unique_key of the call.
 
-            # Log to the metrics file.
-            metrics_data = {
-                OS_KEY: 'Middleware',
-                ACTION_KEY: 'Received',
-                FAILED_REASON_KEY: 'failed no sip_user_id',
-                'unique_key': unique_key,
-            }
-            log_data_to_metrics_log(metrics_data, sip_user_id)
+        Returns:
+            Response: With status=ACK or status=NAK based on succes or failure.
+        """
+        sip_user_id = serialized_data['sip_user_id']
+        caller_id = serialized_data['caller_id']
+        phonenumber = serialized_data['phonenumber']
+
+        try:
+            # Check if there are registered devices for given sip_user_id.
+            devices = find_call_devices(sip_user_id)
+        except Device.DoesNotExist:
+            result = log_no_device(unique_key, sip_user_id)
         except Exception:
-            log_middleware_information(
-                '{0} | EXCEPTION WHILE FINDING DEVICE FOR SIP_USER_ID : {1}',
-                OrderedDict([
-                    ('unique_key', unique_key),
-                    (LOG_SIP_USER_ID, sip_user_id),
-                ]),
-                logging.CRITICAL,
-            )
+            result = log_device_lookup_failed(unique_key, sip_user_id)
         else:
-            log_middleware_information(
-                '{0} | Incoming call for SIP:{1} FROM:\'{2}/{3}\'',
-                OrderedDict([
-                    ('unique_key', unique_key),
-                    (LOG_SIP_USER_ID, sip_user_id),
-                    (LOG_CALL_FROM, phonenumber),
-                    (LOG_CALLER_ID, caller_id),
-                ]),
-                logging.INFO,
-                device=device,
-            )
+            if devices is None:
+                # Answer calls for sip_user_ids without a device without a
+                # lookup.
+                result = get_filtered_call_result()
+            else:
+                device = devices[0]
+                call_timelines.mark(unique_key, PHASE_DEVICE_RESOLVED, platform=device.app.platform)
+                push_metrics(
+                    redis_cache, log_call_received(unique_key, sip_user_id, device, phonenumber, caller_id))
 
-            # Push data to Redis for when a incoming call is received.
-            redis_cache.client.rpush(
-                VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY,
-                {
-                    OS_KEY: 'Middleware',
-                    ACTION_KEY: 'Received',
-                }
-            )
+                if len(devices) > 1:
+                    # Call all devices of the sip_user_id, the first one
+                    # that accepts gets the call.
+                    if self._call_devices(redis_cache, unique_key, devices, phonenumber, caller_id):
+                        return Response(ACK)
+                    return Response(NAK)
 
-            # Log to the metrics file.
-            metrics_data = {
-                OS_KEY: 'Middleware',
-                ACTION_KEY: 'Received',
-                'unique_key': unique_key,
-            }
-            log_data_to_metrics_log(metrics_data, sip_user_id)
+                result = self._call_device(redis_cache, unique_key, sip_user_id, device, phonenumber, caller_id)
+
+        push_metrics(redis_cache, result.metrics)
+        return Response(result.response)
+
+    def _call_device(self, redis_cache, unique_key, sip_user_id, device, phonenumber, caller_id):
+        """
+        Function to send the pushes to a device and wait for its app.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache the call state is
+                stored in.
+            unique_key (string): The unique_key of the call.
+            sip_user_id (string): The sip_user_id that is called.
+            device (Device): The device to call.
+            phonenumber (string): Phonenumber of the caller.
+            caller_id (string): Human readable caller id.
+
+        Returns:
+            CallResult: The answer for asterisk and the metrics.
+        """
+        # Time related settings, from the response history of the device in
+        # 'adaptive' mode.
+        schedule = CallSchedule(get_call_policy(redis_cache, device))
+
+        # Shed the call right away when too many calls are waiting.
+        try:
+            slot = admission_control.acquire(redis_cache, device.app_id, schedule.policy.wait)
+        except AdmissionRejected as ex:
+            return log_call_shed(unique_key, sip_user_id, device, ex.reason)
+
+        # The slot is released when opening the waiter fails too.
+        waiter = None
+        try:
+            # Start listening for the response before the first push is sent.
+            waiter = get_call_waiter(redis_cache, unique_key)
+
+            # Create the call state with the device platform, the app
+            # response is stored in the same record.
+            start_call(
+                redis_cache, unique_key, device.app.platform, device.sip_user_id, schedule.policy.wait, device.id)
 
-            attempt = 1
             # Send push message to wake up app.
-            task_incoming_call_notify(
-                device,
-                unique_key,
-                phonenumber,
-                caller_id,
-                attempt,
-            )
+            call_timelines.mark(unique_key, PHASE_PUSH_ENQUEUED)
+            task_incoming_call_notify(device, unique_key, phonenumber, caller_id, schedule.attempt)
+            log_wait_started(unique_key, device, schedule)
+
+            # We have to wait till the app responds and sets the cache value.
+            while schedule.is_waiting():
+                available = waiter.wait(schedule.get_timeout())
+                if available in RESPONDED_OUTCOMES:
+                    call_timelines.mark(unique_key, PHASE_APP_RESPONDED)
+                    record_call_outcome(redis_cache, device.app.platform, device.id, True)
+                if available in CALL_OUTCOMES:
+                    return log_call_outcome(unique_key, sip_user_id, device, available, schedule.wait_until)
+
+                # Resend the push message every X seconds until the
+                # max_attempts.
+                attempt = schedule.next_attempt()
+                if attempt is not None:
+                    record_call_attempt(redis_cache, unique_key)
+                    task_incoming_call_notify(device, unique_key, phonenumber, caller_id, attempt)
+        finally:
+            if waiter is not None:
+                waiter.close()
+            admission_control.release(redis_cache, slot)
+
+        record_call_outcome(redis_cache, device.app.platform, device.id, False)
+        return log_call_timed_out(unique_key, sip_user_id, device)
+
+    def _call_devices(self, redis_cache, unique_key, devices, phonenumber, caller_id):
+        """
+        Function to send the pushes to several devices at once and wait for
+        the first app that accepts the call. The other devices are
+        cancelled. The call is cancelled by its call_id like a call to one
+        device.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache the call state is
+                stored in.
+            unique_key (string): The unique_key of the call.
+            devices (list): The devices to call.
+            phonenumber (string): Phonenumber of the caller.
+            caller_id (string): Human readable caller id.
+
+        Returns:
+            list: The devices that accepted the call, empty when none
+                accepted in time.
+        """
+        group_call = GroupCall(unique_key, devices)
+        call_timelines.add_keys(unique_key, group_call.member_keys)
+
+        # The devices share one wait loop, timed for all their histories.
+        schedule = CallSchedule(combine_call_policies([get_call_policy(redis_cache, device) for device in devices]))
 
-            # Time related settings.
-            wait_interval = settings.APP_PUSH_ROUNDTRIP_WAIT / 1000
-            wait_until = time.time() + wait_interval
-            resend_interval = settings.APP_PUSH_RESEND_INTERVAL / 1000
-            next_resend_time = time.time() + resend_interval
+        # The call holds one slot like a call to one device.
+        try:
+            slot = admission_control.acquire(redis_cache, devices[0].app_id, schedule.policy.wait)
+        except AdmissionRejected as ex:
+            push_metrics(redis_cache, group_call.log_shed(ex.reason))
+            return []
+
+        waiter = None
+        try:
+            # Start listening for the responses before the first pushes are
+            # sent.
+            waiter = GroupCallWaiter(redis_cache, list(group_call.members))
+            start_calls(redis_cache, group_call.members, schedule.policy.wait)
+
+            call_timelines.mark(unique_key, PHASE_PUSH_ENQUEUED)
+            for member_key in group_call.member_keys:
+                task_incoming_call_notify(
+                    group_call.members[member_key], member_key, phonenumber, caller_id, schedule.attempt)
+            group_call.log_wait_started(schedule)
+
+            while schedule.is_waiting():
+                if group_call.update(waiter.wait(schedule.get_timeout())):
+                    call_timelines.mark(unique_key, PHASE_APP_RESPONDED)
+                if group_call.is_done():
+                    break
+
+                # Resend the pushes to the devices that did not respond.
+                attempt = schedule.next_attempt()
+                if attempt is not None:
+                    pending_keys = group_call.get_pending_keys()
+                    record_call_attempts(redis_cache, pending_keys)
+                    for member_key in pending_keys:
+                        task_incoming_call_notify(
+                            group_call.members[member_key], member_key, phonenumber, caller_id, attempt)
+        finally:
+            if waiter is not None:
+                waiter.close()
+            admission_control.release(redis_cache, slot)
+
+        for device, responded in group_call.get_responses(not schedule.is_waiting()):
+            record_call_outcome(redis_cache, device.app.platform, device.id, responded)
+
+        # Later cancels of the call find it ended.
+        outcome = group_call.get_outcome()
+        if outcome is not None:
+            set_call_response(redis_cache, group_call.group_key, outcome)
+
+        # Let the other devices stop setting up the call.
+        for member_key in group_call.get_pending_keys():
+            if cancel_call(redis_cache, member_key) is not None:
+                task_cancelled_call_notify(group_call.members[member_key], member_key)
+
+        push_metrics(redis_cache, group_call.log_result(schedule.wait_until))
+        return group_call.get_available()
+
+
+class RingGroupCallView(IncomingCallView):
+    """
+    View for asterisk to initiate a incoming call for all members of a ring
+    group in one request.
+    """
+    serializer_class = RingGroupCallSerializer
+    coalescing_prefix = 'group_'
+
+    def _handle_call(self, redis_cache, serialized_data, unique_key):
+        """
+        Function to send the pushes to the devices of all members at once
+        and wait for the first app that accepts the call.
 
-            # Determine max possible attempts. Avoid sending a push
-            # close to the end of the loop.
-            max_attemps = int(wait_interval / resend_interval) - 1
+        Args:
+            redis_cache (RedisClusterCache): The cache the call state is
+                stored in.
+            serialized_data (dict): The validated post data.
+            unique_key (string): The unique_key of the call.
 
-            cache_key = 'call_{0}'.format(unique_key)
-            # Create cache entry with device platform as placeholder for the
-            # available flag. Done for logging purposes.
-            redis_cache.set(cache_key, device.app.platform)
+        Returns:
+            Response: With status=ACK&sip_user_ids=<members> listing the
+                members that accepted the call or status=NAK.
+        """
+        sip_user_ids = [
+            sip_user_id for sip_user_id in serialized_data['sip_user_ids']
+            if sip_user_filter.contains(sip_user_id) != ABSENT
+        ]
+        caller_id = serialized_data['caller_id']
+        phonenumber = serialized_data['phonenumber']
 
+        try:
+            # One lookup for the devices of all members.
+            devices = get_cached_devices(sip_user_ids)
+        except Exception:
             log_middleware_information(
-                '{0} | {1} Starting \'wait for it\' loop until {2} ({3}msec)',
+                '{0} | EXCEPTION WHILE FINDING DEVICES FOR SIP_USER_IDS : {1}',
                 OrderedDict([
                     ('unique_key', unique_key),
-                    ('platform', device.app.platform.upper()),
-                    ('wait_until', datetime.datetime.fromtimestamp(wait_until).strftime('%H:%M:%S.%f')),
-                    ('roundtrip', settings.APP_PUSH_ROUNDTRIP_WAIT),
+                    ('sip_user_ids', sip_user_ids),
                 ]),
-                logging.INFO,
-                device=device,
+                logging.CRITICAL,
             )
+            return Response(NAK)
 
-            # We have to wait till the app responds and sets the cache value.
-            while time.time() < wait_until:
-                available = redis_cache.get(cache_key)
-                # Get on an empty key returns None so we need to check for
-                # True and False.
-                if available == 'True':
-                    log_middleware_information(
-                        '{0} | {1} Device checked in on time, sending ACK on {2}',
-                        OrderedDict([
-                            ('unique_key', unique_key),
-                            ('platform', device.app.platform.upper()),
-                            ('ack_time', datetime.datetime.fromtimestamp(time.time()).strftime('%H:%M:%S.%f')),
-                        ]),
-                        logging.INFO,
-                        device=device,
-                    )
-
-                    # Push data to Redis for when a device successful
-                    # responded to the middleware.
-                    redis_cache.client.rpush(
-                        VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY,
-                        {
-                            OS_KEY: device.app.platform,
-                            DIRECTION_KEY: VIALER_MIDDLEWARE_INCOMING_VALUE,
-                        }
-                    )
-
-                    # Log to the metrics file.
-                    metrics_data = {
-                        OS_KEY: device.app.platform,
-                        CALL_SETUP_SUCCESSFUL_KEY: 'true',
-                    }
-                    log_data_to_metrics_log(metrics_data, sip_user_id)
-
-                    # Success status for asterisk.
-                    return Response('status=ACK')
-                elif available == 'False':
-                    log_middleware_information(
-                        '{0} | {1} Device not available, sending NAK on {2}',
-                        OrderedDict([
-                            ('unique_key', unique_key),
-                            ('platform', device.app.platform.upper()),
-                            ('nak_time', datetime.datetime.fromtimestamp(time.time()).strftime('%H:%M:%S.%f')),
-                        ]),
-                        logging.INFO,
-                        device=device,
-                    )
-
-                    # Push data to Redis for when a device responded as not
-                    # available to the middleware.
-                    redis_cache.client.rpush(
-                        VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY,
-                        {
-                            OS_KEY: device.app.platform,
-                            DIRECTION_KEY: VIALER_MIDDLEWARE_INCOMING_VALUE,
-                            FAILED_REASON_KEY: 'Device not available',
-                        }
-                    )
-
-                    # Log to the metrics file.
-                    metrics_data = {
-                        OS_KEY: device.app.platform,
-                        CALL_SETUP_SUCCESSFUL_KEY: 'false',
-                        FAILED_REASON_KEY: 'Device not available',
-                    }
-                    log_data_to_metrics_log(metrics_data, sip_user_id)
-
-                    # App is not available.
-                    return Response('status=NAK')
-                elif available == 'Removed':
-                    log_middleware_information(
-                        '{0} | {1} Device has no valid push token, sending NAK on {2}',
-                        OrderedDict([
-                            ('unique_key', unique_key),
-                            ('platform', device.app.platform.upper()),
-                            ('nak_time', datetime.datetime.fromtimestamp(time.time()).strftime('%H:%M:%S.%f')),
-                        ]),
-                        logging.INFO,
-                        device=device,
-                    )
-
-                    return Response('status=NAK')
-                else:
-                    # Try to resend the push message every X seconds or
-                    # after exceeding the max_attempts.
-                    if time.time() > next_resend_time and attempt < max_attemps:
-                        attempt += 1
-                        next_resend_time = time.time() + resend_interval
-                        task_incoming_call_notify(
-                            device,
-                            unique_key,
-                            phonenumber,
-                            caller_id,
-                            attempt,
-                        )
-
-                    time.sleep(.01)  # wait 10 ms
-
+        if not devices:
             log_middleware_information(
-                '{0} | {1} Device did NOT check in on time, sending NAK on {2}',
+                '{0} | Failed to find a device for the ring group SIP_user_IDs : {1} sending NAK',
                 OrderedDict([
                     ('unique_key', unique_key),
-                    ('platform', device.app.platform.upper()),
-                    ('nak_time', datetime.datetime.fromtimestamp(time.time()).strftime('%H:%M:%S.%f')),
+                    ('sip_user_ids', serialized_data['sip_user_ids']),
                 ]),
-                logging.INFO,
-                device=device,
+                logging.WARNING,
             )
+            result = get_filtered_call_result()
+            push_metrics(redis_cache, result.metrics)
+            return Response(result.response)
+
+        call_timelines.mark(
+            unique_key,
+            PHASE_DEVICE_RESOLVED,
+            platform=next(iter(devices.values()))[0].app.platform,
+        )
+        log_middleware_information(
+            '{0} | Incoming ring group call for SIP:{1} FROM:\'{2}/{3}\'',
+            OrderedDict([
+                ('unique_key', unique_key),
+                ('sip_user_ids', list(devices)),
+                (LOG_CALL_FROM, phonenumber),
+                (LOG_CALLER_ID, caller_id),
+            ]),
+            logging.INFO,
+        )
 
-            # Push data to Redis for when a device has not responded to the middleware.
-            redis_cache.client.rpush(
-                VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY,
-                {
-                    OS_KEY: device.app.platform,
-                    DIRECTION_KEY: VIALER_MIDDLEWARE_INCOMING_VALUE,
-                    FAILED_REASON_KEY: 'Unable to get response from phone',
-                }
-            )
+        # Push data to Redis for when a incoming call is received.
+        redis_cache.client.rpush(
+            VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY,
+            {
+                OS_KEY: 'Middleware',
+                ACTION_KEY: 'Received',
+            },
+        )
 
-            # Log to the metrics file.
-            metrics_data = {
-                OS_KEY: device.app.platform,
-                CALL_SETUP_SUCCESSFUL_KEY: 'false',
-                FAILED_REASON_KEY: 'Device did not respond in time',
-            }
-            log_data_to_metrics_log(metrics_data, sip_user_id)
+        available = self._call_devices(
+            redis_cache,
+            unique_key,
+            [
+                device for account_devices in devices.values()
+                for device in account_devices[:settings.MAX_DEVICES_PER_SIP_USER_ID]
+            ],
+            phonenumber,
+            caller_id,
+        )
+        if not available:
+            return Response(NAK)
 
-        # Failed status for asterisk.
-        return Response('status=NAK')
+        sip_user_ids = list(OrderedDict.fromkeys(device.sip_user_id for device in available))
+        return Response('{0}&sip_user_ids={1}'.format(ACK, ','.join(sip_user_ids)))
 
 
 class CallResponseView(VialerAPIView):
@@ -413,39 +581,105 @@ class CallResponseView(VialerAPIView):
         message_start_time = serialized_data['message_start_time']
         available = serialized_data['available']
 
-        cache_key = 'call_{0}'.format(unique_key)
+        redis_cache = get_redis_cache()
 
-        redis_cache = RedisClusterCache()
+        # Store the outcome and wake up the waiting incoming call.
+        call_state, handed_off = set_call_response(redis_cache, unique_key, str(available))
 
-        # Check if key exists to avoid endpoint probing spam.
-        if not redis_cache.exists(cache_key):
+        # Check if the call exists to avoid endpoint probing spam.
+        if call_state is None:
             return Response('', status=HTTP_404_NOT_FOUND)
 
-        # Wait loop for asterisk sets the device platform as placeholder
-        # for the available flag.
-        platform = redis_cache.get(cache_key)
+        result = log_call_response(unique_key, message_start_time, call_state, handed_off)
+        push_metrics(redis_cache, result.metrics)
+        if result.responded:
+            record_call_roundtrip(
+                redis_cache, call_state[STATE_PLATFORM], call_state[STATE_DEVICE_ID], result.roundtrip)
 
-        redis_cache.set(cache_key, available)
+        # Threaded task to log information to the database.
+        log_to_db(call_state[STATE_PLATFORM], result.roundtrip, available, call_state[STATE_SIP_USER_ID])
 
-        roundtrip = time.time() - float(message_start_time)
+        return Response('', status=result.status)
 
-        log_middleware_information(
-            '{0} | Device responded. Message start-time: {1} sec, round trip-time: {2} sec',
-            OrderedDict([
-                ('unique_key', unique_key),
-                ('starttime', datetime.datetime.fromtimestamp(message_start_time)),
-                ('roundtrip', roundtrip),
-            ]),
-            logging.INFO,
-        )
 
-        # Threaded task to log information to the database.
-        log_to_db(platform, roundtrip, available)
+class PushReceivedView(VialerAPIView):
+    """
+    View called by the app the moment a call push arrives, before it wakes
+    up and registers.
+    """
+    serializer_class = PushReceivedSerializer
+
+    def post(self, request):
+        """
+        Handle the post request of this view.
+
+        Args:
+            request (Request): Containing the post data.
+
+        Returns:
+            Response: 202 when the receipt was recorded, 404 when the call or
+                attempt is unknown.
+        """
+        serialized_data = self._serialize_request(request)
+        unique_key = serialized_data['unique_key']
+        attempt = serialized_data['attempt']
+
+        redis_cache = get_redis_cache()
+
+        # Only Redis is touched, the app is still starting up.
+        receipt = record_push_received(redis_cache, unique_key, attempt)
+
+        # Check if the call exists to avoid endpoint probing spam.
+        if receipt is None:
+            return Response('', status=HTTP_404_NOT_FOUND)
+
+        push_metrics(redis_cache, log_push_received(unique_key, attempt, receipt))
+        return Response('', status=HTTP_202_ACCEPTED)
+
+
+class CancelCallView(VialerAPIView):
+    """
+    View for asterisk to cancel a incoming call that waits for the app, when
+    the caller hung up or another phone answered.
+    """
+    serializer_class = CancelCallSerializer
+    renderer_classes = (PlainTextRenderer, )
+
+    def post(self, request):
+        """
+        Handle the post request of this view.
 
-        # If device responded too late return 404 request (call) not found.
-        if (roundtrip > (settings.APP_PUSH_ROUNDTRIP_WAIT / 1000)):
+        Args:
+            request (Request): Containing the post data.
+
+        Returns:
+            Response: 202 when the call was cancelled, 404 when the call is
+                unknown or already ended.
+        """
+        serialized_data = self._serialize_request(request)
+        call_id = serialized_data['call_id']
+
+        redis_cache = get_redis_cache()
+
+        # Wake up the waiting incoming call, it stops resending the push.
+        call_state = cancel_call(redis_cache, call_id)
+        is_group_call = False
+        if call_state is None:
+            # A call to several devices, the waiting incoming call cancels
+            # the calls to the devices.
+            call_state = cancel_call(redis_cache, get_group_call_key(call_id))
+            is_group_call = True
+        if call_state is None:
             return Response('', status=HTTP_404_NOT_FOUND)
 
+        log_call_cancelled(call_id, call_state)
+
+        # Let the app stop setting up the call.
+        if not is_group_call:
+            device = find_cancel_device(call_state)
+            if device is not None:
+                task_cancelled_call_notify(device, call_id)
+
         return Response('', status=HTTP_202_ACCEPTED)
 
 
@@ -469,35 +703,47 @@ class DeviceView(VialerAPIView):
 
         app = get_object_or_404(App, app_id=app_id, platform=platform)
 
-        device, created = Device.objects.update_or_create(
-            sip_user_id=sip_user_id,
-            defaults={
-                'app_id': app.id,
-                'token': token,
-                'remote_logging_id': remote_logging_id,
-            })
-
         # Track status.
         status = 'OK'
 
-        # Update token.
-        if device.token != token:
-            if not created:
-                task_notify_old_token(device, device.app)
+        # A device is identified by its app and token, a token that is
+        # registered for another sip_user_id moves to this one.
+        if Device.objects.filter(app=app, token=token).exclude(sip_user_id=sip_user_id).delete()[0]:
+            status += ' moved from other sip_user_id'
+
+        created = False
+        device = Device.objects.filter(app=app, token=token).first()
+        if device is None:
+            # A phone that got a new token keeps its device, only a new
+            # phone replaces the least recently seen device.
+            previous = self._get_same_device(app, sip_user_id, remote_logging_id, serialized_data.get('name'))
+            if previous is None:
+                devices = list(Device.objects.filter(sip_user_id=sip_user_id).order_by('last_seen', 'id'))
+                if len(devices) >= settings.MAX_DEVICES_PER_SIP_USER_ID:
+                    # With one device per sip_user_id a new token replaces
+                    # the old one.
+                    previous = devices[0]
+
+            if previous is not None:
+                # The notify is sent in the background, keep the old token.
+                task_notify_old_token(copy(previous), previous.app)
                 status += ' updated and send notify to old token'
+                device = previous
+                device.sip_user_id = sip_user_id
             else:
-                status += ' and updated token'
-            device.token = token
-
-        # Update remote_logging_id.
-        if device.remote_logging_id != remote_logging_id:
-            device.remote_logging_id = remote_logging_id
-            status += ', updated the remote_logging_id'
-
-        # Update fields.
-        device.name = serialized_data.get('name', None)
-        device.os_version = serialized_data.get('os_version', None)
-        device.client_version = serialized_data.get('client_version', None)
+                device = Device(sip_user_id=sip_user_id)
+                created = True
+        device.token = token
+
+        # Update the fields that were sent, the others keep their value.
+        changed = []
+        for field in ('remote_logging_id', 'name', 'os_version', 'client_version'):
+            if field in serialized_data and getattr(device, field) != serialized_data[field]:
+                setattr(device, field, serialized_data[field])
+                changed.append(field)
+        if changed and not created:
+            status += ', updated the {0}'.format(', '.join(changed))
+
         device.last_seen = timezone.now()
         device.sandbox = serialized_data['sandbox']
 
@@ -523,6 +769,27 @@ class DeviceView(VialerAPIView):
         )
         return Response('', status=status_code)
 
+    def _get_same_device(self, app, sip_user_id, remote_logging_id, name):
+        """
+        Function to find the device of a phone that registers a new token,
+        by its remote_logging_id or else by its name.
+
+        Args:
+            app (App): The app of the device.
+            sip_user_id (string): The sip_user_id of the device.
+            remote_logging_id (string): The remote_logging_id sent by the app.
+            name (string): The name sent by the app.
+
+        Returns:
+            Device: The device or None for a new phone.
+        """
+        devices = Device.objects.filter(app=app, sip_user_id=sip_user_id)
+        if remote_logging_id:
+            return devices.filter(remote_logging_id=remote_logging_id).first()
+        if name:
+            return devices.filter(name=name).first()
+        return None
+
     def delete(self, request, platform):
         """
         Function for deleting a Device.
@@ -592,9 +859,13 @@ class HangupReasonView(VialerAPIView):
         sip_user_id = serialized_data['sip_user_id']
 
         try:
+            # Skip the lookup for sip_user_ids without a device.
+            if sip_user_filter.contains(sip_user_id) == ABSENT:
+                raise Http404
+
             # Check if there is a registered device for given sip_user_id.
-            device = get_object_or_404(Device, sip_user_id=sip_user_id)
-        except Http404:
+            device = get_cached_device(sip_user_id)
+        except (Device.DoesNotExist, Http404):
             log_middleware_information(
                 '{0} | Failed to find a device for SIP_user_ID : {1}',
                 OrderedDict([
@@ -603,7 +874,7 @@ class HangupReasonView(VialerAPIView):
                 ]),
                 logging.WARNING,
             )
-            raise
+            raise Http404
 
         log_middleware_information(
             '{0} | {1} Device not available because: {2} on {3}',
@@ -624,7 +895,7 @@ class LogMetricsView(VialerAPIView):
     authentication_classes = (VoipgridAuthentication,)
 
     def post(self, request):
-        redis_cache = RedisClusterCache()
+        redis_cache = get_redis_cache()
         json_data = request.data
         metric_data = get_metrics_base_data(json_data)
 
@@ -649,7 +920,7 @@ class CheckInView(VialerAPIView):
     """
     View to update when a device has last been seen.
     """
-    serializer_class = SipUserIdSerializer
+    serializer_class = CheckInSerializer
     authentication_classes = (VoipgridAuthentication,)
 
     def post(self, request):
@@ -657,7 +928,8 @@ class CheckInView(VialerAPIView):
         Post view to update the last_seen field on a device.
 
         Args:
-            request (Request): Containing the post data.
+            request (Request): Containing the post data, with the token of
+                the device or without for all devices of the sip_user_id.
 
         Returns:
             Response: 200 if OK 404 if the device has not been found.
@@ -665,12 +937,73 @@ class CheckInView(VialerAPIView):
         serialized_data = self._serialize_request(request)
 
         sip_user_id = serialized_data['sip_user_id']
-        try:
-            device = Device.objects.get(sip_user_id=sip_user_id)
-        except Device.DoesNotExist:
+        devices = Device.objects.filter(sip_user_id=sip_user_id)
+        if 'token' in serialized_data:
+            devices = devices.filter(token=serialized_data['token'])
+
+        devices = list(devices)
+        if not devices:
             return Response(status=HTTP_404_NOT_FOUND)
-        else:
+
+        for device in devices:
             device.last_seen = timezone.now()
             device.save()
 
         return Response(status=HTTP_200_OK)
+
+
+class BulkNotifyView(VialerAPIView):
+    """
+    Internal view to send a text message to all devices of an app and to
+    follow its progress. Only for staff users.
+    """
+    serializer_class = BulkNotifySerializer
+    authentication_classes = (BasicAuthentication, )
+    permission_classes = (IsAdminUser, )
+
+    def get(self, request):
+        """
+        Get the progress of a bulk notification.
+
+        Args:
+            request (Request): With the run_id in the query string.
+
+        Returns:
+            Response: 200 with the progress or 404 for an unknown run.
+        """
+        try:
+            run = BulkNotification(request.query_params.get('run_id', ''))
+        except KeyError:
+            return Response(status=HTTP_404_NOT_FOUND)
+        return Response(run.get_progress(), status=HTTP_200_OK)
+
+    def post(self, request):
+        """
+        Start a bulk notification or resume one from its checkpoint.
+
+        Args:
+            request (Request): With the run_id or the app, platform and
+                message.
+
+        Returns:
+            Response: 202 with the progress, 400 for a message that is too
+                large, 404 for an unknown app or run and 503 when the bulk
+                notification executor is full.
+        """
+        serialized_data = self._serialize_request(request)
+
+        if 'run_id' in serialized_data:
+            try:
+                run = BulkNotification(serialized_data['run_id'])
+            except KeyError:
+                return Response(status=HTTP_404_NOT_FOUND)
+        else:
+            app = get_object_or_404(App, app_id=serialized_data['app'], platform=serialized_data['platform'])
+            try:
+                run = BulkNotification.create(app, serialized_data['message'])
+            except ValueError as ex:
+                return Response({'detail': str(ex)}, status=HTTP_400_BAD_REQUEST)
+
+        if not task_bulk_notify(run.run_id):
+            return Response(status=HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(run.get_progress(), status=HTTP_202_ACCEPTED)
@@ -0,0 +1,287 @@
+from collections import defaultdict, namedtuple, OrderedDict
+import logging
+import math
+from threading import Lock
+import time
+import uuid
+
+from django.conf import settings
+
+from app.calls import SERVER_TIME_LUA
+from app.utils import log_middleware_information
+
+# Keys of the sorted sets with the parked calls of all workers and per app.
+# The hash tag keeps them in one slot of the cluster for the scripts.
+ADMISSION_CALLS_KEY = 'admission:{admission}:calls'
+ADMISSION_APP_CALLS_KEY_PREFIX = 'admission:{admission}:app_'
+
+# Seconds a slot outlives the wait of its call, after that the slot of a
+# worker that died is freed.
+SLOT_GRACE = 5
+
+# Failed reasons of the calls that were shed.
+REJECTED_WORKER = 'overload worker'
+REJECTED_GLOBAL = 'overload global'
+REJECTED_APP = 'overload app'
+
+# Take a slot for a call when the limit and the share of the app allow it.
+# The slots are members of the sorted sets scored by the time they expire.
+# KEYS: calls, app calls. ARGV: token, limit, app limit, fair share
+# threshold, ttl, time. Returns '' when the slot was taken, otherwise
+# 'global' or 'app'.
+ACQUIRE_SCRIPT = SERVER_TIME_LUA + """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local total = redis.call('ZCARD', KEYS[1])
+if total >= tonumber(ARGV[2]) then
+    return 'global'
+end
+if total >= tonumber(ARGV[4]) and redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[3]) then
+    return 'app'
+end
+local ttl = tonumber(ARGV[5])
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+redis.call('ZADD', KEYS[2], now + ttl, ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(ttl))
+redis.call('EXPIRE', KEYS[2], math.ceil(ttl))
+return ''
+"""
+
+# Free the slot of a call.
+# KEYS: calls, app calls. ARGV: token.
+RELEASE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+"""
+
+# The slot of a parked call: its token, the app and whether the call holds
+# a slot in Redis.
+AdmissionSlot = namedtuple('AdmissionSlot', ['token', 'app_pk', 'is_global'])
+
+
+class AdmissionRejected(Exception):
+    """
+    The call can't be parked because too many calls are waiting.
+    """
+    def __init__(self, reason):
+        super(AdmissionRejected, self).__init__(reason)
+        self.reason = reason
+
+
+def get_app_limits(limit):
+    """
+    Function to get the limits of the fair share for a limit. Once the
+    parked calls reach the ADMISSION_FAIR_SHARE_THRESHOLD of the limit an
+    app can only take a slot while it holds less than ADMISSION_MAX_APP_SHARE
+    of them, so the rest stays free for the other apps. Below the threshold
+    an app can take any slot.
+
+    Args:
+        limit (int): The max parked calls.
+
+    Returns:
+        tuple: The max parked calls of an app and the parked calls from
+            which that max applies.
+    """
+    return (
+        int(math.ceil(limit * settings.ADMISSION_MAX_APP_SHARE)),
+        int(limit * settings.ADMISSION_FAIR_SHARE_THRESHOLD),
+    )
+
+
+def get_app_calls_key(app_pk):
+    """
+    Function to get the key of the sorted set with the parked calls of an
+    app.
+
+    Args:
+        app_pk (int): The primary key of the app.
+
+    Returns:
+        string: The key, in the slot of ADMISSION_CALLS_KEY.
+    """
+    return '{0}{1}'.format(ADMISSION_APP_CALLS_KEY_PREFIX, app_pk)
+
+
+def get_slot_ttl(wait):
+    """
+    Function to get how long the slot of a call is kept.
+
+    Args:
+        wait (float): The seconds the call waits for the app.
+
+    Returns:
+        float: The seconds until the slot expires.
+    """
+    return wait + SLOT_GRACE
+
+
+class WorkerSlots(object):
+    """
+    The slots of the calls parked in this process, per app.
+    """
+    def __init__(self):
+        self._slots = {}
+        self._app_counts = defaultdict(int)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def acquire(self, token, app_pk, ttl, limit):
+        """
+        Take a slot when the limit and the share of the app allow it.
+
+        Args:
+            token (string): The token of the slot.
+            app_pk (int): The app of the device that is called.
+            ttl (float): Seconds after which the slot is freed.
+            limit (int): The max parked calls in this process.
+
+        Returns:
+            string: None when the slot was taken, otherwise the reason.
+        """
+        app_limit, threshold = get_app_limits(limit)
+        now = time.time()
+        with self._lock:
+            reason = self._check(app_pk, limit, app_limit, threshold)
+            if reason is not None:
+                # Slots of calls that never released them don't count.
+                self._purge(now)
+                reason = self._check(app_pk, limit, app_limit, threshold)
+            if reason is None:
+                self._slots[token] = (app_pk, now + ttl)
+                self._app_counts[app_pk] += 1
+            return reason
+
+    def release(self, token):
+        with self._lock:
+            slot = self._slots.pop(token, None)
+            if slot is not None:
+                self._decrement(slot[0])
+
+    def _check(self, app_pk, limit, app_limit, threshold):
+        if len(self._slots) >= limit:
+            return REJECTED_WORKER
+        if len(self._slots) >= threshold and self._app_counts[app_pk] >= app_limit:
+            return REJECTED_APP
+        return None
+
+    def _decrement(self, app_pk):
+        self._app_counts[app_pk] -= 1
+        if not self._app_counts[app_pk]:
+            del self._app_counts[app_pk]
+
+    def _purge(self, now):
+        """
+        Remove the expired slots, must be called with the lock held.
+        """
+        for token in [token for token, slot in self._slots.items() if slot[1] < now]:
+            self._decrement(self._slots.pop(token)[0])
+
+
+class AdmissionControl(object):
+    """
+    Bounds the incoming calls that wait for the app, to
+    ADMISSION_MAX_WORKER_CALLS per process and ADMISSION_MAX_GLOBAL_CALLS
+    over all processes with a semaphore in Redis. A limit of 0 disables it.
+    Calls over the limit are answered with a NAK right away instead of
+    adding a wait and pushes to an overloaded middleware.
+    """
+    def __init__(self):
+        self.worker_slots = WorkerSlots()
+
+    def acquire_worker(self, app_pk, wait):
+        """
+        Take a slot of this process for a call.
+
+        Args:
+            app_pk (int): The app of the device that is called.
+            wait (float): Seconds the call waits for the app.
+
+        Returns:
+            AdmissionSlot: The slot, without a slot in Redis.
+
+        Raises:
+            AdmissionRejected: When the call is over the limit.
+        """
+        token = uuid.uuid4().hex
+        if settings.ADMISSION_MAX_WORKER_CALLS:
+            reason = self.worker_slots.acquire(token, app_pk, get_slot_ttl(wait), settings.ADMISSION_MAX_WORKER_CALLS)
+            if reason is not None:
+                raise AdmissionRejected(reason)
+        return AdmissionSlot(token, app_pk, False)
+
+    def get_acquire_args(self, slot, wait):
+        """
+        Get the keys and arguments of ACQUIRE_SCRIPT for a slot.
+        """
+        limit = settings.ADMISSION_MAX_GLOBAL_CALLS
+        app_limit, threshold = get_app_limits(limit)
+        return (
+            [ADMISSION_CALLS_KEY, get_app_calls_key(slot.app_pk)],
+            [slot.token, limit, app_limit, threshold, get_slot_ttl(wait), time.time()],
+        )
+
+    def handle_acquire_result(self, slot, result):
+        """
+        Turn the result of ACQUIRE_SCRIPT into the slot of the call.
+
+        Raises:
+            AdmissionRejected: When the call is over the global limit.
+        """
+        if result:
+            self.worker_slots.release(slot.token)
+            raise AdmissionRejected(REJECTED_APP if result == 'app' else REJECTED_GLOBAL)
+        return slot._replace(is_global=True)
+
+    def acquire(self, redis_cache, app_pk, wait):
+        """
+        Take a slot for a call in this process and over all processes.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache with the semaphore.
+            app_pk (int): The app of the device that is called.
+            wait (float): Seconds the call waits for the app.
+
+        Returns:
+            AdmissionSlot: The slot to release when the call is done.
+
+        Raises:
+            AdmissionRejected: When the call is over a limit.
+        """
+        slot = self.acquire_worker(app_pk, wait)
+        if not settings.ADMISSION_MAX_GLOBAL_CALLS:
+            return slot
+
+        keys, args = self.get_acquire_args(slot, wait)
+        try:
+            result = redis_cache.run_script(ACQUIRE_SCRIPT, keys, args)
+        except Exception:
+            # Let the call through, without Redis it fails anyway.
+            self.log_failure('Taking a global admission slot failed')
+            return slot
+        return self.handle_acquire_result(slot, result)
+
+    def release(self, redis_cache, slot):
+        """
+        Free the slot of a call.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache with the semaphore.
+            slot (AdmissionSlot): The slot returned by `acquire`.
+        """
+        self.worker_slots.release(slot.token)
+        if slot.is_global:
+            try:
+                redis_cache.run_script(
+                    RELEASE_SCRIPT, [ADMISSION_CALLS_KEY, get_app_calls_key(slot.app_pk)], [slot.token])
+            except Exception:
+                # The slot expires after the wait of the call.
+                self.log_failure('Releasing a global admission slot failed')
+
+    def log_failure(self, statement):
+        log_middleware_information(statement, OrderedDict(), logging.ERROR)
+
+
+admission_control = AdmissionControl()
@@ -0,0 +1,340 @@
+from collections import OrderedDict
+import logging
+import os
+import socket
+from threading import Condition, Lock, Thread
+from time import sleep, time
+
+from apns2.client import APNsClient
+from apns2.credentials import Credentials
+from apns2.errors import ConnectionFailed
+from django.conf import settings
+from h2.exceptions import ProtocolError
+from hyper.http20.exceptions import ConnectionError as HTTP20ConnectionError
+import jwt
+
+from app.cache import get_redis_cache
+from app.utils import log_middleware_information
+from main.prometheus.consts import (
+    LATENCY_KEY,
+    TOPIC_KEY,
+    UTILIZATION_KEY,
+    VIALER_MIDDLEWARE_APNS_SEND_KEY)
+
+from .models import App, APNS_PLATFORM
+
+# Errors that mean the connection is gone, like after a GOAWAY of APNs.
+CONNECTION_ERRORS = (ConnectionFailed, HTTP20ConnectionError, ProtocolError, socket.error)
+
+# Opaque data of the health check pings.
+PING_DATA = b'vialerok'
+
+# The pushes are VoIP pushes, with a provider token the topic is not taken
+# from the certificate so it has to be set.
+APNS_VOIP_TOPIC = '{0}.voip'
+
+
+class ProviderTokenCredentials(Credentials):
+    """
+    Credentials that authenticate with a provider token signed with a .p8
+    auth key. The token is signed once and reused by all apps of the team
+    until APNS_TOKEN_REFRESH_INTERVAL, APNs rejects tokens older than an hour
+    and tokens that are refreshed more than once every 20 minutes.
+    """
+    def __init__(self, auth_key_file, key_id, team_id):
+        super(ProviderTokenCredentials, self).__init__()
+        with open(auth_key_file) as f:
+            self.auth_key = f.read()
+        self.key_id = key_id
+        self.team_id = team_id
+        self._token = None
+        self._issued_at = 0
+        self._lock = Lock()
+
+    def get_authorization_header(self, topic):
+        return 'bearer {0}'.format(self.get_token())
+
+    def get_token(self):
+        """
+        Get the provider token, signing a new one when it is due.
+
+        Returns:
+            string: The signed JWT.
+        """
+        refresh_at = self._issued_at + settings.APNS_TOKEN_REFRESH_INTERVAL / 1000
+        if self._token is None or time() >= refresh_at:
+            with self._lock:
+                if self._token is None or time() >= self._issued_at + settings.APNS_TOKEN_REFRESH_INTERVAL / 1000:
+                    issued_at = int(time())
+                    token = jwt.encode(
+                        {'iss': self.team_id, 'iat': issued_at},
+                        self.auth_key,
+                        algorithm='ES256',
+                        headers={'kid': self.key_id},
+                    )
+                    self._token = token.decode('ascii') if isinstance(token, bytes) else token
+                    self._issued_at = issued_at
+        return self._token
+
+
+class APNsConnection(object):
+    """
+    A warm HTTP/2 connection to APNs and the number of streams in use.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.streams = 0
+        self.last_used = time()
+
+
+class APNsConnectionPool(object):
+    """
+    The connections of one app, or of all apps of a team with provider token
+    authentication, and environment. Sends are spread over the connections
+    as concurrent streams, a connection is added when all are busy until
+    APNS_MAX_CONNECTIONS_PER_TOPIC.
+    """
+    def __init__(self, name, credentials, sandbox):
+        self.name = name
+        self.credentials = credentials
+        self.sandbox = sandbox
+        self.connections = []
+        self._condition = Condition(Lock())
+
+    def acquire(self):
+        """
+        Get the least busy connection and claim a stream on it.
+
+        Returns:
+            APNsConnection: The connection to send on.
+        """
+        max_streams = settings.APNS_MAX_STREAMS_PER_CONNECTION
+        with self._condition:
+            while True:
+                connection = min(self.connections, key=lambda connection: connection.streams, default=None)
+                busy = connection is None or connection.streams >= max_streams * settings.APNS_SCALE_UP_UTILIZATION
+                if busy and len(self.connections) < settings.APNS_MAX_CONNECTIONS_PER_TOPIC:
+                    connection = self._open()
+                if connection.streams < max_streams:
+                    connection.streams += 1
+                    connection.last_used = time()
+                    return connection
+                self._condition.wait()
+
+    def release(self, connection):
+        with self._condition:
+            connection.streams -= 1
+            self._condition.notify()
+
+    def discard(self, connection):
+        """
+        Drop a broken connection, the next send opens a new one.
+        """
+        with self._condition:
+            if connection in self.connections:
+                self.connections.remove(connection)
+                self._condition.notify_all()
+        try:
+            connection.client._connection.close()
+        except Exception:
+            pass
+
+    def ping(self):
+        """
+        Ping the idle connections and drop the ones that are gone.
+        """
+        idle_since = time() - settings.APNS_PING_INTERVAL / 1000
+        with self._condition:
+            connections = [
+                connection for connection in self.connections
+                if connection.streams == 0 and connection.last_used < idle_since
+            ]
+
+        for connection in connections:
+            try:
+                connection.client._connection.ping(PING_DATA)
+                connection.last_used = time()
+            except CONNECTION_ERRORS:
+                log_middleware_information(
+                    'Ping to APNSv2 for {0} failed, dropping the connection',
+                    OrderedDict([('pool', self.name)]),
+                    logging.WARNING,
+                )
+                self.discard(connection)
+
+    def open(self):
+        """
+        Make sure there is at least one warm connection.
+        """
+        with self._condition:
+            if not self.connections:
+                self._open()
+
+    def _open(self):
+        """
+        Open a new connection, must be called with the lock held.
+        """
+        client = APNsClient(self.credentials, use_sandbox=self.sandbox)
+        client.connect()
+        connection = APNsConnection(client)
+        self.connections.append(connection)
+        log_middleware_information(
+            'Opened connection {0} to APNSv2 {1} for {2}',
+            OrderedDict([
+                ('connection', len(self.connections)),
+                ('sandbox', 'Sandbox' if self.sandbox else 'Production'),
+                ('pool', self.name),
+            ]),
+            logging.INFO,
+        )
+        return connection
+
+
+class APNsConnectionManager(object):
+    """
+    The APNs connection pools of this process by app and environment, with a
+    thread that pings the idle connections every APNS_PING_INTERVAL.
+    """
+    def __init__(self):
+        self.pools = {}
+        self.thread = None
+        self._lock = Lock()
+
+    def get_pool(self, app, sandbox):
+        """
+        Get the pool for an app and environment. Apps with provider token
+        authentication share the pool of their team and auth key.
+
+        Args:
+            app (App): The APNS app.
+            sandbox (bool): True for the sandbox environment.
+
+        Returns:
+            APNsConnectionPool: The pool.
+        """
+        if app.uses_apns_token_auth:
+            key = (app.apns_team_id, app.apns_key_id, sandbox)
+        else:
+            key = (app.app_id, sandbox)
+        pool = self.pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self.pools.get(key)
+                if pool is None:
+                    auth_file = os.path.join(settings.CERT_DIR, app.push_key)
+                    if app.uses_apns_token_auth:
+                        pool = APNsConnectionPool(
+                            'team_id: {0}'.format(app.apns_team_id),
+                            ProviderTokenCredentials(auth_file, app.apns_key_id, app.apns_team_id),
+                            sandbox,
+                        )
+                    else:
+                        pool = APNsConnectionPool('app_id: {0}'.format(app.app_id), auth_file, sandbox)
+                    self.pools[key] = pool
+            self.start()
+        return pool
+
+    def send(self, app, device, message, expiration=None, collapse_id=None):
+        """
+        Send a notification on a warm connection. When the connection turns
+        out to be gone the notification is sent once more on a new one.
+
+        Args:
+            app (App): The app of the device.
+            device (Device): The device to send to.
+            message (Payload): The notification.
+            expiration (int): Time at which APNs can drop the notification.
+            collapse_id (string): Id of the notifications it replaces.
+
+        Raises:
+            APNsException: When APNs rejects the notification.
+        """
+        pool = self.get_pool(app, device.sandbox)
+        # With a certificate APNs takes the topic from the certificate.
+        topic = APNS_VOIP_TOPIC.format(app.app_id) if app.uses_apns_token_auth else None
+        for attempt in range(2):
+            connection = pool.acquire()
+            utilization = connection.streams / settings.APNS_MAX_STREAMS_PER_CONNECTION
+            start_time = time()
+            try:
+                connection.client.send_notification(
+                    device.token,
+                    message,
+                    topic=topic,
+                    expiration=expiration,
+                    collapse_id=collapse_id,
+                )
+            except CONNECTION_ERRORS:
+                pool.discard(connection)
+                if attempt:
+                    raise
+                continue
+            finally:
+                pool.release(connection)
+
+            # Push data to Redis for the send latency and stream utilization.
+            get_redis_cache().client.rpush(
+                VIALER_MIDDLEWARE_APNS_SEND_KEY,
+                {
+                    TOPIC_KEY: app.app_id,
+                    LATENCY_KEY: time() - start_time,
+                    UTILIZATION_KEY: utilization,
+                },
+            )
+            return
+
+    def open_connections(self):
+        """
+        Open a connection for every APNS app.
+        """
+        for app in App.objects.filter(platform=APNS_PLATFORM):
+            try:
+                self.get_pool(app, False).open()
+            except Exception:
+                log_middleware_information(
+                    'Could not open a connection to APNSv2 for app_id: {0}',
+                    OrderedDict([('app_id', app.app_id)]),
+                    logging.ERROR,
+                )
+
+    def start(self):
+        """
+        Start the ping thread if it is not running yet.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            sleep(settings.APNS_PING_INTERVAL / 1000)
+            for pool in list(self.pools.values()):
+                try:
+                    pool.ping()
+                except Exception:
+                    log_middleware_information(
+                        'Pinging the APNSv2 connections for {0} failed',
+                        OrderedDict([('pool', pool.name)]),
+                        logging.ERROR,
+                    )
+
+
+apns_connection_manager = APNsConnectionManager()
+
+
+def open_apns_connections():
+    """
+    Function to open the APNs connections in the background when a worker
+    starts, so the first calls don't wait for the TLS handshake.
+    """
+    def open_connections():
+        from django.db import connection
+        try:
+            apns_connection_manager.open_connections()
+        finally:
+            connection.close()
+
+    Thread(target=open_connections, daemon=True).start()
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class MiddlewareAppConfig(AppConfig):
+    name = 'app'
+
+    def ready(self):
+        # Connect the signal handlers that keep the device cache, the push
+        # clients and the sip user filter up to date.
+        import app.devices  # noqa
+        import app.push_clients  # noqa
+        import app.sip_user_filter  # noqa
@@ -0,0 +1,266 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+
+from app.cache import get_redis_cache
+from app.models import App, Device
+from app.push import get_message_push_payload
+from app.push_backends import get_push_backend, InvalidTokenError, PushError, PushResult
+from app.token_feedback import report_invalid_token, report_replaced_token, token_feedback
+from app.utils import log_middleware_information
+
+# Prefix of the Redis hash with the checkpoint and progress of a run.
+BULK_NOTIFY_KEY_PREFIX = 'bulk_notify_'
+# Prefix of the key that a process holds while it sends for a run.
+BULK_NOTIFY_LOCK_PREFIX = 'bulk_notify_lock_'
+# Prefix of the per second counters of the rate limit per provider.
+BULK_NOTIFY_RATE_KEY_PREFIX = 'bulk_notify_rate_'
+
+# Seconds the progress of a run is kept after its last update.
+BULK_NOTIFY_TTL = 7 * 24 * 60 * 60
+# Seconds after which the lock of a process that died expires.
+BULK_NOTIFY_LOCK_TTL = 60
+
+STATUS_RUNNING = 'running'
+STATUS_PAUSED = 'paused'
+STATUS_DONE = 'done'
+
+# Counters of the progress of a run.
+COUNTERS = ('sent', 'failed', 'removed', 'replaced')
+
+
+class BulkNotificationRunning(Exception):
+    """
+    Another process is sending for the run.
+    """
+
+
+def get_bulk_notify_key(run_id):
+    """
+    Function to get the key of the hash with the state of a bulk
+    notification run.
+
+    Args:
+        run_id (string): The id of the run.
+
+    Returns:
+        string: The cache key.
+    """
+    return '{0}{1}'.format(BULK_NOTIFY_KEY_PREFIX, run_id)
+
+
+def wait_for_rate_limit(platform, count):
+    """
+    Function to wait until count pushes fit in the rate limit of the
+    provider, shared by all processes.
+
+    Args:
+        platform (string): The platform of the provider.
+        count (int): The amount of pushes to send.
+    """
+    limit = settings.BULK_NOTIFY_RATE_LIMIT[platform]
+    client = get_redis_cache().client
+    while count > 0:
+        now = time.time()
+        key = '{0}{1}_{2}'.format(BULK_NOTIFY_RATE_KEY_PREFIX, platform, int(now))
+        piece = min(count, limit)
+        used = client.incrby(key, piece)
+        client.expire(key, 2)
+        if used <= limit:
+            count -= piece
+        else:
+            time.sleep(int(now) + 1 - now)
+
+
+class BulkNotification(object):
+    """
+    Sends a text message to every device of an app. The devices are read in
+    chunks of BULK_NOTIFY_CHUNK_SIZE ordered by id and sent in
+    batches as large as the provider takes, BULK_NOTIFY_CONCURRENCY at the
+    same time. APNs takes one device per request, those requests share the
+    warm multiplexed connections.
+
+    The last device id of every chunk is stored in Redis with the progress,
+    so a stopped run continues after it. Dead tokens are removed and
+    replaced tokens updated after every chunk.
+    """
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.key = get_bulk_notify_key(run_id)
+        self.client = get_redis_cache().client
+
+        state = self.get_progress()
+        if not state:
+            raise KeyError('Unknown bulk notification run {0}'.format(run_id))
+        self.app = App.objects.get(pk=state['app'])
+        self.message = state['message']
+        self.backend = get_push_backend(self.app.platform)
+
+    @classmethod
+    def create(cls, app, message):
+        """
+        Create a run that sends a message to the devices of an app.
+
+        Args:
+            app (App): The app of the devices.
+            message (string): The message to send.
+
+        Returns:
+            BulkNotification: The run.
+
+        Raises:
+            ValueError: When the platform is unknown or the message too
+                large for the provider.
+        """
+        backend = get_push_backend(app.platform)
+        if backend is None:
+            raise ValueError('Unknown platform {0}'.format(app.platform))
+        if len(json.dumps(get_message_push_payload(message)).encode('utf-8')) > backend.max_payload_size:
+            raise ValueError('The message is larger than the {0} bytes of {1}'.format(
+                backend.max_payload_size, app.platform))
+
+        run_id = uuid.uuid4().hex
+        key = get_bulk_notify_key(run_id)
+        client = get_redis_cache().client
+        client.hmset(key, dict(
+            app=app.pk,
+            platform=app.platform,
+            message=message,
+            status=STATUS_PAUSED,
+            last_device_id='',
+            total=Device.objects.filter(app=app).count(),
+            elapsed=0,
+            **dict.fromkeys(COUNTERS, 0),
+        ))
+        client.expire(key, BULK_NOTIFY_TTL)
+        return cls(run_id)
+
+    def get_progress(self):
+        """
+        Get the checkpoint and progress of the run.
+
+        Returns:
+            dict: The fields of the run with the counters as int, the
+                elapsed seconds and the devices per minute, or an empty dict
+                for an unknown run.
+        """
+        state = self.client.hgetall(self.key)
+        if not state:
+            return {}
+        for field in COUNTERS + ('app', 'total'):
+            state[field] = int(state[field])
+        state['elapsed'] = float(state['elapsed'])
+        done = sum(state[field] for field in ('sent', 'failed', 'removed'))
+        state['per_minute'] = int(done / state['elapsed'] * 60) if state['elapsed'] else 0
+        state['run_id'] = self.run_id
+        return state
+
+    def run(self, progress=None):
+        """
+        Send to the devices after the checkpoint until all are done.
+
+        Args:
+            progress (function): Called with the progress after every chunk.
+
+        Returns:
+            dict: The progress at the end of the run.
+
+        Raises:
+            BulkNotificationRunning: When another process sends for the run.
+        """
+        lock = '{0}{1}'.format(BULK_NOTIFY_LOCK_PREFIX, self.run_id)
+        if not self.client.set(lock, 1, ex=BULK_NOTIFY_LOCK_TTL, nx=True):
+            raise BulkNotificationRunning(self.run_id)
+
+        payload = get_message_push_payload(self.message)
+        executor = ThreadPoolExecutor(max_workers=settings.BULK_NOTIFY_CONCURRENCY)
+        self.client.hset(self.key, 'status', STATUS_RUNNING)
+        try:
+            while True:
+                start_time = time.time()
+                last_device_id = self.client.hget(self.key, 'last_device_id')
+                devices = list(Device.objects.filter(
+                    app=self.app,
+                    id__gt=last_device_id,
+                ).order_by('id')[:settings.BULK_NOTIFY_CHUNK_SIZE])
+                if not devices:
+                    break
+
+                counts = self._send_chunk(executor, devices, payload)
+                # Remove the dead tokens of the chunk right away instead of
+                # batching them with the tokens of the call pushes.
+                token_feedback.flush()
+
+                pipe = self.client.pipeline()
+                for field, count in counts.items():
+                    pipe.hincrby(self.key, field, count)
+                pipe.hset(self.key, 'last_device_id', devices[-1].id)
+                pipe.hincrbyfloat(self.key, 'elapsed', time.time() - start_time)
+                pipe.expire(self.key, BULK_NOTIFY_TTL)
+                pipe.expire(lock, BULK_NOTIFY_LOCK_TTL)
+                pipe.execute()
+
+                if progress:
+                    progress(self.get_progress())
+
+            self.client.hset(self.key, 'status', STATUS_DONE)
+        except BaseException:
+            self.client.hset(self.key, 'status', STATUS_PAUSED)
+            raise
+        finally:
+            executor.shutdown()
+            self.client.delete(lock)
+
+        state = self.get_progress()
+        log_middleware_information(
+            'Bulk notification {0} for app {1} done, sent {2}, failed {3}, removed {4} at {5} per minute',
+            OrderedDict([
+                ('run_id', self.run_id),
+                ('app', str(self.app)),
+                ('sent', state['sent']),
+                ('failed', state['failed']),
+                ('removed', state['removed']),
+                ('per_minute', state['per_minute']),
+            ]),
+            logging.INFO,
+        )
+        return state
+
+    def _send_chunk(self, executor, devices, payload):
+        wait_for_rate_limit(self.app.platform, len(devices))
+
+        size = self.backend.max_batch_size
+        batches = [devices[i:i + size] for i in range(0, len(devices), size)]
+        counts = dict.fromkeys(COUNTERS, 0)
+        for batch, results in zip(batches, executor.map(lambda batch: self._send_batch(batch, payload), batches)):
+            for device, result in zip(batch, results):
+                if result.error is None:
+                    counts['sent'] += 1
+                    if result.new_token:
+                        report_replaced_token(device, result.new_token, 'canonical_id')
+                        counts['replaced'] += 1
+                elif isinstance(result.error, InvalidTokenError):
+                    report_invalid_token(device, result.error.reason)
+                    counts['removed'] += 1
+                else:
+                    counts['failed'] += 1
+        return counts
+
+    def _send_batch(self, devices, payload):
+        try:
+            return self.backend.send_multicast(devices, self.app, payload)
+        except Exception as ex:
+            log_middleware_information(
+                'Bulk notification {0} failed to send to {1} devices',
+                OrderedDict([
+                    ('run_id', self.run_id),
+                    ('devices', len(devices)),
+                ]),
+                logging.ERROR,
+            )
+            return [PushResult(PushError(type(ex).__name__), None)] * len(devices)
@@ -1,30 +1,133 @@
+from collections import OrderedDict
+import logging
+from threading import Condition, Lock
+import time
+
 from django.conf import settings
+from redis.exceptions import ConnectionError, RedisError
 from rediscluster import StrictRedisCluster
+from rediscluster.connection import ClusterConnectionPool
+from rediscluster.exceptions import RedisClusterException
+
+from app.utils import log_middleware_information
 
 DEFAULT_TIMEOUT = 300
 
 
+def get_startup_nodes():
+    """
+    Function to parse the REDIS_SERVER_LIST setting.
+
+    Returns:
+        list: Dicts with the host and port of the cluster nodes.
+    """
+    server_list = settings.REDIS_SERVER_LIST.replace(' ', '').split(',')
+
+    nodes = []
+    for server in server_list:
+        if ':' not in server:
+            continue
+        host, port = server.split(':')
+        nodes.append({'host': host, 'port': port})
+
+    return nodes
+
+
+class BlockingClusterConnectionPool(ClusterConnectionPool):
+    """
+    Connection pool that waits for a connection to be released when all
+    max_connections are in use, instead of failing the command right away.
+    An idle connection to another node is closed to make room for a
+    connection to the node of the command.
+    """
+    def __init__(self, timeout=None, **kwargs):
+        # Seconds to wait for a connection, forever when None.
+        self.timeout = timeout
+        super(BlockingClusterConnectionPool, self).__init__(**kwargs)
+
+    def reset(self):
+        super(BlockingClusterConnectionPool, self).reset()
+        self._released = Condition()
+
+    def get_connection_by_node(self, node):
+        """
+        Get a connection to the node, wait for one to be released when the
+        pool is full.
+
+        Raises:
+            RedisClusterException: When no connection was released within
+                the timeout.
+        """
+        self._checkpid()
+        self.nodes.set_node_name(node)
+
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._released:
+            while True:
+                available = self._available_connections.get(node['name'])
+                if available:
+                    connection = available.pop()
+                    break
+                if self.count_all_num_connections(node) < self.max_connections:
+                    connection = self.make_connection(node)
+                    break
+                if self._close_idle_connection():
+                    continue
+
+                timeout = None if deadline is None else deadline - time.time()
+                if timeout is not None and timeout <= 0:
+                    raise RedisClusterException('Too many connections, no connection released in time')
+                self._released.wait(timeout)
+
+            self._in_use_connections.setdefault(node['name'], set()).add(connection)
+        return connection
+
+    def release(self, connection):
+        with self._released:
+            super(BlockingClusterConnectionPool, self).release(connection)
+            self._released.notify()
+
+    def _close_idle_connection(self):
+        """
+        Close an idle connection to any node, must be called with the
+        condition held.
+
+        Returns:
+            bool: True when a connection was closed.
+        """
+        if self.max_connections_per_node:
+            return False
+        for name, available in self._available_connections.items():
+            if available:
+                available.pop().disconnect()
+                self._created_connections_per_node[name] -= 1
+                return True
+        return False
+
+
 class RedisClusterCache(object):
     """
     Class used for accessing the redis cluster used for caching.
     """
     def __init__(self):
         self.client = self._create_client()
+        # The registered scripts of the client by their Lua source.
+        self._scripts = {}
 
     def _create_client(self):
         """
         Function to connect to the redis cluster and init the client.
         """
-        server_list = settings.REDIS_SERVER_LIST.replace(' ', '').split(',')
-
-        nodes = []
-        for server in server_list:
-            if ':' not in server:
-                continue
-            host, port = server.split(':')
-            nodes.append({'host': host, 'port': port})
-
-        return StrictRedisCluster(startup_nodes=nodes, decode_responses=True)
+        return StrictRedisCluster(
+            connection_pool=BlockingClusterConnectionPool(
+                startup_nodes=get_startup_nodes(),
+                decode_responses=True,
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                timeout=settings.REDIS_POOL_TIMEOUT / 1000,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT / 1000,
+                socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT / 1000,
+            ),
+        )
 
     def get(self, key):
         return self.client.get(key)
@@ -34,3 +137,134 @@ class RedisClusterCache(object):
 
     def set(self, key, value, timeout=DEFAULT_TIMEOUT):
         self.client.set(key, value, timeout)
+
+    def hget(self, key, field):
+        return self.client.hget(key, field)
+
+    def run_script(self, script, keys, args):
+        """
+        Function to run a Lua script on the node that holds the keys. The
+        script is registered with the client once and loaded on the cluster
+        the first time it is run.
+
+        Args:
+            script (string): The Lua source of the script.
+            keys (list): The keys the script accesses, all in the same slot.
+            args (list): The arguments for the script.
+
+        Returns:
+            The value returned by the script.
+        """
+        registered = self._scripts.get(script)
+        if registered is None:
+            # Two threads may both register a script, either one is kept.
+            registered = self._scripts.setdefault(script, self.client.register_script(script))
+        return registered(keys=keys, args=args)
+
+
+class SharedRedisClusterCache(object):
+    """
+    Holds the RedisClusterCache of a process so the slot discovery and the
+    connections are shared by all requests. The cache is created on first
+    use and checked every REDIS_HEALTH_CHECK_INTERVAL. A failed check or
+    connect drops the cache and the next connect waits with an exponential
+    backoff. Safe to use from threads and gevent greenlets.
+    """
+    def __init__(self):
+        self._cache = None
+        self._lock = Lock()
+        self._next_health_check = 0
+        self._next_connect = 0
+        self._failures = 0
+
+    def get(self):
+        """
+        Get the cache of this process.
+
+        Returns:
+            RedisClusterCache: The shared cache.
+
+        Raises:
+            ConnectionError: When the cluster can't be reached.
+        """
+        cache = self._cache
+        if cache is not None and time.time() < self._next_health_check:
+            return cache
+
+        if cache is not None:
+            # Only one request runs the health check, the others keep using
+            # the cache meanwhile.
+            if not self._lock.acquire(blocking=False):
+                return cache
+        else:
+            self._lock.acquire()
+
+        try:
+            return self._check()
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """
+        Drop the cache, the next `get` connects again.
+        """
+        with self._lock:
+            self._cache = None
+            self._next_connect = 0
+            self._failures = 0
+
+    def _check(self):
+        """
+        Check the health of the cache or connect when there is none, must be
+        called with the lock held.
+        """
+        now = time.time()
+        if self._cache is not None:
+            if now < self._next_health_check:
+                return self._cache
+            try:
+                self._cache.client.ping()
+                self._next_health_check = now + settings.REDIS_HEALTH_CHECK_INTERVAL / 1000
+                return self._cache
+            except (RedisError, RedisClusterException):
+                self._log_failure('Redis health check failed, reconnecting')
+                self._cache = None
+
+        if now < self._next_connect:
+            raise ConnectionError('Connecting to the redis cluster is backing off')
+
+        try:
+            self._cache = RedisClusterCache()
+        except (RedisError, RedisClusterException):
+            self._failures += 1
+            backoff = settings.REDIS_RECONNECT_BACKOFF_MIN * 2 ** (self._failures - 1)
+            self._next_connect = now + min(backoff, settings.REDIS_RECONNECT_BACKOFF_MAX) / 1000
+            self._log_failure('Connecting to the redis cluster failed')
+            raise
+
+        self._failures = 0
+        self._next_health_check = now + settings.REDIS_HEALTH_CHECK_INTERVAL / 1000
+        return self._cache
+
+    def _log_failure(self, statement):
+        log_middleware_information(
+            '{0} ({1} failures)',
+            OrderedDict([
+                ('statement', statement),
+                ('failures', self._failures),
+            ]),
+            logging.ERROR,
+        )
+
+
+shared_redis_cache = SharedRedisClusterCache()
+
+
+def get_redis_cache():
+    """
+    Function to get the RedisClusterCache shared by this process.
+
+    Returns:
+        RedisClusterCache: The shared cache.
+    """
+    return shared_redis_cache.get()
@@ -0,0 +1,201 @@
+from collections import OrderedDict
+import logging
+import math
+from threading import Event, Lock
+import time
+
+from django.conf import settings
+
+from app.utils import log_middleware_information
+
+# Prefix for the cache key that holds the leader of a call and, once the
+# leader is done, the response it gave.
+CALL_LEADER_KEY_PREFIX = 'call_leader_'
+# Value of the leader key while the leader waits for the app.
+LEADER_PENDING = 'pending'
+# Seconds the leader key outlives the wait of the call, after that the
+# followers of a leader that died give up.
+LEADER_GRACE = 2
+# Seconds the response of a call is kept for duplicates that come later.
+RESPONSE_TTL = 10
+# Interval in seconds at which a follower checks the cache for the response.
+FOLLOW_POLL_INTERVAL = .05
+
+# Roles of a request for a call: the leader sends the pushes, a local
+# follower waits for a leader or remote follower in this process and a
+# remote follower waits for a leader in another process.
+ROLE_LEADER = 'leader'
+ROLE_LOCAL = 'local'
+ROLE_REMOTE = 'remote'
+
+NAK = 'status=NAK'
+
+
+def get_call_leader_key(unique_key):
+    """
+    Function to get the cache key for the leader of a call.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+
+    Returns:
+        string: The cache key.
+    """
+    return '{0}{1}'.format(CALL_LEADER_KEY_PREFIX, unique_key)
+
+
+def get_leader_ttl():
+    """
+    Function to get the seconds the leader of a call is kept, the longest
+    wait of a call plus LEADER_GRACE.
+
+    Returns:
+        int: The TTL in seconds.
+    """
+    return int(math.ceil(settings.APP_PUSH_ROUNDTRIP_WAIT / 1000 + LEADER_GRACE))
+
+
+def get_follower_response(value):
+    """
+    Function to get the response for a follower from the leader key.
+
+    Args:
+        value (string): The value of the leader key.
+
+    Returns:
+        string: The response of the leader, NAK when the leader is gone or
+            None while the leader waits.
+    """
+    if value is None:
+        return NAK
+    if value == LEADER_PENDING:
+        return None
+    return value
+
+
+class CoalescedCall(object):
+    """
+    The requests in this process for the same call.
+    """
+    __slots__ = ('unique_key', 'event', 'response', 'expires_at')
+
+    def __init__(self, unique_key, expires_at):
+        self.unique_key = unique_key
+        self.event = Event()
+        self.response = None
+        self.expires_at = expires_at
+
+
+class CallCoalescer(object):
+    """
+    Coalesces the incoming call requests with the same call_id, which
+    Asterisk sends again on retries and dialplan loops. Over all processes
+    the first request leads the call, it sends the pushes and waits for the
+    app. The duplicates follow it and get its response without pushes of
+    their own. In a process only the first request waits for a leader in
+    another process, the rest waits for that request.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def join(self, redis_cache, unique_key):
+        """
+        Join the requests for a call.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache with the leader keys.
+            unique_key (string): The call_id of the call.
+
+        Returns:
+            tuple: The CoalescedCall and the role of the request.
+        """
+        now = time.time()
+        with self._lock:
+            call = self._calls.get(unique_key)
+            if call is not None and call.expires_at >= now:
+                return call, ROLE_LOCAL
+            call = CoalescedCall(unique_key, now + get_leader_ttl())
+            self._calls[unique_key] = call
+
+        try:
+            is_leader = redis_cache.client.set(
+                get_call_leader_key(unique_key), LEADER_PENDING, nx=True, ex=get_leader_ttl())
+        except Exception:
+            # Handle the call, at worst a duplicate sends its own pushes.
+            self.log_failure('Taking the lead of call {0} failed', unique_key)
+            is_leader = True
+        return call, ROLE_LEADER if is_leader else ROLE_REMOTE
+
+    def finish(self, redis_cache, call, response):
+        """
+        Hand the response of the leader to the followers of a call.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache with the leader keys.
+            call (CoalescedCall): The call returned by `join`.
+            response (string): The response of the leader.
+        """
+        try:
+            redis_cache.client.set(get_call_leader_key(call.unique_key), response, ex=RESPONSE_TTL)
+        except Exception:
+            # The followers in other processes give up when the key expires.
+            self.log_failure('Storing the response of call {0} failed', call.unique_key)
+        self._resolve(call, response)
+
+    def follow(self, redis_cache, call, role):
+        """
+        Wait for the response of the leader of a call.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache with the leader keys.
+            call (CoalescedCall): The call returned by `join`.
+            role (string): The role returned by `join`, ROLE_LOCAL or
+                ROLE_REMOTE.
+
+        Returns:
+            string: The response of the leader or NAK when it is gone.
+        """
+        if role == ROLE_LOCAL:
+            call.event.wait(max(call.expires_at - time.time(), 0))
+            return call.response or NAK
+
+        response = NAK
+        try:
+            response = self._wait_for_leader(redis_cache, call)
+        finally:
+            self._resolve(call, response)
+        return response
+
+    def _wait_for_leader(self, redis_cache, call):
+        cache_key = get_call_leader_key(call.unique_key)
+        while True:
+            try:
+                response = get_follower_response(redis_cache.client.get(cache_key))
+            except Exception:
+                self.log_failure('Getting the response of call {0} failed', call.unique_key)
+                return NAK
+            if response is not None:
+                return response
+            if time.time() >= call.expires_at:
+                return NAK
+            time.sleep(FOLLOW_POLL_INTERVAL)
+
+    def _resolve(self, call, response):
+        call.response = response
+        call.event.set()
+        with self._lock:
+            if self._calls.get(call.unique_key) is call:
+                del self._calls[call.unique_key]
+
+    def log_failure(self, statement, unique_key):
+        log_middleware_information(
+            statement,
+            OrderedDict([
+                ('unique_key', unique_key),
+            ]),
+            logging.ERROR,
+        )
+
+
+call_coalescer = CallCoalescer()
@@ -0,0 +1,202 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from app.utils import log_data_to_metrics_log
+from main.prometheus.consts import (
+    OS_KEY,
+    PHASES_KEY,
+    RESULT_KEY,
+    VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+
+# The phases of setting up a call in the order they happen. A call that
+# ends early, for example without a device, has no later phases.
+PHASE_RECEIVED = 'received'
+PHASE_DEVICE_RESOLVED = 'device_resolved'
+PHASE_PUSH_ENQUEUED = 'push_enqueued'
+PHASE_PUSH_SENT = 'push_sent'
+PHASE_PROVIDER_ACKED = 'provider_acked'
+PHASE_APP_RESPONDED = 'app_responded'
+PHASE_ANSWERED = 'answered'
+
+PHASES = (
+    PHASE_RECEIVED,
+    PHASE_DEVICE_RESOLVED,
+    PHASE_PUSH_ENQUEUED,
+    PHASE_PUSH_SENT,
+    PHASE_PROVIDER_ACKED,
+    PHASE_APP_RESPONDED,
+    PHASE_ANSWERED,
+)
+
+# Platform of a call that ended before a device was found.
+UNKNOWN_PLATFORM = 'Middleware'
+
+
+class CallTimeline(object):
+    """
+    The times the phases of one call were reached.
+    """
+    __slots__ = ('unique_key', 'keys', 'platform', 'times')
+
+    def __init__(self, unique_key, received_at):
+        self.unique_key = unique_key
+        # The unique_key of the call and of its devices.
+        self.keys = [unique_key]
+        self.platform = UNKNOWN_PLATFORM
+        self.times = {PHASE_RECEIVED: received_at}
+
+    def get_offsets(self):
+        """
+        Function to get the seconds from receiving the call to every phase
+        that was reached.
+
+        Returns:
+            OrderedDict: The seconds per phase in the order of PHASES.
+        """
+        received_at = self.times[PHASE_RECEIVED]
+        return OrderedDict(
+            (phase, self.times[phase] - received_at) for phase in PHASES if phase in self.times
+        )
+
+    def get_durations(self):
+        """
+        Function to get the seconds spent in every phase, from the previous
+        phase that was reached. A phase that was reached before the previous
+        one, like a push sent before it was logged as enqueued, took 0s.
+
+        Returns:
+            OrderedDict: The seconds per phase in the order of PHASES
+                without the received phase.
+        """
+        durations = OrderedDict()
+        previous = None
+        for phase, offset in self.get_offsets().items():
+            if previous is not None:
+                durations[phase] = max(offset - previous, 0)
+                previous = max(offset, previous)
+            else:
+                previous = offset
+        return durations
+
+
+class CallTimelines(object):
+    """
+    The timelines of the calls that are set up in this process. The pushes
+    are sent from other threads, they find the timeline by the unique_key
+    of the call or of a device of the call.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._timelines = {}
+
+    def start(self, unique_key, received_at=None):
+        """
+        Function to start the timeline of a call.
+
+        Args:
+            unique_key (string): The unique_key of the call.
+            received_at (float): The time the request was received, now
+                when not given.
+        """
+        timeline = CallTimeline(unique_key, received_at or time.time())
+        with self._lock:
+            self._timelines[unique_key] = timeline
+
+    def add_keys(self, unique_key, keys):
+        """
+        Function to find the timeline of a call by the unique_keys of its
+        devices too.
+
+        Args:
+            unique_key (string): The unique_key of the call.
+            keys (list): The unique_keys of the devices.
+        """
+        with self._lock:
+            timeline = self._timelines.get(unique_key)
+            if timeline is not None:
+                for key in keys:
+                    self._timelines[key] = timeline
+                timeline.keys.extend(keys)
+
+    def mark(self, unique_key, phase, platform=None):
+        """
+        Function to record that a call reached a phase. Only the first time
+        counts, resends of the push do not move the phase.
+
+        Args:
+            unique_key (string): The unique_key of the call or of a device
+                of the call.
+            phase (string): One of PHASES.
+            platform (string): The platform of the device of the call.
+        """
+        now = time.time()
+        with self._lock:
+            timeline = self._timelines.get(unique_key)
+            if timeline is None:
+                # Not a call of this process or already answered.
+                return
+            timeline.times.setdefault(phase, now)
+            if platform is not None:
+                timeline.platform = platform
+
+    def finish(self, redis_cache, unique_key, result, sip_user_id):
+        """
+        Function to end the timeline of a call after the answer for the PBX
+        was written. The durations of the phases go to the Prometheus
+        process through Redis and the offsets are written as one line to
+        the metrics log.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache to push the phases to.
+            unique_key (string): The unique_key of the call.
+            result (string): The answer for the PBX, ACK or NAK.
+            sip_user_id (string): The sip_user_id that was called.
+        """
+        for key, metric_data in self.end(unique_key, result, sip_user_id):
+            redis_cache.client.rpush(key, metric_data)
+
+    def end(self, unique_key, result, sip_user_id):
+        """
+        Function like `finish` that leaves pushing the durations of the
+        phases to the caller.
+
+        Returns:
+            list: The metrics, empty for an unknown call.
+        """
+        now = time.time()
+        with self._lock:
+            timeline = self._timelines.get(unique_key)
+            if timeline is None:
+                return []
+            for key in timeline.keys:
+                self._timelines.pop(key, None)
+            timeline.times.setdefault(PHASE_ANSWERED, now)
+
+        # Log to the metrics file.
+        metrics_data = {
+            OS_KEY: timeline.platform,
+            'unique_key': unique_key,
+            RESULT_KEY: result,
+        }
+        for phase, offset in timeline.get_offsets().items():
+            metrics_data['{0}_ms'.format(phase)] = int(round(offset * 1000))
+        log_data_to_metrics_log(metrics_data, sip_user_id)
+
+        # Push data to Redis to see where the setup time of a call goes.
+        return [
+            (VIALER_MIDDLEWARE_CALL_PHASE_KEY, {
+                OS_KEY: timeline.platform,
+                RESULT_KEY: result,
+                PHASES_KEY: dict(timeline.get_durations()),
+            }),
+        ]
+
+    def __len__(self):
+        with self._lock:
+            return sum(1 for key, timeline in self._timelines.items() if key == timeline.unique_key)
+
+
+# The timelines of the calls in this process.
+call_timelines = CallTimelines()
@@ -0,0 +1,810 @@
+from collections import defaultdict, namedtuple, OrderedDict
+import logging
+from threading import Event, Lock, Thread
+import time
+
+from django.conf import settings
+from redis import StrictRedis
+
+from app.cache import DEFAULT_TIMEOUT, get_redis_cache, get_startup_nodes
+from app.utils import log_middleware_information
+
+# Prefix for the cache key of the hash that holds the state of a call. Older
+# versions used a `call_` string, see "Upgrading to the call state hash" in
+# docs/README.md.
+CALL_KEY_PREFIX = 'call_state_'
+# Prefix for the pub/sub channel on which the outcome of a call is published.
+CALL_CHANNEL_PREFIX = 'call_response_'
+
+# The values that end the wait loop of an incoming call.
+CALL_OUTCOMES = ('True', 'False', 'Removed', 'Cancelled')
+
+# Fields of the call state hash.
+STATE_PLATFORM = 'platform'
+STATE_ATTEMPTS = 'attempts'
+STATE_STARTED_AT = 'started_at'
+STATE_RESPONDED_AT = 'responded_at'
+STATE_OUTCOME = 'outcome'
+STATE_SIP_USER_ID = 'sip_user_id'
+STATE_WAIT = 'wait'
+STATE_DEVICE_ID = 'device_id'
+STATE_FIELDS = (
+    STATE_PLATFORM, STATE_ATTEMPTS, STATE_STARTED_AT, STATE_RESPONDED_AT, STATE_OUTCOME, STATE_SIP_USER_ID,
+    STATE_WAIT, STATE_DEVICE_ID)
+
+# Lua snippet that sets `now` to the time of the Redis server. Scripts can
+# only write after reading the time when they are replicated by effects,
+# which needs Redis 3.2. Older servers use the time passed by the caller as
+# the last argument.
+SERVER_TIME_LUA = """
+local now = tonumber(ARGV[#ARGV])
+if redis.replicate_commands then
+    redis.replicate_commands()
+    local server_time = redis.call('TIME')
+    now = server_time[1] + server_time[2] / 1000000
+end
+"""
+
+# Start the state of a call.
+# KEYS: state. ARGV: platform, ttl, sip_user_id, wait, device_id, time.
+# Returns the start time.
+START_CALL_SCRIPT = SERVER_TIME_LUA + """
+redis.call('DEL', KEYS[1])
+redis.call(
+    'HMSET', KEYS[1], 'platform', ARGV[1], 'attempts', 1, 'started_at', now, 'sip_user_id', ARGV[3],
+    'wait', ARGV[4], 'device_id', ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return tostring(now)
+"""
+
+# Start the state of a call to several devices and of the calls to them.
+# KEYS: states. ARGV: ttl, wait, then the platform, sip_user_id and
+# device_id per call, time. Returns the start time.
+START_CALLS_SCRIPT = SERVER_TIME_LUA + """
+for i, key in ipairs(KEYS) do
+    redis.call('DEL', key)
+    redis.call(
+        'HMSET', key, 'platform', ARGV[3 * i], 'attempts', 1, 'started_at', now, 'sip_user_id', ARGV[3 * i + 1],
+        'wait', ARGV[2], 'device_id', ARGV[3 * i + 2])
+    redis.call('EXPIRE', key, ARGV[1])
+end
+return tostring(now)
+"""
+
+# Count a resent push of a call that has not expired and store the time
+# it was sent, the first push was sent at the start of the call.
+# KEYS: state. ARGV: time. Returns the number of attempts or nil.
+RECORD_ATTEMPT_SCRIPT = SERVER_TIME_LUA + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local attempts = redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+redis.call('HSET', KEYS[1], 'sent_at_' .. attempts, now)
+return attempts
+"""
+
+# Count a resent push of the calls that have not expired and store the
+# time it was sent.
+# KEYS: states. ARGV: time.
+RECORD_ATTEMPTS_SCRIPT = SERVER_TIME_LUA + """
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        local attempts = redis.call('HINCRBY', key, 'attempts', 1)
+        redis.call('HSET', key, 'sent_at_' .. attempts, now)
+    end
+end
+"""
+
+# Store the time the app received the push of an attempt, only the first
+# time per attempt counts.
+# KEYS: state. ARGV: attempt, time.
+# Returns nil for an unknown call or attempt, otherwise the platform, the
+# time the push of the attempt was sent, the time it was received, 1 when
+# this receipt was stored and 1 when it is the first receipt of the call.
+PUSH_RECEIVED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local sent_at
+if ARGV[1] == '1' then
+    sent_at = redis.call('HGET', KEYS[1], 'started_at')
+else
+    sent_at = redis.call('HGET', KEYS[1], 'sent_at_' .. ARGV[1])
+end
+if not sent_at then
+    return nil
+end
+""" + SERVER_TIME_LUA + """
+local stored = redis.call('HSETNX', KEYS[1], 'received_at_' .. ARGV[1], now)
+local first = 0
+if stored == 1 then
+    first = redis.call('HSETNX', KEYS[1], 'received_at', now)
+end
+return {
+    redis.call('HGET', KEYS[1], 'platform'), sent_at, redis.call('HGET', KEYS[1], 'received_at_' .. ARGV[1]), stored,
+    first}
+"""
+
+# Store the outcome of a call when it has none yet, the first outcome wins.
+# The outcome is published on the channel when one is given.
+# KEYS: state. ARGV: outcome, channel or '', time.
+# Returns nil for an unknown call, otherwise the state fields followed by 1
+# when this outcome was stored.
+SET_OUTCOME_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local stored = 0
+if redis.call('HEXISTS', KEYS[1], 'outcome') == 0 then
+""" + SERVER_TIME_LUA + """
+    redis.call('HMSET', KEYS[1], 'outcome', ARGV[1], 'responded_at', now)
+    if ARGV[2] ~= '' then
+        redis.call('PUBLISH', ARGV[2], ARGV[1])
+    end
+    stored = 1
+end
+local state = redis.call(
+    'HMGET', KEYS[1], 'platform', 'attempts', 'started_at', 'responded_at', 'outcome', 'sip_user_id', 'wait',
+    'device_id')
+table.insert(state, stored)
+return state
+"""
+
+# Get the outcomes of calls in the same cluster slot.
+# KEYS: states. Returns the outcome or nil per call.
+GET_OUTCOMES_SCRIPT = """
+local outcomes = {}
+for i, key in ipairs(KEYS) do
+    outcomes[i] = redis.call('HGET', key, 'outcome')
+end
+return outcomes
+"""
+
+# The push of an attempt of a call that reached the app.
+PushReceipt = namedtuple('PushReceipt', ['platform', 'attempt', 'latency', 'stored', 'first'])
+
+# Wait loop modes for the incoming call view.
+WAIT_MODE_POLL = 'poll'
+WAIT_MODE_NOTIFY = 'notify'
+WAIT_MODE_BATCH = 'batch'
+
+# Interval in seconds used to check the cache in poll mode.
+POLL_INTERVAL = .01
+
+# Seconds a pending call outlives the roundtrip wait before it expires.
+PENDING_CALL_GRACE = 1
+# Seconds between purges of expired pending calls.
+PENDING_CALL_PURGE_INTERVAL = 10
+
+
+def get_call_cache_key(unique_key):
+    """
+    Function to get the cache key for the state of a call.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+
+    Returns:
+        string: The cache key.
+    """
+    return '{0}{1}'.format(CALL_KEY_PREFIX, unique_key)
+
+
+def get_call_channel(unique_key):
+    """
+    Function to get the channel on which the outcome of a call is published.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+
+    Returns:
+        string: The pub/sub channel name.
+    """
+    return '{0}{1}'.format(CALL_CHANNEL_PREFIX, unique_key)
+
+
+class PendingCall(object):
+    """
+    An incoming call in this process that waits for the app to respond.
+    """
+    __slots__ = ('unique_key', 'event', 'value', 'expires_at')
+
+    def __init__(self, unique_key, expires_at, event=None):
+        self.unique_key = unique_key
+        # The calls to the devices of a group call share one event.
+        self.event = event or Event()
+        self.value = None
+        self.expires_at = expires_at
+
+
+class PendingCallRegistry(object):
+    """
+    Registry of the pending calls in this process by unique_key.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self._next_purge = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def get_unresolved_keys(self):
+        """
+        Get the unique_keys of the calls that are still waiting.
+
+        Returns:
+            list: The unique_keys.
+        """
+        with self._lock:
+            return [key for key, call in self._calls.items() if call.value is None]
+
+    def is_pending(self, unique_key):
+        """
+        Check if a call is waiting in this process.
+
+        Args:
+            unique_key (string): The unique_key of the call.
+
+        Returns:
+            bool: True if the call is registered and not expired.
+        """
+        with self._lock:
+            pending_call = self._calls.get(unique_key)
+        return pending_call is not None and pending_call.expires_at >= time.time()
+
+    def register(self, unique_key, event=None):
+        """
+        Register a pending call that expires after the roundtrip wait.
+
+        Args:
+            unique_key (string): The unique_key of the call.
+            event (Event): The event to set when the call gets an outcome,
+                by default an event of its own.
+
+        Returns:
+            PendingCall: The registered call.
+        """
+        now = time.time()
+        pending_call = PendingCall(
+            unique_key,
+            now + settings.APP_PUSH_ROUNDTRIP_WAIT / 1000 + PENDING_CALL_GRACE,
+            event,
+        )
+        with self._lock:
+            if now > self._next_purge:
+                self._purge(now)
+            self._calls[unique_key] = pending_call
+        return pending_call
+
+    def unregister(self, pending_call):
+        """
+        Remove a pending call unless it was replaced by a newer one.
+        """
+        with self._lock:
+            if self._calls.get(pending_call.unique_key) is pending_call:
+                del self._calls[pending_call.unique_key]
+
+    def resolve(self, unique_key, value):
+        """
+        Hand the outcome of a call to its pending call in this process.
+
+        Args:
+            unique_key (string): The unique_key of the call.
+            value (string): The outcome, 'True', 'False', 'Removed' or
+                'Cancelled'.
+
+        Returns:
+            bool: True if a pending call in this process was woken up.
+        """
+        with self._lock:
+            pending_call = self._calls.get(unique_key)
+
+        if pending_call is None or pending_call.expires_at < time.time() or pending_call.value is not None:
+            return False
+
+        pending_call.value = value
+        pending_call.event.set()
+        return True
+
+    def _purge(self, now):
+        """
+        Remove the expired calls, must be called with the lock held.
+        """
+        for unique_key in [key for key, call in self._calls.items() if call.expires_at < now]:
+            del self._calls[unique_key]
+        self._next_purge = now + PENDING_CALL_PURGE_INTERVAL
+
+
+# The pending calls of this process. Don't use the registry directly for
+# waiting but use `get_call_waiter`.
+pending_calls = PendingCallRegistry()
+
+
+class PendingCallThread(object):
+    """
+    Base class for the background thread of a process that resolves the
+    pending calls in the registry.
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.thread = None
+        self._lock = Lock()
+
+    def start(self):
+        """
+        Start the thread if it is not running yet.
+        """
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class CallResponseListener(PendingCallThread):
+    """
+    One subscriber per process that resolves the pending calls with the
+    outcomes published by other processes.
+
+    Messages published in a Redis cluster are broadcast to all nodes, so
+    listening on one node is enough.
+    """
+    def _run(self):
+        node = get_startup_nodes()[0]
+        while True:
+            pubsub = StrictRedis(host=node['host'], port=node['port'], decode_responses=True).pubsub(
+                ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe('{0}*'.format(CALL_CHANNEL_PREFIX))
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.registry.resolve(message['channel'][len(CALL_CHANNEL_PREFIX):], message['data'])
+            except Exception:
+                # Pending calls fall back on the safety net poll meanwhile.
+                log_middleware_information(
+                    'Call response listener failed, reconnecting',
+                    OrderedDict(),
+                    logging.ERROR,
+                )
+                time.sleep(1)
+            finally:
+                pubsub.reset()
+
+
+call_response_listener = CallResponseListener(pending_calls)
+
+
+class CallStatePoller(PendingCallThread):
+    """
+    One poller per process that fetches the state of all pending calls every
+    APP_PUSH_BATCH_POLL_TICK with one pipelined script per cluster slot and
+    resolves the calls that got an outcome.
+    """
+    def _run(self):
+        while True:
+            time.sleep(settings.APP_PUSH_BATCH_POLL_TICK / 1000)
+            try:
+                self.poll(get_redis_cache())
+            except Exception:
+                log_middleware_information(
+                    'Polling the state of pending calls failed',
+                    OrderedDict(),
+                    logging.ERROR,
+                )
+
+    def poll(self, redis_cache):
+        """
+        Fetch the state of all pending calls and resolve the finished ones.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache to fetch the state from.
+        """
+        unique_keys = self.registry.get_unresolved_keys()
+        if not unique_keys:
+            return
+
+        # A script can only access keys in the same slot of the cluster.
+        keys_by_slot = defaultdict(list)
+        nodes = redis_cache.client.connection_pool.nodes
+        for unique_key in unique_keys:
+            keys_by_slot[nodes.keyslot(get_call_cache_key(unique_key))].append(unique_key)
+
+        pipeline = redis_cache.client.pipeline(transaction=False)
+        for slot_keys in keys_by_slot.values():
+            # Use EVAL because scripts can't be registered on cluster
+            # pipelines.
+            pipeline.execute_command(
+                'EVAL',
+                GET_OUTCOMES_SCRIPT,
+                len(slot_keys),
+                *[get_call_cache_key(unique_key) for unique_key in slot_keys],
+            )
+
+        for slot_keys, values in zip(keys_by_slot.values(), pipeline.execute()):
+            for unique_key, value in zip(slot_keys, values):
+                if value in CALL_OUTCOMES:
+                    self.registry.resolve(unique_key, value)
+
+
+call_state_poller = CallStatePoller(pending_calls)
+
+
+def start_call(redis_cache, unique_key, platform, sip_user_id='', wait=None, device_id=''):
+    """
+    Function to create the state of an incoming call before the first push
+    is sent.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache to store the state in.
+        unique_key (string): The unique_key of the call.
+        platform (string): The platform of the device that is called.
+        sip_user_id (string): The sip_user_id of the device that is called.
+        wait (float): Seconds the call waits for the app, by default
+            APP_PUSH_ROUNDTRIP_WAIT.
+        device_id (string): The id of the device that is called.
+
+    Returns:
+        float: The server-side start time of the call.
+    """
+    return float(redis_cache.run_script(
+        START_CALL_SCRIPT,
+        [get_call_cache_key(unique_key)],
+        [
+            platform, DEFAULT_TIMEOUT, sip_user_id, wait or settings.APP_PUSH_ROUNDTRIP_WAIT / 1000, device_id,
+            time.time(),
+        ],
+    ))
+
+
+def get_group_call_key(unique_key):
+    """
+    Function to get the unique_key of the state of a call to several
+    devices, the state that is cancelled when the caller hangs up. The hash
+    tag keeps the states of the call and its members in one slot of the
+    cluster.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+
+    Returns:
+        string: The unique_key of the state of the call.
+    """
+    return '{{{0}}}'.format(unique_key)
+
+
+def get_group_member_key(unique_key, member):
+    """
+    Function to get the unique_key of the call to a device of a call to
+    several devices.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+        member (int): The number of the device in the call.
+
+    Returns:
+        string: The unique_key of the call to the device.
+    """
+    return '{0}{1}'.format(get_group_call_key(unique_key), member)
+
+
+def start_calls(redis_cache, devices, wait):
+    """
+    Function to create the state of a call to several devices and of the
+    calls to the devices with one script.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache to store the state in.
+        devices (OrderedDict): The devices by the unique_key of their call,
+            see `get_group_call_key` and `get_group_member_key`.
+        wait (float): Seconds the calls wait for the apps.
+
+    Returns:
+        float: The server-side start time of the calls.
+    """
+    args = [DEFAULT_TIMEOUT, wait]
+    for device in devices.values():
+        args.extend([device.app.platform, device.sip_user_id, device.id])
+    args.append(time.time())
+    return float(redis_cache.run_script(
+        START_CALLS_SCRIPT, [get_call_cache_key(unique_key) for unique_key in devices], args))
+
+
+def record_call_attempt(redis_cache, unique_key):
+    """
+    Function to count a resent push for a call.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache the state is stored in.
+        unique_key (string): The unique_key of the call.
+
+    Returns:
+        int: The number of attempts or None if the call expired.
+    """
+    return redis_cache.run_script(RECORD_ATTEMPT_SCRIPT, [get_call_cache_key(unique_key)], [time.time()])
+
+
+def record_call_attempts(redis_cache, unique_keys):
+    """
+    Function to count a resent push for the calls to the devices of a group
+    call with one script.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache the state is stored in.
+        unique_keys (list): The unique_keys of the calls.
+    """
+    redis_cache.run_script(
+        RECORD_ATTEMPTS_SCRIPT, [get_call_cache_key(unique_key) for unique_key in unique_keys], [time.time()])
+
+
+def get_push_receipt(result, attempt):
+    """
+    Function to get the receipt of a push from the result of
+    PUSH_RECEIVED_SCRIPT.
+
+    Args:
+        result (list): The result of the script.
+        attempt (int): The attempt of the push.
+
+    Returns:
+        PushReceipt: The receipt, the latency is the time between sending and
+            receiving the push, measured on the Redis server.
+    """
+    platform, sent_at, received_at, stored, first = result
+    return PushReceipt(platform, attempt, max(float(received_at) - float(sent_at), 0), stored == 1, first == 1)
+
+
+def record_push_received(redis_cache, unique_key, attempt):
+    """
+    Function to store the time the app received the push of an attempt of a
+    call, without touching the database.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache the state is stored in.
+        unique_key (string): The unique_key of the call.
+        attempt (int): The attempt of the push.
+
+    Returns:
+        PushReceipt: The receipt or None when the call or attempt is unknown.
+    """
+    result = redis_cache.run_script(
+        PUSH_RECEIVED_SCRIPT, [get_call_cache_key(unique_key)], [attempt, time.time()])
+    if result is None:
+        return None
+    return get_push_receipt(result, attempt)
+
+
+def set_call_response(redis_cache, unique_key, value):
+    """
+    Function to store the outcome of a call and wake up the request that is
+    waiting for it. The waiting request is woken up directly when it is
+    parked in this process, otherwise the outcome is published. Only the
+    first outcome of a call is stored.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache to store the outcome in.
+        unique_key (string): The unique_key of the call.
+        value (string): The outcome, 'True', 'False', 'Removed' or
+            'Cancelled'.
+
+    Returns:
+        tuple: The state of the call as dict, or None for an unknown call,
+            and True if the outcome was handed off in this process.
+    """
+    call_state, stored, handed_off = store_call_outcome(redis_cache, unique_key, value)
+    return call_state, handed_off
+
+
+def store_call_outcome(redis_cache, unique_key, value):
+    """
+    Function like `set_call_response` that also tells if the outcome was
+    stored.
+
+    Returns:
+        tuple: The state of the call as dict or None for an unknown call,
+            True if this outcome was stored and True if it was handed off
+            in this process.
+    """
+    parked = pending_calls.is_pending(unique_key)
+    result = redis_cache.run_script(
+        SET_OUTCOME_SCRIPT,
+        [get_call_cache_key(unique_key)],
+        [value, '' if parked else get_call_channel(unique_key), time.time()],
+    )
+    if result is None:
+        return None, False, False
+
+    call_state = dict(zip(STATE_FIELDS, result))
+    stored = result[-1] == 1
+    handed_off = False
+    if stored:
+        handed_off = parked and pending_calls.resolve(unique_key, value)
+        if parked and not handed_off:
+            # The call left the registry in the meantime, let the other
+            # processes know after all.
+            redis_cache.client.publish(get_call_channel(unique_key), value)
+    return call_state, stored, handed_off
+
+
+def cancel_call(redis_cache, unique_key):
+    """
+    Function to cancel a call that waits for the app. The waiting request is
+    woken up like by `set_call_response` and answers with a NAK.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache the state is stored in.
+        unique_key (string): The unique_key of the call.
+
+    Returns:
+        dict: The state of the call, or None when the call is unknown or
+            already has an outcome.
+    """
+    call_state, stored, handed_off = store_call_outcome(redis_cache, unique_key, 'Cancelled')
+    return call_state if stored else None
+
+
+def get_call_roundtrip(call_state):
+    """
+    Function to get the time between the start of a call and the response of
+    the app, measured on the Redis server.
+
+    Args:
+        call_state (dict): The state returned by `set_call_response`.
+
+    Returns:
+        float: The roundtrip in seconds.
+    """
+    return float(call_state[STATE_RESPONDED_AT]) - float(call_state[STATE_STARTED_AT])
+
+
+def is_call_response_late(call_state):
+    """
+    Function to check if the app responded after the call stopped waiting.
+
+    Args:
+        call_state (dict): The state returned by `set_call_response`.
+
+    Returns:
+        bool: True if the roundtrip exceeds the wait of the call.
+    """
+    # Calls started before the wait was stored waited APP_PUSH_ROUNDTRIP_WAIT.
+    wait = float(call_state[STATE_WAIT] or settings.APP_PUSH_ROUNDTRIP_WAIT / 1000)
+    return get_call_roundtrip(call_state) > wait
+
+
+class PollCallWaiter(object):
+    """
+    Waiter that checks the cache every POLL_INTERVAL for the outcome.
+    """
+    def __init__(self, redis_cache, unique_key):
+        self.redis_cache = redis_cache
+        self.cache_key = get_call_cache_key(unique_key)
+        self.pending_call = pending_calls.register(unique_key)
+
+    def get_interval(self):
+        return POLL_INTERVAL
+
+    def wait(self, timeout):
+        """
+        Wait for at most timeout seconds and return the outcome.
+
+        Args:
+            timeout (float): Max seconds to wait.
+
+        Returns:
+            string: The outcome handed off in this process or the cached
+                outcome of the call.
+        """
+        if self.pending_call.event.wait(max(min(timeout, self.get_interval()), 0)):
+            return self.pending_call.value
+        return self.redis_cache.hget(self.cache_key, STATE_OUTCOME)
+
+    def close(self):
+        pending_calls.unregister(self.pending_call)
+
+
+class NotifyCallWaiter(PollCallWaiter):
+    """
+    Waiter that is woken up by the call response listener and only checks
+    the cache every APP_PUSH_SAFETY_POLL_INTERVAL in case a notification got
+    lost.
+    """
+    def __init__(self, redis_cache, unique_key):
+        super(NotifyCallWaiter, self).__init__(redis_cache, unique_key)
+        call_response_listener.start()
+
+    def get_interval(self):
+        return settings.APP_PUSH_SAFETY_POLL_INTERVAL / 1000
+
+
+class BatchCallWaiter(PollCallWaiter):
+    """
+    Waiter that is woken up by the call state poller of this process and
+    does not access the cache itself.
+    """
+    def __init__(self, redis_cache, unique_key):
+        super(BatchCallWaiter, self).__init__(redis_cache, unique_key)
+        call_state_poller.start()
+
+    def wait(self, timeout):
+        if self.pending_call.event.wait(max(timeout, 0)):
+            return self.pending_call.value
+        return None
+
+
+def get_call_waiter(redis_cache, unique_key):
+    """
+    Function to get a waiter for the configured APP_PUSH_WAIT_MODE. The
+    waiter must be created before the first push is sent and closed when the
+    call is done.
+
+    Args:
+        redis_cache (RedisClusterCache): The cache the outcome is stored in.
+        unique_key (string): The unique_key of the call.
+
+    Returns:
+        PollCallWaiter, NotifyCallWaiter or BatchCallWaiter.
+    """
+    if settings.APP_PUSH_WAIT_MODE == WAIT_MODE_POLL:
+        return PollCallWaiter(redis_cache, unique_key)
+    if settings.APP_PUSH_WAIT_MODE == WAIT_MODE_BATCH:
+        return BatchCallWaiter(redis_cache, unique_key)
+    return NotifyCallWaiter(redis_cache, unique_key)
+
+
+class GroupCallWaiter(object):
+    """
+    Waiter for the calls to the devices of a group call. The pending calls
+    share one event that is set when any of them gets an outcome, and the
+    cache is checked for all of them with one script.
+    """
+    def __init__(self, redis_cache, unique_keys):
+        self.redis_cache = redis_cache
+        self.event = Event()
+        self.pending_calls = [pending_calls.register(unique_key, self.event) for unique_key in unique_keys]
+        self.cache_keys = [get_call_cache_key(unique_key) for unique_key in unique_keys]
+
+        # Like the waiter of a single call in the same mode, without an
+        # interval the call state poller checks the cache.
+        self.interval = None
+        if settings.APP_PUSH_WAIT_MODE == WAIT_MODE_POLL:
+            self.interval = POLL_INTERVAL
+        elif settings.APP_PUSH_WAIT_MODE == WAIT_MODE_BATCH:
+            call_state_poller.start()
+        else:
+            self.interval = settings.APP_PUSH_SAFETY_POLL_INTERVAL / 1000
+            call_response_listener.start()
+
+    def wait(self, timeout):
+        """
+        Wait for at most timeout seconds and return the outcomes.
+
+        Args:
+            timeout (float): Max seconds to wait.
+
+        Returns:
+            dict: The outcome by unique_key of the calls that have one.
+        """
+        if self.interval is None:
+            woken_up = self.event.wait(max(timeout, 0))
+        else:
+            woken_up = self.event.wait(max(min(timeout, self.interval), 0))
+
+        if woken_up or self.interval is None:
+            self.event.clear()
+            return {
+                pending_call.unique_key: pending_call.value
+                for pending_call in self.pending_calls if pending_call.value is not None
+            }
+
+        values = self.redis_cache.run_script(GET_OUTCOMES_SCRIPT, self.cache_keys, [])
+        return {
+            pending_call.unique_key: value
+            for pending_call, value in zip(self.pending_calls, values) if value in CALL_OUTCOMES
+        }
+
+    def close(self):
+        for pending_call in self.pending_calls:
+            pending_calls.unregister(pending_call)
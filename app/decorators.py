@@ -1,10 +1,16 @@
-from threading import Thread
+from functools import wraps
 
 
-def threaded(fn):
+def executed(executor):
     """
-    Decorator to make a function run in his own thread.
+    Decorator to make a function run as a task of a BoundedExecutor.
+
+    Args:
+        executor (BoundedExecutor): The executor of the workload.
     """
-    def wrapper(*args, **kwargs):
-        Thread(target=fn, args=args, kwargs=kwargs).start()
-    return wrapper
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return executor.submit(fn, *args, **kwargs)
+        return wrapper
+    return decorator
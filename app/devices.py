@@ -0,0 +1,549 @@
+from collections import OrderedDict
+import json
+import logging
+from threading import Event, Lock, Thread
+import time
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from redis import StrictRedis
+
+from app.cache import get_redis_cache, get_startup_nodes
+from app.models import App, Device
+from app.utils import log_middleware_information
+from main.prometheus.consts import (
+    CACHE_HIT_VALUE,
+    CACHE_LOCAL_VALUE,
+    CACHE_MISS_VALUE,
+    CACHE_REDIS_VALUE,
+    RESULT_KEY,
+    TIER_KEY,
+    VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY)
+
+# Prefixes for the cache keys of the Redis copies of the records, the
+# devices are cached per sip_user_id.
+DEVICE_CACHE_KEY_PREFIX = 'devices_'
+APP_CACHE_KEY_PREFIX = 'app_'
+
+# Channel on which the processes are told to drop their local copy, the
+# messages are the token of the sending process and the key.
+DEVICE_CACHE_CHANNEL = 'device_cache_invalidate'
+
+# Format of the key with the generation of a record, the hash tag keeps it in
+# the slot of the Redis copy for the scripts.
+GENERATION_KEY_FORMAT = '{{{0}}}_generation'
+
+# Store the Redis copy of a record unless it was invalidated since the
+# generation was read, so a copy read from the database before a write isn't
+# stored after the invalidation of that write.
+# KEYS: copy, generation. ARGV: generation, data, ttl. Returns 1 when stored.
+SET_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# Drop the Redis copy of a record and start a new generation.
+# KEYS: copy, generation. ARGV: ttl.
+INVALIDATE_SCRIPT = """
+redis.call('DEL', KEYS[1])
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+"""
+
+
+class LocalCache(object):
+    """
+    Thread safe LRU cache with a TTL for the records of this process.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get a value that did not expire and mark it as recently used.
+
+        Args:
+            key (string): The key of the value.
+
+        Returns:
+            The value or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Store a value and drop the least recently used one when full.
+        """
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def serialize_instance(instance):
+    """
+    Function to serialize the concrete fields of a model instance.
+
+    Args:
+        instance (Model): The instance to serialize.
+
+    Returns:
+        string: JSON with the field values by attname.
+    """
+    return json.dumps(
+        {field.attname: getattr(instance, field.attname) for field in instance._meta.concrete_fields},
+        cls=DjangoJSONEncoder,
+    )
+
+
+def deserialize_instance(model, data):
+    """
+    Function to build a model instance from `serialize_instance` output as
+    if it was loaded from the database.
+
+    Args:
+        model (Model): The class of the instance.
+        data (string): The JSON with the field values.
+
+    Returns:
+        Model: The instance.
+    """
+    values = json.loads(data)
+    fields = model._meta.concrete_fields
+    return model.from_db(
+        router.db_for_read(model),
+        [field.attname for field in fields],
+        [field.to_python(values[field.attname]) for field in fields],
+    )
+
+
+def serialize_devices(devices):
+    """
+    Function to serialize the devices of a sip_user_id for the cache.
+    """
+    return json.dumps([serialize_instance(device) for device in devices])
+
+
+def deserialize_devices(data):
+    """
+    Function to build the devices from `serialize_devices` output.
+    """
+    return [deserialize_instance(Device, device_data) for device_data in json.loads(data)]
+
+
+class DeviceCache(object):
+    """
+    Two tier cache of the Device and App records for the incoming call. The
+    first tier is a LRU in this process, the second a copy in Redis, both
+    hold the serialized records so every lookup gets its own instances.
+
+    Writes to the records invalidate both tiers, the other processes drop
+    their local copy through pub/sub and otherwise after
+    DEVICE_CACHE_LOCAL_TTL. A copy is only stored when the record was not
+    invalidated since the lookup missed.
+    """
+    def __init__(self):
+        self.local = LocalCache(settings.DEVICE_CACHE_LOCAL_SIZE, settings.DEVICE_CACHE_LOCAL_TTL / 1000)
+        self.listener = None
+        self.subscribed = Event()
+        self.token = ''
+        self._lock = Lock()
+
+    def get_account_devices(self, sip_user_id):
+        """
+        Get the devices of a sip_user_id with their apps.
+
+        Args:
+            sip_user_id (string): The sip_user_id of the devices.
+
+        Returns:
+            list: The devices with the app set, the most recently seen first.
+
+        Raises:
+            Device.DoesNotExist: When there is no device for the sip_user_id.
+        """
+        self._start_listener()
+        metrics = []
+        devices_data, generation = self._get(get_device_cache_key(sip_user_id), metrics)
+        if devices_data is None:
+            devices = list(Device.objects.select_related('app').filter(
+                sip_user_id=sip_user_id).order_by('-last_seen', 'id'))
+            if devices:
+                self._set_devices(sip_user_id, devices, generation)
+            self._push_metrics(metrics)
+        else:
+            devices = deserialize_devices(devices_data)
+            if not self._set_apps(devices, metrics):
+                # The app and with it the device were deleted.
+                invalidate_device(sip_user_id)
+                devices = []
+            self._push_metrics(metrics)
+
+        if not devices:
+            raise Device.DoesNotExist('Device matching query does not exist.')
+        return devices
+
+    def get_device(self, sip_user_id, device_id=None):
+        """
+        Get a device of a sip_user_id with its app.
+
+        Args:
+            sip_user_id (string): The sip_user_id of the device.
+            device_id (string): The id of the device, by default the most
+                recently seen device of the sip_user_id.
+
+        Returns:
+            Device: The device with the app set.
+
+        Raises:
+            Device.DoesNotExist: When there is no device for the sip_user_id
+                with the id.
+        """
+        devices = self.get_account_devices(sip_user_id)
+        if device_id is None:
+            return devices[0]
+        for device in devices:
+            if device.id == device_id:
+                return device
+        raise Device.DoesNotExist('Device matching query does not exist.')
+
+    def get_devices(self, sip_user_ids):
+        """
+        Get the devices for several sip_user_ids with their apps, from this
+        process or with one query for the rest instead of a lookup per
+        sip_user_id.
+
+        Args:
+            sip_user_ids (list): The sip_user_ids of the devices.
+
+        Returns:
+            OrderedDict: The lists of devices with the app set by
+                sip_user_id, in the order of sip_user_ids and without the
+                ones without a device.
+        """
+        self._start_listener()
+        metrics = []
+        devices = {}
+        missing = []
+        for sip_user_id in sip_user_ids:
+            devices_data = self.local.get(get_device_cache_key(sip_user_id))
+            if devices_data is not None:
+                account_devices = deserialize_devices(devices_data)
+                if self._set_apps(account_devices, metrics, local_only=True):
+                    metrics.append({TIER_KEY: CACHE_LOCAL_VALUE, RESULT_KEY: CACHE_HIT_VALUE})
+                    devices[str(sip_user_id)] = account_devices
+                    continue
+            metrics.append({TIER_KEY: CACHE_LOCAL_VALUE, RESULT_KEY: CACHE_MISS_VALUE})
+            missing.append(str(sip_user_id))
+
+        if missing:
+            generations = self._get_generations([get_device_cache_key(sip_user_id) for sip_user_id in missing])
+            for device in Device.objects.select_related('app').filter(
+                    sip_user_id__in=missing).order_by('sip_user_id', '-last_seen', 'id'):
+                devices.setdefault(device.sip_user_id, []).append(device)
+            for sip_user_id, generation in zip(missing, generations):
+                if sip_user_id in devices:
+                    self._set_devices(sip_user_id, devices[sip_user_id], generation)
+
+        if metrics:
+            self._push_metrics(metrics)
+        return OrderedDict(
+            (str(sip_user_id), devices[str(sip_user_id)]) for sip_user_id in sip_user_ids
+            if str(sip_user_id) in devices
+        )
+
+    def invalidate(self, key):
+        """
+        Drop a record from both tiers in all processes.
+
+        Args:
+            key (string): The cache key of the record.
+        """
+        self.local.delete(key)
+        redis_cache = get_redis_cache()
+        redis_cache.run_script(
+            INVALIDATE_SCRIPT, [key, get_generation_key(key)], [settings.DEVICE_CACHE_REDIS_TTL // 1000])
+        redis_cache.client.publish(DEVICE_CACHE_CHANNEL, '{0} {1}'.format(self.token, key))
+
+    def _get(self, key, metrics):
+        """
+        Get a record from the first tier that has it.
+
+        Returns:
+            tuple: The data or None and on a miss the generation for `_set`.
+        """
+        data = self.local.get(key)
+        if data is not None:
+            metrics.append({TIER_KEY: CACHE_LOCAL_VALUE, RESULT_KEY: CACHE_HIT_VALUE})
+            return data, None
+
+        metrics.append({TIER_KEY: CACHE_LOCAL_VALUE, RESULT_KEY: CACHE_MISS_VALUE})
+        data = get_redis_cache().get(key)
+        if data is not None:
+            metrics.append({TIER_KEY: CACHE_REDIS_VALUE, RESULT_KEY: CACHE_HIT_VALUE})
+            self.local.set(key, data)
+            return data, None
+
+        metrics.append({TIER_KEY: CACHE_REDIS_VALUE, RESULT_KEY: CACHE_MISS_VALUE})
+        return None, self._get_generations([key])[0]
+
+    def _get_generations(self, keys):
+        # Read before the database, so a write in between is noticed.
+        return [
+            generation or '' for generation in
+            get_redis_cache().client.mget([get_generation_key(key) for key in keys])
+        ]
+
+    def _set_devices(self, sip_user_id, devices, generation):
+        self._set(get_device_cache_key(sip_user_id), serialize_devices(devices), generation)
+        for app in {device.app_id: device.app for device in devices}.values():
+            # The generation of the app wasn't read before the query.
+            self._set(get_app_cache_key(app.pk), serialize_instance(app))
+
+    def _set_apps(self, devices, metrics, local_only=False):
+        """
+        Set the cached apps on the devices, the apps that are not cached are
+        read from the database unless local_only is set.
+
+        Returns:
+            bool: False when an app is missing.
+        """
+        apps = {}
+        for app_id in {device.app_id for device in devices}:
+            key = get_app_cache_key(app_id)
+            app_data, generation = (self.local.get(key), None) if local_only else self._get(key, metrics)
+            if app_data is not None:
+                apps[app_id] = deserialize_instance(App, app_data)
+            elif local_only:
+                return False
+            else:
+                try:
+                    apps[app_id] = App.objects.get(pk=app_id)
+                except App.DoesNotExist:
+                    return False
+                self._set(key, serialize_instance(apps[app_id]), generation)
+
+        for device in devices:
+            device.app = apps[device.app_id]
+        return True
+
+    def _set(self, key, data, generation=None):
+        """
+        Store a record in both tiers unless it was invalidated since the
+        generation was read. Without a generation the Redis copy is kept
+        for DEVICE_CACHE_LOCAL_TTL, as long as a local copy may be stale.
+        """
+        self.local.set(key, data)
+        redis_cache = get_redis_cache()
+        if generation is None:
+            redis_cache.set(key, data, settings.DEVICE_CACHE_LOCAL_TTL // 1000)
+        elif not redis_cache.run_script(
+                SET_SCRIPT,
+                [key, get_generation_key(key)],
+                [generation, data, settings.DEVICE_CACHE_REDIS_TTL // 1000],
+        ):
+            # The local copy is as old as the one that was refused.
+            self.local.delete(key)
+
+    def _push_metrics(self, metrics):
+        # Push data to Redis to count the hits and misses per tier.
+        get_redis_cache().client.rpush(VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY, *metrics)
+
+    def _start_listener(self):
+        """
+        Start the thread that drops local copies invalidated by other
+        processes if it is not running yet, a forked process starts its own.
+        The lookups wait until it subscribed, so the local copies aren't
+        cleared after they were stored.
+        """
+        if self.listener is None or not self.listener.is_alive():
+            with self._lock:
+                if self.listener is None or not self.listener.is_alive():
+                    self.subscribed = Event()
+                    self.token = uuid.uuid4().hex
+                    self.listener = Thread(target=self._listen, args=(self.subscribed,), daemon=True)
+                    self.listener.start()
+        if not self.subscribed.is_set():
+            self.subscribed.wait(settings.REDIS_SOCKET_CONNECT_TIMEOUT / 1000)
+
+    def _listen(self, subscribed):
+        node = get_startup_nodes()[0]
+        while True:
+            pubsub = StrictRedis(host=node['host'], port=node['port'], decode_responses=True).pubsub(
+                ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(DEVICE_CACHE_CHANNEL)
+                # Invalidations sent while not subscribed may have been missed.
+                self.local.clear()
+                subscribed.set()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        # This process already dropped the copies it invalidated.
+                        token, _, key = message['data'].rpartition(' ')
+                        if token != self.token:
+                            self.local.delete(key)
+            except Exception:
+                log_middleware_information(
+                    'Device cache listener failed, reconnecting',
+                    OrderedDict(),
+                    logging.ERROR,
+                )
+                time.sleep(1)
+            finally:
+                pubsub.reset()
+
+
+device_cache = DeviceCache()
+
+
+def get_device_cache_key(sip_user_id):
+    """
+    Function to get the cache key of the devices of a sip_user_id.
+
+    Args:
+        sip_user_id (string): The sip_user_id of the devices.
+
+    Returns:
+        string: The cache key.
+    """
+    return '{0}{1}'.format(DEVICE_CACHE_KEY_PREFIX, sip_user_id)
+
+
+def get_app_cache_key(app_pk):
+    """
+    Function to get the cache key of an app.
+
+    Args:
+        app_pk (int): The primary key of the app.
+
+    Returns:
+        string: The cache key.
+    """
+    return '{0}{1}'.format(APP_CACHE_KEY_PREFIX, app_pk)
+
+
+def get_generation_key(key):
+    """
+    Function to get the key of the generation of a cached record.
+
+    Args:
+        key (string): The cache key of the record.
+
+    Returns:
+        string: The generation key, in the slot of the cache key.
+    """
+    return GENERATION_KEY_FORMAT.format(key)
+
+
+def get_cached_device(sip_user_id, device_id=None):
+    """
+    Function to get a device for a sip_user_id from the device cache.
+
+    Args:
+        sip_user_id (string): The sip_user_id of the device.
+        device_id (string): The id of the device, by default the most
+            recently seen device of the sip_user_id.
+
+    Returns:
+        Device: The device with the app set.
+
+    Raises:
+        Device.DoesNotExist: When there is no device for the sip_user_id.
+    """
+    return device_cache.get_device(sip_user_id, device_id)
+
+
+def get_cached_account_devices(sip_user_id):
+    """
+    Function to get all devices of a sip_user_id from the device cache.
+
+    Args:
+        sip_user_id (string): The sip_user_id of the devices.
+
+    Returns:
+        list: The devices with the app set, the most recently seen first.
+
+    Raises:
+        Device.DoesNotExist: When there is no device for the sip_user_id.
+    """
+    return device_cache.get_account_devices(sip_user_id)
+
+
+def get_cached_devices(sip_user_ids):
+    """
+    Function to get the devices for several sip_user_ids from the device
+    cache, see `DeviceCache.get_devices`.
+
+    Args:
+        sip_user_ids (list): The sip_user_ids of the devices.
+
+    Returns:
+        OrderedDict: The lists of devices with the app set by sip_user_id.
+    """
+    return device_cache.get_devices(sip_user_ids)
+
+
+def invalidate_device(sip_user_id):
+    """
+    Function to drop the devices of a sip_user_id from the device cache.
+    """
+    device_cache.invalidate(get_device_cache_key(sip_user_id))
+
+
+def invalidate_app(app_pk):
+    """
+    Function to drop an app from the device cache.
+    """
+    device_cache.invalidate(get_app_cache_key(app_pk))
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def invalidate_cached_device(sender, instance, **kwargs):
+    """
+    Invalidate the cached device after a write through DeviceView, the FCM
+    NotRegistered removal, the admin or any other save or delete.
+    """
+    # Django clears the pk of deleted instances, so don't read it on commit.
+    sip_user_id = instance.sip_user_id
+    transaction.on_commit(lambda: invalidate_device(sip_user_id))
+
+
+@receiver(post_save, sender=App)
+@receiver(post_delete, sender=App)
+def invalidate_cached_app(sender, instance, **kwargs):
+    """
+    Invalidate the cached app after it was edited or deleted.
+    """
+    app_pk = instance.pk
+    transaction.on_commit(lambda: invalidate_app(app_pk))
@@ -0,0 +1,292 @@
+import atexit
+from collections import OrderedDict
+import logging
+import os
+import queue
+import socket
+from threading import current_thread, Lock, Thread
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from app.cache import get_redis_cache
+from app.utils import log_middleware_information
+from main.prometheus.consts import (
+    ACTIVE_WORKERS_KEY,
+    EXECUTOR_KEY,
+    LATENCY_KEY,
+    QUEUE_DEPTH_KEY,
+    UPDATED_AT_KEY,
+    VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY,
+    VIALER_MIDDLEWARE_EXECUTOR_STATS_KEY,
+    VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY,
+    WORKERS_KEY)
+
+# What to do with a task when the queue of an executor is full: run it in
+# the thread that submits it or drop it.
+OVERFLOW_CALLER_RUNS = 'caller_runs'
+OVERFLOW_REJECT = 'reject'
+
+# Max task latencies kept per executor until they are reported.
+MAX_LATENCY_SAMPLES = 1000
+
+
+class BoundedExecutor(object):
+    """
+    Pool of at most max_workers threads that run the tasks from a queue of
+    at most max_queue tasks. Workers are started when there is no idle one
+    and the database connections of a worker are closed after each task.
+
+    Uses threading and queue only, so under the gevent worker the workers
+    are greenlets.
+    """
+    def __init__(self, name, max_workers, max_queue, overflow):
+        self.name = name
+        self.max_workers = max_workers
+        self.overflow = overflow
+        self._queue = queue.Queue(max_queue)
+        self._lock = Lock()
+        self._workers = []
+        self._idle = 0
+        self._active = 0
+        self._latencies = []
+        self._rejected = 0
+        self._shutdown = False
+
+    def get_stats(self):
+        """
+        Get the current stats of the executor and reset the latencies and
+        the rejected count.
+
+        Returns:
+            tuple: Dict with the queue depth, active and started workers,
+                the task latencies and the number of rejected tasks.
+        """
+        with self._lock:
+            latencies, self._latencies = self._latencies, []
+            rejected, self._rejected = self._rejected, 0
+            return {
+                QUEUE_DEPTH_KEY: self._queue.qsize(),
+                ACTIVE_WORKERS_KEY: self._active,
+                WORKERS_KEY: len(self._workers),
+            }, latencies, rejected
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a task, applying the overflow policy when the queue is full.
+
+        Args:
+            fn (function): The function to run.
+
+        Returns:
+            bool: False if the task was rejected.
+        """
+        task = (time.time(), fn, args, kwargs)
+        if self._shutdown:
+            return self._overflow(task)
+
+        try:
+            self._queue.put_nowait(task)
+        except queue.Full:
+            return self._overflow(task)
+
+        with self._lock:
+            if self._idle == 0 and len(self._workers) < self.max_workers:
+                worker = Thread(target=self._work, daemon=True)
+                self._workers.append(worker)
+                worker.start()
+        executor_stats_reporter.start()
+        return True
+
+    def shutdown(self, timeout):
+        """
+        Stop accepting tasks and wait for at most timeout seconds until the
+        queued tasks are done.
+
+        Args:
+            timeout (float): Max seconds to wait.
+
+        Returns:
+            bool: True if all workers finished.
+        """
+        self._shutdown = True
+        deadline = time.time() + timeout
+        with self._lock:
+            workers = list(self._workers)
+
+        try:
+            # Stop every worker after the queued tasks.
+            for _ in workers:
+                self._queue.put(None, timeout=max(deadline - time.time(), 0))
+        except queue.Full:
+            return False
+
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0))
+        return not any(worker.is_alive() for worker in workers)
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            task = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            if task is None:
+                with self._lock:
+                    self._workers.remove(current_thread())
+                return
+            self._run(task)
+            # Don't keep connections open between tasks, a worker may idle
+            # for a long time.
+            connections.close_all()
+
+    def _run(self, task):
+        enqueued_at, fn, args, kwargs = task
+        with self._lock:
+            self._active += 1
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            log_middleware_information(
+                'Task {0} of the {1} executor failed',
+                OrderedDict([
+                    ('task', fn.__name__),
+                    ('executor', self.name),
+                ]),
+                logging.ERROR,
+            )
+        finally:
+            with self._lock:
+                self._active -= 1
+                if len(self._latencies) < MAX_LATENCY_SAMPLES:
+                    self._latencies.append(time.time() - enqueued_at)
+
+    def _overflow(self, task):
+        if self.overflow == OVERFLOW_CALLER_RUNS and not self._shutdown:
+            self._run(task)
+            return True
+
+        with self._lock:
+            self._rejected += 1
+        log_middleware_information(
+            'Rejected task {0}, the {1} executor is full',
+            OrderedDict([
+                ('task', task[1].__name__),
+                ('executor', self.name),
+            ]),
+            logging.WARNING,
+        )
+        return False
+
+
+class ExecutorStatsReporter(object):
+    """
+    One thread per process that writes the stats of the executors to Redis
+    every EXECUTOR_STATS_INTERVAL for the Prometheus exporter.
+    """
+    def __init__(self, executors):
+        self.executors = executors
+        self.thread = None
+        self._lock = Lock()
+        self._process = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+    def start(self):
+        """
+        Start the thread if it is not running yet.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.EXECUTOR_STATS_INTERVAL / 1000)
+            try:
+                self.report()
+            except Exception:
+                log_middleware_information(
+                    'Reporting the executor stats failed',
+                    OrderedDict(),
+                    logging.ERROR,
+                )
+
+    def report(self):
+        """
+        Write the gauges of every executor and push the task latencies and
+        rejected tasks since the last report.
+        """
+        client = get_redis_cache().client
+        latency_data = []
+        rejected_data = []
+        for executor in self.executors:
+            stats, latencies, rejected = executor.get_stats()
+            stats[EXECUTOR_KEY] = executor.name
+            stats[UPDATED_AT_KEY] = time.time()
+            client.hset(
+                VIALER_MIDDLEWARE_EXECUTOR_STATS_KEY,
+                '{0}:{1}'.format(self._process, executor.name),
+                stats,
+            )
+            latency_data += [{EXECUTOR_KEY: executor.name, LATENCY_KEY: latency} for latency in latencies]
+            rejected_data += [{EXECUTOR_KEY: executor.name}] * rejected
+
+        # Push data to Redis in one go per metric.
+        if latency_data:
+            client.rpush(VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY, *latency_data)
+        if rejected_data:
+            client.rpush(VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY, *rejected_data)
+
+
+# Executors per workload. Pushes for incoming calls run in the request when
+# the queue is full, the other tasks can be dropped.
+push_executor = BoundedExecutor(
+    'push',
+    settings.PUSH_EXECUTOR_WORKERS,
+    settings.PUSH_EXECUTOR_QUEUE,
+    OVERFLOW_CALLER_RUNS,
+)
+notify_executor = BoundedExecutor(
+    'notify',
+    settings.NOTIFY_EXECUTOR_WORKERS,
+    settings.NOTIFY_EXECUTOR_QUEUE,
+    OVERFLOW_REJECT,
+)
+db_log_executor = BoundedExecutor(
+    'db_log',
+    settings.DB_LOG_EXECUTOR_WORKERS,
+    settings.DB_LOG_EXECUTOR_QUEUE,
+    OVERFLOW_REJECT,
+)
+# Bulk notifications run for minutes, they are resumed when dropped.
+bulk_notify_executor = BoundedExecutor(
+    'bulk_notify',
+    settings.BULK_NOTIFY_EXECUTOR_WORKERS,
+    settings.BULK_NOTIFY_EXECUTOR_QUEUE,
+    OVERFLOW_REJECT,
+)
+executors = [push_executor, notify_executor, db_log_executor, bulk_notify_executor]
+
+executor_stats_reporter = ExecutorStatsReporter(executors)
+
+
+def drain_executors():
+    """
+    Function to let the executors finish their queued tasks when the process
+    stops, within EXECUTOR_DRAIN_TIMEOUT.
+    """
+    deadline = time.time() + settings.EXECUTOR_DRAIN_TIMEOUT / 1000
+    for executor in executors:
+        if not executor.shutdown(max(deadline - time.time(), 0)):
+            log_middleware_information(
+                'The {0} executor did not drain in time',
+                OrderedDict([('executor', executor.name)]),
+                logging.WARNING,
+            )
+
+
+atexit.register(drain_executors)
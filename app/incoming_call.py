@@ -0,0 +1,769 @@
+from collections import namedtuple, OrderedDict
+import datetime
+import logging
+import time
+
+from django.conf import settings
+
+from app.calls import (
+    get_call_roundtrip,
+    get_group_call_key,
+    get_group_member_key,
+    is_call_response_late,
+    STATE_DEVICE_ID,
+    STATE_OUTCOME,
+    STATE_SIP_USER_ID)
+from app.devices import get_cached_account_devices, get_cached_device
+from app.models import Device
+from app.sip_user_filter import ABSENT, sip_user_filter
+from app.utils import (
+    LOG_CALL_FROM,
+    LOG_CALLER_ID,
+    log_data_to_metrics_log,
+    log_middleware_information,
+    LOG_SIP_USER_ID)
+from main.prometheus.consts import (
+    ACTION_KEY,
+    ATTEMPT_KEY,
+    CALL_SETUP_SUCCESSFUL_KEY,
+    DIRECTION_KEY,
+    FAILED_REASON_KEY,
+    FIRST_KEY,
+    HANDOFF_KEY,
+    HANDOFF_LOCAL_VALUE,
+    HANDOFF_REDIS_VALUE,
+    LATENCY_KEY,
+    OS_KEY,
+    SAVED_SECONDS_KEY,
+    VIALER_MIDDLEWARE_CALL_CANCELLED_KEY,
+    VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY,
+    VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY,
+    VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY,
+    VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY,
+    VIALER_MIDDLEWARE_INCOMING_VALUE,
+    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY,
+    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY,
+    VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY)
+
+# The decisions of the incoming call flow, shared by the web views and the
+# ASGI app. The functions log, but leave the Redis, database and push I/O
+# to the caller: the metrics for the Prometheus process are returned as a
+# list of (key, data) for the caller to push with its own client.
+
+ACK = 'status=ACK'
+NAK = 'status=NAK'
+
+# Outcomes of a call the app responded to.
+RESPONDED_OUTCOMES = ('True', 'False')
+
+# The response of a step of the call, the body for asterisk or the status
+# code for the app, and the metrics to push.
+CallResult = namedtuple('CallResult', ['response', 'metrics'])
+
+# The result of a response of the app: the status code, the metrics to
+# push, the roundtrip and whether the roundtrip goes in the response
+# history of the device.
+CallResponseResult = namedtuple('CallResponseResult', ['status', 'metrics', 'roundtrip', 'responded'])
+
+
+def _get_now():
+    return datetime.datetime.fromtimestamp(time.time()).strftime('%H:%M:%S.%f')
+
+
+def find_call_devices(sip_user_id):
+    """
+    Function to find the devices to call for a sip_user_id.
+
+    Args:
+        sip_user_id (string): The sip_user_id that is called.
+
+    Returns:
+        list: The devices, the most recently seen first, or None when the
+            sip_user_id filter knows there is no device.
+
+    Raises:
+        Device.DoesNotExist: When there is no device for the sip_user_id.
+    """
+    if sip_user_filter.contains(sip_user_id) == ABSENT:
+        return None
+    return get_cached_account_devices(sip_user_id)[:settings.MAX_DEVICES_PER_SIP_USER_ID]
+
+
+def find_cancel_device(call_state):
+    """
+    Function to find the device to send the cancel push to.
+
+    Args:
+        call_state (dict): The state of the cancelled call.
+
+    Returns:
+        Device: The device that was called or None when it is gone.
+    """
+    # Calls started before the device was stored called the most recently
+    # seen device.
+    try:
+        return get_cached_device(call_state[STATE_SIP_USER_ID], call_state.get(STATE_DEVICE_ID) or None)
+    except Device.DoesNotExist:
+        return None
+
+
+def get_filtered_call_result():
+    """
+    Function to get the result of a call for a sip_user_id the filter knows
+    has no device, answered without a lookup.
+
+    Returns:
+        CallResult: The NAK and the metrics.
+    """
+    return CallResult(NAK, [
+        (VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY, {
+            OS_KEY: 'Middleware',
+            ACTION_KEY: 'Received',
+            FAILED_REASON_KEY: 'failed no sip_user_id',
+        }),
+    ])
+
+
+def log_no_device(unique_key, sip_user_id):
+    """
+    Function to log a call for a sip_user_id without a device.
+
+    Returns:
+        CallResult: The NAK and the metrics.
+    """
+    log_middleware_information(
+        '{0} | Failed to find a device for SIP_user_ID : {1} sending NAK',
+        OrderedDict([
+            ('unique_key', unique_key),
+            (LOG_SIP_USER_ID, sip_user_id),
+        ]),
+        logging.WARNING,
+    )
+
+    # Log to the metrics file.
+    metrics_data = {
+        OS_KEY: 'Middleware',
+        ACTION_KEY: 'Received',
+        FAILED_REASON_KEY: 'failed no sip_user_id',
+        'unique_key': unique_key,
+    }
+    log_data_to_metrics_log(metrics_data, sip_user_id)
+    return get_filtered_call_result()
+
+
+def log_device_lookup_failed(unique_key, sip_user_id):
+    """
+    Function to log a call of which the device lookup failed.
+
+    Returns:
+        CallResult: The NAK without metrics.
+    """
+    log_middleware_information(
+        '{0} | EXCEPTION WHILE FINDING DEVICE FOR SIP_USER_ID : {1}',
+        OrderedDict([
+            ('unique_key', unique_key),
+            (LOG_SIP_USER_ID, sip_user_id),
+        ]),
+        logging.CRITICAL,
+    )
+    return CallResult(NAK, [])
+
+
+def log_call_received(unique_key, sip_user_id, device, phonenumber, caller_id):
+    """
+    Function to log a call for which a device was found.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+        sip_user_id (string): The sip_user_id that is called.
+        device (Device): The most recently seen device of the sip_user_id.
+        phonenumber (string): Phonenumber of the caller.
+        caller_id (string): Human readable caller id.
+
+    Returns:
+        list: The metrics.
+    """
+    log_middleware_information(
+        '{0} | Incoming call for SIP:{1} FROM:\'{2}/{3}\'',
+        OrderedDict([
+            ('unique_key', unique_key),
+            (LOG_SIP_USER_ID, sip_user_id),
+            (LOG_CALL_FROM, phonenumber),
+            (LOG_CALLER_ID, caller_id),
+        ]),
+        logging.INFO,
+        device=device,
+    )
+
+    # Log to the metrics file.
+    metrics_data = {
+        OS_KEY: 'Middleware',
+        ACTION_KEY: 'Received',
+        'unique_key': unique_key,
+    }
+    log_data_to_metrics_log(metrics_data, sip_user_id)
+    return [
+        (VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY, {
+            OS_KEY: 'Middleware',
+            ACTION_KEY: 'Received',
+        }),
+    ]
+
+
+def log_call_shed(unique_key, sip_user_id, device, reason):
+    """
+    Function to log a call that was shed because too many calls wait.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+        sip_user_id (string): The sip_user_id that is called.
+        device (Device): The device that would be called.
+        reason (string): The reason of the AdmissionRejected.
+
+    Returns:
+        CallResult: The NAK and the metrics.
+    """
+    platform = device.app.platform
+    log_middleware_information(
+        '{0} | {1} Too many waiting calls ({2}), sending NAK',
+        OrderedDict([
+            ('unique_key', unique_key),
+            ('platform', platform.upper()),
+            ('reason', reason),
+        ]),
+        logging.WARNING,
+        device=device,
+    )
+
+    # Log to the metrics file.
+    metrics_data = {
+        OS_KEY: platform,
+        CALL_SETUP_SUCCESSFUL_KEY: 'false',
+        FAILED_REASON_KEY: reason,
+    }
+    log_data_to_metrics_log(metrics_data, sip_user_id)
+    return CallResult(NAK, [
+        (VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY, {
+            OS_KEY: platform,
+            ACTION_KEY: 'Received',
+            FAILED_REASON_KEY: reason,
+        }),
+    ])
+
+
+def log_wait_started(unique_key, device, schedule):
+    """
+    Function to log the start of the wait for the app of a device.
+    """
+    log_middleware_information(
+        '{0} | {1} Starting \'wait for it\' loop until {2} ({3}msec), {4} policy resending every {5}msec',
+        OrderedDict([
+            ('unique_key', unique_key),
+            ('platform', device.app.platform.upper()),
+            ('wait_until', datetime.datetime.fromtimestamp(schedule.wait_until).strftime('%H:%M:%S.%f')),
+            ('roundtrip', int(schedule.policy.wait * 1000)),
+            ('policy', schedule.policy.source),
+            ('resend_interval', int(schedule.policy.resend_interval * 1000)),
+        ]),
+        logging.INFO,
+        device=device,
+    )
+
+
+def log_call_outcome(unique_key, sip_user_id, device, available, wait_until):
+    """
+    Function to log the outcome of a call to a device.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+        sip_user_id (string): The sip_user_id that is called.
+        device (Device): The device that is called.
+        available (string): The outcome, 'True', 'False', 'Removed' or
+            'Cancelled'.
+        wait_until (float): The time the call would stop waiting.
+
+    Returns:
+        CallResult: The ACK or NAK and the metrics.
+    """
+    platform = device.app.platform
+
+    if available == 'True':
+        log_middleware_information(
+            '{0} | {1} Device checked in on time, sending ACK on {2}',
+            OrderedDict([
+                ('unique_key', unique_key),
+                ('platform', platform.upper()),
+                ('ack_time', _get_now()),
+            ]),
+            logging.INFO,
+            device=device,
+        )
+
+        # Log to the metrics file.
+        metrics_data = {
+            OS_KEY: platform,
+            CALL_SETUP_SUCCESSFUL_KEY: 'true',
+        }
+        log_data_to_metrics_log(metrics_data, sip_user_id)
+
+        # Success status for asterisk.
+        return CallResult(ACK, [
+            (VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY, {
+                OS_KEY: platform,
+                DIRECTION_KEY: VIALER_MIDDLEWARE_INCOMING_VALUE,
+            }),
+        ])
+
+    if available == 'False':
+        log_middleware_information(
+            '{0} | {1} Device not available, sending NAK on {2}',
+            OrderedDict([
+                ('unique_key', unique_key),
+                ('platform', platform.upper()),
+                ('nak_time', _get_now()),
+            ]),
+            logging.INFO,
+            device=device,
+        )
+
+        # Log to the metrics file.
+        metrics_data = {
+            OS_KEY: platform,
+            CALL_SETUP_SUCCESSFUL_KEY: 'false',
+            FAILED_REASON_KEY: 'Device not available',
+        }
+        log_data_to_metrics_log(metrics_data, sip_user_id)
+        return CallResult(NAK, [
+            (VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY, {
+                OS_KEY: platform,
+                DIRECTION_KEY: VIALER_MIDDLEWARE_INCOMING_VALUE,
+                FAILED_REASON_KEY: 'Device not available',
+            }),
+        ])
+
+    if available == 'Cancelled':
+        saved_seconds = max(wait_until - time.time(), 0)
+        log_middleware_information(
+            '{0} | {1} Call cancelled {2:.2f}s before the deadline, sending NAK on {3}',
+            OrderedDict([
+                ('unique_key', unique_key),
+                ('platform', platform.upper()),
+                ('saved_seconds', saved_seconds),
+                ('nak_time', _get_now()),
+            ]),
+            logging.INFO,
+            device=device,
+        )
+
+        # Log to the metrics file.
+        metrics_data = {
+            OS_KEY: platform,
+            CALL_SETUP_SUCCESSFUL_KEY: 'false',
+            FAILED_REASON_KEY: 'Call cancelled',
+        }
+        log_data_to_metrics_log(metrics_data, sip_user_id)
+
+        # Track the cancelled calls and the wait they saved.
+        return CallResult(NAK, [
+            (VIALER_MIDDLEWARE_CALL_CANCELLED_KEY, {
+                OS_KEY: platform,
+                SAVED_SECONDS_KEY: saved_seconds,
+            }),
+        ])
+
+    log_middleware_information(
+        '{0} | {1} Device has no valid push token, sending NAK on {2}',
+        OrderedDict([
+            ('unique_key', unique_key),
+            ('platform', platform.upper()),
+            ('nak_time', _get_now()),
+        ]),
+        logging.INFO,
+        device=device,
+    )
+    return CallResult(NAK, [])
+
+
+def log_call_timed_out(unique_key, sip_user_id, device):
+    """
+    Function to log a call the app did not respond to in time.
+
+    Returns:
+        CallResult: The NAK and the metrics.
+    """
+    platform = device.app.platform
+    log_middleware_information(
+        '{0} | {1} Device did NOT check in on time, sending NAK on {2}',
+        OrderedDict([
+            ('unique_key', unique_key),
+            ('platform', platform.upper()),
+            ('nak_time', _get_now()),
+        ]),
+        logging.INFO,
+        device=device,
+    )
+
+    # Log to the metrics file.
+    metrics_data = {
+        OS_KEY: platform,
+        CALL_SETUP_SUCCESSFUL_KEY: 'false',
+        FAILED_REASON_KEY: 'Device did not respond in time',
+    }
+    log_data_to_metrics_log(metrics_data, sip_user_id)
+    return CallResult(NAK, [
+        (VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY, {
+            OS_KEY: platform,
+            DIRECTION_KEY: VIALER_MIDDLEWARE_INCOMING_VALUE,
+            FAILED_REASON_KEY: 'Unable to get response from phone',
+        }),
+    ])
+
+
+def log_duplicate_call(call_id):
+    """
+    Function to log a request for a call that is already handled.
+    """
+    log_middleware_information(
+        '{0} | Duplicate incoming call, waiting for the response of the first request',
+        OrderedDict([
+            ('unique_key', call_id),
+        ]),
+        logging.INFO,
+    )
+
+
+def get_coalesced_metrics(local):
+    """
+    Function to get the metrics of a duplicate request that got the response
+    of the first request, to track how often that was in this process.
+
+    Args:
+        local (bool): Whether the first request was in this process.
+
+    Returns:
+        list: The metrics.
+    """
+    return [
+        (VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY, {
+            HANDOFF_KEY: HANDOFF_LOCAL_VALUE if local else HANDOFF_REDIS_VALUE,
+        }),
+    ]
+
+
+class CallSchedule(object):
+    """
+    The deadline of a call and the times its pushes are resent.
+    """
+    def __init__(self, policy):
+        now = time.time()
+        self.policy = policy
+        self.wait_until = now + policy.wait
+        self.next_resend_time = now + policy.resend_interval
+        self.attempt = 1
+
+    def is_waiting(self):
+        return time.time() < self.wait_until
+
+    def get_timeout(self):
+        """
+        Get the seconds to wait for the app, until the next push is due at
+        the latest.
+        """
+        if self.attempt < self.policy.max_attempts:
+            return min(self.next_resend_time, self.wait_until) - time.time()
+        return self.wait_until - time.time()
+
+    def next_attempt(self):
+        """
+        Count the next push when it is due.
+
+        Returns:
+            int: The attempt of the push to send or None when no push is
+                due.
+        """
+        if time.time() < self.next_resend_time or self.attempt >= self.policy.max_attempts:
+            return None
+        self.attempt += 1
+        self.next_resend_time = time.time() + self.policy.resend_interval
+        return self.attempt
+
+
+class GroupCall(object):
+    """
+    A call to several devices at once, the first device that accepts gets
+    the call. The devices are called by the unique_key of their member and
+    the call is cancelled by the unique_key of the group.
+    """
+    def __init__(self, unique_key, devices):
+        self.unique_key = unique_key
+        self.group_key = get_group_call_key(unique_key)
+        self.devices = devices
+        # The state of the call with the devices by the unique_key their
+        # apps respond with.
+        self.members = OrderedDict([(self.group_key, devices[0])])
+        for member, device in enumerate(devices):
+            self.members[get_group_member_key(unique_key, member)] = device
+        self.member_keys = list(self.members)[1:]
+        self.outcomes = {}
+
+    def update(self, outcomes):
+        """
+        Add the outcomes of the calls.
+
+        Returns:
+            bool: True when a device responded.
+        """
+        self.outcomes.update(outcomes)
+        return any(self.outcomes.get(member_key) in RESPONDED_OUTCOMES for member_key in self.member_keys)
+
+    def is_cancelled(self):
+        return self.outcomes.get(self.group_key) == 'Cancelled'
+
+    def is_done(self):
+        """
+        Whether the call stops waiting: it was cancelled, a device accepted
+        or all devices responded.
+        """
+        return (
+            self.is_cancelled() or
+            any(self.outcomes.get(member_key) == 'True' for member_key in self.member_keys) or
+            all(member_key in self.outcomes for member_key in self.member_keys)
+        )
+
+    def get_pending_keys(self):
+        """
+        Get the unique_keys of the calls to the devices that did not respond.
+        """
+        return [member_key for member_key in self.member_keys if member_key not in self.outcomes]
+
+    def get_responses(self, timed_out):
+        """
+        Get the devices for the response history.
+
+        Args:
+            timed_out (bool): Whether the call waited until the deadline.
+
+        Returns:
+            list: The device and whether its app responded per device.
+        """
+        responses = []
+        for member_key in self.member_keys:
+            outcome = self.outcomes.get(member_key)
+            if outcome in RESPONDED_OUTCOMES:
+                responses.append((self.members[member_key], True))
+            elif outcome is None and timed_out:
+                responses.append((self.members[member_key], False))
+        return responses
+
+    def get_available(self):
+        """
+        Get the devices that accepted the call.
+        """
+        return [self.members[member_key] for member_key in self.member_keys if self.outcomes.get(member_key) == 'True']
+
+    def get_outcome(self):
+        """
+        Get the outcome to store for the group, so later cancels find the
+        call ended.
+
+        Returns:
+            string: 'True' when a device accepted, 'False' when none did or
+                None when the call was cancelled.
+        """
+        if self.get_available():
+            return 'True'
+        if self.is_cancelled():
+            return None
+        return 'False'
+
+    def log_wait_started(self, schedule):
+        log_middleware_information(
+            '{0} | Starting \'wait for it\' loop for {1} devices until {2} ({3}msec), resending every {4}msec',
+            OrderedDict([
+                ('unique_key', self.unique_key),
+                ('devices', len(self.member_keys)),
+                ('wait_until', datetime.datetime.fromtimestamp(schedule.wait_until).strftime('%H:%M:%S.%f')),
+                ('roundtrip', int(schedule.policy.wait * 1000)),
+                ('resend_interval', int(schedule.policy.resend_interval * 1000)),
+            ]),
+            logging.INFO,
+        )
+
+    def log_shed(self, reason):
+        """
+        Log a call that was shed because too many calls wait.
+
+        Returns:
+            list: The metrics.
+        """
+        log_middleware_information(
+            '{0} | Too many waiting calls ({1}), sending NAK',
+            OrderedDict([
+                ('unique_key', self.unique_key),
+                ('reason', reason),
+            ]),
+            logging.WARNING,
+        )
+        return [
+            (VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY, {
+                OS_KEY: self.devices[0].app.platform,
+                ACTION_KEY: 'Received',
+                FAILED_REASON_KEY: reason,
+            }),
+        ]
+
+    def log_result(self, wait_until):
+        """
+        Log the outcome of the call.
+
+        Args:
+            wait_until (float): The time the call would stop waiting.
+
+        Returns:
+            list: The metrics.
+        """
+        available = self.get_available()
+        if available:
+            log_middleware_information(
+                '{0} | {1} of {2} devices checked in, sending ACK on {3}',
+                OrderedDict([
+                    ('unique_key', self.unique_key),
+                    ('available', len(available)),
+                    ('devices', len(self.member_keys)),
+                    ('ack_time', _get_now()),
+                ]),
+                logging.INFO,
+            )
+
+            # Log to the metrics file.
+            metrics_data = {
+                OS_KEY: available[0].app.platform,
+                CALL_SETUP_SUCCESSFUL_KEY: 'true',
+            }
+            log_data_to_metrics_log(metrics_data, available[0].sip_user_id)
+            return [
+                (VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY, {
+                    OS_KEY: available[0].app.platform,
+                    DIRECTION_KEY: VIALER_MIDDLEWARE_INCOMING_VALUE,
+                }),
+            ]
+
+        metrics = []
+        if self.is_cancelled():
+            failed_reason = 'Call cancelled'
+            # Track the cancelled calls and the wait they saved.
+            metrics.append((VIALER_MIDDLEWARE_CALL_CANCELLED_KEY, {
+                OS_KEY: self.devices[0].app.platform,
+                SAVED_SECONDS_KEY: max(wait_until - time.time(), 0),
+            }))
+        else:
+            failed_reason = 'No device available'
+
+        log_middleware_information(
+            '{0} | No device accepted the call ({1}), sending NAK on {2}',
+            OrderedDict([
+                ('unique_key', self.unique_key),
+                ('reason', failed_reason),
+                ('nak_time', _get_now()),
+            ]),
+            logging.INFO,
+        )
+
+        # Log to the metrics file.
+        metrics_data = {
+            OS_KEY: self.devices[0].app.platform,
+            CALL_SETUP_SUCCESSFUL_KEY: 'false',
+            FAILED_REASON_KEY: failed_reason,
+        }
+        log_data_to_metrics_log(metrics_data, self.devices[0].sip_user_id)
+        return metrics
+
+
+def log_call_response(unique_key, message_start_time, call_state, handed_off):
+    """
+    Function to log the response of the app to a call.
+
+    Args:
+        unique_key (string): The unique_key of the call.
+        message_start_time (float): The time the app sent the response.
+        call_state (dict): The state of the call after the response.
+        handed_off (bool): Whether the waiting incoming call was woken up
+            in this process.
+
+    Returns:
+        CallResponseResult: 404 when the app responded too late or the call
+            was cancelled, otherwise 202.
+    """
+    # Measured on the Redis server so the clock of the app does not matter.
+    roundtrip = get_call_roundtrip(call_state)
+
+    log_middleware_information(
+        '{0} | Device responded. Message start-time: {1} sec, round trip-time: {2} sec',
+        OrderedDict([
+            ('unique_key', unique_key),
+            ('starttime', datetime.datetime.fromtimestamp(message_start_time)),
+            ('roundtrip', roundtrip),
+        ]),
+        logging.INFO,
+    )
+
+    # If device responded too late or the call was cancelled return 404
+    # request (call) not found.
+    if call_state[STATE_OUTCOME] == 'Cancelled' or is_call_response_late(call_state):
+        status = 404
+    else:
+        status = 202
+
+    # Track how often the waiting incoming call was woken up in this
+    # process. Late responses go in the history too, they tell how long the
+    # app needs.
+    return CallResponseResult(status, [
+        (VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY, {
+            HANDOFF_KEY: HANDOFF_LOCAL_VALUE if handed_off else HANDOFF_REDIS_VALUE,
+        }),
+    ], roundtrip, call_state[STATE_OUTCOME] in RESPONDED_OUTCOMES)
+
+
+def log_push_received(unique_key, attempt, receipt):
+    """
+    Function to log the push of an attempt that reached the app.
+
+    Returns:
+        list: The metrics for the delivery latency and rate per attempt.
+    """
+    if not receipt.stored:
+        # Only the first receipt of an attempt counts.
+        return []
+
+    log_middleware_information(
+        '{0} | {1} Push of attempt {2} received after {3:.3f}s',
+        OrderedDict([
+            ('unique_key', unique_key),
+            ('platform', receipt.platform.upper()),
+            ('attempt', attempt),
+            ('latency', receipt.latency),
+        ]),
+        logging.INFO,
+    )
+    return [
+        (VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY, {
+            OS_KEY: receipt.platform,
+            ATTEMPT_KEY: attempt,
+            LATENCY_KEY: receipt.latency,
+            FIRST_KEY: receipt.first,
+        }),
+    ]
+
+
+def log_call_cancelled(call_id, call_state):
+    """
+    Function to log a call that was cancelled by asterisk.
+    """
+    log_middleware_information(
+        '{0} | Call cancelled for SIP:{1}',
+        OrderedDict([
+            ('unique_key', call_id),
+            (LOG_SIP_USER_ID, call_state[STATE_SIP_USER_ID]),
+        ]),
+        logging.INFO,
+    )
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.bulk_notify import BulkNotification, BulkNotificationRunning
+from app.models import App, PLATFORM_CHOICES
+
+
+class Command(BaseCommand):
+    help = 'Send a text message to all devices of an app, or resume such a run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--app', help='The app_id of the app.')
+        parser.add_argument('--platform', choices=[platform for platform, _ in PLATFORM_CHOICES])
+        parser.add_argument('--message', help='The message to send.')
+        parser.add_argument('--resume', metavar='RUN_ID', help='Continue a run from its checkpoint.')
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            try:
+                run = BulkNotification(options['resume'])
+            except KeyError as ex:
+                raise CommandError(ex.args[0])
+        else:
+            if not (options['app'] and options['platform'] and options['message']):
+                raise CommandError('Give --resume or --app, --platform and --message.')
+            try:
+                app = App.objects.get(app_id=options['app'], platform=options['platform'])
+                run = BulkNotification.create(app, options['message'])
+            except App.DoesNotExist:
+                raise CommandError('Unknown app {0} for {1}'.format(options['app'], options['platform']))
+            except ValueError as ex:
+                raise CommandError(ex.args[0])
+
+        self.stdout.write('Sending bulk notification {0}, resume with --resume {0}'.format(run.run_id))
+        try:
+            state = run.run(progress=self.write_progress)
+        except BulkNotificationRunning:
+            raise CommandError('Bulk notification {0} is being sent by another process'.format(run.run_id))
+
+        self.stdout.write(
+            'Done in {elapsed:.1f}s: sent {sent}, failed {failed}, removed {removed}, '
+            'replaced {replaced} of {total} devices, {per_minute} per minute'.format(**state),
+        )
+
+    def write_progress(self, state):
+        self.stdout.write(
+            '{done}/{total} devices, sent {sent}, failed {failed}, removed {removed}, {per_minute} per minute'.format(
+                done=state['sent'] + state['failed'] + state['removed'], **state),
+        )
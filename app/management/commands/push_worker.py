@@ -0,0 +1,27 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from app.outbox import PLATFORMS, PushWorker
+
+
+class Command(BaseCommand):
+    help = 'Send the call pushes from the push outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--platform',
+            action='append',
+            choices=PLATFORMS,
+            help='Only send the pushes of this platform, can be given more than once.',
+        )
+
+    def handle(self, *args, **options):
+        worker = PushWorker(options['platform'] or PLATFORMS)
+        # Stop reading on SIGTERM and send the pushes that were read.
+        signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: worker.stop())
+
+        self.stdout.write('Sending pushes for {0} as {1}'.format(
+            ', '.join(consumer.platform for consumer in worker.consumers), worker.consumer))
+        worker.run()
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.sip_user_filter import sip_user_filter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the filter of sip_user_ids with a device from the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=10000,
+            help='The number of devices fetched per query.',
+        )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        count = sip_user_filter.rebuild(chunk_size=options['chunk_size'])
+        self.stdout.write('Rebuilt the sip user filter with {0} devices in {1:.2f}s'.format(
+            count, time.time() - start))
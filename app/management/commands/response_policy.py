@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.cache import get_redis_cache
+from app.models import Device
+from app.response_policy import choose_call_policy, response_policy
+
+
+class Command(BaseCommand):
+    help = (
+        'Show the response history of the devices of a sip_user_id and the timing the adaptive policy chooses '
+        'for their calls.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('sip_user_id', help='The sip_user_id of the device.')
+
+    def handle(self, *args, **options):
+        devices = Device.objects.select_related('app').filter(
+            sip_user_id=options['sip_user_id']).order_by('-last_seen')
+        if not devices:
+            raise CommandError('No device for sip_user_id {0}'.format(options['sip_user_id']))
+
+        redis_cache = get_redis_cache()
+        for device in devices:
+            device_stats = response_policy.get_device_stats(redis_cache, device.id)
+            platform_stats = response_policy.get_platform_stats(redis_cache, device.app.platform)
+            policy = choose_call_policy(device_stats, platform_stats)
+
+            device_name = 'device {0} ({1})'.format(device.id, device.name)
+            for name, stats in ((device_name, device_stats), (device.app.platform, platform_stats)):
+                self.stdout.write('{0}: {1}'.format(name, ', '.join(
+                    '{0}={1}'.format(field, value) for field, value in stats.as_dict().items())))
+            self.stdout.write('policy: source={0}, wait={1}ms, resend_interval={2}ms, max_attempts={3}'.format(
+                policy.source, int(policy.wait * 1000), int(policy.resend_interval * 1000), policy.max_attempts))
@@ -0,0 +1,26 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.models import PLATFORM_CHOICES, ResponseLog
+from app.response_policy import simulate_response_logs
+
+
+class Command(BaseCommand):
+    help = 'Replay the response logs under the static and the adaptive policy and compare them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Replay the logs of the last days.')
+        parser.add_argument('--platform', choices=[platform for platform, _ in PLATFORM_CHOICES])
+
+    def handle(self, *args, **options):
+        response_logs = ResponseLog.objects.filter(
+            date__gte=timezone.now() - datetime.timedelta(days=options['days']),
+        ).order_by('date', 'id')
+        if options['platform']:
+            response_logs = response_logs.filter(platform=options['platform'])
+
+        for name, result in simulate_response_logs(response_logs.iterator()).items():
+            self.stdout.write('{0}: {1}'.format(name, ', '.join(
+                '{0}={1}'.format(field, value) for field, value in result.as_dict().items())))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_remove_device_use_apns2'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='app',
+            name='apns_key_id',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='app',
+            name='apns_team_id',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+    ]
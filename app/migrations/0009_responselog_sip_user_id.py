@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_app_apns_token_auth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='responselog',
+            name='sip_user_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
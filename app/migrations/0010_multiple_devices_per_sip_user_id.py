@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import app.models
+
+
+def remove_duplicate_tokens(apps, schema_editor):
+    """
+    Keep the most recently seen device of every app and token, a token that
+    was registered for another sip_user_id was added again before.
+    """
+    Device = apps.get_model('app', 'Device')
+    seen = set()
+    for device in Device.objects.order_by('app_id', 'token', '-last_seen').only('app_id', 'token', 'last_seen'):
+        if (device.app_id, device.token) in seen:
+            device.delete()
+        else:
+            seen.add((device.app_id, device.token))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_responselog_sip_user_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='device',
+            name='id',
+            field=models.CharField(
+                default=app.models.get_device_id, editable=False, max_length=255, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='device',
+            name='sip_user_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AlterUniqueTogether(
+            name='device',
+            unique_together=set([('app', 'token')]),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 
 APNS_PLATFORM = 'apns'
@@ -17,26 +19,47 @@ class App(models.Model):
     platform = models.CharField(choices=PLATFORM_CHOICES, max_length=10)
     app_id = models.CharField(max_length=255)
 
+    # The API key for Google or the file in CERT_DIR with the certificate for
+    # APNS, or with the .p8 auth key when apns_key_id is set.
     push_key = models.CharField(max_length=255)
+    # Key and team id for APNS provider token authentication.
+    apns_key_id = models.CharField(max_length=10, blank=True, default='')
+    apns_team_id = models.CharField(max_length=10, blank=True, default='')
     logentries_token = models.CharField(max_length=255, blank=False, null=False, default='')
     partner_logentries_token = models.CharField(max_length=255, blank=True, null=True, default='')
 
     def __str__(self):
         return '{0} for {1}'.format(self.app_id, self.platform)
 
+    @property
+    def uses_apns_token_auth(self):
+        return bool(self.apns_key_id and self.apns_team_id)
+
     class Meta:
         unique_together = ('app_id', 'platform')
 
 
+def get_device_id():
+    """
+    Function to get the id of a new device.
+
+    Returns:
+        string: A random hex id.
+    """
+    return uuid.uuid4().hex
+
+
 class Device(models.Model):
     """
-    Model for all device who register at the middleware.
+    Model for all device who register at the middleware. A sip_user_id can
+    have several devices, a device is identified by its app and token.
     """
-    # FIXME: We need this to be backwards compatible for one release.
-    id = models.CharField(max_length=255, unique=True)
+    # Devices registered before several devices per sip_user_id were
+    # supported have their sip_user_id as id.
+    id = models.CharField(max_length=255, primary_key=True, default=get_device_id, editable=False)
 
     name = models.CharField(max_length=255, blank=True, null=True)
-    sip_user_id = models.CharField(max_length=255, unique=True, primary_key=True)
+    sip_user_id = models.CharField(max_length=255, db_index=True)
     os_version = models.CharField(max_length=255, blank=True, null=True)
     client_version = models.CharField(max_length=255, blank=True, null=True)
     token = models.CharField(max_length=250)
@@ -48,16 +71,8 @@ class Device(models.Model):
     def __str__(self):
         return '{0} - {1}'.format(self.sip_user_id, self.name)
 
-    # FIXME: We need this to be backwards compatible for one release.
-    def save(self, *args, **kwargs):
-        """
-        Make sure the id fields stays the same as sip_user_id so we are
-        backwards compatible.
-        """
-        if self.sip_user_id:
-            self.id = self.sip_user_id
-            obj = super(Device, self).save(*args, **kwargs)
-            return obj
+    class Meta:
+        unique_together = ('app', 'token')
 
 
 class ResponseLog(models.Model):
@@ -68,3 +83,5 @@ class ResponseLog(models.Model):
     roundtrip_time = models.FloatField()
     available = models.BooleanField()
     date = models.DateTimeField(auto_now_add=True)
+    # The device that responded, to replay the history per device.
+    sip_user_id = models.CharField(max_length=255, blank=True, null=True)
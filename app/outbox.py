@@ -0,0 +1,323 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import socket
+from threading import Condition, Event, Thread
+import time
+
+from django.conf import settings
+from redis import StrictRedis
+from redis.exceptions import RedisError, ResponseError
+from rediscluster.exceptions import RedisClusterException
+
+from app.cache import get_redis_cache, shared_redis_cache
+from app.devices import get_cached_device
+from app.executors import BoundedExecutor, OVERFLOW_CALLER_RUNS
+from app.models import ANDROID_PLATFORM, APNS_PLATFORM, Device, GCM_PLATFORM
+from app.push import send_call_message
+from app.utils import log_middleware_information
+from main.prometheus.consts import LATENCY_KEY, OS_KEY, VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY
+
+# How call pushes are sent: 'executor' sends them from the web worker,
+# 'outbox' appends them to a stream for `manage.py push_worker`.
+SEND_MODE_EXECUTOR = 'executor'
+SEND_MODE_OUTBOX = 'outbox'
+
+# One stream per provider so a slow provider doesn't hold up the others. The
+# hash tag keeps every command on a stream in one slot.
+PUSH_OUTBOX_KEY = 'push_outbox:{{{0}}}'
+PUSH_OUTBOX_GROUP = 'push_workers'
+
+PLATFORMS = (APNS_PLATFORM, ANDROID_PLATFORM, GCM_PLATFORM)
+
+
+def get_push_outbox_key(platform):
+    """
+    Function to get the key of the push outbox stream of a provider.
+
+    Args:
+        platform (string): The platform of the provider.
+
+    Returns:
+        string: The stream key.
+    """
+    return PUSH_OUTBOX_KEY.format(platform)
+
+
+def enqueue_call_push(device, unique_key, phonenumber, caller_id, attempt):
+    """
+    Function to append a call push to the outbox of the platform of the
+    device.
+
+    Args:
+        device (Device): The device to wake up.
+        unique_key (string): The unique_key of the call.
+        phonenumber (string): The phonenumber of the caller.
+        caller_id (string): The name of the caller.
+        attempt (int): The attempt of the push.
+    """
+    job = json.dumps({
+        'sip_user_id': device.sip_user_id,
+        'device_id': device.id,
+        'unique_key': unique_key,
+        'phonenumber': phonenumber,
+        'caller_id': caller_id,
+        'attempt': attempt,
+    })
+    # Use execute_command because redis 2.10 has no stream commands, the key
+    # is the first argument so the cluster client finds its slot.
+    get_redis_cache().client.execute_command(
+        'XADD',
+        get_push_outbox_key(device.app.platform),
+        'MAXLEN',
+        '~',
+        settings.PUSH_OUTBOX_MAX_LENGTH,
+        '*',
+        'job',
+        job,
+    )
+
+
+def get_stream_client(key):
+    """
+    Function to get a client for the master that holds a stream. The
+    cluster client can't route XGROUP and XREADGROUP because their key is
+    not the first argument.
+
+    Args:
+        key (string): The key of the stream.
+
+    Returns:
+        StrictRedis: The client.
+    """
+    pool = get_redis_cache().client.connection_pool
+    node = pool.get_master_node_by_slot(pool.nodes.keyslot(key))
+    return StrictRedis(
+        host=node['host'],
+        port=node['port'],
+        decode_responses=True,
+        socket_timeout=(settings.PUSH_WORKER_BLOCK + settings.REDIS_SOCKET_TIMEOUT) / 1000,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT / 1000,
+    )
+
+
+def parse_entries(entries):
+    """
+    Function to parse the entries of a XREADGROUP or XCLAIM reply.
+
+    Args:
+        entries (list): Lists of the id and the flat field list of an entry.
+
+    Returns:
+        list: Tuples of the id and the fields as dict, None for entries that
+            were trimmed from the stream.
+    """
+    return [
+        (entry_id, dict(zip(fields[::2], fields[1::2])) if fields else None)
+        for entry_id, fields in entries
+    ]
+
+
+class ProviderConsumer(object):
+    """
+    Consumer of the outbox of one provider that sends at most
+    `concurrency` pushes at the same time.
+    """
+    def __init__(self, platform, consumer, concurrency, stopped):
+        self.platform = platform
+        self.key = get_push_outbox_key(platform)
+        self.consumer = consumer
+        self.concurrency = concurrency
+        self.stopped = stopped
+        self.executor = BoundedExecutor('push_{0}'.format(platform), concurrency, concurrency, OVERFLOW_CALLER_RUNS)
+        self.client = None
+        self._active = 0
+        self._condition = Condition()
+
+    def run(self):
+        """
+        Read and send new pushes and reclaim the ones of crashed workers
+        until the worker is stopped.
+        """
+        last_reclaim = 0
+        while not self.stopped.is_set():
+            try:
+                if self.client is None:
+                    self.client = get_stream_client(self.key)
+                    self.create_group()
+
+                if time.time() - last_reclaim > settings.PUSH_WORKER_RECLAIM_INTERVAL / 1000:
+                    last_reclaim = time.time()
+                    self.reclaim()
+
+                self.read()
+            except (RedisError, RedisClusterException):
+                log_middleware_information(
+                    'Reading the {0} push outbox failed, reconnecting',
+                    OrderedDict([('platform', self.platform)]),
+                    logging.ERROR,
+                )
+                # The stream may have moved to another node, get the slots
+                # from the cluster again.
+                self.client = None
+                shared_redis_cache.reset()
+                self.stopped.wait(1)
+
+    def read(self):
+        """
+        Wait for new pushes and send as many as there are free workers.
+        """
+        reply = self.client.execute_command(
+            'XREADGROUP',
+            'GROUP',
+            PUSH_OUTBOX_GROUP,
+            self.consumer,
+            'COUNT',
+            self._wait_for_free(),
+            'BLOCK',
+            settings.PUSH_WORKER_BLOCK,
+            'STREAMS',
+            self.key,
+            '>',
+        )
+        for entry_id, fields in parse_entries(reply[0][1] if reply else []):
+            self._submit(entry_id, fields)
+
+    def reclaim(self):
+        """
+        Take over the pushes that were read by a worker that did not send
+        them within PUSH_WORKER_CLAIM_IDLE.
+        """
+        pending = self.client.execute_command(
+            'XPENDING', self.key, PUSH_OUTBOX_GROUP, '-', '+', self.concurrency)
+        entry_ids = [
+            entry_id for entry_id, consumer, idle, deliveries in pending
+            if consumer != self.consumer and idle >= settings.PUSH_WORKER_CLAIM_IDLE
+        ]
+        if not entry_ids:
+            return
+
+        entries = self.client.execute_command(
+            'XCLAIM', self.key, PUSH_OUTBOX_GROUP, self.consumer, settings.PUSH_WORKER_CLAIM_IDLE, *entry_ids)
+        log_middleware_information(
+            'Reclaimed {0} pushes from the {1} push outbox',
+            OrderedDict([
+                ('count', len(entries)),
+                ('platform', self.platform),
+            ]),
+            logging.WARNING,
+        )
+        for entry_id, fields in parse_entries(entries):
+            self._wait_for_free()
+            self._submit(entry_id, fields)
+
+    def send(self, entry_id, fields):
+        """
+        Send a push and acknowledge it. Pushes for calls that already ended
+        are dropped.
+
+        Args:
+            entry_id (string): The id of the entry in the stream.
+            fields (dict): The fields of the entry or None if it was trimmed.
+        """
+        # The id starts with the time in ms at which Redis added the entry.
+        enqueued_at = int(entry_id.split('-')[0]) / 1000
+        if fields is not None and time.time() - enqueued_at < settings.APP_PUSH_ROUNDTRIP_WAIT / 1000:
+            job = json.loads(fields['job'])
+            try:
+                # Jobs enqueued before the device_id was added go to the
+                # most recently seen device.
+                device = get_cached_device(job['sip_user_id'], job.get('device_id'))
+            except Device.DoesNotExist:
+                device = None
+
+            if device is not None:
+                send_call_message(device, job['unique_key'], job['phonenumber'], job['caller_id'], job['attempt'])
+                # Push data to Redis for the time between the enqueue and the send.
+                get_redis_cache().client.rpush(
+                    VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY,
+                    {
+                        OS_KEY: self.platform,
+                        LATENCY_KEY: time.time() - enqueued_at,
+                    },
+                )
+        else:
+            log_middleware_information(
+                'Dropped push {0} from the {1} push outbox, the call ended',
+                OrderedDict([
+                    ('entry_id', entry_id),
+                    ('platform', self.platform),
+                ]),
+                logging.WARNING,
+            )
+
+        get_redis_cache().client.execute_command('XACK', self.key, PUSH_OUTBOX_GROUP, entry_id)
+
+    def create_group(self):
+        """
+        Create the consumer group and the stream if they don't exist yet.
+        """
+        try:
+            self.client.execute_command('XGROUP', 'CREATE', self.key, PUSH_OUTBOX_GROUP, '$', 'MKSTREAM')
+        except ResponseError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    def _wait_for_free(self):
+        """
+        Wait until a push can be sent.
+
+        Returns:
+            int: The number of pushes that can be sent.
+        """
+        with self._condition:
+            while self._active >= self.concurrency:
+                self._condition.wait()
+            return self.concurrency - self._active
+
+    def _submit(self, entry_id, fields):
+        with self._condition:
+            self._active += 1
+        self.executor.submit(self._send, entry_id, fields)
+
+    def _send(self, entry_id, fields):
+        try:
+            self.send(entry_id, fields)
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify()
+
+
+class PushWorker(object):
+    """
+    Sends the pushes from the outboxes of the given providers as a consumer
+    of the push_workers group. Pushes that a worker read but did not
+    acknowledge are reclaimed by another worker.
+    """
+    def __init__(self, platforms=PLATFORMS):
+        self.consumer = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.stopped = Event()
+        self.consumers = [
+            ProviderConsumer(platform, self.consumer, settings.PUSH_WORKER_CONCURRENCY[platform], self.stopped)
+            for platform in platforms
+        ]
+
+    def run(self):
+        """
+        Run a consumer per provider until `stop` is called, then wait for
+        the pushes that are being sent.
+        """
+        threads = [Thread(target=consumer.run, daemon=True) for consumer in self.consumers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        deadline = time.time() + settings.EXECUTOR_DRAIN_TIMEOUT / 1000
+        for consumer in self.consumers:
+            consumer.executor.shutdown(max(deadline - time.time(), 0))
+
+    def stop(self):
+        self.stopped.set()
@@ -1,25 +1,24 @@
 from collections import OrderedDict
 import datetime
+import hashlib
+import json
 import logging
-import os
+import math
 from time import time
 from urllib.parse import urljoin
 
-from apns2.client import APNsClient
-from apns2.errors import APNsException, BadDeviceToken, DeviceTokenNotForTopic, Unregistered
-from apns2.payload import Payload
 from django.conf import settings
-from gcm.gcm import GCM, GCMAuthenticationException
-from pyfcm import FCMNotification
-from pyfcm.errors import AuthenticationError, FCMServerError, InternalPackageError
 
-from app.cache import RedisClusterCache
+from app.cache import get_redis_cache
+from app.call_timeline import call_timelines, PHASE_PROVIDER_ACKED, PHASE_PUSH_SENT
+from app.push_backends import get_push_backend, InvalidTokenError, PushError
+from app.token_feedback import report_invalid_token, report_replaced_token
 from app.utils import log_middleware_information
-
-from .models import ANDROID_PLATFORM, APNS_PLATFORM, GCM_PLATFORM
+from main.prometheus.consts import ATTEMPT_KEY, OS_KEY, VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY
 
 
 TYPE_CALL = 'call'
+TYPE_CANCEL = 'cancel'
 TYPE_MESSAGE = 'message'
 
 
@@ -40,23 +39,18 @@ def send_call_message(device, unique_key, phonenumber, caller_id, attempt):
         'caller_id': caller_id,
         'attempt': attempt,
     }
-    if device.app.platform == APNS_PLATFORM:
-        send_apns_message(device, device.app, TYPE_CALL, data)
-    elif device.app.platform == GCM_PLATFORM:
-        send_gcm_message(device, device.app, TYPE_CALL, data)
-    elif device.app.platform == ANDROID_PLATFORM:
-        send_fcm_message(device, device.app, TYPE_CALL, data)
-    else:
-        log_middleware_information(
-            '{0} | Trying to sent \'call\' notification to unknown platform:{1} device:{2}',
-            OrderedDict([
-                ('unique_key', unique_key),
-                ('platform', device.app.platform),
-                ('token', device.token),
-            ]),
-            logging.WARNING,
-            device=device,
-        )
+    send_push_message(device, device.app, TYPE_CALL, data)
+
+
+def send_cancel_message(device, unique_key):
+    """
+    Function to send the push notification that a call was cancelled.
+
+    Args:
+        device (Device): A Device object.
+        unique_key (string): String with the unique_key.
+    """
+    send_push_message(device, device.app, TYPE_CANCEL, {'unique_key': unique_key})
 
 
 def send_text_message(device, app, message):
@@ -67,22 +61,7 @@ def send_text_message(device, app, message):
         device (Device): A Device object.
         message (string): The message that needs to be send to the device.
     """
-    if app.platform == APNS_PLATFORM:
-        send_apns_message(device, app, TYPE_MESSAGE, {'message': message})
-    elif app.platform == GCM_PLATFORM:
-        send_gcm_message(device, app, TYPE_MESSAGE, {'message': message})
-    elif app.platform == ANDROID_PLATFORM:
-        send_fcm_message(device, app, TYPE_MESSAGE, {'message': message})
-    else:
-        log_middleware_information(
-            'Trying to sent \'message\' notification to unknown platform:{0} device:{1}',
-            OrderedDict([
-                ('platform', device.app.platform),
-                ('token', device.token),
-            ]),
-            logging.WARNING,
-            device=device,
-        )
+    send_push_message(device, app, TYPE_MESSAGE, {'message': message})
 
 
 def get_call_push_payload(unique_key, phonenumber, caller_id, attempt):
@@ -118,185 +97,123 @@ def get_call_push_payload(unique_key, phonenumber, caller_id, attempt):
     return payload
 
 
-def get_message_push_payload(message):
+def get_cancel_push_payload(unique_key):
     """
-    Function to create a dict used in the message push notification.
+    Function to create a dict used in the cancel push notification.
 
     Args:
-        message (string): The message send in the notification.
+        unique_key (string): The unique_key of the cancelled call.
 
     Returns:
         dict: A dictionary with the following keys:
                 type
-                message
+                unique_key
     """
     payload = {
-        'type': TYPE_MESSAGE,
-        'message': message,
+        'type': TYPE_CANCEL,
+        'unique_key': unique_key,
     }
     return payload
 
 
-def send_apns_message(device, app, message_type, data=None):
+def get_call_push_ttl():
     """
-    Send an Apple Push Notification message via the new v2 API.
+    Function to get the time to live of a call push. After
+    APP_PUSH_ROUNDTRIP_WAIT the call is answered with a NAK, so the providers
+    can drop the push.
+
+    Returns:
+        int: The time to live in seconds.
     """
-    unique_key = device.token
+    return int(math.ceil(settings.APP_PUSH_ROUNDTRIP_WAIT / 1000))
 
-    if message_type == TYPE_CALL:
-        unique_key = data['unique_key']
-        message = Payload(custom=get_call_push_payload(
-            unique_key,
-            data['phonenumber'],
-            data['caller_id'],
-            data['attempt'],
-        ))
-    elif message_type == TYPE_MESSAGE:
-        message = Payload(custom=get_message_push_payload(data['message']))
-    else:
-        log_middleware_information(
-            '{0} | TRYING TO SENT MESSAGE OF UNKNOWN TYPE: {1}',
-            OrderedDict([
-                ('unique_key', unique_key),
-                ('message_type', message_type),
-            ]),
-            logging.WARNING,
-            device=device,
-        )
 
-        # Unknown message type: ignore this message.
-        return
+def get_call_collapse_id(unique_key):
+    """
+    Function to get the collapse id of the pushes of a call, so every
+    attempt replaces the previous one that was not delivered yet.
 
-    # Get the APNSv2 connection. There is one global connection.
-    client = get_apns2_connection(app, device, unique_key)
+    Args:
+        unique_key (string): The unique_key of the call.
 
-    try:
-        log_middleware_information(
-            '{0} | Sending APNSv2 \'{1}\' message at time:{2} to {3}',
-            OrderedDict([
-                ('unique_key', unique_key),
-                ('message_type', message_type),
-                ('message_time', datetime.datetime.fromtimestamp(time()).strftime('%H:%M:%S.%f')),
-                ('token', device.token),
-            ]),
-            logging.INFO,
-            device=device,
-        )
+    Returns:
+        string: The unique_key or its hash if it is longer than the 64 bytes
+            APNs allows.
+    """
+    if len(unique_key.encode('utf-8')) <= 64:
+        return unique_key
+    return hashlib.sha256(unique_key.encode('utf-8')).hexdigest()
 
-        start_time = time()
-        try:
-            client.send_notification(device.token, message)
-        finally:
-            elapsed_time = time() - start_time
-            log_middleware_information(
-                '{0} | Sending message to APNSv2 took {1:.2f}s',
-                OrderedDict([
-                    ('unique_key', unique_key),
-                    ('conn_time', elapsed_time),
-                ]),
-                logging.INFO,
-                device=device,
-            )
 
-    except (DeviceTokenNotForTopic, BadDeviceToken, Unregistered) as ex:
-        # According to APNs protocol the token reported here
-        # is garbage (invalid or empty), stop using and remove it.
-        log_middleware_information(
-            '{0} | Sending APNSv2 message failed for device: {1}, reason: {2}',
-            OrderedDict([
-                ('unique_key', unique_key),
-                ('token', device.token),
-                ('error_msg', type(ex).__name__),
-            ]),
-            logging.WARNING,
-            device=device,
-        )
-    except APNsException as ex:
-        # Failures not related to devices.
-        log_middleware_information(
-            '{0} | Error sending APNSv2 message. \'{1}\'',
-            OrderedDict([
-                ('unique_key', unique_key),
-                ('error_msg', type(ex).__name__),
-            ]),
-            logging.WARNING,
-            device=device,
-        )
-    except Exception:
-        log_middleware_information(
-            '{0} | Error sending APNSv2 message',
-            OrderedDict(
-                unique_key=unique_key,
-            ),
-            logging.CRITICAL,
-            device=device,
-        )
+def get_message_push_payload(message):
+    """
+    Function to create a dict used in the message push notification.
 
+    Args:
+        message (string): The message send in the notification.
 
-# The APNSv2 connection pool. The connection pool stores an APNSv2 connection for
-# an app_id. This connection pool can be shared among multiple threads.
-# Don't use the connection pool directly but use `get_apns2_connection`.
-apns2_connection_pool = {}
+    Returns:
+        dict: A dictionary with the following keys:
+                type
+                message
+    """
+    payload = {
+        'type': TYPE_MESSAGE,
+        'message': message,
+    }
+    return payload
 
 
-def get_apns2_connection(app, device, unique_key):
+def send_push_message(device, app, message_type, data=None):
     """
-    Get the active APNSv2 connection for the device.
-
-    This returns a reference to the connection object
-    for the app and with the device's sandbox setting.
-    Initializes the connection if it was not yet set up.
+    Function to send a push notification with the push backend of the
+    platform of the app.
 
     Args:
-        app (App): App requesting the connection.
-        device (Device): Device requesting the connection.
-        unique_key (str): Unique key used for logging.
-
-    Returns:
-        APNsClient.
+        device (Device): A Device object.
+        app (App): The app of the device.
+        message_type (string): TYPE_CALL, TYPE_CANCEL or TYPE_MESSAGE.
+        data (dict): The data for the payload of the message type.
     """
-    global apns2_connection_pool
-    key = (app.app_id, device.sandbox)
-    if key not in apns2_connection_pool:
-        full_cert_path = os.path.join(settings.CERT_DIR, app.push_key)
-        apns2_connection = APNsClient(full_cert_path, use_sandbox=device.sandbox)
+    unique_key = device.token
+    collapse_id = None
+    ttl = None
+
+    backend = get_push_backend(app.platform)
+    if backend is None:
         log_middleware_information(
-            '{0} | Opened new connection to APNSv2 {1} for app_id: {2}',
+            '{0} | Trying to sent \'{1}\' notification to unknown platform:{2} device:{3}',
             OrderedDict([
-                ('token', unique_key),
-                ('sandbox', 'Sandbox' if device.sandbox else 'Production'),
-                ('app_id', app.app_id),
+                ('unique_key', data.get('unique_key', unique_key)),
+                ('message_type', message_type),
+                ('platform', app.platform),
+                ('token', device.token),
             ]),
-            logging.INFO,
+            logging.WARNING,
             device=device,
         )
-        apns2_connection_pool.update({
-            key: apns2_connection
-        })
-    else:
-        # Test the existing connection, will throw an exception if this fails.
-        apns2_connection = apns2_connection_pool[key]
-        apns2_connection.connect()
-
-    return apns2_connection
-
+        return
 
-def send_fcm_message(device, app, message_type, data=None):
-    """
-    Function for sending a push message using firebase.
-    """
-    registration_id = device.token
-    unique_key = device.token
     if message_type == TYPE_CALL:
         unique_key = data['unique_key']
-        message = get_call_push_payload(
+        payload = get_call_push_payload(
             unique_key,
             data['phonenumber'],
             data['caller_id'],
             data['attempt'],
         )
+        if backend.supports_collapse:
+            collapse_id = get_call_collapse_id(unique_key)
+            ttl = get_call_push_ttl()
+    elif message_type == TYPE_CANCEL:
+        unique_key = data['unique_key']
+        payload = get_cancel_push_payload(unique_key)
+        if backend.supports_collapse:
+            # Replace the call push when it was not delivered yet.
+            collapse_id = get_call_collapse_id(unique_key)
+            ttl = get_call_push_ttl()
     elif message_type == TYPE_MESSAGE:
-        message = get_message_push_payload(data['message'])
+        payload = get_message_push_payload(data['message'])
     else:
         log_middleware_information(
             '{0} | Trying to sent message of unknown type: {1}',
@@ -308,204 +225,88 @@ def send_fcm_message(device, app, message_type, data=None):
             device=device,
         )
 
-    push_service = FCMNotification(api_key=app.push_key)
+        # Unknown message type: ignore this message.
+        return
 
-    try:
-        start_time = time()
-        result = push_service.notify_single_device(registration_id=registration_id, data_message=message)
-    except AuthenticationError:
+    if len(json.dumps(payload).encode('utf-8')) > backend.max_payload_size:
         log_middleware_information(
-            '{0} | Our Google API key was rejected!!!',
-            OrderedDict([
-                ('unique_key', unique_key),
-            ]),
-            logging.ERROR,
-            device=device,
-        )
-    except InternalPackageError:
-        log_middleware_information(
-            '{0} | Bad api request made by package.',
-            OrderedDict([
-                ('unique_key', unique_key),
-            ]),
-            logging.ERROR,
-            device=device,
-        )
-    except FCMServerError:
-        log_middleware_information(
-            '{0} | FCM Server error.',
+            '{0} | Not sending \'{1}\' message, the payload is larger than the {2} bytes of {3}',
             OrderedDict([
                 ('unique_key', unique_key),
+                ('message_type', message_type),
+                ('max_payload_size', backend.max_payload_size),
+                ('platform', backend.platform),
             ]),
             logging.ERROR,
             device=device,
         )
-    else:
-        if result.get('success'):
-            log_middleware_information(
-                '{0} | FCM \'{1}\' message sent at time:{2} to {3}',
-                OrderedDict([
-                    ('unique_key', unique_key),
-                    ('message_type', message_type),
-                    ('sent_time', datetime.datetime.fromtimestamp(start_time).strftime('%H:%M:%S.%f')),
-                    ('registration_id', registration_id),
-                ]),
-                logging.INFO,
-                device=device,
-            )
-
-        if result.get('failure'):
-            log_middleware_information(
-                '{0} | Should remove {1} because {2}',
-                OrderedDict([
-                    ('unique_key', unique_key),
-                    ('registration_id', registration_id),
-                    ('results', result['results']),
-                ]),
-                logging.WARNING,
-                device=device,
-            )
-
-            if (len(result['results']) > 0 and 'error' in result['results'][0] and
-                    result['results'][0]['error'] == 'NotRegistered'):
-                log_middleware_information(
-                    '{0} | Removed {1}',
-                    OrderedDict([
-                        ('unique_key', unique_key),
-                        ('device', device),
-                    ]),
-                    logging.INFO,
-                )
-                # Remove the unique key from the cache so we can sent
-                # NAK to asterisk.
-                redis_cache = RedisClusterCache()
-                if redis_cache.exists(unique_key):
-                    redis_cache.set(unique_key, "Removed")
-                device.delete()
-
-        if result.get('canonical_ids'):
-            log_middleware_information(
-                '{0} | Should replace device token {1}',
-                OrderedDict([
-                    ('unique_key', unique_key),
-                    ('registration_id', registration_id),
-                ]),
-                logging.WARNING,
-                device=device,
-            )
-
-
-def send_gcm_message(device, app, message_type, data=None):
-    """
-    Send a Google Cloud Messaging message.
-    """
-    token_list = [device.token]
-    unique_key = device.token
+        return
 
-    key = '%d-cycle.key' % int(time())
     if message_type == TYPE_CALL:
-        unique_key = data['unique_key']
-        message = get_call_push_payload(
-            unique_key,
-            data['phonenumber'],
-            data['caller_id'],
-            data['attempt'],
-        )
-    elif message_type == TYPE_MESSAGE:
-        message = get_message_push_payload(data['message'])
-    else:
+        call_timelines.mark(unique_key, PHASE_PUSH_SENT)
+
+    start_time = time()
+    try:
+        new_token = backend.send(device, app, payload, collapse_id=collapse_id, ttl=ttl)
+    except InvalidTokenError as ex:
         log_middleware_information(
-            '{0} | Trying to sent message of unknown type: {1}',
+            '{0} | Sending {1} message failed for device: {2}, reason: {3}',
             OrderedDict([
                 ('unique_key', unique_key),
-                ('message_type', message_type),
+                ('platform', backend.platform),
+                ('token', device.token),
+                ('error_msg', ex.reason),
             ]),
             logging.WARNING,
             device=device,
         )
-
-    gcm = GCM(app.push_key)
-
-    try:
-        start_time = time()
-        response = gcm.json_request(
-            registration_ids=token_list,
-            data=message,
-            collapse_key=key,
-            priority='high',
-        )
-
-        success = response.get('success')
-        canonical = response.get('canonical')
-        errors = response.get('errors')
-
-        if success:
-            for reg_id, msg_id in success.items():
-                log_middleware_information(
-                    '{0} | GCM \'{1}\' message sent at time:{2} to {3}',
-                    OrderedDict([
-                        ('unique_key', unique_key),
-                        ('message_type', message_type),
-                        ('sent_time', datetime.datetime.fromtimestamp(start_time).strftime('%H:%M:%S.%f')),
-                        ('registration_id', reg_id),
-                    ]),
-                    logging.INFO,
-                    device=device,
-                )
-
-        if canonical:
-            for reg_id, new_reg_id in canonical.items():
-                log_middleware_information(
-                    '{0} | Should replace device token {1} with {2} in database',
-                    OrderedDict([
-                        ('unique_key', unique_key),
-                        ('registration_id', reg_id),
-                        ('new_registration_id', new_reg_id),
-                    ]),
-                    logging.WARNING,
-                    device=device,
-                )
-
-        if errors:
-            for err_code, reg_id in errors.items():
-                log_middleware_information(
-                    '{0} | Should remove {1} because {2}',
-                    OrderedDict([
-                        ('unique_key', unique_key),
-                        ('registration_id', reg_id),
-                        ('error_code', err_code),
-                    ]),
-                    logging.WARNING,
-                    device=device,
-                )
-
-    except GCMAuthenticationException:
-        # Stop and fix your settings.
+        report_invalid_token(device, ex.reason, unique_key=unique_key if message_type == TYPE_CALL else None)
+    except PushError as ex:
         log_middleware_information(
-            '{0} | Our Google API key was rejected!!!',
+            '{0} | Error sending {1} message. \'{2}\'',
             OrderedDict([
                 ('unique_key', unique_key),
+                ('platform', backend.platform),
+                ('error_msg', ex.reason),
             ]),
-            logging.ERROR,
+            ex.level,
             device=device,
         )
-    except ValueError:
-        # Probably your extra options, such as time_to_live,
-        # are invalid. Read error message for more info.
+    except Exception:
         log_middleware_information(
-            '{0} | Invalid message/option or invalid GCM response',
+            '{0} | Error sending {1} message',
             OrderedDict([
                 ('unique_key', unique_key),
+                ('platform', backend.platform),
             ]),
-            logging.ERROR,
+            logging.CRITICAL,
             device=device,
         )
-    except Exception:
+    else:
+        if message_type == TYPE_CALL:
+            call_timelines.mark(unique_key, PHASE_PROVIDER_ACKED)
+
+            # Push data to Redis for the delivery rate per attempt.
+            get_redis_cache().client.rpush(
+                VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY,
+                {
+                    OS_KEY: app.platform,
+                    ATTEMPT_KEY: data['attempt'],
+                },
+            )
+
         log_middleware_information(
-            '{0} | Error sending GCM message',
+            '{0} | {1} \'{2}\' message sent at time:{3} to {4} in {5:.2f}s',
             OrderedDict([
                 ('unique_key', unique_key),
+                ('platform', backend.platform),
+                ('message_type', message_type),
+                ('sent_time', datetime.datetime.fromtimestamp(start_time).strftime('%H:%M:%S.%f')),
+                ('token', device.token),
+                ('conn_time', time() - start_time),
             ]),
-            logging.CRITICAL,
+            logging.INFO,
             device=device,
         )
+        if new_token:
+            report_replaced_token(device, new_token, 'canonical_id')
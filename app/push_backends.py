@@ -0,0 +1,393 @@
+from collections import namedtuple, OrderedDict
+import logging
+import random
+from threading import Lock, Timer
+import time
+
+from apns2.errors import APNsException, BadDeviceToken, DeviceTokenNotForTopic, Unregistered
+from apns2.payload import Payload
+from django.conf import settings
+from gcm.gcm import GCMAuthenticationException
+from pyfcm.errors import AuthenticationError, FCMServerError, InternalPackageError
+import requests
+from requests.exceptions import RequestException
+
+from app.apns import apns_connection_manager
+from app.push_clients import get_google_push_timeout, google_push_clients
+from app.token_feedback import INVALID_GOOGLE_TOKEN_ERRORS
+from app.utils import log_middleware_information
+
+from .models import ANDROID_PLATFORM, APNS_PLATFORM, GCM_PLATFORM
+
+
+class PushError(Exception):
+    """
+    The provider did not accept the push for a reason that is not related to
+    the token of the device.
+    """
+    def __init__(self, reason, level=logging.WARNING):
+        super(PushError, self).__init__(reason)
+        self.reason = reason
+        self.level = level
+
+
+class InvalidTokenError(PushError):
+    """
+    The provider rejected the token of the device, it won't work again.
+    """
+
+
+# Outcome of a push to one device of a multicast: the PushError or None and
+# the token that replaces the token of the device or None.
+PushResult = namedtuple('PushResult', ['error', 'new_token'])
+
+
+class PushBackend(object):
+    """
+    Interface for sending pushes to one provider.
+
+    Attributes:
+        platform (string): The platform of the apps the backend sends to.
+        supports_batching (bool): Whether one request can send the same push
+            to max_batch_size devices.
+        max_batch_size (int): Max devices per request.
+        supports_collapse (bool): Whether a push replaces an undelivered push
+            with the same collapse id and expires after a time to live.
+        max_payload_size (int): Max bytes of the JSON payload.
+    """
+    platform = None
+    supports_batching = False
+    max_batch_size = 1
+    supports_collapse = False
+    max_payload_size = 4096
+
+    def send(self, device, app, payload, collapse_id=None, ttl=None):
+        """
+        Send a push to a device.
+
+        Args:
+            device (Device): The device to send to.
+            app (App): The app the device uses.
+            payload (dict): The data of the push.
+            collapse_id (string): Id of the pushes that replace each other.
+            ttl (int): Seconds after which the push is dropped.
+
+        Returns:
+            string: The token that replaces the token of the device or None.
+
+        Raises:
+            InvalidTokenError: When the token of the device is dead.
+            PushError: When the provider did not accept the push.
+        """
+        raise NotImplementedError
+
+    def send_multicast(self, devices, app, payload):
+        """
+        Send the same push to at most max_batch_size devices of an app.
+
+        Args:
+            devices (list): The devices to send to.
+            app (App): The app the devices use.
+            payload (dict): The data of the push.
+
+        Returns:
+            list: A PushResult per device.
+        """
+        results = []
+        for device in devices:
+            try:
+                results.append(PushResult(None, self.send(device, app, payload)))
+            except PushError as ex:
+                results.append(PushResult(ex, None))
+        return results
+
+
+class APNsBackend(PushBackend):
+    """
+    Sends to Apple over the warm HTTP/2 connections of the connection
+    manager.
+    """
+    platform = APNS_PLATFORM
+    supports_collapse = True
+    # Max size of VoIP notifications.
+    max_payload_size = 5120
+
+    def send(self, device, app, payload, collapse_id=None, ttl=None):
+        expiration = int(time.time()) + ttl if ttl else None
+        try:
+            apns_connection_manager.send(
+                app, device, Payload(custom=payload), expiration=expiration, collapse_id=collapse_id)
+        except (DeviceTokenNotForTopic, BadDeviceToken, Unregistered) as ex:
+            # According to APNs protocol the token reported here
+            # is garbage (invalid or empty), stop using and remove it.
+            raise InvalidTokenError(type(ex).__name__)
+        except APNsException as ex:
+            # Failures not related to devices.
+            raise PushError(type(ex).__name__)
+
+
+class FCMBackend(PushBackend):
+    """
+    Sends to Firebase with the shared client of the app.
+    """
+    platform = ANDROID_PLATFORM
+    supports_batching = True
+    max_batch_size = 1000
+    supports_collapse = True
+
+    def send(self, device, app, payload, collapse_id=None, ttl=None):
+        result = self._notify(
+            app,
+            registration_id=device.token,
+            data_message=payload,
+            collapse_key=collapse_id,
+            time_to_live=ttl,
+        ).get('results') or [{}]
+        return get_google_result(result[0].get('error'), result[0].get('registration_id'))
+
+    def send_multicast(self, devices, app, payload):
+        try:
+            result = self._notify(
+                app,
+                registration_ids=[device.token for device in devices],
+                data_message=payload,
+            )
+        except PushError as ex:
+            return [PushResult(ex, None)] * len(devices)
+
+        # The results are in the order of the registration ids.
+        results = []
+        for device_result in result.get('results') or [{}] * len(devices):
+            try:
+                new_token = get_google_result(device_result.get('error'), device_result.get('registration_id'))
+            except PushError as ex:
+                results.append(PushResult(ex, None))
+            else:
+                results.append(PushResult(None, new_token))
+        return results
+
+    def _notify(self, app, **kwargs):
+        push_service = google_push_clients.get_fcm_client(app)
+        try:
+            if 'registration_ids' in kwargs:
+                return push_service.notify_multiple_devices(timeout=get_google_push_timeout(), **kwargs)
+            return push_service.notify_single_device(timeout=get_google_push_timeout(), **kwargs)
+        except AuthenticationError:
+            raise PushError('Our Google API key was rejected', logging.ERROR)
+        except InternalPackageError:
+            raise PushError('Bad api request made by package', logging.ERROR)
+        except (FCMServerError, RequestException) as ex:
+            raise PushError(type(ex).__name__, logging.ERROR)
+
+
+class GCMBackend(PushBackend):
+    """
+    Sends to Google Cloud Messaging with the shared client of the app.
+    """
+    platform = GCM_PLATFORM
+    supports_batching = True
+    max_batch_size = 1000
+    supports_collapse = True
+
+    def send(self, device, app, payload, collapse_id=None, ttl=None):
+        result = self._json_request([device], app, payload, collapse_id, ttl)[0]
+        if result.error:
+            raise result.error
+        return result.new_token
+
+    def send_multicast(self, devices, app, payload):
+        return self._json_request(devices, app, payload)
+
+    def _json_request(self, devices, app, payload, collapse_id=None, ttl=None):
+        options = {}
+        if ttl:
+            options['time_to_live'] = ttl
+
+        gcm = google_push_clients.get_gcm_client(app)
+        try:
+            response = gcm.json_request(
+                registration_ids=[device.token for device in devices],
+                data=payload,
+                collapse_key=collapse_id or '%d-cycle.key' % int(time.time()),
+                priority='high',
+                **options,
+            )
+        except GCMAuthenticationException:
+            # Stop and fix your settings.
+            return [PushResult(PushError('Our Google API key was rejected', logging.ERROR), None)] * len(devices)
+        except ValueError:
+            # Probably your extra options, such as time_to_live,
+            # are invalid. Read error message for more info.
+            error = PushError('Invalid message/option or invalid GCM response', logging.ERROR)
+            return [PushResult(error, None)] * len(devices)
+
+        # The ids are grouped per error code.
+        errors = {}
+        for error, tokens in (response.get('errors') or {}).items():
+            for token in tokens:
+                errors[token] = error
+
+        canonical = response.get('canonical') or {}
+        results = []
+        for device in devices:
+            try:
+                new_token = get_google_result(errors.get(device.token), canonical.get(device.token))
+            except PushError as ex:
+                results.append(PushResult(ex, None))
+            else:
+                results.append(PushResult(None, new_token))
+        return results
+
+
+class StubPushBackend(PushBackend):
+    """
+    Backend for load tests that sends nothing. It waits for a latency drawn
+    from a log-normal distribution around PUSH_STUB_LATENCY, fails at
+    PUSH_STUB_ERROR_RATE and rejects the token at
+    PUSH_STUB_INVALID_TOKEN_RATE. A share of PUSH_STUB_ANSWER_RATE of the
+    call pushes is answered like the app does, after PUSH_STUB_ANSWER_DELAY.
+    """
+    supports_batching = True
+    max_batch_size = 1000
+    supports_collapse = True
+
+    def __init__(self, platform):
+        self.platform = platform
+        self.session = requests.Session()
+
+    def send(self, device, app, payload, collapse_id=None, ttl=None):
+        time.sleep(random.lognormvariate(0, settings.PUSH_STUB_LATENCY_SIGMA) * settings.PUSH_STUB_LATENCY / 1000)
+
+        chance = random.random()
+        if chance < settings.PUSH_STUB_INVALID_TOKEN_RATE:
+            raise InvalidTokenError('StubInvalidToken')
+        if chance < settings.PUSH_STUB_INVALID_TOKEN_RATE + settings.PUSH_STUB_ERROR_RATE:
+            raise PushError('StubError')
+
+        if payload.get('type') == 'call' and random.random() < settings.PUSH_STUB_ANSWER_RATE:
+            delay = random.lognormvariate(0, settings.PUSH_STUB_LATENCY_SIGMA) * settings.PUSH_STUB_ANSWER_DELAY
+            answer = Timer(delay / 1000, self.answer, args=(payload,))
+            answer.daemon = True
+            answer.start()
+        return None
+
+    def send_multicast(self, devices, app, payload):
+        # One request for the batch, like the providers that support it.
+        time.sleep(random.lognormvariate(0, settings.PUSH_STUB_LATENCY_SIGMA) * settings.PUSH_STUB_LATENCY / 1000)
+
+        results = []
+        for _ in devices:
+            chance = random.random()
+            if chance < settings.PUSH_STUB_INVALID_TOKEN_RATE:
+                results.append(PushResult(InvalidTokenError('StubInvalidToken'), None))
+            elif chance < settings.PUSH_STUB_INVALID_TOKEN_RATE + settings.PUSH_STUB_ERROR_RATE:
+                results.append(PushResult(PushError('StubError'), None))
+            else:
+                results.append(PushResult(None, None))
+        return results
+
+    def answer(self, payload):
+        """
+        Post the call response of the simulated app.
+
+        Args:
+            payload (dict): The data of the call push.
+        """
+        try:
+            self.session.post(payload['response_api'], data={
+                'unique_key': payload['unique_key'],
+                'message_start_time': payload['message_start_time'],
+                'available': True,
+            }, timeout=settings.APP_PUSH_ROUNDTRIP_WAIT / 1000)
+        except RequestException as ex:
+            log_middleware_information(
+                '{0} | Stub call response failed. \'{1}\'',
+                OrderedDict([
+                    ('unique_key', payload['unique_key']),
+                    ('error_msg', type(ex).__name__),
+                ]),
+                logging.WARNING,
+            )
+
+
+def get_google_result(error, registration_id):
+    """
+    Function to turn the result of FCM or GCM for a registration id into the
+    outcome of a push.
+
+    Args:
+        error (string): The error of the result or None.
+        registration_id (string): The canonical registration id or None.
+
+    Returns:
+        string: The token that replaces the token of the device or None.
+
+    Raises:
+        InvalidTokenError: When the registration id is dead.
+        PushError: For the other errors.
+    """
+    if error in INVALID_GOOGLE_TOKEN_ERRORS:
+        raise InvalidTokenError(error)
+    elif error:
+        raise PushError(error)
+    return registration_id
+
+
+class PushBackendRegistry(object):
+    """
+    The backends per platform. The platforms in PUSH_STUB_PLATFORMS are sent
+    to a stub backend instead.
+    """
+    def __init__(self):
+        self._backends = {}
+        self._stubs = {}
+        self._lock = Lock()
+
+    def register(self, backend):
+        """
+        Register the backend for its platform.
+
+        Args:
+            backend (PushBackend): The backend.
+
+        Returns:
+            PushBackend: The backend.
+        """
+        self._backends[backend.platform] = backend
+        return backend
+
+    def get(self, platform):
+        """
+        Get the backend for a platform.
+
+        Args:
+            platform (string): The platform of the app.
+
+        Returns:
+            PushBackend: The backend or None for an unknown platform.
+        """
+        if platform in settings.PUSH_STUB_PLATFORMS:
+            with self._lock:
+                if platform not in self._stubs:
+                    self._stubs[platform] = StubPushBackend(platform)
+                return self._stubs[platform]
+        return self._backends.get(platform)
+
+
+push_backends = PushBackendRegistry()
+push_backends.register(APNsBackend())
+push_backends.register(FCMBackend())
+push_backends.register(GCMBackend())
+
+
+def get_push_backend(platform):
+    """
+    Function to get the push backend for a platform.
+
+    Args:
+        platform (string): The platform of the app.
+
+    Returns:
+        PushBackend: The backend or None for an unknown platform.
+    """
+    return push_backends.get(platform)
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import logging
+from threading import local, Lock
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from gcm.gcm import GCM
+from pyfcm import FCMNotification
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.models import App
+from app.utils import log_middleware_information
+
+
+def get_google_push_timeout():
+    """
+    Function to get the connect and read timeout for requests to Google.
+
+    Returns:
+        tuple: The connect and read timeout in seconds.
+    """
+    return settings.GOOGLE_PUSH_CONNECT_TIMEOUT / 1000, settings.GOOGLE_PUSH_READ_TIMEOUT / 1000
+
+
+def create_session():
+    """
+    Function to create a keep-alive session with a connection for every push
+    worker that sends at the same time.
+
+    Returns:
+        requests.Session: The session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.PUSH_EXECUTOR_WORKERS)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class FCMClient(FCMNotification):
+    """
+    FCMNotification that posts on a keep-alive session. The responses of a
+    send are kept per thread so the client can be shared.
+    """
+    def __init__(self, api_key, session):
+        self._local = local()
+        super(FCMClient, self).__init__(api_key=api_key)
+        self.session = session
+
+    @property
+    def send_request_responses(self):
+        return getattr(self._local, 'send_request_responses', [])
+
+    @send_request_responses.setter
+    def send_request_responses(self, value):
+        self._local.send_request_responses = value
+
+    def do_request(self, payload, timeout):
+        response = self.session.post(
+            self.FCM_END_POINT,
+            headers=self.request_headers(),
+            data=payload,
+            proxies=self.FCM_REQ_PROXIES,
+            timeout=timeout,
+        )
+        if 'Retry-After' in response.headers and int(response.headers['Retry-After']) > 0:
+            time.sleep(int(response.headers['Retry-After']))
+            return self.do_request(payload, timeout)
+        return response
+
+
+class GCMClient(GCM):
+    """
+    GCM that posts on a keep-alive session. The retry delay of a send is kept
+    per thread so the client can be shared.
+    """
+    def __init__(self, api_key, session):
+        self._local = local()
+        super(GCMClient, self).__init__(api_key, timeout=get_google_push_timeout())
+        self.session = session
+
+    @property
+    def retry_after(self):
+        return getattr(self._local, 'retry_after', None)
+
+    @retry_after.setter
+    def retry_after(self, value):
+        self._local.retry_after = value
+
+    def json_request(self, **kwargs):
+        kwargs.setdefault('session', self.session)
+        return super(GCMClient, self).json_request(**kwargs)
+
+
+class GooglePushClientPool(object):
+    """
+    The FCM and GCM clients of this process by app. A client is replaced when
+    the push_key of its app changed.
+    """
+    def __init__(self):
+        self._clients = {}
+        self._lock = Lock()
+
+    def get_fcm_client(self, app):
+        """
+        Get the FCM client of an app.
+
+        Args:
+            app (App): The app to send for.
+
+        Returns:
+            FCMClient: The client.
+        """
+        return self._get_client(app, FCMClient)
+
+    def get_gcm_client(self, app):
+        """
+        Get the GCM client of an app.
+
+        Args:
+            app (App): The app to send for.
+
+        Returns:
+            GCMClient: The client.
+        """
+        return self._get_client(app, GCMClient)
+
+    def evict(self, app_pk):
+        """
+        Drop the client of an app and close its connections.
+
+        Args:
+            app_pk (int): The pk of the app.
+        """
+        with self._lock:
+            entry = self._clients.pop(app_pk, None)
+        if entry is not None:
+            entry[1].session.close()
+
+    def _get_client(self, app, client_class):
+        entry = self._clients.get(app.pk)
+        if entry is not None and entry[0] == app.push_key and isinstance(entry[1], client_class):
+            return entry[1]
+
+        with self._lock:
+            old_entry = self._clients.get(app.pk)
+            if old_entry is not None and old_entry[0] == app.push_key and isinstance(old_entry[1], client_class):
+                return old_entry[1]
+            client = client_class(app.push_key, create_session())
+            self._clients[app.pk] = (app.push_key, client)
+
+        if old_entry is not None:
+            log_middleware_information(
+                'Replaced the push client of app_id: {0}',
+                OrderedDict([('app_id', app.app_id)]),
+                logging.INFO,
+            )
+            old_entry[1].session.close()
+        return client
+
+
+google_push_clients = GooglePushClientPool()
+
+
+@receiver(post_save, sender=App)
+@receiver(post_delete, sender=App)
+def evict_google_push_client(sender, instance, **kwargs):
+    """
+    Drop the client of an edited or deleted app in this process, the other
+    processes replace it when they see the new push_key.
+    """
+    google_push_clients.evict(instance.pk)
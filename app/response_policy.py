@@ -0,0 +1,464 @@
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+import logging
+import math
+
+from django.conf import settings
+
+from app.devices import LocalCache
+from app.utils import log_middleware_information
+
+# Prefixes of the Redis hashes with the response history of a device and of
+# all devices of a platform.
+DEVICE_STATS_KEY_PREFIX = 'response_stats_device_'
+PLATFORM_STATS_KEY_PREFIX = 'response_stats_platform_'
+
+# Seconds the history of a device is kept after its last call.
+RESPONSE_STATS_TTL = 30 * 24 * 60 * 60
+# Seconds this process keeps the history of a platform.
+PLATFORM_STATS_CACHE_TTL = 10
+
+# Upper bounds in seconds of the buckets of the roundtrip sketch, 50 ms to
+# 10 s in steps of 20%. Longer roundtrips go in one last bucket.
+SKETCH_BOUNDS = tuple(round(.05 * 1.2 ** i, 3) for i in range(30))
+
+POLICY_MODE_STATIC = 'static'
+POLICY_MODE_ADAPTIVE = 'adaptive'
+
+# Where the timing of a call came from.
+SOURCE_STATIC = 'static'
+SOURCE_DEVICE = 'device'
+SOURCE_PLATFORM = 'platform'
+SOURCE_UNRESPONSIVE = 'unresponsive'
+
+# Record a roundtrip and/or the outcome of a call in a response history.
+# The roundtrip goes in the EWMA and in its bucket of the sketch, the
+# buckets are halved when the sketch holds more than max samples so it
+# follows the recent roundtrips. Keep in sync with ResponseStats.update.
+# KEYS: stats. ARGV: roundtrip or '', bucket, responded ('1', '0' or ''),
+# alpha, max samples, ttl.
+RECORD_RESPONSE_SCRIPT = """
+local alpha = tonumber(ARGV[4])
+if ARGV[1] ~= '' then
+    local roundtrip = tonumber(ARGV[1])
+    local ewma = tonumber(redis.call('HGET', KEYS[1], 'roundtrip') or roundtrip)
+    redis.call('HSET', KEYS[1], 'roundtrip', tostring(ewma + alpha * (roundtrip - ewma)))
+    redis.call('HINCRBY', KEYS[1], 'b' .. ARGV[2], 1)
+    local samples = redis.call('HINCRBY', KEYS[1], 'samples', 1)
+    if samples > tonumber(ARGV[5]) then
+        local fields = redis.call('HGETALL', KEYS[1])
+        samples = 0
+        for i = 1, #fields, 2 do
+            if string.sub(fields[i], 1, 1) == 'b' then
+                local count = math.floor(tonumber(fields[i + 1]) / 2)
+                redis.call('HSET', KEYS[1], fields[i], count)
+                samples = samples + count
+            end
+        end
+        redis.call('HSET', KEYS[1], 'samples', samples)
+    end
+end
+if ARGV[3] ~= '' then
+    local responded = tonumber(ARGV[3])
+    local rate = tonumber(redis.call('HGET', KEYS[1], 'answer_rate') or responded)
+    redis.call('HSET', KEYS[1], 'answer_rate', tostring(rate + alpha * (responded - rate)))
+    redis.call('HINCRBY', KEYS[1], 'calls', 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+"""
+
+# The timing of an incoming call: seconds to wait for the app, seconds
+# between the pushes, the max pushes and where the timing came from.
+CallPolicy = namedtuple('CallPolicy', ['wait', 'resend_interval', 'max_attempts', 'source'])
+
+
+def get_device_stats_key(device_id):
+    """
+    Function to get the key of the response history of a device.
+
+    Args:
+        device_id (string): The id of the device.
+
+    Returns:
+        string: The cache key.
+    """
+    return '{0}{1}'.format(DEVICE_STATS_KEY_PREFIX, device_id)
+
+
+def get_platform_stats_key(platform):
+    """
+    Function to get the key of the response history of a platform.
+
+    Args:
+        platform (string): The platform of the devices.
+
+    Returns:
+        string: The cache key.
+    """
+    return '{0}{1}'.format(PLATFORM_STATS_KEY_PREFIX, platform)
+
+
+def get_sketch_bucket(roundtrip):
+    """
+    Function to get the bucket of the sketch for a roundtrip.
+
+    Args:
+        roundtrip (float): The roundtrip in seconds.
+
+    Returns:
+        int: The index of the bucket.
+    """
+    return bisect_left(SKETCH_BOUNDS, roundtrip)
+
+
+class ResponseStats(object):
+    """
+    The response history of a device or platform: an EWMA of the roundtrip
+    and of the share of calls the app responded to in time, and a sketch of
+    the roundtrips to estimate their quantiles.
+    """
+    def __init__(self, fields=None):
+        fields = fields or {}
+        self.roundtrip = float(fields['roundtrip']) if 'roundtrip' in fields else None
+        self.answer_rate = float(fields.get('answer_rate', 0))
+        self.calls = int(fields.get('calls', 0))
+        self.samples = int(fields.get('samples', 0))
+        self.buckets = [int(fields.get('b{0}'.format(i), 0)) for i in range(len(SKETCH_BOUNDS) + 1)]
+
+    def update(self, roundtrip=None, responded=None, max_samples=None):
+        """
+        Record a roundtrip and/or an outcome like RECORD_RESPONSE_SCRIPT.
+
+        Args:
+            roundtrip (float): The roundtrip in seconds.
+            responded (bool): Whether the app responded in time.
+            max_samples (int): Samples at which the sketch is halved.
+        """
+        alpha = settings.RESPONSE_POLICY_EWMA_ALPHA
+        if roundtrip is not None:
+            ewma = roundtrip if self.roundtrip is None else self.roundtrip
+            self.roundtrip = ewma + alpha * (roundtrip - ewma)
+            self.buckets[get_sketch_bucket(roundtrip)] += 1
+            self.samples += 1
+            if max_samples is not None and self.samples > max_samples:
+                self.buckets = [count // 2 for count in self.buckets]
+                self.samples = sum(self.buckets)
+        if responded is not None:
+            rate = self.answer_rate if self.calls else float(responded)
+            self.answer_rate = rate + alpha * (float(responded) - rate)
+            self.calls += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile of the roundtrips.
+
+        Args:
+            q (float): The quantile between 0 and 1.
+
+        Returns:
+            float: The upper bound in seconds of the bucket the quantile is
+                in, infinite for the last bucket or None without samples.
+        """
+        total = sum(self.buckets)
+        if not total:
+            return None
+        cumulative = 0
+        for bound, count in zip(SKETCH_BOUNDS + (math.inf,), self.buckets):
+            cumulative += count
+            if cumulative >= q * total:
+                return bound
+        return math.inf
+
+    def as_dict(self):
+        return OrderedDict([
+            ('calls', self.calls),
+            ('answer_rate', round(self.answer_rate, 3)),
+            ('samples', self.samples),
+            ('roundtrip', None if self.roundtrip is None else round(self.roundtrip, 3)),
+            ('p50', self.quantile(.5)),
+            ('p90', self.quantile(.9)),
+            ('p99', self.quantile(.99)),
+        ])
+
+
+def get_static_call_policy():
+    """
+    Function to get the timing from APP_PUSH_ROUNDTRIP_WAIT and
+    APP_PUSH_RESEND_INTERVAL.
+
+    Returns:
+        CallPolicy: The same timing for every call.
+    """
+    wait = settings.APP_PUSH_ROUNDTRIP_WAIT / 1000
+    resend_interval = settings.APP_PUSH_RESEND_INTERVAL / 1000
+    # Avoid sending a push close to the end of the loop.
+    return CallPolicy(wait, resend_interval, int(wait / resend_interval) - 1, SOURCE_STATIC)
+
+
+def choose_call_policy(device_stats, platform_stats):
+    """
+    Function to choose the timing of a call from the response history of
+    the device, or of its platform while the device has too few samples.
+
+    The app gets until the RESPONSE_POLICY_DEADLINE_QUANTILE of its
+    roundtrips plus RESPONSE_POLICY_DEADLINE_MARGIN to respond, and a push
+    is resent when the RESPONSE_POLICY_RESEND_QUANTILE of its roundtrips
+    passed without a response. Devices that respond to less than
+    RESPONSE_POLICY_MIN_ANSWER_RATE of the calls get RESPONSE_POLICY_MIN_WAIT.
+    The wait stays between RESPONSE_POLICY_MIN_WAIT and
+    APP_PUSH_ROUNDTRIP_WAIT.
+
+    Args:
+        device_stats (ResponseStats): The history of the device.
+        platform_stats (ResponseStats): The history of the platform.
+
+    Returns:
+        CallPolicy: The timing of the call.
+    """
+    min_samples = settings.RESPONSE_POLICY_MIN_SAMPLES
+    if device_stats.samples >= min_samples:
+        stats, source = device_stats, SOURCE_DEVICE
+    elif platform_stats.samples >= min_samples:
+        stats, source = platform_stats, SOURCE_PLATFORM
+    else:
+        return get_static_call_policy()
+
+    max_wait = settings.APP_PUSH_ROUNDTRIP_WAIT / 1000
+    min_wait = min(settings.RESPONSE_POLICY_MIN_WAIT / 1000, max_wait)
+
+    if device_stats.calls >= min_samples and device_stats.answer_rate < settings.RESPONSE_POLICY_MIN_ANSWER_RATE:
+        wait, source = min_wait, SOURCE_UNRESPONSIVE
+    else:
+        deadline = stats.quantile(settings.RESPONSE_POLICY_DEADLINE_QUANTILE)
+        wait = min(max(deadline + settings.RESPONSE_POLICY_DEADLINE_MARGIN / 1000, min_wait), max_wait)
+
+    resend_interval = stats.quantile(settings.RESPONSE_POLICY_RESEND_QUANTILE)
+    resend_interval = min(max(resend_interval, settings.RESPONSE_POLICY_MIN_RESEND_INTERVAL / 1000), wait)
+    return CallPolicy(wait, resend_interval, max(int(wait / resend_interval) - 1, 1), source)
+
+
+def combine_call_policies(policies):
+    """
+    Function to get the timing of a call to several devices. The call waits
+    as long as the slowest device needs and resends as often as the fastest
+    device needs.
+
+    Args:
+        policies (list): The CallPolicy of every device.
+
+    Returns:
+        CallPolicy: The timing of the call.
+    """
+    if len(set(policies)) == 1:
+        return policies[0]
+    slowest = max(policies, key=lambda policy: policy.wait)
+    resend_interval = min(policy.resend_interval for policy in policies)
+    return CallPolicy(
+        slowest.wait,
+        resend_interval,
+        max(int(slowest.wait / resend_interval) - 1, 1),
+        slowest.source,
+    )
+
+
+def get_record_calls(platform, device_id, roundtrip=None, responded=None):
+    """
+    Function to get the keys and arguments of RECORD_RESPONSE_SCRIPT to
+    record a roundtrip and/or an outcome for a device and its platform.
+
+    Returns:
+        list: A tuple of the key and the arguments per history.
+    """
+    histories = [(get_platform_stats_key(platform), settings.RESPONSE_STATS_PLATFORM_MAX_SAMPLES)]
+    if device_id:
+        histories.insert(0, (get_device_stats_key(device_id), settings.RESPONSE_STATS_DEVICE_MAX_SAMPLES))
+    return [(key, [
+        '' if roundtrip is None else roundtrip,
+        0 if roundtrip is None else get_sketch_bucket(roundtrip),
+        '' if responded is None else int(responded),
+        settings.RESPONSE_POLICY_EWMA_ALPHA,
+        max_samples,
+        RESPONSE_STATS_TTL,
+    ]) for key, max_samples in histories]
+
+
+class ResponsePolicy(object):
+    """
+    Keeps the response history of the devices and platforms in Redis and
+    chooses the timing of the incoming calls from it when
+    APP_PUSH_POLICY_MODE is 'adaptive'. The history is always recorded, so
+    it is there when the mode is switched.
+    """
+    def __init__(self):
+        self.platform_stats = LocalCache(10, PLATFORM_STATS_CACHE_TTL)
+
+    def get_device_stats(self, redis_cache, device_id):
+        return ResponseStats(redis_cache.client.hgetall(get_device_stats_key(device_id)))
+
+    def get_platform_stats(self, redis_cache, platform):
+        stats = self.platform_stats.get(platform)
+        if stats is None:
+            stats = ResponseStats(redis_cache.client.hgetall(get_platform_stats_key(platform)))
+            self.platform_stats.set(platform, stats)
+        return stats
+
+    def get_call_policy(self, redis_cache, device):
+        """
+        Get the timing of a call to a device.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache with the history.
+            device (Device): The device that is called.
+
+        Returns:
+            CallPolicy: The timing of the call, the static timing when the
+                history can't be read.
+        """
+        if settings.APP_PUSH_POLICY_MODE != POLICY_MODE_ADAPTIVE:
+            return get_static_call_policy()
+        try:
+            return choose_call_policy(
+                self.get_device_stats(redis_cache, device.id),
+                self.get_platform_stats(redis_cache, device.app.platform),
+            )
+        except Exception:
+            log_middleware_information(
+                'Reading the response history of {0} failed, using the static policy',
+                OrderedDict([
+                    ('sip_user_id', device.sip_user_id),
+                ]),
+                logging.ERROR,
+            )
+            return get_static_call_policy()
+
+    def record(self, redis_cache, platform, device_id, roundtrip=None, responded=None):
+        """
+        Record a roundtrip and/or the outcome of a call in the history of the
+        device and of its platform.
+
+        Args:
+            redis_cache (RedisClusterCache): The cache with the history.
+            platform (string): The platform of the device.
+            device_id (string): The id of the device or None.
+            roundtrip (float): Seconds between the start of the call and the
+                response of the app.
+            responded (bool): Whether the app responded before the call
+                gave up.
+        """
+        try:
+            for key, args in get_record_calls(platform, device_id, roundtrip, responded):
+                redis_cache.run_script(RECORD_RESPONSE_SCRIPT, [key], args)
+        except Exception:
+            log_middleware_information(
+                'Recording the response history of device {0} failed',
+                OrderedDict([
+                    ('device_id', device_id),
+                ]),
+                logging.ERROR,
+            )
+
+
+response_policy = ResponsePolicy()
+
+
+def get_call_policy(redis_cache, device):
+    """
+    Function to get the timing of an incoming call to a device.
+    """
+    return response_policy.get_call_policy(redis_cache, device)
+
+
+def record_call_roundtrip(redis_cache, platform, device_id, roundtrip):
+    """
+    Function to record the roundtrip of a response of the app, also when it
+    came too late.
+    """
+    response_policy.record(redis_cache, platform, device_id, roundtrip=roundtrip)
+
+
+def record_call_outcome(redis_cache, platform, device_id, responded):
+    """
+    Function to record whether the app responded to a call before the call
+    gave up.
+    """
+    response_policy.record(redis_cache, platform, device_id, responded=responded)
+
+
+class SimulationResult(object):
+    """
+    The outcome of the calls of a simulation under one policy.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.responded = 0
+        self.pushes = 0
+        self.hold_times = []
+
+    def add(self, policy, roundtrip):
+        """
+        Add a call the app responded to after roundtrip seconds.
+
+        Returns:
+            bool: Whether the app responded before the call gave up.
+        """
+        responded = roundtrip <= policy.wait
+        end = roundtrip if responded else policy.wait
+        self.calls += 1
+        self.responded += responded
+        self.hold_times.append(end)
+        # The first push and the resends that were due before the end.
+        self.pushes += 1 + sum(
+            1 for attempt in range(1, policy.max_attempts) if attempt * policy.resend_interval < end)
+        return responded
+
+    def as_dict(self):
+        hold_times = sorted(self.hold_times)
+        return OrderedDict([
+            ('calls', self.calls),
+            ('answer_rate', round(self.responded / self.calls, 4) if self.calls else 0),
+            ('mean_hold', round(sum(hold_times) / self.calls, 3) if self.calls else 0),
+            ('p95_hold', round(hold_times[int(.95 * (self.calls - 1))], 3) if self.calls else 0),
+            ('pushes_per_call', round(self.pushes / self.calls, 3) if self.calls else 0),
+        ])
+
+
+def simulate_response_logs(response_logs):
+    """
+    Function to replay response logs in order of date under the static and
+    the adaptive policy with a history built up during the replay.
+
+    Calls the app never responded to are not logged, so the answer rate is
+    the share of the logged responses that arrived before the call gave up.
+    The logs have no device, the devices of a sip_user_id are told apart by
+    their platform.
+
+    Args:
+        response_logs (iterable): ResponseLog records ordered by date.
+
+    Returns:
+        OrderedDict: SimulationResult per policy.
+    """
+    results = OrderedDict([
+        (POLICY_MODE_STATIC, SimulationResult()),
+        (POLICY_MODE_ADAPTIVE, SimulationResult()),
+    ])
+    static_policy = get_static_call_policy()
+    device_stats = {}
+    platform_stats = {}
+
+    for response_log in response_logs:
+        if response_log.sip_user_id:
+            device = device_stats.setdefault((response_log.sip_user_id, response_log.platform), ResponseStats())
+        else:
+            # Only the history of the platform is used.
+            device = ResponseStats()
+        platform = platform_stats.setdefault(response_log.platform, ResponseStats())
+
+        results[POLICY_MODE_STATIC].add(static_policy, response_log.roundtrip_time)
+        responded = results[POLICY_MODE_ADAPTIVE].add(
+            choose_call_policy(device, platform), response_log.roundtrip_time)
+
+        for stats, max_samples in ((device, settings.RESPONSE_STATS_DEVICE_MAX_SAMPLES),
+                                   (platform, settings.RESPONSE_STATS_PLATFORM_MAX_SAMPLES)):
+            stats.update(response_log.roundtrip_time, responded, max_samples)
+    return results
@@ -0,0 +1,205 @@
+from collections import OrderedDict
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from redis.exceptions import RedisError
+from rediscluster.exceptions import RedisClusterException
+
+from app.cache import get_redis_cache
+from app.models import Device
+from app.utils import log_middleware_information
+
+# The range of sip_user_ids accepted by SipUserIdSerializer.
+MIN_SIP_USER_ID = 100000000
+MAX_SIP_USER_ID = 999999999
+
+# The bitmap is split in shards of 2^20 bits (128KiB) spread over the
+# cluster. The hash tag keeps the live and rebuild key of a shard in one slot.
+SHARD_BITS = 20
+SHARD_COUNT = ((MAX_SIP_USER_ID - MIN_SIP_USER_ID) >> SHARD_BITS) + 1
+FILTER_KEY = 'sip_user_filter:{{{0}}}'
+REBUILD_KEY = 'sip_user_filter_rebuild:{{{0}}}'
+
+# Results of a lookup.
+UNKNOWN = -1
+ABSENT = 0
+PRESENT = 1
+
+# Get the bit of a sip_user_id, -1 when the shard was never built.
+# KEYS: shard. ARGV: offset.
+CONTAINS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+return redis.call('GETBIT', KEYS[1], ARGV[1])
+"""
+
+# Set the bit of a sip_user_id in the live shard and in the shard that is
+# being rebuilt. Shards that don't exist are left alone, creating one would
+# hide the other devices in it.
+# KEYS: shard, rebuild shard. ARGV: offset, value.
+SET_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('SETBIT', key, ARGV[1], ARGV[2])
+    end
+end
+"""
+
+
+def get_position(sip_user_id):
+    """
+    Function to get the shard and offset of a sip_user_id in the bitmap.
+
+    Args:
+        sip_user_id (int|string): The sip_user_id.
+
+    Returns:
+        tuple: The shard and offset or None for an id outside the range.
+    """
+    try:
+        index = int(sip_user_id) - MIN_SIP_USER_ID
+    except (TypeError, ValueError):
+        return None
+    if not 0 <= index <= MAX_SIP_USER_ID - MIN_SIP_USER_ID:
+        return None
+    return index >> SHARD_BITS, index & ((1 << SHARD_BITS) - 1)
+
+
+class SipUserFilter(object):
+    """
+    Bitmap in Redis with a bit for every sip_user_id that has a device, so
+    calls for unknown sip_user_ids are answered without a query.
+
+    The bitmap is exact: there are no false positives except for devices
+    deleted while the filter is rebuilt, which keep their bit until the
+    next rebuild. A positive only means the device is looked up as before.
+    Until `manage.py rebuild_sip_user_filter` has run the lookups are
+    UNKNOWN and every call goes to the database.
+    """
+    def contains(self, sip_user_id):
+        """
+        Check if a sip_user_id has a device.
+
+        Args:
+            sip_user_id (int|string): The sip_user_id.
+
+        Returns:
+            int: PRESENT, ABSENT or UNKNOWN when the filter can't tell.
+        """
+        position = get_position(sip_user_id)
+        if position is None:
+            return UNKNOWN
+        shard, offset = position
+        try:
+            return get_redis_cache().run_script(CONTAINS_SCRIPT, [FILTER_KEY.format(shard)], [offset])
+        except (RedisError, RedisClusterException):
+            return UNKNOWN
+
+    def set(self, sip_user_id, value):
+        """
+        Set or clear the bit of a sip_user_id.
+
+        Args:
+            sip_user_id (int|string): The sip_user_id.
+            value (int): 1 for a registered device, 0 for a deleted one.
+        """
+        position = get_position(sip_user_id)
+        if position is None:
+            return
+        shard, offset = position
+        try:
+            get_redis_cache().run_script(
+                SET_SCRIPT,
+                [FILTER_KEY.format(shard), REBUILD_KEY.format(shard)],
+                [offset, value],
+            )
+        except (RedisError, RedisClusterException):
+            # A missed bit makes calls fail, so force a rebuild.
+            log_middleware_information(
+                'Failed to update the sip user filter for {0}, run rebuild_sip_user_filter',
+                OrderedDict([('sip_user_id', sip_user_id)]),
+                logging.CRITICAL,
+            )
+
+    def rebuild(self, chunk_size=10000):
+        """
+        Rebuild the bitmap from the devices in the database. Devices that
+        register or are deleted meanwhile are written to both bitmaps.
+
+        Args:
+            chunk_size (int): The number of devices fetched per query.
+
+        Returns:
+            int: The number of devices in the filter.
+        """
+        client = get_redis_cache().client
+
+        # Create every shard so writes during the rebuild end up in it.
+        pipeline = client.pipeline(transaction=False)
+        for shard in range(SHARD_COUNT):
+            pipeline.delete(REBUILD_KEY.format(shard))
+            pipeline.setbit(REBUILD_KEY.format(shard), 0, 0)
+        pipeline.execute()
+
+        count = 0
+        last_sip_user_id = ''
+        while True:
+            sip_user_ids = list(
+                Device.objects.filter(sip_user_id__gt=last_sip_user_id).order_by(
+                    'sip_user_id').values_list('sip_user_id', flat=True)[:chunk_size])
+            if not sip_user_ids:
+                break
+
+            pipeline = client.pipeline(transaction=False)
+            for sip_user_id in sip_user_ids:
+                position = get_position(sip_user_id)
+                if position is not None:
+                    pipeline.setbit(REBUILD_KEY.format(position[0]), position[1], 1)
+                    count += 1
+            pipeline.execute()
+            last_sip_user_id = sip_user_ids[-1]
+
+        pipeline = client.pipeline(transaction=False)
+        for shard in range(SHARD_COUNT):
+            # Use execute_command because rename is blocked on cluster
+            # pipelines, both keys are in the same slot.
+            pipeline.execute_command('RENAME', REBUILD_KEY.format(shard), FILTER_KEY.format(shard))
+        pipeline.execute()
+        return count
+
+
+sip_user_filter = SipUserFilter()
+
+
+@receiver(post_save, sender=Device)
+def add_to_sip_user_filter(sender, instance, **kwargs):
+    """
+    Set the bit before the device is committed, a call in between finds the
+    bit and checks the database like before. Set it again after the commit
+    in case a rebuild started in between and missed the device.
+    """
+    sip_user_id = instance.sip_user_id
+    sip_user_filter.set(sip_user_id, 1)
+    transaction.on_commit(lambda: sip_user_filter.set(sip_user_id, 1))
+
+
+def clear_deleted_sip_user_id(sip_user_id):
+    """
+    Function to clear the bit of a deleted device unless the sip_user_id
+    registered again in the meantime.
+    """
+    if not Device.objects.filter(sip_user_id=sip_user_id).exists():
+        sip_user_filter.set(sip_user_id, 0)
+
+
+@receiver(post_delete, sender=Device)
+def remove_from_sip_user_filter(sender, instance, **kwargs):
+    """
+    Clear the bit once the delete is committed.
+    """
+    # Django clears the pk of deleted instances, so don't read it on commit.
+    sip_user_id = instance.sip_user_id
+    transaction.on_commit(lambda: clear_deleted_sip_user_id(sip_user_id))
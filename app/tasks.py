@@ -1,33 +1,67 @@
-from .decorators import threaded
+from django.conf import settings
+
+from .decorators import executed
+from .bulk_notify import BulkNotification
+from .executors import bulk_notify_executor, db_log_executor, notify_executor, push_executor
 from .models import ResponseLog
-from .push import send_call_message, send_text_message
+from .outbox import enqueue_call_push, SEND_MODE_OUTBOX
+from .push import send_call_message, send_cancel_message, send_text_message
 
 
-@threaded
 def task_incoming_call_notify(device, unique_key, phonenumber, caller_id, attempt):
     """
-    Threaded task to send a call push notification.
+    Task to send a call push notification, through the push outbox when
+    APP_PUSH_SEND_MODE is 'outbox'.
+    """
+    if settings.APP_PUSH_SEND_MODE == SEND_MODE_OUTBOX:
+        enqueue_call_push(device, unique_key, phonenumber, caller_id, attempt)
+    else:
+        task_send_call_message(device, unique_key, phonenumber, caller_id, attempt)
+
+
+@executed(push_executor)
+def task_send_call_message(device, unique_key, phonenumber, caller_id, attempt):
+    """
+    Task to send a call push notification from this process.
     """
     send_call_message(device, unique_key, phonenumber, caller_id, attempt)
 
 
-@threaded
+@executed(push_executor)
+def task_cancelled_call_notify(device, unique_key):
+    """
+    Task to send the push notification that a call was cancelled, from this
+    process also in 'outbox' mode.
+    """
+    send_cancel_message(device, unique_key)
+
+
+@executed(notify_executor)
 def task_notify_old_token(device, app):
     """
-    Threaded task to send a text push notification.
+    Task to send a text push notification.
     """
     msg = 'A other device has registered for the same account. You won\'t be reachable on this device'
     send_text_message(device, app, msg)
 
 
-@threaded
-def log_to_db(platform, roundtrip_time, available):
+@executed(bulk_notify_executor)
+def task_bulk_notify(run_id):
+    """
+    Task to send a bulk notification from its checkpoint.
+    """
+    BulkNotification(run_id).run()
+
+
+@executed(db_log_executor)
+def log_to_db(platform, roundtrip_time, available, sip_user_id=None):
     """
-    Log the info in a seperate thread to the DB to make sure the log write
-    does not block the api requests.
+    Log the info in a worker to the DB to make sure the log write does not
+    block the api requests.
     """
     ResponseLog.objects.create(
         platform=platform,
         roundtrip_time=roundtrip_time,
         available=available,
+        sip_user_id=sip_user_id or None,
     )
@@ -0,0 +1,106 @@
+from django.test import override_settings, SimpleTestCase
+
+from ..admission import (
+    ADMISSION_CALLS_KEY,
+    AdmissionControl,
+    AdmissionRejected,
+    get_app_calls_key,
+    REJECTED_APP,
+    REJECTED_GLOBAL,
+    REJECTED_WORKER,
+    WorkerSlots)
+from ..cache import RedisClusterCache
+
+
+@override_settings(ADMISSION_FAIR_SHARE_THRESHOLD=0.8, ADMISSION_MAX_APP_SHARE=0.5)
+class WorkerSlotsTestCase(SimpleTestCase):
+    """
+    Tests for the slots of the calls parked in this process.
+    """
+    def setUp(self):
+        super(WorkerSlotsTestCase, self).setUp()
+        self.slots = WorkerSlots()
+
+    def test_limit(self):
+        """
+        Test that a call over the limit is rejected until a slot is freed.
+        """
+        for i in range(10):
+            self.assertIsNone(self.slots.acquire('token{0}'.format(i), i, 10, 10))
+
+        self.assertEqual(self.slots.acquire('token', 10, 10, 10), REJECTED_WORKER)
+        self.slots.release('token0')
+        self.assertIsNone(self.slots.acquire('token', 10, 10, 10))
+
+    def test_fair_share(self):
+        """
+        Test that one app can use all free slots until the threshold and
+        then only its share, which leaves room for the other apps.
+        """
+        for i in range(8):
+            self.assertIsNone(self.slots.acquire('token{0}'.format(i), 1, 10, 10))
+
+        self.assertEqual(self.slots.acquire('token8', 1, 10, 10), REJECTED_APP)
+        self.assertIsNone(self.slots.acquire('token8', 2, 10, 10))
+
+    def test_expired_slots(self):
+        """
+        Test that slots that were never released don't count after their
+        ttl.
+        """
+        for i in range(10):
+            self.slots.acquire('token{0}'.format(i), i, -1, 10)
+
+        self.assertIsNone(self.slots.acquire('token', 1, 10, 10))
+        self.assertEqual(len(self.slots), 1)
+
+
+@override_settings(
+    ADMISSION_MAX_WORKER_CALLS=0,
+    ADMISSION_MAX_GLOBAL_CALLS=10,
+    ADMISSION_FAIR_SHARE_THRESHOLD=0.8,
+    ADMISSION_MAX_APP_SHARE=0.5,
+)
+class GlobalAdmissionTestCase(SimpleTestCase):
+    """
+    Tests for the semaphore of the calls parked in all processes.
+    """
+    def setUp(self):
+        super(GlobalAdmissionTestCase, self).setUp()
+        self.redis_cache = RedisClusterCache()
+        self.admission_control = AdmissionControl()
+        self.keys = [ADMISSION_CALLS_KEY, get_app_calls_key(1), get_app_calls_key(2)]
+        self.redis_cache.client.delete(*self.keys)
+
+    def tearDown(self):
+        super(GlobalAdmissionTestCase, self).tearDown()
+        self.redis_cache.client.delete(*self.keys)
+
+    def test_limit_and_fair_share(self):
+        """
+        Test that an app is limited to its share near the limit and that the
+        other apps get the rest.
+        """
+        slots = [self.admission_control.acquire(self.redis_cache, 1, 4) for _ in range(8)]
+        with self.assertRaises(AdmissionRejected) as context:
+            self.admission_control.acquire(self.redis_cache, 1, 4)
+        self.assertEqual(context.exception.reason, REJECTED_APP)
+
+        slots += [self.admission_control.acquire(self.redis_cache, 2, 4) for _ in range(2)]
+        with self.assertRaises(AdmissionRejected) as context:
+            self.admission_control.acquire(self.redis_cache, 2, 4)
+        self.assertEqual(context.exception.reason, REJECTED_GLOBAL)
+
+        self.admission_control.release(self.redis_cache, slots[0])
+        self.assertEqual(self.redis_cache.client.zcard(ADMISSION_CALLS_KEY), 9)
+        self.admission_control.acquire(self.redis_cache, 2, 4)
+
+    def test_expired_slots(self):
+        """
+        Test that the slots of a process that died are freed after the wait.
+        """
+        for _ in range(10):
+            self.admission_control.acquire(self.redis_cache, 1, -10)
+
+        self.assertTrue(self.admission_control.acquire(self.redis_cache, 2, 4).is_global)
+        self.assertEqual(self.redis_cache.client.zcard(ADMISSION_CALLS_KEY), 1)
@@ -0,0 +1,190 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from apns2.client import APNsClient
+from apns2.errors import BadDeviceToken
+from apns2.payload import Payload
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.test import override_settings, SimpleTestCase
+from hyper.http20.exceptions import ConnectionError as HTTP20ConnectionError
+from hyper.tls import init_context
+import jwt
+
+from .utils import StubAPNsServer, write_key
+from ..apns import APNsConnectionManager, APNsConnectionPool, ProviderTokenCredentials
+
+
+@override_settings(
+    APNS_MAX_STREAMS_PER_CONNECTION=2,
+    APNS_SCALE_UP_UTILIZATION=0.5,
+    APNS_MAX_CONNECTIONS_PER_TOPIC=2,
+    APNS_PING_INTERVAL=60000,
+)
+@mock.patch('app.apns.log_middleware_information')
+@mock.patch('app.apns.get_redis_cache')
+@mock.patch('app.apns.APNsClient')
+class APNsConnectionManagerTestCase(SimpleTestCase):
+    """
+    Tests for the warm APNs connections.
+    """
+    def setUp(self):
+        super(APNsConnectionManagerTestCase, self).setUp()
+        self.manager = APNsConnectionManager()
+        self.manager.start = mock.Mock()
+        self.app = mock.Mock(app_id='com.voipgrid.vialer', push_key='cert.pem', uses_apns_token_auth=False)
+        self.device = mock.Mock(token='token', sandbox=False)
+
+    def test_connection_reused(self, client_class, *mocks):
+        """
+        Test that sends share one connection that is opened once.
+        """
+        for _ in range(3):
+            self.manager.send(self.app, self.device, 'message')
+
+        self.assertEqual(client_class.call_count, 1)
+        client = client_class.return_value
+        self.assertEqual(client.connect.call_count, 1)
+        self.assertEqual(client.send_notification.call_count, 3)
+
+    def test_reconnect_on_connection_error(self, client_class, *mocks):
+        """
+        Test that a notification is sent on a new connection when the old one
+        is gone.
+        """
+        broken_client = mock.Mock()
+        broken_client.send_notification.side_effect = HTTP20ConnectionError('GOAWAY')
+        client = mock.Mock()
+        client_class.side_effect = [broken_client, client]
+
+        self.manager.send(self.app, self.device, 'message')
+
+        client.send_notification.assert_called_once_with(
+            'token', 'message', topic=None, expiration=None, collapse_id=None)
+        pool = self.manager.get_pool(self.app, False)
+        self.assertEqual([connection.client for connection in pool.connections], [client])
+
+    def test_rejected_notification_releases_stream(self, client_class, *mocks):
+        """
+        Test that a notification rejected by APNs frees its stream and keeps
+        the connection.
+        """
+        client_class.return_value.send_notification.side_effect = BadDeviceToken()
+
+        with self.assertRaises(BadDeviceToken):
+            self.manager.send(self.app, self.device, 'message')
+
+        pool = self.manager.get_pool(self.app, False)
+        self.assertEqual(len(pool.connections), 1)
+        self.assertEqual(pool.connections[0].streams, 0)
+
+    def test_scale_up_under_load(self, client_class, *mocks):
+        """
+        Test that a connection is added when the streams are in use, until
+        the max connections per topic.
+        """
+        client_class.side_effect = lambda *args, **kwargs: mock.Mock()
+        pool = APNsConnectionPool('com.voipgrid.vialer', 'cert.pem', False)
+
+        connections = [pool.acquire() for _ in range(4)]
+
+        self.assertEqual(len(pool.connections), 2)
+        self.assertEqual([connection.streams for connection in pool.connections], [2, 2])
+        for connection in connections:
+            pool.release(connection)
+
+    def test_ping_drops_broken_connection(self, client_class, *mocks):
+        """
+        Test that idle connections that don't answer the ping are dropped.
+        """
+        pool = APNsConnectionPool('com.voipgrid.vialer', 'cert.pem', False)
+        pool.open()
+        connection = pool.connections[0]
+        connection.last_used = 0
+        connection.client._connection.ping.side_effect = OSError()
+
+        pool.ping()
+
+        self.assertEqual(pool.connections, [])
+        connection.client._connection.close.assert_called_once_with()
+
+
+@override_settings(APNS_TOKEN_REFRESH_INTERVAL=2400000)
+@mock.patch('app.apns.log_middleware_information')
+@mock.patch('app.apns.get_redis_cache')
+class APNsTokenAuthTestCase(SimpleTestCase):
+    """
+    Tests for provider token authentication against a local HTTP/2 stub.
+    """
+    def setUp(self):
+        super(APNsTokenAuthTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.server = StubAPNsServer(self.directory)
+
+        self.auth_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        write_key(self.auth_key, os.path.join(self.directory, 'AuthKey.p8'))
+
+        self.manager = APNsConnectionManager()
+        self.manager.start = mock.Mock()
+        self.device = mock.Mock(token='token', sandbox=False)
+
+    def tearDown(self):
+        super(APNsTokenAuthTestCase, self).tearDown()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def _get_app(self, app_id):
+        return mock.Mock(
+            app_id=app_id,
+            push_key='AuthKey.p8',
+            apns_key_id='ABC123DEFG',
+            apns_team_id='TEAM123456',
+            uses_apns_token_auth=True,
+        )
+
+    def test_apps_of_team_share_connection(self, *mocks):
+        """
+        Test that the apps of a team send on one connection with their own
+        topic and the same signed token.
+        """
+        # Trust the certificate of the stub for connections without a client
+        # certificate.
+        with override_settings(CERT_DIR=self.directory), \
+                mock.patch('hyper.tls._context', init_context(cert_path=self.server.cert_file)), \
+                mock.patch.object(APNsClient, 'LIVE_SERVER', 'localhost'), \
+                mock.patch.object(APNsClient, 'DEFAULT_PORT', self.server.port):
+            for app_id in ('com.voipgrid.vialer', 'com.voipgrid.whitelabel', 'com.voipgrid.vialer'):
+                self.manager.send(self._get_app(app_id), self.device, Payload(custom={'type': 'call'}))
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            [request['apns-topic'] for request in self.server.requests],
+            ['com.voipgrid.vialer.voip', 'com.voipgrid.whitelabel.voip', 'com.voipgrid.vialer.voip'],
+        )
+        authorizations = {request['authorization'] for request in self.server.requests}
+        self.assertEqual(len(authorizations), 1)
+
+        token = authorizations.pop().split(' ')[1]
+        self.assertEqual(jwt.get_unverified_header(token)['kid'], 'ABC123DEFG')
+        claims = jwt.decode(token, self.auth_key.public_key(), algorithms=['ES256'])
+        self.assertEqual(claims['iss'], 'TEAM123456')
+
+    @mock.patch('app.apns.time')
+    def test_token_refreshed_before_expiry(self, time, *mocks):
+        """
+        Test that the token is reused until APNS_TOKEN_REFRESH_INTERVAL.
+        """
+        credentials = ProviderTokenCredentials(
+            os.path.join(self.directory, 'AuthKey.p8'), 'ABC123DEFG', 'TEAM123456')
+
+        time.return_value = 1000
+        token = credentials.get_token()
+        time.return_value = 1000 + 2399
+        self.assertEqual(credentials.get_token(), token)
+
+        time.return_value = 1000 + 2400
+        new_token = credentials.get_token()
+        self.assertNotEqual(new_token, token)
+        self.assertEqual(jwt.decode(new_token, verify=False)['iat'], 3400)
@@ -0,0 +1,109 @@
+from unittest import mock
+
+from django.test import override_settings, SimpleTestCase, TransactionTestCase
+
+from ..bulk_notify import BulkNotification, STATUS_DONE, STATUS_PAUSED, wait_for_rate_limit
+from ..cache import get_redis_cache
+from ..models import App, Device
+from ..push_backends import StubPushBackend
+
+
+@override_settings(
+    PUSH_STUB_PLATFORMS=['android'],
+    PUSH_STUB_LATENCY=0,
+    PUSH_STUB_ERROR_RATE=0,
+    PUSH_STUB_INVALID_TOKEN_RATE=0,
+    BULK_NOTIFY_CHUNK_SIZE=10,
+    BULK_NOTIFY_CONCURRENCY=2,
+    BULK_NOTIFY_RATE_LIMIT={'android': 1000},
+)
+@mock.patch('app.token_feedback.log_middleware_information')
+class BulkNotificationTestCase(TransactionTestCase):
+    """
+    Tests for sending a text message to all devices of an app.
+    """
+    def setUp(self):
+        super(BulkNotificationTestCase, self).setUp()
+        self.app = App.objects.create(platform='android', app_id='com.voipgrid.vialer', push_key='key')
+        for i in range(25):
+            Device.objects.create(
+                name='test device',
+                token='token{0}'.format(i),
+                sip_user_id=str(100000000 + i),
+                app=self.app,
+            )
+
+    def test_send_to_all_devices(self, *mocks):
+        """
+        Test that every device gets the message and the progress is reported
+        per chunk.
+        """
+        progress = mock.Mock()
+
+        state = BulkNotification.create(self.app, 'Hello').run(progress=progress)
+
+        self.assertEqual(state['status'], STATUS_DONE)
+        self.assertEqual((state['total'], state['sent'], state['failed']), (25, 25, 0))
+        self.assertEqual(progress.call_count, 3)
+
+    def test_resume_from_checkpoint(self, *mocks):
+        """
+        Test that a stopped run continues after the last chunk it finished.
+        """
+        tokens = []
+        send_multicast = StubPushBackend.send_multicast
+
+        def record(backend, devices, app, payload):
+            tokens.extend(device.token for device in devices)
+            return send_multicast(backend, devices, app, payload)
+
+        run = BulkNotification.create(self.app, 'Hello')
+        with mock.patch.object(StubPushBackend, 'send_multicast', autospec=True, side_effect=record):
+            with self.assertRaises(RuntimeError):
+                run.run(progress=mock.Mock(side_effect=RuntimeError))
+            self.assertEqual(run.get_progress()['status'], STATUS_PAUSED)
+            self.assertEqual(run.get_progress()['sent'], 10)
+
+            state = BulkNotification(run.run_id).run()
+
+        self.assertEqual(state['sent'], 25)
+        self.assertEqual(sorted(tokens), sorted(Device.objects.values_list('token', flat=True)))
+
+    @override_settings(PUSH_STUB_INVALID_TOKEN_RATE=1)
+    def test_dead_tokens_removed(self, *mocks):
+        """
+        Test that the devices with a dead token are removed during the run.
+        """
+        state = BulkNotification.create(self.app, 'Hello').run()
+
+        self.assertEqual(state['removed'], 25)
+        self.assertFalse(Device.objects.exists())
+
+    def test_message_too_large(self, *mocks):
+        """
+        Test that a message larger than the provider takes is refused.
+        """
+        with self.assertRaises(ValueError):
+            BulkNotification.create(self.app, 'a' * 5000)
+
+
+@override_settings(BULK_NOTIFY_RATE_LIMIT={'android': 10})
+class RateLimitTestCase(SimpleTestCase):
+    """
+    Tests for the rate limit per provider of the bulk notifications.
+    """
+    def setUp(self):
+        super(RateLimitTestCase, self).setUp()
+        get_redis_cache().client.delete('bulk_notify_rate_android_1000', 'bulk_notify_rate_android_1001')
+
+    @mock.patch('app.bulk_notify.time')
+    def test_wait_for_next_second(self, time):
+        """
+        Test that the pushes over the limit of a second wait for the next.
+        """
+        time.time.side_effect = [1000.5, 1000.5, 1001.5]
+
+        wait_for_rate_limit('android', 15)
+
+        time.sleep.assert_called_once_with(.5)
+        self.assertEqual(get_redis_cache().client.get('bulk_notify_rate_android_1001'), '5')
@@ -0,0 +1,132 @@
+from datetime import timedelta
+from threading import Thread
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase
+from freezegun import freeze_time
+from redis.exceptions import ConnectionError
+from rediscluster.exceptions import RedisClusterException
+
+from ..cache import BlockingClusterConnectionPool, get_startup_nodes, RedisClusterCache, SharedRedisClusterCache
+
+
+@mock.patch('app.cache.log_middleware_information')
+class SharedRedisClusterCacheTestCase(SimpleTestCase):
+    """
+    Tests for the redis cluster cache shared by a process.
+    """
+    def setUp(self):
+        super(SharedRedisClusterCacheTestCase, self).setUp()
+        self.shared_cache = SharedRedisClusterCache()
+
+    def test_get_reuses_cache(self, *mocks):
+        """
+        Test that the slot discovery only happens once per process.
+        """
+        with mock.patch('app.cache.RedisClusterCache', wraps=RedisClusterCache) as cache_class:
+            cache = self.shared_cache.get()
+            self.assertIs(self.shared_cache.get(), cache)
+
+        self.assertEqual(cache_class.call_count, 1)
+
+    def test_connect_backs_off(self, *mocks):
+        """
+        Test that a failed connect is not retried before the backoff passed.
+        """
+        with self.settings(REDIS_RECONNECT_BACKOFF_MIN=100, REDIS_RECONNECT_BACKOFF_MAX=150), \
+                freeze_time('2018-01-01 12:00:00') as frozen_time, \
+                mock.patch('app.cache.RedisClusterCache', side_effect=RedisClusterException) as cache_class:
+            self.assertRaises(RedisClusterException, self.shared_cache.get)
+            self.assertRaises(ConnectionError, self.shared_cache.get)
+            self.assertEqual(cache_class.call_count, 1)
+
+            frozen_time.tick(delta=timedelta(milliseconds=100))
+            self.assertRaises(RedisClusterException, self.shared_cache.get)
+            self.assertEqual(cache_class.call_count, 2)
+
+            # The backoff doubles up to REDIS_RECONNECT_BACKOFF_MAX.
+            frozen_time.tick(delta=timedelta(milliseconds=100))
+            self.assertRaises(ConnectionError, self.shared_cache.get)
+            frozen_time.tick(delta=timedelta(milliseconds=50))
+            self.assertRaises(RedisClusterException, self.shared_cache.get)
+            self.assertEqual(cache_class.call_count, 3)
+
+    def test_failed_health_check_reconnects(self, *mocks):
+        """
+        Test that the cache is replaced when the health check fails.
+        """
+        broken_cache = mock.Mock()
+        broken_cache.client.ping.side_effect = ConnectionError
+        new_cache = mock.Mock()
+
+        with freeze_time('2018-01-01 12:00:00') as frozen_time, \
+                mock.patch('app.cache.RedisClusterCache', side_effect=[broken_cache, new_cache]):
+            self.assertIs(self.shared_cache.get(), broken_cache)
+
+            frozen_time.tick(delta=timedelta(milliseconds=settings.REDIS_HEALTH_CHECK_INTERVAL))
+            self.assertIs(self.shared_cache.get(), new_cache)
+
+
+class RedisClusterCacheTestCase(SimpleTestCase):
+    """
+    Tests for the redis cluster cache.
+    """
+    def test_run_script_registers_once(self):
+        """
+        Test that a script is registered once and reused by later runs.
+        """
+        cache = RedisClusterCache()
+        with mock.patch.object(cache.client, 'register_script', wraps=cache.client.register_script) as register:
+            self.assertEqual(cache.run_script('return ARGV[1]', ['run_script'], ['a']), 'a')
+            self.assertEqual(cache.run_script('return ARGV[1]', ['run_script'], ['b']), 'b')
+
+        self.assertEqual(register.call_count, 1)
+
+
+class BlockingClusterConnectionPoolTestCase(SimpleTestCase):
+    """
+    Tests for the connection pool that waits for a free connection.
+    """
+    def setUp(self):
+        super(BlockingClusterConnectionPoolTestCase, self).setUp()
+        self.pool = BlockingClusterConnectionPool(
+            startup_nodes=get_startup_nodes(), max_connections=1, timeout=.5, decode_responses=True)
+        self.node = self.pool.get_node_by_slot(self.pool.nodes.keyslot('pool'))
+
+    def tearDown(self):
+        super(BlockingClusterConnectionPoolTestCase, self).tearDown()
+        self.pool.disconnect()
+
+    def test_waits_for_release(self):
+        """
+        Test that a full pool hands out the connection that is released.
+        """
+        connection = self.pool.get_connection_by_node(self.node)
+        Thread(target=lambda: (time.sleep(.1), self.pool.release(connection))).start()
+
+        self.assertIs(self.pool.get_connection_by_node(self.node), connection)
+
+    def test_timeout(self):
+        """
+        Test that a full pool fails when no connection is released in time.
+        """
+        self.pool.timeout = .1
+        self.pool.get_connection_by_node(self.node)
+
+        self.assertRaises(RedisClusterException, self.pool.get_connection_by_node, self.node)
+
+    def test_closes_idle_connection(self):
+        """
+        Test that an idle connection to another node makes room for a
+        connection to the node of the command.
+        """
+        other_node = next(node for node in self.pool.nodes.all_masters() if node['name'] != self.node['name'])
+        idle_connection = self.pool.get_connection_by_node(other_node)
+        self.pool.release(idle_connection)
+
+        connection = self.pool.get_connection_by_node(self.node)
+
+        self.assertEqual(connection.node, self.node)
+        self.assertEqual(self.pool.count_all_num_connections(self.node), 1)
@@ -0,0 +1,75 @@
+from threading import Thread
+import time
+
+from django.test import override_settings, SimpleTestCase
+
+from ..cache import RedisClusterCache
+from ..call_coalescing import (
+    CallCoalescer,
+    get_call_leader_key,
+    NAK,
+    ROLE_LEADER,
+    ROLE_LOCAL,
+    ROLE_REMOTE)
+
+
+@override_settings(APP_PUSH_ROUNDTRIP_WAIT=1000)
+class CallCoalescerTestCase(SimpleTestCase):
+    """
+    Tests for coalescing the requests for the same call_id.
+    """
+    def setUp(self):
+        super(CallCoalescerTestCase, self).setUp()
+        self.redis_cache = RedisClusterCache()
+        self.redis_cache.client.delete(get_call_leader_key('call-1'))
+        # A coalescer per process.
+        self.coalescer = CallCoalescer()
+        self.other_coalescer = CallCoalescer()
+
+    def tearDown(self):
+        super(CallCoalescerTestCase, self).tearDown()
+        self.redis_cache.client.delete(get_call_leader_key('call-1'))
+
+    def _finish_after(self, delay, call, response):
+        def finish():
+            time.sleep(delay)
+            self.coalescer.finish(self.redis_cache, call, response)
+        Thread(target=finish).start()
+
+    def test_roles(self):
+        """
+        Test that the first request leads and the duplicates follow it in
+        the same and in another process.
+        """
+        call, role = self.coalescer.join(self.redis_cache, 'call-1')
+        local_call, local_role = self.coalescer.join(self.redis_cache, 'call-1')
+        remote_call, remote_role = self.other_coalescer.join(self.redis_cache, 'call-1')
+
+        self.assertEqual((role, local_role, remote_role), (ROLE_LEADER, ROLE_LOCAL, ROLE_REMOTE))
+        self.assertIs(local_call, call)
+
+        self._finish_after(.2, call, 'status=ACK')
+        self.assertEqual(self.coalescer.follow(self.redis_cache, local_call, local_role), 'status=ACK')
+        self.assertEqual(self.other_coalescer.follow(self.redis_cache, remote_call, remote_role), 'status=ACK')
+
+    def test_duplicate_after_call(self):
+        """
+        Test that a duplicate after the call ended gets the same response.
+        """
+        call, role = self.coalescer.join(self.redis_cache, 'call-1')
+        self.coalescer.finish(self.redis_cache, call, 'status=NAK')
+
+        call, role = self.coalescer.join(self.redis_cache, 'call-1')
+
+        self.assertEqual(role, ROLE_REMOTE)
+        self.assertEqual(self.coalescer.follow(self.redis_cache, call, role), 'status=NAK')
+
+    def test_leader_gone(self):
+        """
+        Test that the followers of a leader that died get a NAK.
+        """
+        self.coalescer.join(self.redis_cache, 'call-1')
+        call, role = self.other_coalescer.join(self.redis_cache, 'call-1')
+        self.redis_cache.client.delete(get_call_leader_key('call-1'))
+
+        self.assertEqual(self.other_coalescer.follow(self.redis_cache, call, role), NAK)
@@ -0,0 +1,113 @@
+from ast import literal_eval
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from main.prometheus.consts import OS_KEY, PHASES_KEY, RESULT_KEY, VIALER_MIDDLEWARE_CALL_PHASE_KEY
+from ..cache import RedisClusterCache
+from ..call_timeline import (
+    CallTimelines,
+    PHASE_ANSWERED,
+    PHASE_APP_RESPONDED,
+    PHASE_DEVICE_RESOLVED,
+    PHASE_PROVIDER_ACKED,
+    PHASE_PUSH_ENQUEUED,
+    PHASE_PUSH_SENT)
+
+
+class CallTimelinesTestCase(SimpleTestCase):
+    """
+    Tests for the setup phase timings of the calls.
+    """
+    def setUp(self):
+        super(CallTimelinesTestCase, self).setUp()
+        self.redis_cache = RedisClusterCache()
+        self.redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+        self.timelines = CallTimelines()
+
+    def tearDown(self):
+        super(CallTimelinesTestCase, self).tearDown()
+        self.redis_cache.client.delete(VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+
+    def _get_pushed_phases(self):
+        values = self.redis_cache.client.lrange(VIALER_MIDDLEWARE_CALL_PHASE_KEY, 0, -1)
+        return [literal_eval(value) for value in values]
+
+    @mock.patch('app.call_timeline.time')
+    @mock.patch('app.call_timeline.log_data_to_metrics_log')
+    def test_phases(self, mock_log, mock_time):
+        """
+        Test that the time spent in each phase is pushed per platform and
+        the offsets are logged in one line.
+        """
+        mock_time.time.side_effect = [100.1, 100.15, 100.2, 100.9, 101.5, 101.8, 101.9]
+        self.timelines.start('call-1', 100)
+        self.timelines.mark('call-1', PHASE_DEVICE_RESOLVED, platform='apns')
+        self.timelines.mark('call-1', PHASE_PUSH_ENQUEUED)
+        self.timelines.mark('call-1', PHASE_PUSH_SENT)
+        self.timelines.mark('call-1', PHASE_PROVIDER_ACKED)
+        self.timelines.mark('call-1', PHASE_APP_RESPONDED)
+        # A resend does not move the phase.
+        self.timelines.mark('call-1', PHASE_PUSH_SENT)
+        self.timelines.finish(self.redis_cache, 'call-1', 'ACK', '123456789')
+
+        data = self._get_pushed_phases()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0][OS_KEY], 'apns')
+        self.assertEqual(data[0][RESULT_KEY], 'ACK')
+        self.assertEqual(
+            {phase: round(seconds, 2) for phase, seconds in data[0][PHASES_KEY].items()},
+            {
+                PHASE_DEVICE_RESOLVED: .1,
+                PHASE_PUSH_ENQUEUED: .05,
+                PHASE_PUSH_SENT: .05,
+                PHASE_PROVIDER_ACKED: .7,
+                PHASE_APP_RESPONDED: .6,
+                PHASE_ANSWERED: .4,
+            },
+        )
+
+        log_data, sip_user_id = mock_log.call_args[0]
+        self.assertEqual(sip_user_id, '123456789')
+        self.assertEqual(log_data['answered_ms'], 1900)
+        self.assertEqual(log_data['device_resolved_ms'], 100)
+        self.assertEqual(len(self.timelines), 0)
+
+    @mock.patch('app.call_timeline.log_data_to_metrics_log')
+    def test_device_keys(self, mock_log):
+        """
+        Test that the pushes to the devices of a call mark the timeline of
+        the call, and nothing is left after it is finished.
+        """
+        self.timelines.start('call-1')
+        self.timelines.add_keys('call-1', ['{call-1}0', '{call-1}1'])
+        self.timelines.mark('{call-1}1', PHASE_PUSH_SENT)
+        self.timelines.finish(self.redis_cache, 'call-1', 'NAK', '123456789')
+
+        data = self._get_pushed_phases()
+        self.assertEqual(data[0][OS_KEY], 'Middleware')
+        self.assertEqual(list(data[0][PHASES_KEY]), [PHASE_PUSH_SENT, PHASE_ANSWERED])
+        self.assertEqual(self.timelines._timelines, {})
+
+        # Marks and finishes of unknown calls are ignored.
+        self.timelines.mark('{call-1}0', PHASE_PROVIDER_ACKED)
+        self.timelines.finish(self.redis_cache, 'call-1', 'NAK', '123456789')
+        self.assertEqual(len(self._get_pushed_phases()), 1)
+
+    @mock.patch('app.call_timeline.log_data_to_metrics_log')
+    def test_end(self, mock_log):
+        """
+        Test that ending a timeline returns the phases instead of pushing
+        them.
+        """
+        self.timelines.start('call-1')
+        self.timelines.mark('call-1', PHASE_DEVICE_RESOLVED, platform='android')
+
+        metrics = self.timelines.end('call-1', 'NAK', '123456789')
+
+        self.assertEqual(self._get_pushed_phases(), [])
+        self.assertEqual([key for key, data in metrics], [VIALER_MIDDLEWARE_CALL_PHASE_KEY])
+        self.assertEqual(metrics[0][1][OS_KEY], 'android')
+        self.assertEqual(list(metrics[0][1][PHASES_KEY]), [PHASE_DEVICE_RESOLVED, PHASE_ANSWERED])
+        self.assertEqual(mock_log.call_count, 1)
+        self.assertEqual(self.timelines.end('call-1', 'NAK', '123456789'), [])
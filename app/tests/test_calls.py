@@ -0,0 +1,362 @@
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Thread
+import time
+
+from django.test import override_settings, SimpleTestCase
+from freezegun import freeze_time
+
+from ..cache import RedisClusterCache
+from ..calls import (
+    CallStatePoller,
+    cancel_call,
+    get_call_cache_key,
+    get_call_roundtrip,
+    get_group_member_key,
+    GroupCallWaiter,
+    is_call_response_late,
+    PendingCall,
+    PendingCallRegistry,
+    pending_calls,
+    record_call_attempt,
+    record_call_attempts,
+    record_push_received,
+    set_call_response,
+    start_call,
+    start_calls,
+    STATE_ATTEMPTS,
+    STATE_DEVICE_ID,
+    STATE_OUTCOME,
+    STATE_PLATFORM,
+    STATE_RESPONDED_AT,
+    STATE_SIP_USER_ID,
+    STATE_STARTED_AT)
+
+
+class PendingCallRegistryTestCase(SimpleTestCase):
+    """
+    Tests for the in process registry of pending calls.
+    """
+    def setUp(self):
+        super(PendingCallRegistryTestCase, self).setUp()
+        self.registry = PendingCallRegistry()
+
+    def test_pending_call_has_no_dict(self):
+        """
+        Test that pending calls are compact slotted objects.
+        """
+        self.assertFalse(hasattr(PendingCall('key', 0), '__dict__'))
+
+    def test_resolve_wakes_up_waiter(self):
+        """
+        Test that resolving a call wakes up the thread waiting for it.
+        """
+        pending_call = self.registry.register('key')
+        Thread(target=self.registry.resolve, args=('key', 'True')).start()
+
+        self.assertTrue(pending_call.event.wait(1))
+        self.assertEqual(pending_call.value, 'True')
+
+    def test_resolve_unknown_call(self):
+        """
+        Test that resolving a call that is not pending in this process
+        returns False.
+        """
+        self.assertFalse(self.registry.resolve('unknown', 'True'))
+
+    def test_unregister(self):
+        """
+        Test that an unregistered call can not be resolved anymore.
+        """
+        pending_call = self.registry.register('key')
+        self.registry.unregister(pending_call)
+
+        self.assertEqual(len(self.registry), 0)
+        self.assertFalse(self.registry.resolve('key', 'True'))
+
+    def test_unregister_keeps_newer_call(self):
+        """
+        Test that unregistering an old call keeps a newer one for the same key.
+        """
+        old_call = self.registry.register('key')
+        new_call = self.registry.register('key')
+        self.registry.unregister(old_call)
+
+        self.assertTrue(self.registry.resolve('key', 'True'))
+        self.assertEqual(new_call.value, 'True')
+
+    def test_expired_calls_are_purged(self):
+        """
+        Test that calls that were never unregistered expire.
+        """
+        with freeze_time() as frozen_time:
+            self.registry.register('key')
+            frozen_time.tick(delta=timedelta(seconds=60))
+
+            self.assertFalse(self.registry.resolve('key', 'True'))
+
+            self.registry.register('other_key')
+            self.assertEqual(len(self.registry), 1)
+
+
+class CallStatePollerTestCase(SimpleTestCase):
+    """
+    Tests for the batched poller of the pending calls.
+    """
+    def setUp(self):
+        super(CallStatePollerTestCase, self).setUp()
+        self.registry = PendingCallRegistry()
+        self.poller = CallStatePoller(self.registry)
+        self.redis_cache = RedisClusterCache()
+        self.unique_keys = ['poller-call-{0}'.format(i) for i in range(20)]
+
+    def tearDown(self):
+        super(CallStatePollerTestCase, self).tearDown()
+        for unique_key in self.unique_keys:
+            self.redis_cache.client.delete(get_call_cache_key(unique_key))
+
+    def test_poll_resolves_finished_calls(self):
+        """
+        Test that one poll resolves only the calls with an outcome.
+        """
+        pending_calls = [self.registry.register(unique_key) for unique_key in self.unique_keys]
+        for unique_key in self.unique_keys:
+            start_call(self.redis_cache, unique_key, 'apns')
+        for unique_key in self.unique_keys[:10]:
+            set_call_response(self.redis_cache, unique_key, 'True')
+
+        self.poller.poll(self.redis_cache)
+
+        self.assertEqual([call.value for call in pending_calls], ['True'] * 10 + [None] * 10)
+        self.assertEqual(sorted(self.registry.get_unresolved_keys()), sorted(self.unique_keys[10:]))
+
+
+class CallStateTestCase(SimpleTestCase):
+    """
+    Tests for the transitions of the call state hash.
+    """
+    def setUp(self):
+        super(CallStateTestCase, self).setUp()
+        self.redis_cache = RedisClusterCache()
+        self.unique_key = 'call-state-test'
+        self.cache_key = get_call_cache_key(self.unique_key)
+
+    def tearDown(self):
+        super(CallStateTestCase, self).tearDown()
+        self.redis_cache.client.delete(self.cache_key)
+
+    def test_start_call(self):
+        """
+        Test that starting a call creates a fresh state with a ttl.
+        """
+        self.redis_cache.client.hset(self.cache_key, STATE_OUTCOME, 'True')
+
+        started_at = start_call(self.redis_cache, self.unique_key, 'android')
+
+        state = self.redis_cache.client.hgetall(self.cache_key)
+        self.assertEqual(state[STATE_PLATFORM], 'android')
+        self.assertEqual(state[STATE_ATTEMPTS], '1')
+        self.assertAlmostEqual(float(state[STATE_STARTED_AT]), started_at, places=3)
+        self.assertNotIn(STATE_OUTCOME, state)
+        self.assertGreater(self.redis_cache.client.ttl(self.cache_key), 0)
+
+    def test_record_call_attempt(self):
+        """
+        Test that resent pushes are counted.
+        """
+        start_call(self.redis_cache, self.unique_key, 'apns')
+
+        self.assertEqual(record_call_attempt(self.redis_cache, self.unique_key), 2)
+        self.assertEqual(record_call_attempt(self.redis_cache, self.unique_key), 3)
+
+    def test_record_push_received(self):
+        """
+        Test that the receipt of the push of an attempt is stored once with
+        the time since the push of that attempt was sent.
+        """
+        start_call(self.redis_cache, self.unique_key, 'apns')
+        time.sleep(.1)
+        record_call_attempt(self.redis_cache, self.unique_key)
+
+        receipt = record_push_received(self.redis_cache, self.unique_key, 2)
+        self.assertEqual(receipt.platform, 'apns')
+        self.assertEqual(receipt.attempt, 2)
+        self.assertLess(receipt.latency, .1)
+        self.assertTrue(receipt.stored)
+        self.assertTrue(receipt.first)
+
+        # The push of the first attempt arrived later.
+        receipt = record_push_received(self.redis_cache, self.unique_key, 1)
+        self.assertGreaterEqual(receipt.latency, .1)
+        self.assertTrue(receipt.stored)
+        self.assertFalse(receipt.first)
+
+        # A retried receipt keeps the first time.
+        retried = record_push_received(self.redis_cache, self.unique_key, 1)
+        self.assertFalse(retried.stored)
+        self.assertEqual(retried.latency, receipt.latency)
+
+    def test_record_push_received_unknown_attempt(self):
+        """
+        Test that a receipt for an unknown call or attempt is not stored.
+        """
+        self.assertIsNone(record_push_received(self.redis_cache, self.unique_key, 1))
+
+        start_call(self.redis_cache, self.unique_key, 'apns')
+        self.assertIsNone(record_push_received(self.redis_cache, self.unique_key, 2))
+
+    def test_record_call_attempt_unknown_call(self):
+        """
+        Test that an attempt for an expired call does not create a state.
+        """
+        self.assertIsNone(record_call_attempt(self.redis_cache, self.unique_key))
+        self.assertFalse(self.redis_cache.exists(self.cache_key))
+
+    def test_set_call_response(self):
+        """
+        Test that the response is stored with a server-side roundtrip.
+        """
+        start_call(self.redis_cache, self.unique_key, 'apns')
+        time.sleep(.1)
+
+        call_state, handed_off = set_call_response(self.redis_cache, self.unique_key, 'True')
+
+        self.assertFalse(handed_off)
+        self.assertEqual(call_state[STATE_PLATFORM], 'apns')
+        self.assertEqual(call_state[STATE_OUTCOME], 'True')
+        self.assertEqual(self.redis_cache.hget(self.cache_key, STATE_RESPONDED_AT), call_state[STATE_RESPONDED_AT])
+        self.assertGreaterEqual(get_call_roundtrip(call_state), .1)
+        self.assertLess(get_call_roundtrip(call_state), 1)
+
+    def test_response_after_wait_of_call(self):
+        """
+        Test that a response is late after the wait chosen for the call.
+        """
+        start_call(self.redis_cache, self.unique_key, 'apns', '123456789', wait=.05, device_id=7)
+        time.sleep(.1)
+
+        call_state, _ = set_call_response(self.redis_cache, self.unique_key, 'True')
+
+        self.assertEqual(call_state[STATE_SIP_USER_ID], '123456789')
+        self.assertEqual(call_state[STATE_DEVICE_ID], '7')
+        self.assertTrue(is_call_response_late(call_state))
+
+    def test_set_call_response_unknown_call(self):
+        """
+        Test that a response for an unknown call does not create a state.
+        """
+        self.assertEqual(set_call_response(self.redis_cache, self.unique_key, 'True'), (None, False))
+        self.assertFalse(self.redis_cache.exists(self.cache_key))
+
+    def test_first_outcome_wins(self):
+        """
+        Test that a later outcome, like 'Removed' after the app responded,
+        does not overwrite the first one.
+        """
+        start_call(self.redis_cache, self.unique_key, 'android')
+        first_state, _ = set_call_response(self.redis_cache, self.unique_key, 'True')
+
+        call_state, _ = set_call_response(self.redis_cache, self.unique_key, 'Removed')
+
+        self.assertEqual(call_state[STATE_OUTCOME], 'True')
+        self.assertEqual(call_state[STATE_RESPONDED_AT], first_state[STATE_RESPONDED_AT])
+
+    def test_set_call_response_hands_off(self):
+        """
+        Test that a call parked in this process is woken up directly.
+        """
+        start_call(self.redis_cache, self.unique_key, 'apns')
+        pending_call = pending_calls.register(self.unique_key)
+        try:
+            _, handed_off = set_call_response(self.redis_cache, self.unique_key, 'False')
+        finally:
+            pending_calls.unregister(pending_call)
+
+        self.assertTrue(handed_off)
+        self.assertEqual(pending_call.value, 'False')
+
+    def test_cancel_call(self):
+        """
+        Test that a cancel wakes up the parked call once and that the app
+        can't answer the call after it.
+        """
+        start_call(self.redis_cache, self.unique_key, 'apns', '123456789')
+        pending_call = pending_calls.register(self.unique_key)
+        try:
+            call_state = cancel_call(self.redis_cache, self.unique_key)
+        finally:
+            pending_calls.unregister(pending_call)
+
+        self.assertEqual(call_state[STATE_SIP_USER_ID], '123456789')
+        self.assertEqual(pending_call.value, 'Cancelled')
+        self.assertIsNone(cancel_call(self.redis_cache, self.unique_key))
+        call_state, _ = set_call_response(self.redis_cache, self.unique_key, 'True')
+        self.assertEqual(call_state[STATE_OUTCOME], 'Cancelled')
+
+    def test_cancel_unknown_call(self):
+        """
+        Test that cancelling an unknown call does not create a state.
+        """
+        self.assertIsNone(cancel_call(self.redis_cache, self.unique_key))
+        self.assertFalse(self.redis_cache.exists(self.cache_key))
+
+
+class FakeDevice(object):
+    def __init__(self, platform, sip_user_id, id=None):
+        self.app = FakeApp(platform)
+        self.sip_user_id = sip_user_id
+        self.id = id
+
+
+class FakeApp(object):
+    def __init__(self, platform):
+        self.platform = platform
+
+
+@override_settings(APP_PUSH_WAIT_MODE='poll')
+class GroupCallTestCase(SimpleTestCase):
+    """
+    Tests for the calls to the devices of a group call.
+    """
+    def setUp(self):
+        super(GroupCallTestCase, self).setUp()
+        self.redis_cache = RedisClusterCache()
+        self.devices = OrderedDict(
+            (get_group_member_key('group-test', member), FakeDevice(platform, sip_user_id, member + 1))
+            for member, (platform, sip_user_id) in enumerate([('apns', '123456789'), ('android', '234567891')])
+        )
+        self.cache_keys = [get_call_cache_key(unique_key) for unique_key in self.devices]
+
+    def tearDown(self):
+        super(GroupCallTestCase, self).tearDown()
+        for cache_key in self.cache_keys:
+            self.redis_cache.client.delete(cache_key)
+
+    def test_start_calls(self):
+        """
+        Test that the states of all devices are created and counted with
+        one script.
+        """
+        start_calls(self.redis_cache, self.devices, 4)
+        record_call_attempts(self.redis_cache, list(self.devices)[1:])
+
+        states = [self.redis_cache.client.hgetall(cache_key) for cache_key in self.cache_keys]
+        self.assertEqual([state[STATE_PLATFORM] for state in states], ['apns', 'android'])
+        self.assertEqual([state[STATE_SIP_USER_ID] for state in states], ['123456789', '234567891'])
+        self.assertEqual([state[STATE_DEVICE_ID] for state in states], ['1', '2'])
+        self.assertEqual([state[STATE_ATTEMPTS] for state in states], ['1', '2'])
+
+    def test_waiter_wakes_up_on_any_member(self):
+        """
+        Test that the outcome of any device wakes up the waiter.
+        """
+        start_calls(self.redis_cache, self.devices, 4)
+        unique_keys = list(self.devices)
+        waiter = GroupCallWaiter(self.redis_cache, unique_keys)
+        try:
+            Thread(target=set_call_response, args=(self.redis_cache, unique_keys[1], 'True')).start()
+            outcomes = waiter.wait(2)
+        finally:
+            waiter.close()
+
+        self.assertEqual(outcomes, {unique_keys[1]: 'True'})
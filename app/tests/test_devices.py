@@ -0,0 +1,220 @@
+from datetime import timedelta
+import time
+
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+from freezegun import freeze_time
+
+from main.prometheus.consts import (
+    CACHE_HIT_VALUE,
+    CACHE_LOCAL_VALUE,
+    RESULT_KEY,
+    TIER_KEY,
+    VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY)
+
+from ..cache import get_redis_cache
+from ..devices import (
+    DEVICE_CACHE_CHANNEL,
+    device_cache,
+    get_cached_account_devices,
+    get_cached_device,
+    get_cached_devices,
+    get_device_cache_key,
+    invalidate_device,
+    LocalCache)
+from ..models import App, Device
+
+
+class LocalCacheTestCase(SimpleTestCase):
+    """
+    Tests for the LRU with TTL of the device cache.
+    """
+    def test_least_recently_used_is_dropped(self):
+        """
+        Test that the least recently used value is dropped when full.
+        """
+        cache = LocalCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_value_expires(self):
+        """
+        Test that values are not returned after the TTL.
+        """
+        cache = LocalCache(2, 60)
+        with freeze_time('2018-01-01 12:00:00') as frozen_time:
+            cache.set('a', 1)
+            frozen_time.tick(delta=timedelta(seconds=61))
+            self.assertIsNone(cache.get('a'))
+
+
+class DeviceCacheTestCase(TransactionTestCase):
+    """
+    Tests for the two tier device cache and its invalidation.
+    """
+    def setUp(self):
+        super(DeviceCacheTestCase, self).setUp()
+        self.delete_cache_keys()
+        self.app = App.objects.create(platform='android', app_id='com.voipgrid.vialer', push_key='key')
+        self.device = Device.objects.create(
+            name='test device',
+            token='token',
+            sip_user_id='123456789',
+            app=self.app,
+        )
+        device_cache.local.clear()
+
+    def tearDown(self):
+        super(DeviceCacheTestCase, self).tearDown()
+        self.delete_cache_keys()
+
+    def delete_cache_keys(self):
+        """
+        Delete the Redis copies and generations left by other tests.
+        """
+        client = get_redis_cache().client
+        for pattern in ('devices_*', 'app_*', '{devices_*', '{app_*'):
+            keys = list(client.scan_iter(match=pattern))
+            if keys:
+                client.delete(*keys)
+
+    def test_lookup_without_queries(self):
+        """
+        Test that cached lookups from both tiers do not query the database.
+        """
+        get_cached_device('123456789')
+
+        with self.assertNumQueries(0):
+            device = get_cached_device('123456789')
+            self.assertEqual(device.app.platform, 'android')
+
+        device_cache.local.clear()
+        with self.assertNumQueries(0):
+            device = get_cached_device('123456789')
+            self.assertEqual(device.token, 'token')
+
+    def test_lookup_several_devices(self):
+        """
+        Test that the devices of several sip_user_ids take one query and
+        are returned in the order they were asked for.
+        """
+        Device.objects.create(name='other device', token='other token', sip_user_id='234567891', app=self.app)
+
+        with self.assertNumQueries(1):
+            devices = get_cached_devices(['234567891', '987654321', '123456789'])
+        with self.assertNumQueries(0):
+            get_cached_devices(['234567891', '123456789'])
+
+        self.assertEqual(list(devices), ['234567891', '123456789'])
+        self.assertEqual(devices['123456789'][0].app.platform, 'android')
+
+    def test_lookup_devices_of_sip_user_id(self):
+        """
+        Test that all devices of a sip_user_id are cached together, the most
+        recently seen first.
+        """
+        ios_app = App.objects.create(platform='apns', app_id='com.voipgrid.vialer', push_key='cert')
+        tablet = Device.objects.create(
+            name='tablet', token='tablet token', sip_user_id='123456789', last_seen=timezone.now(), app=ios_app)
+
+        get_cached_account_devices('123456789')
+        device_cache.local.clear()
+        with self.assertNumQueries(0):
+            devices = get_cached_account_devices('123456789')
+            device = get_cached_device('123456789', self.device.id)
+
+        self.assertEqual([device.name for device in devices], ['tablet', 'test device'])
+        self.assertEqual([device.app.platform for device in devices], ['apns', 'android'])
+        self.assertEqual(device.token, 'token')
+        self.assertEqual(get_cached_device('123456789').id, tablet.id)
+        with self.assertRaises(Device.DoesNotExist):
+            get_cached_device('123456789', 'unknown')
+
+    def test_lookup_unknown_device(self):
+        """
+        Test that an unknown sip_user_id raises DoesNotExist.
+        """
+        with self.assertRaises(Device.DoesNotExist):
+            get_cached_device('987654321')
+
+    def test_device_save_invalidates(self):
+        """
+        Test that a saved device is fetched again.
+        """
+        get_cached_device('123456789')
+        self.device.token = 'new token'
+        self.device.save()
+
+        self.assertEqual(get_cached_device('123456789').token, 'new token')
+
+    def test_device_delete_invalidates(self):
+        """
+        Test that a deleted device is not returned anymore.
+        """
+        get_cached_device('123456789')
+        self.device.delete()
+
+        with self.assertRaises(Device.DoesNotExist):
+            get_cached_device('123456789')
+
+    def test_app_save_invalidates(self):
+        """
+        Test that an edited app is fetched again.
+        """
+        get_cached_device('123456789')
+        self.app.push_key = 'new key'
+        self.app.save()
+
+        self.assertEqual(get_cached_device('123456789').app.push_key, 'new key')
+
+    def test_hits_are_counted(self):
+        """
+        Test that the hits and misses are pushed per tier.
+        """
+        redis_cache = get_redis_cache()
+        get_cached_device('123456789')
+        redis_cache.client.delete(VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY)
+
+        get_cached_device('123456789')
+
+        self.assertEqual(
+            redis_cache.client.lrange(VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY, 0, -1),
+            [str({TIER_KEY: CACHE_LOCAL_VALUE, RESULT_KEY: CACHE_HIT_VALUE})] * 2,
+        )
+
+    def test_stale_copy_is_not_stored(self):
+        """
+        Test that a copy read before an invalidation is not stored after it.
+        """
+        key = get_device_cache_key('123456789')
+        data, generation = device_cache._get(key, [])
+        invalidate_device('123456789')
+
+        device_cache._set(key, 'stale', generation)
+
+        self.assertIsNone(get_redis_cache().get(key))
+        self.assertIsNone(device_cache.local.get(key))
+        self.assertEqual(get_cached_device('123456789').token, 'token')
+
+    def test_own_invalidation_is_ignored(self):
+        """
+        Test that the local copies are only dropped for the invalidations
+        of other processes.
+        """
+        get_cached_device('123456789')
+        Device.objects.create(name='other device', token='other token', sip_user_id='234567891', app=self.app)
+        get_cached_device('234567891')
+
+        get_redis_cache().client.publish(DEVICE_CACHE_CHANNEL, 'other {0}'.format(get_device_cache_key('123456789')))
+        deadline = time.time() + 1
+        while device_cache.local.get(get_device_cache_key('123456789')) is not None and time.time() < deadline:
+            time.sleep(.01)
+
+        self.assertIsNone(device_cache.local.get(get_device_cache_key('123456789')))
+        self.assertIsNotNone(device_cache.local.get(get_device_cache_key('234567891')))
@@ -0,0 +1,104 @@
+from threading import current_thread, Event
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from ..executors import BoundedExecutor, OVERFLOW_CALLER_RUNS, OVERFLOW_REJECT
+
+
+@mock.patch('app.executors.log_middleware_information')
+@mock.patch('app.executors.executor_stats_reporter')
+class BoundedExecutorTestCase(SimpleTestCase):
+    """
+    Tests for the bounded executor of the background tasks.
+    """
+    def setUp(self):
+        super(BoundedExecutorTestCase, self).setUp()
+        self.release = Event()
+
+    def tearDown(self):
+        super(BoundedExecutorTestCase, self).tearDown()
+        self.release.set()
+
+    def _block(self):
+        self.release.wait(5)
+
+    def test_workers_are_bounded(self, *mocks):
+        """
+        Test that no more than max_workers are started.
+        """
+        executor = BoundedExecutor('test', 2, 10, OVERFLOW_REJECT)
+        for _ in range(5):
+            executor.submit(self._block)
+
+        stats, _, _ = executor.get_stats()
+        self.assertEqual(stats['workers'], 2)
+        self.release.set()
+        self.assertTrue(executor.shutdown(5))
+
+    @mock.patch('app.executors.connections')
+    def test_connections_closed_after_task(self, connections, *mocks):
+        """
+        Test that the database connections are closed after every task.
+        """
+        executor = BoundedExecutor('test', 1, 10, OVERFLOW_REJECT)
+        executor.submit(lambda: None)
+        executor.submit(lambda: None)
+        self.assertTrue(executor.shutdown(5))
+
+        self.assertEqual(connections.close_all.call_count, 2)
+
+    def test_overflow_reject(self, *mocks):
+        """
+        Test that tasks are dropped when the queue is full.
+        """
+        executor = BoundedExecutor('test', 1, 1, OVERFLOW_REJECT)
+        results = []
+        self.assertTrue(executor.submit(self._block))
+        # Wait until the worker took the blocking task from the queue.
+        while executor.get_stats()[0]['active_workers'] == 0:
+            self.release.wait(.01)
+
+        self.assertTrue(executor.submit(results.append, 1))
+        self.assertFalse(executor.submit(results.append, 2))
+
+        self.release.set()
+        self.assertTrue(executor.shutdown(5))
+        self.assertEqual(results, [1])
+        self.assertEqual(executor.get_stats()[2], 1)
+
+    def test_overflow_caller_runs(self, *mocks):
+        """
+        Test that tasks run in the submitting thread when the queue is full.
+        """
+        executor = BoundedExecutor('test', 1, 1, OVERFLOW_CALLER_RUNS)
+        threads = []
+        executor.submit(self._block)
+        while executor.get_stats()[0]['active_workers'] == 0:
+            self.release.wait(.01)
+        executor.submit(lambda: None)
+
+        self.assertTrue(executor.submit(lambda: threads.append(current_thread())))
+        self.assertEqual(threads, [current_thread()])
+        self.release.set()
+        self.assertTrue(executor.shutdown(5))
+
+    def test_shutdown_drains_queue(self, *mocks):
+        """
+        Test that the queued tasks are run on shutdown and new ones rejected.
+        """
+        executor = BoundedExecutor('test', 1, 10, OVERFLOW_REJECT)
+        results = []
+        executor.submit(self._block)
+        for index in range(5):
+            executor.submit(results.append, index)
+
+        self.release.set()
+        self.assertTrue(executor.shutdown(5))
+
+        self.assertEqual(results, list(range(5)))
+        self.assertFalse(executor.submit(results.append, 5))
+        stats, latencies, rejected = executor.get_stats()
+        self.assertEqual(stats['workers'], 0)
+        self.assertEqual(len(latencies), 6)
+        self.assertEqual(rejected, 1)
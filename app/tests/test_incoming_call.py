@@ -0,0 +1,137 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from main.prometheus.consts import (
+    FAILED_REASON_KEY,
+    VIALER_MIDDLEWARE_CALL_CANCELLED_KEY,
+    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY,
+    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY)
+from ..calls import get_group_call_key, get_group_member_key
+from ..incoming_call import ACK, CallSchedule, GroupCall, log_call_outcome, NAK
+from ..response_policy import CallPolicy, SOURCE_STATIC
+from .test_calls import FakeDevice
+
+
+@mock.patch('app.incoming_call.time')
+class CallScheduleTestCase(SimpleTestCase):
+    """
+    Tests for the deadline and the resends of a call.
+    """
+    def test_resends(self, mock_time):
+        """
+        Test that a push is due every resend interval until the max
+        attempts.
+        """
+        mock_time.time.return_value = 100
+        schedule = CallSchedule(CallPolicy(4, 1, 3, SOURCE_STATIC))
+
+        self.assertEqual(schedule.get_timeout(), 1)
+        self.assertIsNone(schedule.next_attempt())
+
+        mock_time.time.return_value = 101
+        self.assertEqual(schedule.next_attempt(), 2)
+        mock_time.time.return_value = 102
+        self.assertEqual(schedule.next_attempt(), 3)
+
+        # No more resends, wait until the deadline.
+        mock_time.time.return_value = 103
+        self.assertIsNone(schedule.next_attempt())
+        self.assertEqual(schedule.get_timeout(), 1)
+        self.assertTrue(schedule.is_waiting())
+
+        mock_time.time.return_value = 104
+        self.assertFalse(schedule.is_waiting())
+
+
+@mock.patch('app.incoming_call.log_data_to_metrics_log')
+class GroupCallTestCase(SimpleTestCase):
+    """
+    Tests for the decisions of a call to several devices.
+    """
+    def setUp(self):
+        super(GroupCallTestCase, self).setUp()
+        self.devices = [FakeDevice('apns', '123456789', 'a'), FakeDevice('android', '123456789', 'b')]
+        self.group_call = GroupCall('call-1', self.devices)
+        self.member_keys = [get_group_member_key('call-1', 0), get_group_member_key('call-1', 1)]
+
+    def test_members(self, *mocks):
+        """
+        Test that the group state comes first and a device per member.
+        """
+        self.assertEqual(list(self.group_call.members), [get_group_call_key('call-1')] + self.member_keys)
+        self.assertEqual(self.group_call.member_keys, self.member_keys)
+
+    def test_first_device_accepts(self, *mocks):
+        """
+        Test that the call is done when a device accepts and the other
+        device is cancelled.
+        """
+        self.assertTrue(self.group_call.update({self.member_keys[1]: 'True'}))
+
+        self.assertTrue(self.group_call.is_done())
+        self.assertEqual(self.group_call.get_pending_keys(), self.member_keys[:1])
+        self.assertEqual(self.group_call.get_available(), self.devices[1:])
+        self.assertEqual(self.group_call.get_outcome(), 'True')
+        self.assertEqual(self.group_call.get_responses(False), [(self.devices[1], True)])
+        metrics = self.group_call.log_result(0)
+        self.assertEqual([key for key, data in metrics], [VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY])
+
+    def test_all_devices_decline(self, *mocks):
+        """
+        Test that the call waits for all devices when they decline.
+        """
+        self.group_call.update({self.member_keys[0]: 'False'})
+        self.assertFalse(self.group_call.is_done())
+
+        self.group_call.update({self.member_keys[1]: 'False'})
+        self.assertTrue(self.group_call.is_done())
+        self.assertEqual(self.group_call.get_outcome(), 'False')
+        self.assertEqual(self.group_call.log_result(0), [])
+        self.assertEqual(mocks[0].call_args[0][0][FAILED_REASON_KEY], 'No device available')
+
+    def test_timed_out(self, *mocks):
+        """
+        Test that the devices that did not respond are recorded after the
+        deadline only.
+        """
+        self.assertFalse(self.group_call.update({}))
+
+        self.assertEqual(self.group_call.get_responses(False), [])
+        self.assertEqual(
+            self.group_call.get_responses(True), [(self.devices[0], False), (self.devices[1], False)])
+
+    def test_cancelled(self, *mocks):
+        """
+        Test that a cancelled call stops waiting and keeps its outcome.
+        """
+        self.group_call.update({get_group_call_key('call-1'): 'Cancelled'})
+
+        self.assertTrue(self.group_call.is_done())
+        self.assertIsNone(self.group_call.get_outcome())
+        self.assertEqual(self.group_call.get_pending_keys(), self.member_keys)
+        metrics = self.group_call.log_result(0)
+        self.assertEqual([key for key, data in metrics], [VIALER_MIDDLEWARE_CALL_CANCELLED_KEY])
+
+
+@mock.patch('app.incoming_call.log_data_to_metrics_log')
+class CallOutcomeTestCase(SimpleTestCase):
+    """
+    Tests for the answer for asterisk per outcome of a call.
+    """
+    def test_outcomes(self, *mocks):
+        device = FakeDevice('apns', '123456789', 'a')
+        device.remote_logging_id = None
+
+        results = {
+            available: log_call_outcome('call-1', '123456789', device, available, 0)
+            for available in ('True', 'False', 'Removed', 'Cancelled')
+        }
+
+        self.assertEqual(
+            {available: result.response for available, result in results.items()},
+            {'True': ACK, 'False': NAK, 'Removed': NAK, 'Cancelled': NAK},
+        )
+        self.assertEqual(
+            [key for key, data in results['False'].metrics], [VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY])
+        self.assertEqual(results['Removed'].metrics, [])
@@ -0,0 +1,83 @@
+from threading import Event
+from unittest import mock
+
+from django.test import override_settings, TransactionTestCase
+
+from ..cache import get_redis_cache
+from ..models import App, Device
+from ..outbox import (
+    enqueue_call_push,
+    get_push_outbox_key,
+    get_stream_client,
+    ProviderConsumer,
+    PUSH_OUTBOX_GROUP)
+
+
+@override_settings(PUSH_WORKER_BLOCK=100)
+@mock.patch('app.outbox.send_call_message')
+class PushOutboxTestCase(TransactionTestCase):
+    """
+    Tests for sending the call pushes through the push outbox.
+    """
+    def setUp(self):
+        super(PushOutboxTestCase, self).setUp()
+        self.key = get_push_outbox_key('android')
+        get_redis_cache().client.delete(self.key)
+        app = App.objects.create(platform='android', app_id='com.voipgrid.vialer', push_key='key')
+        self.device = Device.objects.create(name='test device', token='token', sip_user_id='123456789', app=app)
+
+    def _get_consumer(self, name):
+        consumer = ProviderConsumer('android', name, 10, Event())
+        consumer.client = get_stream_client(self.key)
+        consumer.create_group()
+        return consumer
+
+    def _get_pending(self):
+        return get_redis_cache().client.execute_command('XPENDING', self.key, PUSH_OUTBOX_GROUP)[0]
+
+    def test_send_and_acknowledge(self, send_call_message):
+        """
+        Test that a worker sends a push from the outbox and acknowledges it.
+        """
+        consumer = self._get_consumer('worker')
+        enqueue_call_push(self.device, 'unique_key', '0123456789', 'Test name', 1)
+
+        consumer.read()
+        self.assertTrue(consumer.executor.shutdown(5))
+
+        send_call_message.assert_called_once_with(mock.ANY, 'unique_key', '0123456789', 'Test name', 1)
+        self.assertEqual(send_call_message.call_args[0][0].sip_user_id, '123456789')
+        self.assertEqual(self._get_pending(), 0)
+
+    @override_settings(PUSH_WORKER_CLAIM_IDLE=0)
+    def test_reclaim_from_crashed_worker(self, send_call_message):
+        """
+        Test that a push read by a worker that crashed is sent by another.
+        """
+        crashed = self._get_consumer('crashed')
+        enqueue_call_push(self.device, 'unique_key', '0123456789', 'Test name', 1)
+        crashed.client.execute_command(
+            'XREADGROUP', 'GROUP', PUSH_OUTBOX_GROUP, 'crashed', 'COUNT', 1, 'STREAMS', self.key, '>')
+        self.assertEqual(self._get_pending(), 1)
+
+        consumer = self._get_consumer('worker')
+        consumer.reclaim()
+        self.assertTrue(consumer.executor.shutdown(5))
+
+        self.assertEqual(send_call_message.call_count, 1)
+        self.assertEqual(self._get_pending(), 0)
+
+    @override_settings(APP_PUSH_ROUNDTRIP_WAIT=0)
+    def test_drop_push_of_ended_call(self, send_call_message):
+        """
+        Test that a push is acknowledged without sending it when its call
+        already ended.
+        """
+        consumer = self._get_consumer('worker')
+        enqueue_call_push(self.device, 'unique_key', '0123456789', 'Test name', 1)
+
+        consumer.read()
+        self.assertTrue(consumer.executor.shutdown(5))
+
+        self.assertFalse(send_call_message.called)
+        self.assertEqual(self._get_pending(), 0)
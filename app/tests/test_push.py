@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+from time import sleep
+from unittest import mock
+
+from apns2.client import APNsClient
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.test import override_settings, SimpleTestCase
+from hyper.tls import init_context
+from pyfcm import FCMNotification
+
+from .utils import StubAPNsServer, StubPushServer, write_key
+from ..apns import apns_connection_manager
+from ..push import (
+    get_call_collapse_id,
+    get_call_push_ttl,
+    send_call_message,
+    send_cancel_message,
+    send_text_message)
+from ..push_backends import get_push_backend, StubPushBackend
+from ..push_clients import google_push_clients
+
+
+@override_settings(APP_PUSH_ROUNDTRIP_WAIT=4000)
+class CallPushExpiryTestCase(SimpleTestCase):
+    """
+    Tests for the collapse id and time to live of the call pushes.
+    """
+    def test_ttl(self):
+        """
+        Test that call pushes live as long as the call waits for the app.
+        """
+        self.assertEqual(get_call_push_ttl(), 4)
+        with override_settings(APP_PUSH_ROUNDTRIP_WAIT=4500):
+            self.assertEqual(get_call_push_ttl(), 5)
+
+    def test_collapse_id(self):
+        """
+        Test that long unique_keys are hashed to fit the 64 bytes of APNs.
+        """
+        self.assertEqual(get_call_collapse_id('sduiqayduiryqwuioeryqwer76789'), 'sduiqayduiryqwuioeryqwer76789')
+        self.assertEqual(len(get_call_collapse_id('a' * 100)), 64)
+
+
+@override_settings(APP_PUSH_ROUNDTRIP_WAIT=4000)
+@mock.patch('app.push.log_middleware_information')
+@mock.patch('app.apns.get_redis_cache')
+class CallPushProviderTestCase(SimpleTestCase):
+    """
+    Tests for the headers and payloads the provider stubs receive for the
+    attempts of a call.
+    """
+    def _get_device(self, platform, **app_fields):
+        app = mock.Mock(pk=platform, platform=platform, app_id='com.voipgrid.vialer', push_key='key', **app_fields)
+        google_push_clients.evict(app.pk)
+        return mock.Mock(token='token', sandbox=False, app=app)
+
+    def _send_attempts(self, device):
+        for attempt in (1, 2):
+            send_call_message(device, 'unique_key', '0123456789', 'Test name', attempt)
+
+    @mock.patch('app.push_backends.time')
+    def test_apns(self, time, *mocks):
+        """
+        Test that APNs gets the same collapse id for every attempt and the
+        expiration of the call.
+        """
+        time.time.return_value = 1000
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        server = StubAPNsServer(directory)
+        self.addCleanup(server.close)
+        write_key(ec.generate_private_key(ec.SECP256R1(), default_backend()), os.path.join(directory, 'key'))
+        device = self._get_device(
+            'apns', apns_key_id='ABC123DEFG', apns_team_id='TEAM123456', uses_apns_token_auth=True)
+        self.addCleanup(apns_connection_manager.pools.clear)
+
+        with override_settings(CERT_DIR=directory), \
+                mock.patch('hyper.tls._context', init_context(cert_path=server.cert_file)), \
+                mock.patch.object(APNsClient, 'LIVE_SERVER', 'localhost'), \
+                mock.patch.object(APNsClient, 'DEFAULT_PORT', server.port):
+            self._send_attempts(device)
+            send_text_message(device, device.app, 'message')
+
+        self.assertEqual([request['apns-collapse-id'] for request in server.requests[:2]], ['unique_key'] * 2)
+        self.assertEqual([request['apns-expiration'] for request in server.requests[:2]], ['1004'] * 2)
+        self.assertNotIn('apns-collapse-id', server.requests[2])
+        self.assertNotIn('apns-expiration', server.requests[2])
+
+    def test_fcm(self, *mocks):
+        """
+        Test that FCM gets the same collapse key for every attempt and the
+        time to live of the call.
+        """
+        server = StubPushServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        device = self._get_device('android')
+
+        with mock.patch.object(FCMNotification, 'FCM_END_POINT', server.url):
+            self._send_attempts(device)
+
+        self.assertEqual([request['collapse_key'] for request in server.requests], ['unique_key'] * 2)
+        self.assertEqual([request['time_to_live'] for request in server.requests], [4] * 2)
+        self.assertEqual([request['data']['attempt'] for request in server.requests], [1, 2])
+
+    def test_fcm_cancel(self, *mocks):
+        """
+        Test that the cancel push replaces the call push that was not
+        delivered yet.
+        """
+        server = StubPushServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        device = self._get_device('android')
+
+        with mock.patch.object(FCMNotification, 'FCM_END_POINT', server.url):
+            send_call_message(device, 'unique_key', '0123456789', 'Test name', 1)
+            send_cancel_message(device, 'unique_key')
+
+        self.assertEqual([request['collapse_key'] for request in server.requests], ['unique_key'] * 2)
+        self.assertEqual(server.requests[1]['data'], {'type': 'cancel', 'unique_key': 'unique_key'})
+
+    def test_gcm(self, *mocks):
+        """
+        Test that GCM gets the same collapse key for every attempt and the
+        time to live of the call.
+        """
+        server = StubPushServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        device = self._get_device('gcm')
+
+        with mock.patch('gcm.gcm.GCM_URL', server.url):
+            self._send_attempts(device)
+
+        self.assertEqual([request['collapse_key'] for request in server.requests], ['unique_key'] * 2)
+        self.assertEqual([request['time_to_live'] for request in server.requests], [4] * 2)
+        self.assertEqual([request['data']['attempt'] for request in server.requests], [1, 2])
+
+
+@override_settings(
+    APP_PUSH_ROUNDTRIP_WAIT=4000,
+    PUSH_STUB_PLATFORMS=['apns'],
+    PUSH_STUB_LATENCY=0,
+    PUSH_STUB_ERROR_RATE=0,
+    PUSH_STUB_INVALID_TOKEN_RATE=0,
+    PUSH_STUB_ANSWER_RATE=1,
+    PUSH_STUB_ANSWER_DELAY=0,
+)
+@mock.patch('app.push.log_middleware_information')
+class StubPushBackendTestCase(SimpleTestCase):
+    """
+    Tests for the push backend that simulates a provider and the app.
+    """
+    def setUp(self):
+        super(StubPushBackendTestCase, self).setUp()
+        app = mock.Mock(platform='apns', app_id='com.voipgrid.vialer')
+        self.device = mock.Mock(token='token', sandbox=False, app=app)
+
+    def test_stub_replaces_platform(self, *mocks):
+        """
+        Test that only the platforms in PUSH_STUB_PLATFORMS use the stub.
+        """
+        self.assertIsInstance(get_push_backend('apns'), StubPushBackend)
+        self.assertNotIsInstance(get_push_backend('android'), StubPushBackend)
+        self.assertIsNone(get_push_backend('unknown'))
+
+    @mock.patch.object(StubPushBackend, 'answer')
+    def test_call_answered(self, answer, *mocks):
+        """
+        Test that the simulated app answers a call push.
+        """
+        send_call_message(self.device, 'unique_key', '0123456789', 'Test name', 1)
+
+        for _ in range(100):
+            if answer.called:
+                break
+            sleep(.01)
+        payload = answer.call_args[0][0]
+        self.assertEqual(payload['unique_key'], 'unique_key')
+        self.assertTrue(payload['response_api'].endswith('api/call-response/'))
+
+    @override_settings(PUSH_STUB_INVALID_TOKEN_RATE=1)
+    @mock.patch('app.push.report_invalid_token')
+    def test_invalid_token_reported(self, report_invalid_token, *mocks):
+        """
+        Test that a token rejected by the stub is reported like a real one.
+        """
+        send_call_message(self.device, 'unique_key', '0123456789', 'Test name', 1)
+
+        report_invalid_token.assert_called_once_with(self.device, 'StubInvalidToken', unique_key='unique_key')
@@ -0,0 +1,85 @@
+from threading import Thread
+from unittest import mock
+
+from django.test import override_settings, SimpleTestCase
+
+from ..push_clients import FCMClient, GCMClient, GooglePushClientPool
+
+
+@override_settings(GOOGLE_PUSH_CONNECT_TIMEOUT=500, GOOGLE_PUSH_READ_TIMEOUT=2000)
+@mock.patch('app.push_clients.log_middleware_information')
+class GooglePushClientPoolTestCase(SimpleTestCase):
+    """
+    Tests for the FCM and GCM clients shared per app.
+    """
+    def setUp(self):
+        super(GooglePushClientPoolTestCase, self).setUp()
+        self.pool = GooglePushClientPool()
+        self.app = mock.Mock(pk=1, app_id='com.voipgrid.vialer', push_key='key')
+
+    def test_client_reused(self, *mocks):
+        """
+        Test that the sends of an app share one client and session.
+        """
+        client = self.pool.get_fcm_client(self.app)
+
+        self.assertIsInstance(client, FCMClient)
+        self.assertIs(self.pool.get_fcm_client(self.app), client)
+
+    def test_client_replaced_on_new_push_key(self, *mocks):
+        """
+        Test that the client is replaced and its connections closed when the
+        push_key of the app changed.
+        """
+        client = self.pool.get_gcm_client(self.app)
+        client.session = mock.Mock()
+
+        self.app.push_key = 'new key'
+        new_client = self.pool.get_gcm_client(self.app)
+
+        self.assertIsNot(new_client, client)
+        self.assertEqual(new_client.api_key, 'new key')
+        client.session.close.assert_called_once_with()
+
+    def test_evict(self, *mocks):
+        """
+        Test that an evicted client is not used anymore.
+        """
+        client = self.pool.get_fcm_client(self.app)
+        self.pool.evict(self.app.pk)
+
+        self.assertIsNot(self.pool.get_fcm_client(self.app), client)
+
+    def test_timeouts(self, *mocks):
+        """
+        Test that the requests to Google use the configured timeouts.
+        """
+        client = self.pool.get_gcm_client(self.app)
+        self.assertIsInstance(client, GCMClient)
+        client.session = mock.Mock()
+        client.session.post.return_value = mock.Mock(
+            status_code=200,
+            headers={},
+            json=mock.Mock(return_value={'success': 1, 'failure': 0, 'results': [{'message_id': '1'}]}),
+        )
+
+        client.json_request(registration_ids=['token'], data={})
+
+        self.assertEqual(client.session.post.call_args[1]['timeout'], (0.5, 2))
+
+    def test_responses_per_thread(self, *mocks):
+        """
+        Test that concurrent sends on a shared FCM client don't see each
+        others responses.
+        """
+        client = FCMClient('key', mock.Mock())
+        client.send_request_responses = ['main']
+
+        def send():
+            client.send_request_responses = ['thread']
+
+        thread = Thread(target=send)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(client.send_request_responses, ['main'])
@@ -0,0 +1,164 @@
+from collections import namedtuple
+import random
+
+from django.test import override_settings, SimpleTestCase
+
+from ..cache import RedisClusterCache
+from ..response_policy import (
+    CallPolicy,
+    choose_call_policy,
+    combine_call_policies,
+    get_device_stats_key,
+    get_platform_stats_key,
+    response_policy,
+    ResponseStats,
+    simulate_response_logs,
+    SOURCE_DEVICE,
+    SOURCE_PLATFORM,
+    SOURCE_STATIC,
+    SOURCE_UNRESPONSIVE)
+
+FakeResponseLog = namedtuple('FakeResponseLog', ['platform', 'sip_user_id', 'roundtrip_time'])
+
+
+def get_stats(roundtrips, responded=()):
+    """
+    Get the stats after the roundtrips and the responded outcomes.
+    """
+    stats = ResponseStats()
+    for roundtrip in roundtrips:
+        stats.update(roundtrip=roundtrip)
+    for outcome in responded:
+        stats.update(responded=outcome)
+    return stats
+
+
+@override_settings(RESPONSE_STATS_DEVICE_MAX_SAMPLES=20, RESPONSE_STATS_PLATFORM_MAX_SAMPLES=1000)
+class ResponseStatsTestCase(SimpleTestCase):
+    """
+    Tests for recording the response history in Redis.
+    """
+    def setUp(self):
+        super(ResponseStatsTestCase, self).setUp()
+        self.redis_cache = RedisClusterCache()
+        self.keys = [get_device_stats_key(1), get_device_stats_key(2), get_platform_stats_key('android')]
+        self.redis_cache.client.delete(*self.keys)
+
+    def tearDown(self):
+        super(ResponseStatsTestCase, self).tearDown()
+        self.redis_cache.client.delete(*self.keys)
+
+    def test_script_matches_stats(self):
+        """
+        Test that the history in Redis is the same as the history kept in
+        Python by the simulator, also after the sketch was halved.
+        """
+        expected = ResponseStats()
+        for i in range(50):
+            roundtrip = random.uniform(.2, 5)
+            response_policy.record(self.redis_cache, 'android', 1, roundtrip=roundtrip)
+            response_policy.record(self.redis_cache, 'android', 1, responded=i % 3 > 0)
+            expected.update(roundtrip, None, 20)
+            expected.update(None, i % 3 > 0, 20)
+
+        stats = response_policy.get_device_stats(self.redis_cache, 1)
+
+        self.assertEqual(stats.buckets, expected.buckets)
+        self.assertEqual((stats.samples, stats.calls), (expected.samples, 50))
+        self.assertLessEqual(stats.samples, 20)
+        self.assertAlmostEqual(stats.roundtrip, expected.roundtrip, places=6)
+        self.assertAlmostEqual(stats.answer_rate, expected.answer_rate, places=6)
+        self.assertEqual(ResponseStats(self.redis_cache.client.hgetall(self.keys[2])).samples, 50)
+        # Another device of the sip_user_id has its own history.
+        self.assertEqual(response_policy.get_device_stats(self.redis_cache, 2).samples, 0)
+
+
+@override_settings(
+    APP_PUSH_ROUNDTRIP_WAIT=4000,
+    APP_PUSH_RESEND_INTERVAL=1000,
+    RESPONSE_POLICY_MIN_SAMPLES=10,
+    RESPONSE_POLICY_MIN_WAIT=1500,
+    RESPONSE_POLICY_MIN_RESEND_INTERVAL=500,
+)
+class ChooseCallPolicyTestCase(SimpleTestCase):
+    """
+    Tests for choosing the timing of a call from the response history.
+    """
+    def test_static_without_history(self):
+        """
+        Test that the settings are used until there are enough samples.
+        """
+        policy = choose_call_policy(get_stats([.5] * 5), get_stats([.5] * 9))
+
+        self.assertEqual(policy, (4, 1, 3, SOURCE_STATIC))
+
+    def test_fast_device(self):
+        """
+        Test that a device that responds fast is held shortly and gets no
+        resends it does not need.
+        """
+        policy = choose_call_policy(get_stats([.5, .6] * 10, [True] * 10), ResponseStats())
+
+        self.assertEqual(policy.source, SOURCE_DEVICE)
+        self.assertEqual(policy.wait, 1.5)
+        self.assertEqual(policy.max_attempts, 1)
+
+    def test_slow_device(self):
+        """
+        Test that a device that needs long still gets the full wait.
+        """
+        policy = choose_call_policy(get_stats([2, 3.5] * 10, [True] * 10), ResponseStats())
+
+        self.assertEqual(policy.wait, 4)
+        self.assertGreaterEqual(policy.resend_interval, 3.5)
+
+    def test_unresponsive_device(self):
+        """
+        Test that a device that stopped responding gives up early.
+        """
+        policy = choose_call_policy(get_stats([2] * 10, [False] * 20), ResponseStats())
+
+        self.assertEqual((policy.wait, policy.source), (1.5, SOURCE_UNRESPONSIVE))
+
+    def test_platform_fallback(self):
+        """
+        Test that a new device gets the timing of its platform.
+        """
+        policy = choose_call_policy(ResponseStats(), get_stats([.8] * 100))
+
+        self.assertEqual(policy.source, SOURCE_PLATFORM)
+        self.assertLess(policy.wait, 4)
+
+    def test_combine_policies(self):
+        """
+        Test that a call to several devices waits for the slowest device
+        and resends for the fastest.
+        """
+        fast = CallPolicy(1.5, .5, 2, SOURCE_DEVICE)
+        slow = CallPolicy(4, 2, 1, SOURCE_PLATFORM)
+
+        self.assertEqual(combine_call_policies([fast, slow]), (4, .5, 7, SOURCE_PLATFORM))
+        self.assertEqual(combine_call_policies([fast, fast]), fast)
+
+
+@override_settings(APP_PUSH_ROUNDTRIP_WAIT=4000, APP_PUSH_RESEND_INTERVAL=1000)
+class SimulationTestCase(SimpleTestCase):
+    """
+    Tests for replaying the response logs.
+    """
+    def test_simulate(self):
+        """
+        Test that the adaptive policy holds a fast device shorter with fewer
+        pushes and keeps the responses of a slow device.
+        """
+        response_logs = []
+        for i in range(100):
+            response_logs.append(FakeResponseLog('apns', 'fast', random.uniform(.4, .7)))
+            response_logs.append(FakeResponseLog('apns', 'slow', random.uniform(2.5, 3.5)))
+
+        results = simulate_response_logs(response_logs)
+
+        static, adaptive = results['static'].as_dict(), results['adaptive'].as_dict()
+        self.assertEqual(static['answer_rate'], 1)
+        self.assertGreaterEqual(adaptive['answer_rate'], .98)
+        self.assertLess(adaptive['pushes_per_call'], static['pushes_per_call'])
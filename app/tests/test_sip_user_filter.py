@@ -0,0 +1,127 @@
+from threading import Thread
+
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase
+
+from ..cache import get_redis_cache
+from ..models import App, Device
+from ..sip_user_filter import (
+    ABSENT,
+    FILTER_KEY,
+    get_position,
+    PRESENT,
+    REBUILD_KEY,
+    SHARD_BITS,
+    SHARD_COUNT,
+    sip_user_filter,
+    UNKNOWN)
+
+
+class GetPositionTestCase(SimpleTestCase):
+    """
+    Tests for the position of a sip_user_id in the bitmap.
+    """
+    def test_position(self):
+        """
+        Test the first, next shard and last sip_user_id.
+        """
+        self.assertEqual(get_position('100000000'), (0, 0))
+        self.assertEqual(get_position(100000000 + (1 << SHARD_BITS) + 5), (1, 5))
+        self.assertEqual(get_position(999999999)[0], SHARD_COUNT - 1)
+
+    def test_outside_range(self):
+        """
+        Test that ids outside the 9 digit range have no position.
+        """
+        self.assertIsNone(get_position('99999999'))
+        self.assertIsNone(get_position('1000000000'))
+        self.assertIsNone(get_position('abc'))
+
+
+class SipUserFilterTestCase(TransactionTestCase):
+    """
+    Tests for the filter of sip_user_ids with a device.
+    """
+    def setUp(self):
+        super(SipUserFilterTestCase, self).setUp()
+        self.app = App.objects.create(platform='android', app_id='com.voipgrid.vialer', push_key='key')
+        pipeline = get_redis_cache().client.pipeline(transaction=False)
+        for shard in range(SHARD_COUNT):
+            pipeline.delete(FILTER_KEY.format(shard))
+            pipeline.delete(REBUILD_KEY.format(shard))
+        pipeline.execute()
+
+    def _create_device(self, sip_user_id):
+        return Device.objects.create(
+            name='test device', token='token{0}'.format(sip_user_id), sip_user_id=sip_user_id, app=self.app)
+
+    def test_unknown_before_rebuild(self):
+        """
+        Test that registering without a rebuild does not make the filter
+        answer for the other devices.
+        """
+        self._create_device('123456789')
+
+        self.assertEqual(sip_user_filter.contains('123456789'), UNKNOWN)
+        self.assertEqual(sip_user_filter.contains('123456788'), UNKNOWN)
+
+    def test_rebuild(self):
+        """
+        Test that the rebuilt filter contains the devices in the database.
+        """
+        Device.objects.bulk_create([
+            Device(id=sip_user_id, sip_user_id=sip_user_id, token='token{0}'.format(sip_user_id), app=self.app)
+            for sip_user_id in ('123456789', '987654321')
+        ])
+
+        self.assertEqual(sip_user_filter.rebuild(chunk_size=1), 2)
+
+        self.assertEqual(sip_user_filter.contains('123456789'), PRESENT)
+        self.assertEqual(sip_user_filter.contains('987654321'), PRESENT)
+        self.assertEqual(sip_user_filter.contains('123456788'), ABSENT)
+
+    def test_register_and_delete(self):
+        """
+        Test that registered and deleted devices update the filter.
+        """
+        sip_user_filter.rebuild()
+
+        device = self._create_device('123456789')
+        self.assertEqual(sip_user_filter.contains('123456789'), PRESENT)
+
+        device.delete()
+        self.assertEqual(sip_user_filter.contains('123456789'), ABSENT)
+
+    def test_concurrent_registration(self):
+        """
+        Test that devices registered while the filter is rebuilt are in it.
+        """
+        sip_user_ids = [str(200000000 + index * 7919) for index in range(200)]
+        Device.objects.bulk_create([
+            Device(id=sip_user_id, sip_user_id=sip_user_id, token='token{0}'.format(sip_user_id), app=self.app)
+            for sip_user_id in sip_user_ids[:100]
+        ])
+
+        def register(chunk):
+            try:
+                for sip_user_id in chunk:
+                    self._create_device(sip_user_id)
+            finally:
+                connection.close()
+
+        def rebuild():
+            try:
+                sip_user_filter.rebuild(chunk_size=10)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=register, args=(sip_user_ids[index::10],)) for index in range(100, 110)]
+        threads.append(Thread(target=rebuild))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for sip_user_id in sip_user_ids:
+            self.assertEqual(sip_user_filter.contains(sip_user_id), PRESENT)
+        self.assertEqual(sip_user_filter.contains('200000001'), ABSENT)
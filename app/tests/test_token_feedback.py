@@ -0,0 +1,72 @@
+from unittest import mock
+
+from django.test import TransactionTestCase
+
+from main.prometheus.consts import VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY
+
+from ..cache import get_redis_cache
+from ..devices import device_cache, get_cached_device
+from ..models import App, Device
+from ..token_feedback import report_invalid_token, report_replaced_token, token_feedback
+
+
+@mock.patch('app.token_feedback.set_call_response')
+class TokenFeedbackTestCase(TransactionTestCase):
+    """
+    Tests for applying the tokens reported by the providers to the devices.
+    """
+    def setUp(self):
+        super(TokenFeedbackTestCase, self).setUp()
+        self.app = App.objects.create(platform='android', app_id='com.voipgrid.vialer', push_key='key')
+        self.device = Device.objects.create(
+            name='test device',
+            token='token',
+            sip_user_id='123456789',
+            app=self.app,
+        )
+        device_cache.local.clear()
+        get_redis_cache().client.delete(VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY)
+        # Apply the batches in the tests only.
+        patcher = mock.patch.object(token_feedback, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_invalid_token_removed_once(self, set_call_response):
+        """
+        Test that a token reported by every attempt of a call removes the
+        device once and answers the call right away.
+        """
+        report_invalid_token(self.device, 'NotRegistered', unique_key='unique_key')
+        report_invalid_token(self.device, 'NotRegistered', unique_key='unique_key')
+
+        self.assertEqual(len(token_feedback), 1)
+        set_call_response.assert_called_with(mock.ANY, 'unique_key', 'Removed')
+        self.assertEqual(get_redis_cache().client.llen(VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY), 2)
+
+        self.assertEqual(token_feedback.flush(), 1)
+        self.assertFalse(Device.objects.filter(sip_user_id='123456789').exists())
+
+    def test_replaced_token_updated(self, set_call_response):
+        """
+        Test that the canonical token is stored and the cached device is
+        dropped.
+        """
+        get_cached_device('123456789')
+
+        report_replaced_token(self.device, 'new_token', 'canonical_id')
+        token_feedback.flush()
+
+        self.assertFalse(set_call_response.called)
+        self.assertEqual(get_cached_device('123456789').token, 'new_token')
+
+    def test_registered_again_before_flush(self, set_call_response):
+        """
+        Test that a device that registered a new token before the batch was
+        written is kept.
+        """
+        report_invalid_token(self.device, 'Unregistered')
+        Device.objects.filter(sip_user_id='123456789').update(token='new_token')
+
+        token_feedback.flush()
+
+        self.assertTrue(Device.objects.filter(sip_user_id='123456789').exists())
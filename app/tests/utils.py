@@ -0,0 +1,139 @@
+import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import socket
+from socketserver import ThreadingMixIn
+import ssl
+from threading import Thread
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import RequestReceived, StreamEnded
+
+
+def write_key(key, path):
+    """
+    Write a private key to a PEM file.
+    """
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+
+
+class StubAPNsServer(object):
+    """
+    HTTP/2 server on localhost that accepts every notification and keeps the
+    headers of the requests.
+    """
+    def __init__(self, directory):
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+        certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+            key.public_key()).serial_number(1).not_valid_before(
+            datetime.datetime.utcnow() - datetime.timedelta(days=1)).not_valid_after(
+            datetime.datetime.utcnow() + datetime.timedelta(days=1)).add_extension(
+            x509.SubjectAlternativeName([x509.DNSName('localhost')]), critical=False).sign(
+            key, hashes.SHA256(), default_backend())
+
+        self.cert_file = os.path.join(directory, 'stub.pem')
+        with open(self.cert_file, 'wb') as f:
+            f.write(certificate.public_bytes(serialization.Encoding.PEM))
+        key_file = os.path.join(directory, 'stub.key')
+        write_key(key, key_file)
+
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(self.cert_file, key_file)
+        self.context.set_alpn_protocols(['h2'])
+
+        self.socket = socket.socket()
+        self.socket.bind(('localhost', 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.requests = []
+        Thread(target=self._serve, daemon=True).start()
+
+    def close(self):
+        self.socket.close()
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except OSError:
+                return
+            self.connections += 1
+            Thread(target=self._handle, args=(sock,), daemon=True).start()
+
+    def _handle(self, sock):
+        with self.context.wrap_socket(sock, server_side=True) as tls:
+            connection = H2Connection(config=H2Configuration(client_side=False, header_encoding='utf-8'))
+            connection.initiate_connection()
+            tls.sendall(connection.data_to_send())
+            headers = {}
+            while True:
+                data = tls.recv(65535)
+                if not data:
+                    return
+                for event in connection.receive_data(data):
+                    if isinstance(event, RequestReceived):
+                        headers[event.stream_id] = dict(event.headers)
+                    elif isinstance(event, StreamEnded):
+                        self.requests.append(headers.pop(event.stream_id))
+                        connection.send_headers(event.stream_id, [(':status', '200')], end_stream=True)
+                tls.sendall(connection.data_to_send())
+
+
+class StubPushHandler(BaseHTTPRequestHandler):
+    """
+    Keep-alive endpoint that answers every push like FCM and GCM do.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Send the body with the headers like the Google frontends do.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(StubPushHandler, self).setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.server.requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+        body = json.dumps({
+            'multicast_id': 1,
+            'success': 1,
+            'failure': 0,
+            'canonical_ids': 0,
+            'results': [{'message_id': '1'}],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubPushServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server on localhost for FCM and GCM that counts the connections it
+    accepted and keeps the JSON bodies of the pushes.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super(StubPushServer, self).__init__(('127.0.0.1', 0), StubPushHandler)
+        self.url = 'http://127.0.0.1:{0}/send'.format(self.server_port)
+        self.connections = 0
+        self.requests = []
+        Thread(target=self.serve_forever, daemon=True).start()
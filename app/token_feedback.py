@@ -0,0 +1,209 @@
+import atexit
+from collections import OrderedDict
+import logging
+from threading import Event, Lock, Thread
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
+
+from app.cache import get_redis_cache
+from app.calls import set_call_response
+from app.devices import invalidate_device
+from app.models import Device
+from app.utils import log_middleware_information
+from main.prometheus.consts import (
+    ACTION_KEY,
+    OS_KEY,
+    REASON_KEY,
+    VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY)
+
+# What to do with the devices of a token the provider reported.
+ACTION_REMOVE = 'remove'
+ACTION_REPLACE = 'replace'
+
+# FCM and GCM errors for registration ids that will never work again.
+INVALID_GOOGLE_TOKEN_ERRORS = ('NotRegistered', 'InvalidRegistration')
+
+
+class TokenFeedback(object):
+    """
+    Collects the tokens the providers reported as dead or replaced and
+    applies them to the devices in batches. A token reported more than
+    once before the batch is written is applied once, the last report wins.
+
+    Batches are written every TOKEN_FEEDBACK_FLUSH_INTERVAL or as soon as
+    TOKEN_FEEDBACK_BATCH_SIZE tokens are pending.
+    """
+    def __init__(self):
+        self.thread = None
+        self._pending = OrderedDict()
+        self._lock = Lock()
+        self._flush_now = Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def report(self, device, action, reason, new_token=None, unique_key=None):
+        """
+        Queue a token of a device for removal or replacement.
+
+        Args:
+            device (Device): The device the push was sent to.
+            action (string): ACTION_REMOVE or ACTION_REPLACE.
+            reason (string): The error or result of the provider.
+            new_token (string): The token that replaces the token of the
+                device for ACTION_REPLACE.
+            unique_key (string): The unique_key of the call the push was
+                for, the call is answered with a NAK when the token is dead.
+        """
+        if action == ACTION_REMOVE and unique_key:
+            # Don't let the PBX wait for a device that won't get the push.
+            set_call_response(get_redis_cache(), unique_key, 'Removed')
+
+        log_middleware_information(
+            '{0} | Queued {1} of token {2} because {3}',
+            OrderedDict([
+                ('unique_key', unique_key or device.token),
+                ('action', action),
+                ('token', device.token),
+                ('reason', reason),
+            ]),
+            logging.INFO,
+            device=device,
+        )
+
+        # Push data to Redis to count the feedback per provider and reason.
+        get_redis_cache().client.rpush(VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY, {
+            OS_KEY: device.app.platform,
+            ACTION_KEY: action,
+            REASON_KEY: reason,
+        })
+
+        with self._lock:
+            self._pending[(device.app_id, device.token)] = (action, new_token)
+            full = len(self._pending) >= settings.TOKEN_FEEDBACK_BATCH_SIZE
+        if full:
+            self._flush_now.set()
+        self.start()
+
+    def flush(self):
+        """
+        Delete the devices with a dead token and update the replaced tokens
+        in one transaction.
+
+        Returns:
+            int: The amount of tokens that were applied.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        if not pending:
+            return 0
+
+        removals = {}
+        replacements = {}
+        for (app_id, token), (action, new_token) in pending.items():
+            if action == ACTION_REMOVE:
+                removals.setdefault(app_id, []).append(token)
+            else:
+                replacements.setdefault(app_id, {})[token] = new_token
+
+        with transaction.atomic():
+            # The delete signals drop the devices from the device cache.
+            for app_id, tokens in removals.items():
+                Device.objects.filter(app_id=app_id, token__in=tokens).delete()
+
+            for app_id, tokens in replacements.items():
+                # A device that registered the new token already is the same
+                # device, a token is unique per app.
+                Device.objects.filter(app_id=app_id, token__in=list(tokens.values())).exclude(
+                    token__in=list(tokens)).delete()
+                devices = Device.objects.filter(app_id=app_id, token__in=list(tokens))
+                # Updates don't send signals, invalidate the devices here.
+                sip_user_ids = list(devices.values_list('sip_user_id', flat=True))
+                devices.update(token=Case(
+                    *[When(token=token, then=Value(new_token)) for token, new_token in tokens.items()],
+                    output_field=CharField(),
+                ))
+                for sip_user_id in sip_user_ids:
+                    transaction.on_commit(lambda sip_user_id=sip_user_id: invalidate_device(sip_user_id))
+
+        log_middleware_information(
+            'Applied {0} token removals and {1} token replacements',
+            OrderedDict([
+                ('removals', sum(len(tokens) for tokens in removals.values())),
+                ('replacements', sum(len(tokens) for tokens in replacements.values())),
+            ]),
+            logging.INFO,
+        )
+        return len(pending)
+
+    def start(self):
+        """
+        Start the thread that writes the batches if it is not running yet.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self._lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            self._flush_now.wait(settings.TOKEN_FEEDBACK_FLUSH_INTERVAL / 1000)
+            self._flush_now.clear()
+            try:
+                self.flush()
+            except Exception:
+                log_middleware_information(
+                    'Applying the token feedback failed',
+                    OrderedDict(),
+                    logging.ERROR,
+                )
+
+
+token_feedback = TokenFeedback()
+
+
+def report_invalid_token(device, reason, unique_key=None):
+    """
+    Function to queue the removal of a device whose token the provider
+    rejected.
+
+    Args:
+        device (Device): The device the push was sent to.
+        reason (string): The error of the provider.
+        unique_key (string): The unique_key of the call the push was for.
+    """
+    token_feedback.report(device, ACTION_REMOVE, reason, unique_key=unique_key)
+
+
+def report_replaced_token(device, new_token, reason):
+    """
+    Function to queue the replacement of the token of a device by the
+    canonical token the provider returned.
+
+    Args:
+        device (Device): The device the push was sent to.
+        new_token (string): The token to use from now on.
+        reason (string): The result of the provider.
+    """
+    token_feedback.report(device, ACTION_REPLACE, reason, new_token=new_token)
+
+
+def flush_token_feedback():
+    """
+    Function to write the pending token feedback when the process stops.
+    """
+    try:
+        token_feedback.flush()
+    except Exception:
+        log_middleware_information(
+            'Applying the token feedback failed',
+            OrderedDict(),
+            logging.ERROR,
+        )
+
+
+atexit.register(flush_token_feedback)
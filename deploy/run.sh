@@ -35,5 +35,16 @@ python /usr/src/app/manage.py collectstatic --noinput
 # Start prometheus webserver and healthcheck the platform
 python /usr/src/app/main/prometheus/prometheus.py &
 
+# Start the async incoming call application when a port is configured.
+if [ -n "${ASGI_PORT}" ]; then
+    /usr/local/bin/uvicorn --host 0.0.0.0 --port ${ASGI_PORT} main.asgi:application &
+fi
+
+# Start a push sender when the call pushes go through the push outbox. More
+# senders can run on other nodes with `manage.py push_worker`.
+if [ "${APP_PUSH_SEND_MODE}" = "outbox" ]; then
+    python /usr/src/app/manage.py push_worker &
+fi
+
 # Run
 exec /usr/local/bin/gunicorn --bind 0.0.0.0:8000 -w 1 -k gevent main.wsgi:application
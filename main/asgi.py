@@ -0,0 +1,20 @@
+"""
+ASGI config for the async incoming call flow.
+
+It exposes the ASGI callable as a module-level variable named ``application``
+and is served by uvicorn next to the gunicorn WSGI workers.
+"""
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
+django.setup()
+
+from api.asgi import IncomingCallApplication  # noqa
+from app.apns import open_apns_connections  # noqa
+
+application = IncomingCallApplication()
+
+# Warm up the APNs connections of this worker before the first call.
+open_apns_connections()
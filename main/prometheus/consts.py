@@ -1,7 +1,9 @@
 # JSON keys.
 ACTION_KEY = 'action'
+ACTIVE_WORKERS_KEY = 'active_workers'
 APP_STATUS_KEY = 'app_status'
 APP_VERSION_KEY = 'app_version'
+ATTEMPT_KEY = 'attempt'
 BLUETOOTH_AUDIO_KEY = 'bluetooth_audio'
 BLUETOOTH_DEVICE_KEY = 'bluetooth_device'
 CALL_ID_KEY = 'call_id'
@@ -10,8 +12,12 @@ CLIENT_COUNTRY_KEY = 'client_country'
 CODEC_KEY = 'codec'
 CONNECTION_TYPE_KEY = 'connection_type'
 DIRECTION_KEY = 'direction'
+EXECUTOR_KEY = 'executor'
 FAILED_REASON_KEY = 'failed_reason'
+FIRST_KEY = 'first'
+HANDOFF_KEY = 'handoff'
 HANGUP_REASON_KEY = 'hangup_reason'
+LATENCY_KEY = 'latency'
 LOG_ID_KEY = 'log_id'
 MIDDLEWARE_UNIQUE_KEY = 'middleware_unique_key'
 MOS_KEY = 'mos'
@@ -20,7 +26,17 @@ NETWORK_OPERATOR_KEY = 'network_operator'
 NETWORK_SIGNAL_STRENGTH_KEY = 'network_signal_strength'
 OS_KEY = 'os'
 OS_VERSION_KEY = 'os_version'
+PHASES_KEY = 'phases'
+QUEUE_DEPTH_KEY = 'queue_depth'
+REASON_KEY = 'reason'
+SAVED_SECONDS_KEY = 'saved_seconds'
+RESULT_KEY = 'result'
+TIER_KEY = 'tier'
 TIME_TO_INITIAL_RESPONSE_KEY = 'time_to_initial_response'
+TOPIC_KEY = 'topic'
+UPDATED_AT_KEY = 'updated_at'
+UTILIZATION_KEY = 'utilization'
+WORKERS_KEY = 'workers'
 
 # Redis keys.
 VIALER_CALL_SUCCESS_TOTAL_KEY = 'vialer_call_success_total'
@@ -30,5 +46,35 @@ VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY = 'vialer_middleware_push_
 VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY = 'vialer_middleware_push_notification_failed_total'
 VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY = 'vialer_middleware_incoming_call_success_total'
 VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY = 'vialer_middleware_incoming_call_failed_total'
+VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY = 'vialer_middleware_call_response_handoff_total'
+VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY = 'vialer_middleware_incoming_call_coalesced_total'
+VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY = 'vialer_middleware_device_cache_total'
+VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY = 'vialer_middleware_executor_rejected_total'
+VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY = 'vialer_middleware_executor_task_latency_seconds'
+VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY = 'vialer_middleware_push_outbox_latency_seconds'
+VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY = 'vialer_middleware_push_token_feedback_total'
+# List with the platform and the seconds of wait left of every cancelled call.
+VIALER_MIDDLEWARE_CALL_CANCELLED_KEY = 'vialer_middleware_call_cancelled'
+# List with the latency and stream utilization of every APNs send.
+VIALER_MIDDLEWARE_APNS_SEND_KEY = 'vialer_middleware_apns_send'
+# List with the platform, result and seconds per setup phase of every call.
+VIALER_MIDDLEWARE_CALL_PHASE_KEY = 'vialer_middleware_call_phase_seconds'
+# List with the platform and attempt of every call push the provider accepted.
+VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY = 'vialer_middleware_call_push_sent_total'
+# List with the platform, attempt and delivery latency of every call push the
+# app received.
+VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY = 'vialer_middleware_push_received'
+# Hash with the executor gauges per process.
+VIALER_MIDDLEWARE_EXECUTOR_STATS_KEY = 'vialer_middleware_executor_stats'
 
 VIALER_MIDDLEWARE_INCOMING_VALUE = 'Incoming'
+
+# Values for the handoff label.
+HANDOFF_LOCAL_VALUE = 'local'
+HANDOFF_REDIS_VALUE = 'redis'
+
+# Values for the tier and result labels of the device cache.
+CACHE_LOCAL_VALUE = 'local'
+CACHE_REDIS_VALUE = 'redis'
+CACHE_HIT_VALUE = 'hit'
+CACHE_MISS_VALUE = 'miss'
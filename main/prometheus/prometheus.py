@@ -16,7 +16,7 @@ import time
 
 from django.conf import settings
 from django.db import connection, DatabaseError
-from prometheus_client import Counter, Gauge, start_http_server
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from raven.contrib.django.models import client as raven_client
 from redis import RedisError
 from rediscluster.exceptions import RedisClusterException
@@ -25,24 +25,52 @@ from app.cache import RedisClusterCache
 from app.models import GCM_PLATFORM, ResponseLog
 from main.prometheus.consts import (
     ACTION_KEY,
+    ACTIVE_WORKERS_KEY,
     APP_VERSION_KEY,
+    ATTEMPT_KEY,
     CODEC_KEY,
     CONNECTION_TYPE_KEY,
     DIRECTION_KEY,
+    EXECUTOR_KEY,
     FAILED_REASON_KEY,
+    FIRST_KEY,
+    HANDOFF_KEY,
     HANGUP_REASON_KEY,
+    LATENCY_KEY,
     MOS_KEY,
     NETWORK_KEY,
     NETWORK_OPERATOR_KEY,
     OS_KEY,
     OS_VERSION_KEY,
+    PHASES_KEY,
+    QUEUE_DEPTH_KEY,
+    REASON_KEY,
+    RESULT_KEY,
+    SAVED_SECONDS_KEY,
+    TIER_KEY,
+    TOPIC_KEY,
+    UPDATED_AT_KEY,
+    UTILIZATION_KEY,
     VIALER_CALL_FAILURE_TOTAL_KEY,
     VIALER_CALL_SUCCESS_TOTAL_KEY,
     VIALER_HANGUP_REASON_TOTAL_KEY,
+    VIALER_MIDDLEWARE_APNS_SEND_KEY,
+    VIALER_MIDDLEWARE_CALL_CANCELLED_KEY,
+    VIALER_MIDDLEWARE_CALL_PHASE_KEY,
+    VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY,
+    VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY,
+    VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY,
+    VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY,
+    VIALER_MIDDLEWARE_EXECUTOR_STATS_KEY,
+    VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY,
+    VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY,
     VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY,
     VIALER_MIDDLEWARE_INCOMING_CALL_SUCCESS_TOTAL_KEY,
     VIALER_MIDDLEWARE_PUSH_NOTIFICATION_FAILED_TOTAL_KEY,
-    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY)
+    VIALER_MIDDLEWARE_PUSH_NOTIFICATION_SUCCESS_TOTAL_KEY,
+    VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY,
+    VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY,
+    VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY)
 
 # Middleware health metrics.
 MYSQL_HEALTH = Gauge('mysql_health', 'See if MySQL is still reachable through the ORM.')
@@ -84,6 +112,7 @@ VIALER_CALL_FAILURE_TOTAL = Counter(
 
 VIALER_HANGUP_REASON_TOTAL = Counter(
     VIALER_HANGUP_REASON_TOTAL_KEY,
+    VIALER_MIDDLEWARE_APNS_SEND_KEY,
     'The amount of why a call was ended for the Vialer app',
     [
         'app_version',
@@ -121,6 +150,121 @@ VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL = Counter(
     ['action', 'failed_reason', 'os'],
 )
 
+VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL = Counter(
+    VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY,
+    'The amount of call responses handed off to a waiting incoming call in the same process (local) or via Redis',
+    ['handoff'],
+)
+
+VIALER_MIDDLEWARE_CALL_CANCELLED_TOTAL = Counter(
+    'vialer_middleware_call_cancelled_total',
+    'The amount of incoming calls cancelled by the PBX while they waited for the app, per os',
+    ['os'],
+)
+
+VIALER_MIDDLEWARE_CALL_CANCELLED_SAVED_SECONDS_TOTAL = Counter(
+    'vialer_middleware_call_cancelled_saved_seconds_total',
+    'The seconds the cancelled incoming calls would still have waited for the app, per os',
+    ['os'],
+)
+
+VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL = Counter(
+    VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY,
+    'The amount of duplicate incoming calls that got the response of the first request for the same call_id '
+    'in the same process (local) or via Redis',
+    ['handoff'],
+)
+
+VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL = Counter(
+    VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY,
+    'The amount of hits and misses per tier of the device cache',
+    ['tier', 'result'],
+)
+
+# Executor metrics.
+EXECUTOR_NAMES = ('push', 'notify', 'db_log', 'bulk_notify')
+# Seconds after which the stats of a process that stopped are dropped.
+EXECUTOR_STATS_MAX_AGE = 60
+
+VIALER_MIDDLEWARE_EXECUTOR_QUEUE_DEPTH = Gauge(
+    'vialer_middleware_executor_queue_depth',
+    'The amount of queued tasks per executor summed over the processes',
+    ['executor'],
+)
+
+VIALER_MIDDLEWARE_EXECUTOR_ACTIVE_WORKERS = Gauge(
+    'vialer_middleware_executor_active_workers',
+    'The amount of workers running a task per executor summed over the processes',
+    ['executor'],
+)
+
+VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY = Histogram(
+    VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY,
+    'The time between queueing and finishing a task per executor',
+    ['executor'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+
+VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL = Counter(
+    VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY,
+    'The amount of tasks dropped because the queue of the executor was full',
+    ['executor'],
+)
+
+VIALER_MIDDLEWARE_APNS_SEND_LATENCY = Histogram(
+    'vialer_middleware_apns_send_latency_seconds',
+    'The time to send a notification on a warm APNs connection per topic',
+    ['topic'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+)
+
+VIALER_MIDDLEWARE_APNS_STREAM_UTILIZATION = Histogram(
+    'vialer_middleware_apns_stream_utilization',
+    'The share of the max concurrent streams in use on the APNs connection of a send per topic',
+    ['topic'],
+    buckets=(.05, .1, .2, .3, .4, .5, .6, .7, .8, .9, 1),
+)
+
+VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY = Histogram(
+    VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY,
+    'The time between appending a push to the outbox and sending it per os',
+    ['os'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5),
+)
+
+VIALER_MIDDLEWARE_CALL_PHASE = Histogram(
+    VIALER_MIDDLEWARE_CALL_PHASE_KEY,
+    'The time an incoming call spent in each setup phase per os, phase and result',
+    ['os', 'phase', 'result'],
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+
+VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL = Counter(
+    VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY,
+    'The amount of call pushes the provider accepted per os and attempt',
+    ['os', 'attempt'],
+)
+
+VIALER_MIDDLEWARE_PUSH_RECEIVED_TOTAL = Counter(
+    'vialer_middleware_push_received_total',
+    'The amount of call pushes the app received per os and attempt, first is true for the first push of the call'
+    ' that arrived',
+    ['os', 'attempt', 'first'],
+)
+
+VIALER_MIDDLEWARE_PUSH_DELIVERY_LATENCY = Histogram(
+    'vialer_middleware_push_delivery_latency_seconds',
+    'The time between sending a call push and the app receiving it per os and attempt',
+    ['os', 'attempt'],
+    buckets=(.1, .25, .5, .75, 1, 1.5, 2, 3, 5, 10),
+)
+
+VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL = Counter(
+    VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY,
+    'The amount of tokens the providers reported as dead (remove) or replaced per os and reason',
+    ['os', 'action', 'reason'],
+)
+
 
 def ping_redis():
     """
@@ -382,6 +526,388 @@ def increment_vialer_middleware_failed_incoming_call_metric_counter():
     REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_INCOMING_CALL_FAILED_TOTAL_KEY, list_length, -1)
 
 
+def increment_vialer_middleware_call_response_handoff_metric_counter():
+    """
+    Function that increments the
+    vialer_middleware_call_response_handoff_total counter.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL.labels(
+            handoff=value_dict[HANDOFF_KEY],
+        ).inc()
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_CALL_RESPONSE_HANDOFF_TOTAL_KEY, list_length, -1)
+
+
+def increment_vialer_middleware_incoming_call_coalesced_metric_counter():
+    """
+    Function that increments the
+    vialer_middleware_incoming_call_coalesced_total counter.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL.labels(
+            handoff=value_dict[HANDOFF_KEY],
+        ).inc()
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_INCOMING_CALL_COALESCED_TOTAL_KEY, list_length, -1)
+
+
+def increment_vialer_middleware_call_cancelled_metric_counters():
+    """
+    Function that increments the vialer_middleware_call_cancelled_total and
+    vialer_middleware_call_cancelled_saved_seconds_total counters.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_CALL_CANCELLED_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_CALL_CANCELLED_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_CALL_CANCELLED_TOTAL.labels(
+            os=value_dict[OS_KEY],
+        ).inc()
+        VIALER_MIDDLEWARE_CALL_CANCELLED_SAVED_SECONDS_TOTAL.labels(
+            os=value_dict[OS_KEY],
+        ).inc(value_dict[SAVED_SECONDS_KEY])
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_CALL_CANCELLED_KEY, list_length, -1)
+
+
+def increment_vialer_middleware_device_cache_metric_counter():
+    """
+    Function that increments the vialer_middleware_device_cache_total
+    counter.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL.labels(
+            tier=value_dict[TIER_KEY],
+            result=value_dict[RESULT_KEY],
+        ).inc()
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_DEVICE_CACHE_TOTAL_KEY, list_length, -1)
+
+
+def set_vialer_middleware_executor_gauges():
+    """
+    Function that sets the executor gauges to the sum of the stats of the
+    processes that reported recently.
+    """
+    queue_depth = dict.fromkeys(EXECUTOR_NAMES, 0)
+    active_workers = dict.fromkeys(EXECUTOR_NAMES, 0)
+
+    stats = REDIS_CLUSTER_CLIENT.client.hgetall(VIALER_MIDDLEWARE_EXECUTOR_STATS_KEY)
+    for field, value_str in stats.items():
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        if value_dict[UPDATED_AT_KEY] < time.time() - EXECUTOR_STATS_MAX_AGE:
+            REDIS_CLUSTER_CLIENT.client.hdel(VIALER_MIDDLEWARE_EXECUTOR_STATS_KEY, field)
+            continue
+        executor = value_dict[EXECUTOR_KEY]
+        queue_depth[executor] = queue_depth.get(executor, 0) + value_dict[QUEUE_DEPTH_KEY]
+        active_workers[executor] = active_workers.get(executor, 0) + value_dict[ACTIVE_WORKERS_KEY]
+
+    for executor in queue_depth:
+        VIALER_MIDDLEWARE_EXECUTOR_QUEUE_DEPTH.labels(executor=executor).set(queue_depth[executor])
+        VIALER_MIDDLEWARE_EXECUTOR_ACTIVE_WORKERS.labels(executor=executor).set(active_workers[executor])
+
+
+def observe_vialer_middleware_executor_task_latency_metric_histogram():
+    """
+    Function that observes the task latencies in the
+    vialer_middleware_executor_task_latency_seconds histogram.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY.labels(
+            executor=value_dict[EXECUTOR_KEY],
+        ).observe(value_dict[LATENCY_KEY])
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_EXECUTOR_TASK_LATENCY_KEY, list_length, -1)
+
+
+def increment_vialer_middleware_executor_rejected_metric_counter():
+    """
+    Function that increments the vialer_middleware_executor_rejected_total
+    counter.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL.labels(
+            executor=value_dict[EXECUTOR_KEY],
+        ).inc()
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_EXECUTOR_REJECTED_TOTAL_KEY, list_length, -1)
+
+
+def observe_vialer_middleware_apns_send_metric_histograms():
+    """
+    Function that observes the APNs sends in the
+    vialer_middleware_apns_send_latency_seconds and
+    vialer_middleware_apns_stream_utilization histograms.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_APNS_SEND_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_APNS_SEND_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_APNS_SEND_LATENCY.labels(
+            topic=value_dict[TOPIC_KEY],
+        ).observe(value_dict[LATENCY_KEY])
+        VIALER_MIDDLEWARE_APNS_STREAM_UTILIZATION.labels(
+            topic=value_dict[TOPIC_KEY],
+        ).observe(value_dict[UTILIZATION_KEY])
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_APNS_SEND_KEY, list_length, -1)
+
+
+def observe_vialer_middleware_push_outbox_latency_metric_histogram():
+    """
+    Function that observes the latencies of the pushes from the outbox in the
+    vialer_middleware_push_outbox_latency_seconds histogram.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY.labels(
+            os=value_dict[OS_KEY],
+        ).observe(value_dict[LATENCY_KEY])
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_PUSH_OUTBOX_LATENCY_KEY, list_length, -1)
+
+
+def observe_vialer_middleware_call_phase_metric_histogram():
+    """
+    Function that observes the time spent in each setup phase of the incoming
+    calls in the vialer_middleware_call_phase_seconds histogram.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_CALL_PHASE_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_CALL_PHASE_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        for phase, seconds in value_dict[PHASES_KEY].items():
+            VIALER_MIDDLEWARE_CALL_PHASE.labels(
+                os=value_dict[OS_KEY],
+                phase=phase,
+                result=value_dict[RESULT_KEY],
+            ).observe(seconds)
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_CALL_PHASE_KEY, list_length, -1)
+
+
+def increment_vialer_middleware_call_push_sent_metric_counter():
+    """
+    Function that increments the vialer_middleware_call_push_sent_total
+    counter with the call pushes the providers accepted.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL.labels(
+            os=value_dict[OS_KEY],
+            attempt=value_dict[ATTEMPT_KEY],
+        ).inc()
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_CALL_PUSH_SENT_TOTAL_KEY, list_length, -1)
+
+
+def observe_vialer_middleware_push_received_metrics():
+    """
+    Function that increments the vialer_middleware_push_received_total
+    counter and observes the delivery latency in the
+    vialer_middleware_push_delivery_latency_seconds histogram for the call
+    pushes the apps received.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_PUSH_RECEIVED_TOTAL.labels(
+            os=value_dict[OS_KEY],
+            attempt=value_dict[ATTEMPT_KEY],
+            first=str(value_dict[FIRST_KEY]).lower(),
+        ).inc()
+        VIALER_MIDDLEWARE_PUSH_DELIVERY_LATENCY.labels(
+            os=value_dict[OS_KEY],
+            attempt=value_dict[ATTEMPT_KEY],
+        ).observe(value_dict[LATENCY_KEY])
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_PUSH_RECEIVED_KEY, list_length, -1)
+
+
+def increment_vialer_middleware_push_token_feedback_metric_counter():
+    """
+    Function that increments the vialer_middleware_push_token_feedback_total
+    counter.
+    """
+    # Get the length of the list in redis.
+    list_length = REDIS_CLUSTER_CLIENT.client.llen(VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY)
+
+    # Get the values from the list in redis.
+    data_list = REDIS_CLUSTER_CLIENT.client.lrange(
+        VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY,
+        0,
+        list_length,
+    )
+
+    for value_str in data_list:
+        # Parse the string to a dict.
+        value_dict = literal_eval(value_str)
+        VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL.labels(
+            os=value_dict[OS_KEY],
+            action=value_dict[ACTION_KEY],
+            reason=value_dict[REASON_KEY],
+        ).inc()
+
+    # Trim the list, this means that the values that are outside
+    # of the selected range are deleted. In this case we are keeping
+    # all of the values we did not yet process in the list.
+    REDIS_CLUSTER_CLIENT.client.ltrim(VIALER_MIDDLEWARE_PUSH_TOKEN_FEEDBACK_TOTAL_KEY, list_length, -1)
+
+
 if __name__ == '__main__':
     try:
         start_http_server(int(settings.PROMETHEUS_PORT))
@@ -412,6 +938,19 @@ if __name__ == '__main__':
             increment_vialer_middleware_success_push_notifications_metric_counter()
             increment_vialer_middleware_incoming_call_metric_counter()
             increment_vialer_middleware_failed_incoming_call_metric_counter()
+            increment_vialer_middleware_call_response_handoff_metric_counter()
+            increment_vialer_middleware_incoming_call_coalesced_metric_counter()
+            increment_vialer_middleware_call_cancelled_metric_counters()
+            increment_vialer_middleware_device_cache_metric_counter()
+            set_vialer_middleware_executor_gauges()
+            observe_vialer_middleware_executor_task_latency_metric_histogram()
+            increment_vialer_middleware_executor_rejected_metric_counter()
+            observe_vialer_middleware_apns_send_metric_histograms()
+            observe_vialer_middleware_push_outbox_latency_metric_histogram()
+            increment_vialer_middleware_push_token_feedback_metric_counter()
+            observe_vialer_middleware_call_phase_metric_histogram()
+            increment_vialer_middleware_call_push_sent_metric_counter()
+            observe_vialer_middleware_push_received_metrics()
         except (RedisError, RedisClusterException):
             # Log exception to Sentry each time Redis changes state.
             if not is_redis_down:
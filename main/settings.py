@@ -106,12 +106,163 @@ CACHES = {
 
 # List of redis cluster nodes eq. '127.0.0.1:6789,123.4.5.6:7895'.
 REDIS_SERVER_LIST = os.environ.get('REDIS_SERVER_LIST', 'redis:7000')
+# Max connections of the redis cluster client shared by a process and the max
+# wait in ms for a connection to be released once they are all in use.
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 64))
+REDIS_POOL_TIMEOUT = int(os.environ.get('REDIS_POOL_TIMEOUT', 2000))
+# Socket timeouts in ms for commands and connecting to a cluster node.
+REDIS_SOCKET_TIMEOUT = int(os.environ.get('REDIS_SOCKET_TIMEOUT', 2000))
+REDIS_SOCKET_CONNECT_TIMEOUT = int(os.environ.get('REDIS_SOCKET_CONNECT_TIMEOUT', 500))
+# Interval in ms at which the shared client pings the cluster.
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30000))
+# Min and max wait in ms between failed attempts to connect to the cluster.
+REDIS_RECONNECT_BACKOFF_MIN = int(os.environ.get('REDIS_RECONNECT_BACKOFF_MIN', 100))
+REDIS_RECONNECT_BACKOFF_MAX = int(os.environ.get('REDIS_RECONNECT_BACKOFF_MAX', 5000))
+
+# Device cache for the incoming call: max records and TTL in ms of the copy in
+# each process and the TTL in ms of the copy in Redis.
+DEVICE_CACHE_LOCAL_SIZE = int(os.environ.get('DEVICE_CACHE_LOCAL_SIZE', 10000))
+DEVICE_CACHE_LOCAL_TTL = int(os.environ.get('DEVICE_CACHE_LOCAL_TTL', 30000))
+DEVICE_CACHE_REDIS_TTL = int(os.environ.get('DEVICE_CACHE_REDIS_TTL', 3600000))
 
 # URL send with push notification payload so the app can respond to the right
 # server.
 APP_API_URL = os.environ.get('APP_API_URL')
 APP_PUSH_ROUNDTRIP_WAIT = int(os.environ.get('APP_PUSH_ROUNDTRIP_WAIT', 4000))
 APP_PUSH_RESEND_INTERVAL = int(os.environ.get('APP_PUSH_RESEND_INTERVAL', 1000))
+# How the incoming call waits for the app: 'notify' wakes up through Redis
+# pub/sub, 'poll' checks the cache every 10 ms and 'batch' lets one poller per
+# process check all waiting calls every APP_PUSH_BATCH_POLL_TICK.
+APP_PUSH_WAIT_MODE = os.environ.get('APP_PUSH_WAIT_MODE', 'notify')
+# Interval in ms at which the cache is still checked in 'notify' mode.
+APP_PUSH_SAFETY_POLL_INTERVAL = int(os.environ.get('APP_PUSH_SAFETY_POLL_INTERVAL', 500))
+# Interval in ms of the poller in 'batch' mode.
+APP_PUSH_BATCH_POLL_TICK = int(os.environ.get('APP_PUSH_BATCH_POLL_TICK', 50))
+
+# Max sip_user_ids of a ring group call.
+RING_GROUP_MAX_MEMBERS = int(os.environ.get('RING_GROUP_MAX_MEMBERS', 50))
+
+# Max devices of a sip_user_id that are called at the same time, a new device
+# over the max replaces the least recently seen one.
+MAX_DEVICES_PER_SIP_USER_ID = int(os.environ.get('MAX_DEVICES_PER_SIP_USER_ID', 5))
+
+# Timing of the incoming calls: 'static' waits APP_PUSH_ROUNDTRIP_WAIT and
+# resends every APP_PUSH_RESEND_INTERVAL, 'adaptive' chooses both per call
+# from the response history of the device (app/response_policy.py).
+APP_PUSH_POLICY_MODE = os.environ.get('APP_PUSH_POLICY_MODE', 'static')
+# Samples a device or platform needs before its history is used.
+RESPONSE_POLICY_MIN_SAMPLES = int(os.environ.get('RESPONSE_POLICY_MIN_SAMPLES', 10))
+# The wait is the RESPONSE_POLICY_DEADLINE_QUANTILE of the roundtrips plus
+# RESPONSE_POLICY_DEADLINE_MARGIN ms, at least RESPONSE_POLICY_MIN_WAIT ms.
+RESPONSE_POLICY_DEADLINE_QUANTILE = float(os.environ.get('RESPONSE_POLICY_DEADLINE_QUANTILE', 0.99))
+RESPONSE_POLICY_DEADLINE_MARGIN = int(os.environ.get('RESPONSE_POLICY_DEADLINE_MARGIN', 500))
+RESPONSE_POLICY_MIN_WAIT = int(os.environ.get('RESPONSE_POLICY_MIN_WAIT', 1500))
+# Pushes are resent every RESPONSE_POLICY_RESEND_QUANTILE of the roundtrips,
+# at least RESPONSE_POLICY_MIN_RESEND_INTERVAL ms.
+RESPONSE_POLICY_RESEND_QUANTILE = float(os.environ.get('RESPONSE_POLICY_RESEND_QUANTILE', 0.9))
+RESPONSE_POLICY_MIN_RESEND_INTERVAL = int(os.environ.get('RESPONSE_POLICY_MIN_RESEND_INTERVAL', 500))
+# Devices that respond to less of the calls get RESPONSE_POLICY_MIN_WAIT.
+RESPONSE_POLICY_MIN_ANSWER_RATE = float(os.environ.get('RESPONSE_POLICY_MIN_ANSWER_RATE', 0.1))
+# Weight of the last call in the averages of the history.
+RESPONSE_POLICY_EWMA_ALPHA = float(os.environ.get('RESPONSE_POLICY_EWMA_ALPHA', 0.2))
+# Samples at which the roundtrip sketch of a device or platform is halved.
+RESPONSE_STATS_DEVICE_MAX_SAMPLES = int(os.environ.get('RESPONSE_STATS_DEVICE_MAX_SAMPLES', 100))
+RESPONSE_STATS_PLATFORM_MAX_SAMPLES = int(os.environ.get('RESPONSE_STATS_PLATFORM_MAX_SAMPLES', 10000))
+
+# Max incoming calls that wait for the app per process and over all
+# processes (0 for no limit), calls over the limit get a NAK right away.
+ADMISSION_MAX_WORKER_CALLS = int(os.environ.get('ADMISSION_MAX_WORKER_CALLS', 500))
+ADMISSION_MAX_GLOBAL_CALLS = int(os.environ.get('ADMISSION_MAX_GLOBAL_CALLS', 0))
+# Once ADMISSION_FAIR_SHARE_THRESHOLD of a limit is in use, an app can only
+# hold ADMISSION_MAX_APP_SHARE of it.
+ADMISSION_FAIR_SHARE_THRESHOLD = float(os.environ.get('ADMISSION_FAIR_SHARE_THRESHOLD', 0.8))
+ADMISSION_MAX_APP_SHARE = float(os.environ.get('ADMISSION_MAX_APP_SHARE', 0.5))
+
+# How call pushes are sent: 'executor' sends them from the web worker and
+# 'outbox' appends them to a Redis stream per provider for the
+# `manage.py push_worker` processes (needs Redis 5 or later).
+APP_PUSH_SEND_MODE = os.environ.get('APP_PUSH_SEND_MODE', 'executor')
+# Approximate max entries kept in a push outbox stream.
+PUSH_OUTBOX_MAX_LENGTH = int(os.environ.get('PUSH_OUTBOX_MAX_LENGTH', 100000))
+# Max pushes a push worker sends at the same time per provider.
+PUSH_WORKER_CONCURRENCY = {
+    'apns': int(os.environ.get('PUSH_WORKER_APNS_CONCURRENCY', 50)),
+    'android': int(os.environ.get('PUSH_WORKER_ANDROID_CONCURRENCY', 50)),
+    'gcm': int(os.environ.get('PUSH_WORKER_GCM_CONCURRENCY', 10)),
+}
+# Max ms a push worker waits for new pushes in one read.
+PUSH_WORKER_BLOCK = int(os.environ.get('PUSH_WORKER_BLOCK', 1000))
+# Pushes read but not acknowledged for PUSH_WORKER_CLAIM_IDLE ms are taken
+# over by another worker, which checks for them every
+# PUSH_WORKER_RECLAIM_INTERVAL ms.
+PUSH_WORKER_CLAIM_IDLE = int(os.environ.get('PUSH_WORKER_CLAIM_IDLE', 2000))
+PUSH_WORKER_RECLAIM_INTERVAL = int(os.environ.get('PUSH_WORKER_RECLAIM_INTERVAL', 1000))
+
+# Thread pools of the ASGI incoming call application (main/asgi.py) for the
+# blocking device lookups and push notifications.
+ASGI_DB_WORKERS = int(os.environ.get('ASGI_DB_WORKERS', 10))
+ASGI_PUSH_WORKERS = int(os.environ.get('ASGI_PUSH_WORKERS', 50))
+
+# Workers and max queued tasks of the executors for the incoming call pushes,
+# the old token notifications, the response logs and the bulk notifications.
+PUSH_EXECUTOR_WORKERS = int(os.environ.get('PUSH_EXECUTOR_WORKERS', 50))
+PUSH_EXECUTOR_QUEUE = int(os.environ.get('PUSH_EXECUTOR_QUEUE', 1000))
+NOTIFY_EXECUTOR_WORKERS = int(os.environ.get('NOTIFY_EXECUTOR_WORKERS', 5))
+NOTIFY_EXECUTOR_QUEUE = int(os.environ.get('NOTIFY_EXECUTOR_QUEUE', 200))
+DB_LOG_EXECUTOR_WORKERS = int(os.environ.get('DB_LOG_EXECUTOR_WORKERS', 2))
+DB_LOG_EXECUTOR_QUEUE = int(os.environ.get('DB_LOG_EXECUTOR_QUEUE', 1000))
+BULK_NOTIFY_EXECUTOR_WORKERS = int(os.environ.get('BULK_NOTIFY_EXECUTOR_WORKERS', 1))
+BULK_NOTIFY_EXECUTOR_QUEUE = int(os.environ.get('BULK_NOTIFY_EXECUTOR_QUEUE', 10))
+# Max ms to finish the queued tasks on shutdown.
+EXECUTOR_DRAIN_TIMEOUT = int(os.environ.get('EXECUTOR_DRAIN_TIMEOUT', 5000))
+# Interval in ms at which the executor stats are written to Redis.
+EXECUTOR_STATS_INTERVAL = int(os.environ.get('EXECUTOR_STATS_INTERVAL', 5000))
+
+# APNs connections per app and environment: max concurrent streams on a
+# connection, the share of those in use at which a new connection is opened,
+# the max connections and the interval in ms at which idle ones are pinged.
+APNS_MAX_STREAMS_PER_CONNECTION = int(os.environ.get('APNS_MAX_STREAMS_PER_CONNECTION', 100))
+APNS_SCALE_UP_UTILIZATION = float(os.environ.get('APNS_SCALE_UP_UTILIZATION', 0.5))
+APNS_MAX_CONNECTIONS_PER_TOPIC = int(os.environ.get('APNS_MAX_CONNECTIONS_PER_TOPIC', 3))
+APNS_PING_INTERVAL = int(os.environ.get('APNS_PING_INTERVAL', 60000))
+# Interval in ms at which the APNs provider tokens are signed again, APNs
+# accepts tokens between 20 and 60 minutes old.
+APNS_TOKEN_REFRESH_INTERVAL = int(os.environ.get('APNS_TOKEN_REFRESH_INTERVAL', 2400000))
+
+# Connect and read timeout in ms of the requests to FCM and GCM.
+GOOGLE_PUSH_CONNECT_TIMEOUT = int(os.environ.get('GOOGLE_PUSH_CONNECT_TIMEOUT', 1000))
+GOOGLE_PUSH_READ_TIMEOUT = int(os.environ.get('GOOGLE_PUSH_READ_TIMEOUT', 3000))
+
+# Tokens the providers reported as dead or replaced are applied to the devices
+# in batches of at most TOKEN_FEEDBACK_BATCH_SIZE every
+# TOKEN_FEEDBACK_FLUSH_INTERVAL ms.
+TOKEN_FEEDBACK_BATCH_SIZE = int(os.environ.get('TOKEN_FEEDBACK_BATCH_SIZE', 100))
+TOKEN_FEEDBACK_FLUSH_INTERVAL = int(os.environ.get('TOKEN_FEEDBACK_FLUSH_INTERVAL', 1000))
+
+# Platforms whose pushes go to the stub push backend for load tests, like
+# 'apns,android,gcm'. The stub waits a log-normal latency with median
+# PUSH_STUB_LATENCY ms and shape PUSH_STUB_LATENCY_SIGMA, fails a share of
+# PUSH_STUB_ERROR_RATE and rejects the token of PUSH_STUB_INVALID_TOKEN_RATE
+# of the pushes. PUSH_STUB_ANSWER_RATE of the call pushes is answered at the
+# call response API after a median of PUSH_STUB_ANSWER_DELAY ms.
+PUSH_STUB_PLATFORMS = [platform for platform in os.environ.get('PUSH_STUB_PLATFORMS', '').split(',') if platform]
+PUSH_STUB_LATENCY = int(os.environ.get('PUSH_STUB_LATENCY', 50))
+PUSH_STUB_LATENCY_SIGMA = float(os.environ.get('PUSH_STUB_LATENCY_SIGMA', 0.5))
+PUSH_STUB_ERROR_RATE = float(os.environ.get('PUSH_STUB_ERROR_RATE', 0))
+PUSH_STUB_INVALID_TOKEN_RATE = float(os.environ.get('PUSH_STUB_INVALID_TOKEN_RATE', 0))
+PUSH_STUB_ANSWER_RATE = float(os.environ.get('PUSH_STUB_ANSWER_RATE', 0))
+PUSH_STUB_ANSWER_DELAY = int(os.environ.get('PUSH_STUB_ANSWER_DELAY', 500))
+
+# Bulk notifications read the devices in chunks of BULK_NOTIFY_CHUNK_SIZE and
+# send BULK_NOTIFY_CONCURRENCY requests at the same time, at most
+# BULK_NOTIFY_RATE_LIMIT pushes per second per provider over all processes.
+BULK_NOTIFY_CHUNK_SIZE = int(os.environ.get('BULK_NOTIFY_CHUNK_SIZE', 1000))
+BULK_NOTIFY_CONCURRENCY = int(os.environ.get('BULK_NOTIFY_CONCURRENCY', 50))
+BULK_NOTIFY_RATE_LIMIT = {
+    'apns': int(os.environ.get('BULK_NOTIFY_APNS_RATE_LIMIT', 1000)),
+    'android': int(os.environ.get('BULK_NOTIFY_ANDROID_RATE_LIMIT', 2000)),
+    'gcm': int(os.environ.get('BULK_NOTIFY_GCM_RATE_LIMIT', 1000)),
+}
 
 LOGGING_DIR = os.environ.get('LOGGING_DIR', '/var/log/middleware')
 LOG_SOURCE = 'web-app'
@@ -195,6 +346,7 @@ VG_API_USER_URL = urljoin(VG_API_BASE_URL, os.environ.get('VG_API_USER_URL', '/a
 # Testing
 TESTING = os.environ.get('TESTING', sys.argv[1:2] == ['test'])
 PERFORMANCE_TEST_ITERATIONS = os.environ.get('PERFORMANCE_TEST_ITERATIONS', 1)
+PERFORMANCE_TEST_CONCURRENCY = os.environ.get('PERFORMANCE_TEST_CONCURRENCY', 100)
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
 
@@ -16,3 +16,8 @@ from raven.contrib.django.raven_compat.middleware.wsgi import Sentry
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
 
 application = Sentry(get_wsgi_application())
+
+from app.apns import open_apns_connections  # noqa
+
+# Warm up the APNs connections of this worker before the first call.
+open_apns_connections()